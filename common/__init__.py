@@ -0,0 +1,2 @@
+# Shared helpers for the Facturatie services.
+# Every service image copies this package next to its own code (see the Dockerfiles).
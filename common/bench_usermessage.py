@@ -0,0 +1,59 @@
+# Compares the shared UserMessage decoder with the ElementTree find/findtext parsers the
+# user consumers used before. Run from the repository root:
+#
+#   python -m common.bench_usermessage [iterations]
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+from common import usermessage
+
+FULL = b"""<?xml version="1.0" encoding="UTF-8"?>
+<UserMessage><ActionType>CREATE</ActionType><UUID>2025-04-29T14:22:27.816332Z</UUID><TimeOfAction>2025-04-29T14:22:28.104215Z</TimeOfAction><EncryptedPassword>$2y$10$Qm9ndXNIYXNoRm9yQmVuY2htYXJraW5nUHVycG9zZXMuLi4</EncryptedPassword><FirstName>Jan</FirstName><LastName>Janssens</LastName><PhoneNumber>+32 470 12 34 56</PhoneNumber><EmailAddress>jan.janssens@example.be</EmailAddress><Business><BusinessName>Janssens &amp; Zonen BV</BusinessName><BusinessEmail>jan.janssens@example.be</BusinessEmail><RealAddress>Nijverheidskaai 170, Anderlecht, 1070, BE</RealAddress><BTWNumber>BE0123456789</BTWNumber><FacturationAddress>Nijverheidskaai 170, Anderlecht, 1070, BE</FacturationAddress></Business></UserMessage>"""
+
+DELETE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<UserMessage><ActionType>DELETE</ActionType><UUID>2025-04-29T14:22:27.816332Z</UUID><TimeOfAction>2025-05-02T09:01:44.551020Z</TimeOfAction></UserMessage>"""
+
+
+# The creation consumer's parser before the shared decoder (including the body.decode() copy)
+def legacy_parse(body):
+    root = ET.fromstring(body.decode())
+    business = root.find('Business')
+    return {
+        'action_type': root.find('ActionType').text,
+        'uuid': root.find('UUID').text,
+        'timestamp': root.find('TimeOfAction').text,
+        'password': root.find('EncryptedPassword').text if root.find('EncryptedPassword') is not None else None,
+        'first_name': root.findtext('FirstName', default=''),
+        'last_name': root.findtext('LastName', default=''),
+        'phone': root.findtext('PhoneNumber', default=''),
+        'email': root.findtext('EmailAddress', default=''),
+        'company': business.findtext('BusinessName', default='') if business is not None else '',
+        'company_email': business.findtext('BusinessEmail', default='') if business is not None else '',
+        'address': business.findtext('RealAddress', default='') if business is not None else '',
+        'vat': business.findtext('BTWNumber', default='') if business is not None else '',
+        'invoice_address': business.findtext('FacturationAddress', default='') if business is not None else ''
+    }
+
+
+def bench(name, func, body, iterations):
+    seconds = min(timeit.repeat(lambda: func(body), number=iterations, repeat=5))
+    per_message = seconds / iterations * 1e6
+    print(f"{name:<28} {per_message:8.2f} us/message  {iterations / seconds:10.0f} messages/s")
+    return per_message
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    iterations = int(argv[0]) if argv else 20000
+    backend = "lxml" if usermessage.lxml_etree is not None else "xml.etree"
+    print(f"usermessage backend: {backend}, {iterations} iterations, best of 5")
+
+    for label, body in (("full CREATE", FULL), ("DELETE", DELETE)):
+        print(f"\n{label} ({len(body)} bytes)")
+        legacy = bench("ElementTree find/findtext", legacy_parse, body, iterations)
+        decoded = bench("usermessage.decode", usermessage.decode, body, iterations)
+        print(f"{'speed-up':<28} {legacy / decoded:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+# Compares the precompiled xmlout templates with the ElementTree builders the providers used
+# before. Run from the repository root:
+#
+#   python -m common.bench_xmlout [iterations]
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+from common import xmlout
+from common.xmlout import Field, Group
+
+USER = {
+    'first_name': 'Jan',
+    'last_name': 'Janssens',
+    'email': 'jan.janssens@example.be',
+    'phone': '+32 470 12 34 56',
+    'pass': '$2y$10$Qm9ndXNIYXNoRm9yQmVuY2htYXJraW5nUHVycG9zZXMuLi4',
+    'timestamp': '2025-04-29T14:22:27.816332Z',
+    'business_name': 'Janssens & Zonen BV',
+    'btw_number': 'BE0123456789',
+    'real_address': 'Nijverheidskaai 170, Anderlecht, 1070, BE',
+}
+TIME_OF_ACTION = '2025-05-01T12:00:00.123456Z'
+
+# Same layout as USER_CREATE_TEMPLATE in the creation provider
+CREATE_TEMPLATE = xmlout.Template("UserMessage", [
+    Field("ActionType"),
+    Field("UUID"),
+    Field("TimeOfAction"),
+    Field("EncryptedPassword"),
+    Field("FirstName", optional=True),
+    Field("LastName", optional=True),
+    Field("PhoneNumber", optional=True),
+    Field("EmailAddress", optional=True),
+    Group("Business", [
+        Field("BusinessName", optional=True),
+        Field("BusinessEmail", optional=True),
+        Field("RealAddress", optional=True),
+        Field("BTWNumber", optional=True),
+        Field("FacturationAddress", optional=True),
+    ]),
+])
+
+DELETE_TEMPLATE = xmlout.Template("UserMessage", [Field("ActionType"), Field("UUID"), Field("TimeOfAction")])
+
+
+# The creation provider's create_xml_message before the templates
+def legacy_create(user):
+    xml = ET.Element("UserMessage")
+    ET.SubElement(xml, "ActionType").text = "CREATE"
+    ET.SubElement(xml, "UUID").text = user['timestamp']
+    ET.SubElement(xml, "TimeOfAction").text = TIME_OF_ACTION
+    ET.SubElement(xml, "EncryptedPassword").text = user.get('pass', '')
+    if user.get('first_name'):
+        ET.SubElement(xml, "FirstName").text = user['first_name']
+    if user.get('last_name'):
+        ET.SubElement(xml, "LastName").text = user['last_name']
+    if user.get('phone'):
+        ET.SubElement(xml, "PhoneNumber").text = user['phone']
+    if user.get('email'):
+        ET.SubElement(xml, "EmailAddress").text = user['email']
+    if any(user.get(field) for field in ['business_name', 'btw_number', 'real_address']):
+        business = ET.SubElement(xml, "Business")
+        if user.get('business_name'):
+            ET.SubElement(business, "BusinessName").text = user['business_name']
+        if user.get('email', ''):
+            ET.SubElement(business, "BusinessEmail").text = user['email']
+        if user.get('real_address'):
+            ET.SubElement(business, "RealAddress").text = user['real_address']
+        if user.get('btw_number'):
+            ET.SubElement(business, "BTWNumber").text = user['btw_number']
+        if user.get('real_address', ''):
+            ET.SubElement(business, "FacturationAddress").text = user['real_address']
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(xml, encoding='unicode')
+
+
+def template_create(user):
+    return CREATE_TEMPLATE.render({
+        "ActionType": "CREATE",
+        "UUID": user['timestamp'],
+        "TimeOfAction": TIME_OF_ACTION,
+        "EncryptedPassword": user.get('pass', ''),
+        "FirstName": user.get('first_name'),
+        "LastName": user.get('last_name'),
+        "PhoneNumber": user.get('phone'),
+        "EmailAddress": user.get('email'),
+        "Business": any(user.get(field) for field in ['business_name', 'btw_number', 'real_address']),
+        "BusinessName": user.get('business_name'),
+        "BusinessEmail": user.get('email', ''),
+        "RealAddress": user.get('real_address'),
+        "BTWNumber": user.get('btw_number'),
+        "FacturationAddress": user.get('real_address', ''),
+    })
+
+
+def legacy_delete(user):
+    xml = ET.Element("UserMessage")
+    ET.SubElement(xml, "ActionType").text = "DELETE"
+    ET.SubElement(xml, "UUID").text = user['timestamp']
+    ET.SubElement(xml, "TimeOfAction").text = TIME_OF_ACTION
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(xml, encoding='unicode')
+
+
+def template_delete(user):
+    return DELETE_TEMPLATE.render({"ActionType": "DELETE", "UUID": user['timestamp'], "TimeOfAction": TIME_OF_ACTION})
+
+
+def bench(name, func, iterations):
+    seconds = min(timeit.repeat(lambda: func(USER), number=iterations, repeat=5))
+    per_message = seconds / iterations * 1e6
+    print(f"{name:<28} {per_message:8.2f} us/message  {iterations / seconds:10.0f} messages/s")
+    return per_message
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    iterations = int(argv[0]) if argv else 20000
+    print(f"{iterations} iterations, best of 5")
+
+    for label, legacy_func, template_func in (
+        ("full CREATE", legacy_create, template_create),
+        ("DELETE", legacy_delete, template_delete),
+    ):
+        assert legacy_func(USER) == template_func(USER), f"{label}: output differs"
+        print(f"\n{label} ({len(template_func(USER).encode('utf-8'))} bytes)")
+        legacy = bench("ElementTree + tostring", legacy_func, iterations)
+        rendered = bench("xmlout.Template.render", template_func, iterations)
+        print(f"{'speed-up':<28} {legacy / rendered:8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
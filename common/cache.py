@@ -0,0 +1,91 @@
+import time
+import threading
+import logging
+from collections import OrderedDict
+import pika
+from common import rabbitmq
+
+logger = logging.getLogger(__name__)
+
+# Fanout exchange on which the user consumers announce "this UUID changed"
+INVALIDATION_EXCHANGE = "facturatie_cache"
+
+
+# Small thread-safe LRU cache whose entries also expire after `ttl` seconds.
+# The TTL bounds staleness even if an invalidation message is lost.
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if time.monotonic() < expires_at:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._data.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+# Fire-and-forget: invalidations are transient, the TTL covers anything that gets lost
+_publisher = rabbitmq.Publisher(exchange=INVALIDATION_EXCHANGE, exchange_type="fanout", confirm=False)
+TRANSIENT = pika.BasicProperties(delivery_mode=1)
+
+
+def publish_invalidation(uuid):
+    try:
+        _publisher.publish("", uuid, properties=TRANSIENT)
+    except Exception as e:
+        logger.warning(f"Could not publish cache invalidation for {uuid}: {e}")
+
+
+# Binds a private, auto-deleted queue to the invalidation exchange and calls on_invalidate(uuid)
+# for every announced change. Runs on the consumer's own channel; the callback must be cheap.
+def subscribe_invalidations(channel, on_invalidate):
+    channel.exchange_declare(exchange=INVALIDATION_EXCHANGE, exchange_type="fanout", durable=True)
+    result = channel.queue_declare(queue="", exclusive=True, auto_delete=True)
+    queue = result.method.queue
+    channel.queue_bind(exchange=INVALIDATION_EXCHANGE, queue=queue)
+
+    def callback(ch, method, properties, body):
+        on_invalidate(body.decode())
+
+    channel.basic_consume(queue=queue, on_message_callback=callback, auto_ack=True)
@@ -0,0 +1,216 @@
+import os
+import zlib
+import logging
+from collections import namedtuple
+from common import db
+
+try:
+    from pymysqlreplication import BinLogStreamReader
+    from pymysqlreplication.event import XidEvent, QueryEvent
+    from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
+    ROW_EVENTS = {WriteRowsEvent: "insert", UpdateRowsEvent: "update", DeleteRowsEvent: "delete"}
+    XID_EVENTS = (XidEvent,)
+    QUERY_EVENTS = (QueryEvent,)
+except ImportError:  # CDC mode is optional; the polling providers work without mysql-replication
+    BinLogStreamReader = None
+    ROW_EVENTS = {}
+    XID_EVENTS = ()
+    QUERY_EVENTS = ()
+
+logger = logging.getLogger(__name__)
+
+# One changed row; `before` is only filled in for updates
+Change = namedtuple("Change", ["action", "row", "before"])
+# All rows of one transaction plus the position right after its commit (what gets checkpointed)
+ChangeBatch = namedtuple("ChangeBatch", ["changes", "log_file", "log_pos"])
+
+
+def is_enabled():
+    return os.getenv("CDC_ENABLED", "0") == "1"
+
+
+# MySQL keeps one binlog dump connection per server_id and drops the older one when another client
+# registers with the same id, so every tailer needs its own. CDC_SERVER_ID sets it explicitly
+# (docker-compose gives each provider one); otherwise it is derived from the tailer's name.
+def server_id(name):
+    configured = os.getenv("CDC_SERVER_ID")
+    if configured:
+        return int(configured)
+    return 4100 + zlib.crc32(name.encode("utf-8")) % 100000
+
+
+# Map a raw client row from the binlog onto the dict the providers' XML builders expect
+# (same aliases as the polling queries: company -> business_name, CONCAT_WS address, ...).
+# 'timestamp' is client.timestamp, the creation provider's UUID; the update and deletion
+# providers replace it with the column their polling query uses.
+def client_row_to_user(row):
+    timestamp = row.get('timestamp')
+    if hasattr(timestamp, 'strftime'):
+        timestamp = timestamp.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    return {
+        'id': row.get('id'),
+        'first_name': row.get('first_name'),
+        'last_name': row.get('last_name'),
+        'email': row.get('email'),
+        'pass': row.get('pass'),
+        'phone': row.get('phone'),
+        'timestamp': timestamp,
+        'business_name': row.get('company'),
+        'btw_number': row.get('company_vat'),
+        'real_address': ", ".join(
+            str(value) for value in (row.get('address_1'), row.get('city'), row.get('country'))
+            if value is not None
+        )
+    }
+
+
+# End of a transaction: InnoDB commits write an Xid event, non-transactional tables a COMMIT query
+def is_commit(binlog_event):
+    if isinstance(binlog_event, XID_EVENTS):
+        return True
+    return isinstance(binlog_event, QUERY_EVENTS) and binlog_event.query.strip().upper() == "COMMIT"
+
+
+def current_position():
+    conn = db.get_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("SHOW MASTER STATUS")
+        row = cursor.fetchone()
+        if row is None:
+            raise RuntimeError("Binary logging is disabled on the database server")
+        return row[0], row[1]
+    finally:
+        cursor.close()
+        conn.close()
+
+
+# Tails the row-based binlog for the FossBilling client table.
+# The position is stored per consumer in cdc_checkpoints, so a restart resumes where it left off.
+# Rows are collected per transaction and handed out at its commit: a checkpoint never points into
+# the middle of a transaction, where resuming would skip its table map and lose the remaining rows.
+# Callers checkpoint a batch only after it was published: delivery is at-least-once, like polling.
+class BinlogTailer:
+    def __init__(self, name, actions=("insert", "update", "delete"), table="client"):
+        if BinLogStreamReader is None:
+            raise RuntimeError("CDC mode requires the mysql-replication package")
+        self.name = name
+        self.actions = set(actions)
+        self.table = table
+        self._stream = None
+        self._start = None
+        initialize_checkpoints()
+
+    # Decides where the stream starts: at the checkpoint, or without one at the binlog position of
+    # this moment. Returns True in the latter case: rows that were already waiting in the provider's
+    # outbox table lie before that position, so the caller publishes them with its polling query
+    # before calling batches(). Rows committed while it does so may be sent twice, never lost.
+    def pin_start(self):
+        log_file, log_pos = load_checkpoint(self.name)
+        if log_file:
+            self._start = (log_file, log_pos)
+            return False
+        self._start = current_position()
+        logger.info(f"No checkpoint for {self.name}; starting at {self._start[0]}:{self._start[1]}")
+        return True
+
+    def _open_stream(self):
+        if self._start is None:
+            self.pin_start()
+        log_file, log_pos = self._start
+        logger.info(f"Reading binlog for {self.name} from {log_file}:{log_pos}")
+
+        return BinLogStreamReader(
+            connection_settings={
+                "host": os.environ["DB_HOST"],
+                "port": int(os.getenv("DB_PORT", "3306")),
+                "user": os.environ["DB_USER"],
+                "passwd": os.environ["DB_PASSWORD"]
+            },
+            server_id=server_id(self.name),
+            only_schemas=[os.environ["DB_NAME"]],
+            only_tables=[self.table],
+            only_events=[event for event, action in ROW_EVENTS.items() if action in self.actions] + list(XID_EVENTS + QUERY_EVENTS),
+            log_file=log_file,
+            log_pos=log_pos,
+            resume_stream=True,
+            blocking=True
+        )
+
+    def batches(self):
+        self._stream = self._open_stream()
+        changes = []
+        for binlog_event in self._stream:
+            if is_commit(binlog_event):
+                # Transactions without client rows are not handed out (nor checkpointed)
+                if changes:
+                    yield ChangeBatch(changes, self._stream.log_file, self._stream.log_pos)
+                    changes = []
+                continue
+
+            action = ROW_EVENTS.get(type(binlog_event))
+            if action not in self.actions:
+                continue
+            for row in binlog_event.rows:
+                if action == "update":
+                    changes.append(Change(action, row["after_values"], row["before_values"]))
+                else:
+                    changes.append(Change(action, row["values"], None))
+
+    def save_checkpoint(self, batch):
+        save_checkpoint(self.name, batch.log_file, batch.log_pos)
+
+    def close(self):
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+
+
+def initialize_checkpoints():
+    conn = db.get_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS cdc_checkpoints (
+                name VARCHAR(64) PRIMARY KEY,
+                log_file VARCHAR(255) NOT NULL,
+                log_pos BIGINT NOT NULL,
+                updated_at DATETIME NOT NULL
+            )
+        """)
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def load_checkpoint(name):
+    conn = db.get_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("SELECT log_file, log_pos FROM cdc_checkpoints WHERE name = %s", (name,))
+        row = cursor.fetchone()
+        return (row[0], row[1]) if row else (None, None)
+    finally:
+        cursor.close()
+        conn.close()
+
+
+def save_checkpoint(name, log_file, log_pos):
+    conn = db.get_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute("""
+            INSERT INTO cdc_checkpoints (name, log_file, log_pos, updated_at)
+            VALUES (%s, %s, %s, NOW())
+            ON DUPLICATE KEY UPDATE log_file = VALUES(log_file), log_pos = VALUES(log_pos), updated_at = NOW()
+        """, (name, log_file, log_pos))
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
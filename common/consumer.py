@@ -0,0 +1,200 @@
+import os
+import re
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from common import stats, retry
+
+logger = logging.getLogger(__name__)
+
+UUID_PATTERN = re.compile(rb"<UUID>\s*(.*?)\s*</UUID>", re.DOTALL)
+
+
+# Routing key for ordering: messages about the same user must be handled in arrival order
+def extract_uuid(body):
+    match = UUID_PATTERN.search(body)
+    return match.group(1) if match else None
+
+
+# Stand-in for the pika channel handed to on_message when it runs on a worker thread.
+# pika channels are not thread-safe, so acks/nacks are scheduled back onto the connection's
+# I/O thread with add_callback_threadsafe instead of being sent from the worker.
+class ThreadSafeChannel:
+    def __init__(self, channel):
+        self._channel = channel
+        self._connection = channel.connection
+
+    def _call_threadsafe(self, method, *args, **kwargs):
+        def callback():
+            try:
+                getattr(self._channel, method)(*args, **kwargs)
+            except Exception as e:
+                logger.error(f"{method} failed (channel closed?): {e}")
+        self._connection.add_callback_threadsafe(callback)
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._call_threadsafe("basic_ack", delivery_tag, multiple=multiple)
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self._call_threadsafe("basic_nack", delivery_tag, multiple=multiple, requeue=requeue)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self._call_threadsafe("basic_publish", exchange=exchange, routing_key=routing_key, body=body, properties=properties)
+
+    def basic_reject(self, delivery_tag=0, requeue=True):
+        self._call_threadsafe("basic_reject", delivery_tag, requeue=requeue)
+
+
+# What the on_message handlers call to ack a delivery they are done with. The outcome is counted
+# here, where it is decided, so it is counted whether the handler got a ThreadSafeChannel or the
+# raw channel (CONSUMER_WORKERS=0); failed deliveries are counted by retry.reject instead.
+def ack(channel, delivery_tag):
+    stats.incr("acked")
+    channel.basic_ack(delivery_tag)
+
+
+# Reports the backlog of a queue as the "queue_lag:<queue>" gauge every `interval` seconds.
+# The passive declare runs on the pika I/O thread through call_later, the only thread allowed
+# to use the channel, and costs one broker round trip per interval instead of anything per message.
+def watch_queue_depth(channel, queue, interval):
+    connection = channel.connection
+
+    def probe():
+        try:
+            result = channel.queue_declare(queue=queue, durable=True, passive=True)
+        except Exception as e:
+            logger.debug(f"Queue depth probe for {queue} stopped: {e}")
+            return
+        stats.gauge(f"queue_lag:{queue}", result.method.message_count)
+        connection.call_later(interval, probe)
+
+    connection.call_later(interval, probe)
+
+
+# Declares the queue's retry/dead-letter queues (when CONSUMER_RETRY_ATTEMPTS is set) and registers
+# the consumer, so retry.reject() knows where its failed deliveries go
+def _consume(channel, queue, callback):
+    topology = retry.RetryTopology(queue)
+    if topology.enabled():
+        topology.declare(channel)
+    consumer_tag = channel.basic_consume(
+        queue=queue,
+        on_message_callback=callback,
+        auto_ack=False
+    )
+    retry.register(consumer_tag, topology)
+
+
+# Starts the queue depth probe when this process reports stats (see common.stats.start)
+def _watch_if_reporting(channel, queue):
+    reporter = stats.reporter()
+    if reporter is not None:
+        watch_queue_depth(channel, queue, reporter.interval)
+
+
+# Runs a service's on_message callback on a pool of worker lanes so DB work never blocks the
+# pika I/O thread (and with it the heartbeats). Each lane is a single thread; messages are
+# assigned to a lane by UUID, which keeps per-user ordering while different users run in parallel.
+class ConsumerRuntime:
+    def __init__(self, handler, workers=None, prefetch=None, key_func=extract_uuid):
+        self.handler = handler
+        self.workers = int(workers if workers is not None else os.getenv("CONSUMER_WORKERS", "4"))
+        self.prefetch = int(prefetch if prefetch is not None else os.getenv("CONSUMER_PREFETCH", "20"))
+        self.key_func = key_func
+        self._lanes = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"consumer-lane-{lane}")
+            for lane in range(self.workers)
+        ]
+
+    # Set prefetch and register the dispatcher on a queue
+    def consume(self, channel, queue):
+        channel.basic_qos(prefetch_count=self.prefetch)
+        _consume(channel, queue, self.dispatch)
+        _watch_if_reporting(channel, queue)
+
+    def dispatch(self, channel, method, properties, body):
+        stats.incr("messages")
+        # Without workers the handler runs inline, exactly like a plain pika callback
+        if not self._lanes:
+            self.handler(channel, method, properties, body)
+            return
+
+        key = self.key_func(body) if self.key_func else None
+        if key is None:
+            key = method.delivery_tag
+        lane = self._lanes[hash(key) % len(self._lanes)]
+        lane.submit(self._run, ThreadSafeChannel(channel), method, properties, body)
+
+    def _run(self, channel, method, properties, body):
+        try:
+            self.handler(channel, method, properties, body)
+        except Exception as e:
+            # The handlers ack/nack themselves; this only guards against a crash leaving the message unacked
+            logger.error(f"Unhandled error in consumer worker: {e}")
+            retry.reject(channel, method, properties, body, e)
+
+    # Waits for in-flight messages; call before closing the connection
+    def shutdown(self, connection=None):
+        for lane in self._lanes:
+            lane.shutdown(wait=True)
+        if connection is not None:
+            # Flush the acks the workers queued with add_callback_threadsafe
+            connection.process_data_events(time_limit=0)
+
+
+# Micro-batching variant: collects up to batch_size deliveries (or whatever arrived within
+# max_wait seconds) and hands them to batch_handler(channel, deliveries) on a worker thread.
+# deliveries is a list of (method, properties, body); the handler acks/nacks each one itself.
+# dispatch, the timer and flush all run on the pika I/O thread, so the buffer needs no lock.
+class BatchingRuntime:
+    def __init__(self, batch_handler, batch_size=50, max_wait=0.2, prefetch=None):
+        self.batch_handler = batch_handler
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        # The broker must be allowed to send at least a full batch, otherwise it never fills up
+        self.prefetch = max(int(prefetch if prefetch is not None else os.getenv("CONSUMER_PREFETCH", "20")), 2 * batch_size)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="consumer-batch")
+        self._pending = []
+        self._channel = None
+        self._timer = None
+
+    def consume(self, channel, queue):
+        channel.basic_qos(prefetch_count=self.prefetch)
+        _consume(channel, queue, self.dispatch)
+        _watch_if_reporting(channel, queue)
+
+    def dispatch(self, channel, method, properties, body):
+        stats.incr("messages")
+        self._channel = channel
+        self._pending.append((method, properties, body))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = channel.connection.call_later(self.max_wait, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self.flush()
+
+    def flush(self):
+        if self._timer is not None:
+            self._channel.connection.remove_timeout(self._timer)
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        self._executor.submit(self._run, ThreadSafeChannel(self._channel), batch)
+
+    def _run(self, channel, batch):
+        try:
+            self.batch_handler(channel, batch)
+        except Exception as e:
+            logger.error(f"Unhandled error in batch worker: {e}")
+            for method, properties, body in batch:
+                retry.reject(channel, method, properties, body, e)
+
+    def shutdown(self, connection=None):
+        self.flush()
+        self._executor.shutdown(wait=True)
+        if connection is not None:
+            connection.process_data_events(time_limit=0)
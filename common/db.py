@@ -0,0 +1,221 @@
+import os
+import queue
+import threading
+import time
+import logging
+import mysql.connector
+from mysql.connector import errors
+
+logger = logging.getLogger(__name__)
+
+
+# Raised when no connection became available within the wait timeout.
+# Subclass of mysql.connector.Error so the existing "except mysql.connector.Error" handlers catch it.
+class PoolTimeout(errors.PoolError):
+    pass
+
+
+# Thin wrapper around a raw MySQL connection.
+# close() hands the connection back to the pool instead of tearing down the TCP session,
+# so existing "conn = get_db_connection() ... conn.close()" code keeps working unchanged.
+class PooledConnection:
+    def __init__(self, pool, raw, created_at):
+        self._pool = pool
+        self._raw = raw
+        self._created_at = created_at
+
+    def __getattr__(self, name):
+        if self._raw is None:
+            raise errors.InterfaceError("Connection already returned to the pool")
+        return getattr(self._raw, name)
+
+    def close(self):
+        if self._raw is not None:
+            self._pool._release(self._raw, self._created_at)
+            self._raw = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ConnectionPool:
+    def __init__(self, size=5, max_lifetime=1800, wait_timeout=30, health_check_interval=30, **connect_kwargs):
+        self.size = size
+        self.max_lifetime = max_lifetime
+        self.wait_timeout = wait_timeout
+        self.health_check_interval = health_check_interval
+        self._connect_kwargs = connect_kwargs
+
+        # LIFO so the warmest connection is reused first and surplus ones age out
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._stats = {
+            'created': 0,
+            'recycled': 0,
+            'health_check_failures': 0,
+            'checkouts': 0,
+            'in_use': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,
+        }
+
+    def _bump(self, key, amount=1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def _is_expired(self, created_at):
+        return self.max_lifetime and time.monotonic() - created_at > self.max_lifetime
+
+    def _discard(self, raw):
+        try:
+            raw.close()
+        except Exception as e:
+            logger.debug(f"Closing pooled connection failed: {e}")
+
+    # Checks an idle connection before handing it out; only pings when it has been idle for a while
+    def _is_healthy(self, raw, last_used):
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            raw.ping(reconnect=False)
+            return True
+        except Exception as e:
+            logger.warning(f"Pooled connection failed health check: {e}")
+            self._bump('health_check_failures')
+            return False
+
+    def get_connection(self):
+        start = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            # Pool is exhausted: wait for a connection to come back and record how long it took
+            self._bump('waits')
+            acquired = self._slots.acquire(timeout=self.wait_timeout)
+            waited = time.monotonic() - start
+            with self._lock:
+                self._stats['wait_time_total'] += waited
+                self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+            if not acquired:
+                self._bump('timeouts')
+                raise PoolTimeout(f"No database connection available after {self.wait_timeout}s")
+            logger.debug(f"Waited {waited:.3f}s for a database connection")
+
+        try:
+            raw, created_at = self._checkout_idle()
+            if raw is None:
+                raw = mysql.connector.connect(**self._connect_kwargs)
+                created_at = time.monotonic()
+                self._bump('created')
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+        return PooledConnection(self, raw, created_at)
+
+    def _checkout_idle(self):
+        while True:
+            try:
+                raw, created_at, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                return None, None
+            if self._is_expired(created_at):
+                self._bump('recycled')
+                self._discard(raw)
+                continue
+            if not self._is_healthy(raw, last_used):
+                self._discard(raw)
+                continue
+            return raw, created_at
+
+    def _release(self, raw, created_at):
+        try:
+            if self._is_expired(created_at):
+                self._bump('recycled')
+                self._discard(raw)
+                return
+            try:
+                # Never hand out a connection with a half-finished transaction
+                if raw.in_transaction:
+                    raw.rollback()
+            except Exception as e:
+                logger.warning(f"Dropping pooled connection after failed rollback: {e}")
+                self._discard(raw)
+                return
+            self._idle.put((raw, created_at, time.monotonic()))
+        finally:
+            with self._lock:
+                self._stats['in_use'] -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['size'] = self.size
+        stats['idle'] = self._idle.qsize()
+        return stats
+
+    def close_all(self):
+        while True:
+            try:
+                raw, _, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._discard(raw)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# Process-wide pool, configured from the same DB_* variables the services already use
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    size=int(os.getenv("DB_POOL_SIZE", "5")),
+                    max_lifetime=float(os.getenv("DB_POOL_MAX_LIFETIME", "1800")),
+                    wait_timeout=float(os.getenv("DB_POOL_WAIT_TIMEOUT", "30")),
+                    health_check_interval=float(os.getenv("DB_POOL_HEALTH_CHECK_INTERVAL", "30")),
+                    host=os.environ["DB_HOST"],
+                    user=os.environ["DB_USER"],
+                    password=os.environ["DB_PASSWORD"],
+                    database=os.environ["DB_NAME"]
+                )
+    return _pool
+
+
+def get_connection():
+    return get_pool().get_connection()
+
+
+# Round trip of a trivial query through the pool, in milliseconds (health probe, see common.stats)
+def ping_latency_ms():
+    start = time.monotonic()
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.fetchall()
+        cursor.close()
+    finally:
+        conn.close()
+    return round((time.monotonic() - start) * 1000, 2)
+
+
+# Drops the process-wide pool (used by tests and after a fork)
+def reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close_all()
+        _pool = None
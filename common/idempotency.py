@@ -0,0 +1,99 @@
+import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from common import db, stats
+
+logger = logging.getLogger(__name__)
+
+
+# Ledger key of a message: sha256 over its identifying parts, e.g. (UUID, TimeOfAction).
+# None when a part is missing; such messages are simply not deduplicated.
+def message_key(*parts):
+    if any(part is None or part == "" for part in parts):
+        return None
+    return hashlib.sha256("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+
+# Records which messages a consumer already handled, so a redelivery is acked without redoing the
+# work. The processed_messages table (unique on consumer + key) is the source of truth: claim()
+# inserts the key as the first statement of the consumer's own transaction, so it is committed
+# together with the work or not at all, and a duplicate is detected before any other table is
+# touched. Keys handled by this process are also kept in a bounded LRU, which answers most
+# redeliveries (nacked or unacked messages coming back after a reconnect) in O(1) without the database.
+class Ledger:
+    def __init__(self, consumer, maxsize=None, retention_days=None):
+        self.consumer = consumer
+        self.maxsize = int(maxsize if maxsize is not None else os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+        self.retention_days = int(retention_days if retention_days is not None else os.getenv("IDEMPOTENCY_RETENTION_DAYS", "30"))
+        self._recent = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Creates the table and drops entries older than the retention period; call at startup
+    def initialize(self):
+        conn = db.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS processed_messages (
+                    consumer VARCHAR(64) NOT NULL,
+                    message_key CHAR(64) NOT NULL,
+                    processed_at DATETIME NOT NULL,
+                    PRIMARY KEY (consumer, message_key),
+                    INDEX idx_processed_messages_processed_at (processed_at)
+                )
+            """)
+            cursor.execute(
+                "DELETE FROM processed_messages WHERE consumer = %s AND processed_at < NOW() - INTERVAL %s DAY",
+                (self.consumer, self.retention_days)
+            )
+            conn.commit()
+            if cursor.rowcount:
+                logger.info(f"Removed {cursor.rowcount} expired idempotency keys for {self.consumer}")
+        finally:
+            cursor.close()
+            conn.close()
+
+    # Memory-only check: True when this process already handled the key
+    def is_duplicate(self, key):
+        if key is None:
+            return False
+        with self._lock:
+            if key in self._recent:
+                self._recent.move_to_end(key)
+                found = True
+            else:
+                found = False
+        if found:
+            stats.incr("duplicates")
+        return found
+
+    # Records the key on the caller's cursor, inside its transaction. Returns False when the key
+    # was already recorded (the message is a duplicate: roll back and ack it).
+    def claim(self, cursor, key):
+        if key is None:
+            return True
+        cursor.execute(
+            "INSERT IGNORE INTO processed_messages (consumer, message_key, processed_at) VALUES (%s, %s, NOW())",
+            (self.consumer, key)
+        )
+        if cursor.rowcount == 0:
+            self.remember(key)
+            stats.incr("duplicates")
+            return False
+        return True
+
+    # Adds a key to the in-memory front; call once the transaction that claimed it has committed
+    def remember(self, key):
+        if key is None:
+            return
+        with self._lock:
+            self._recent[key] = True
+            self._recent.move_to_end(key)
+            while len(self._recent) > self.maxsize:
+                self._recent.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._recent.clear()
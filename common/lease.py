@@ -0,0 +1,183 @@
+import os
+import time
+import socket
+import logging
+from common import db
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL = 30
+
+
+# PROVIDER_PARTITIONS=N splits a provider's work into N hash partitions (MOD(id, N)) so several
+# replicas can run side by side; unset or 0 keeps the single-instance behaviour.
+def partition_count():
+    return int(os.getenv("PROVIDER_PARTITIONS", "0") or 0)
+
+
+# hostname is the container id under docker, so a restarted container takes its own leases back
+# right away instead of waiting for them to expire
+def default_owner():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+# Lease-based work partitioning for the providers. Every provider has one row per partition in
+# provider_leases (owner + expiry) and every running replica a heartbeat row in provider_replicas.
+# refresh() renews both under a row lock and rebalances: a replica keeps (or takes over expired and
+# free partitions up to) its fair share of N / live replicas and hands back any surplus, so a new
+# replica gets work within a couple of renewals and the partitions of a crashed one move on after
+# `ttl` seconds. Providers only select rows whose id falls in an owned partition (see condition()),
+# so two replicas never publish the same row. A partition only changes owner between the batches of
+# its previous owner, which stops using it as soon as its own lease is no longer fresh.
+class PartitionLease:
+    def __init__(self, provider, partitions=None, ttl=None, owner=None, clock=time.monotonic):
+        self.provider = provider
+        self.partitions = partition_count() if partitions is None else partitions
+        self.ttl = float(ttl if ttl is not None else os.getenv("PROVIDER_LEASE_TTL", str(DEFAULT_TTL)))
+        self.owner = owner or default_owner()
+        self.owned = ()
+        self._clock = clock
+        self._renewed_at = None
+        self._initialized = False
+
+    def enabled(self):
+        return self.partitions > 0
+
+    def _initialize(self, cursor):
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS provider_leases (
+                provider VARCHAR(64) NOT NULL,
+                partition_no INT NOT NULL,
+                owner VARCHAR(255) NULL,
+                expires_at DATETIME(6) NOT NULL,
+                PRIMARY KEY (provider, partition_no)
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS provider_replicas (
+                provider VARCHAR(64) NOT NULL,
+                owner VARCHAR(255) NOT NULL,
+                expires_at DATETIME(6) NOT NULL,
+                PRIMARY KEY (provider, owner)
+            )
+        """)
+        rows = ", ".join(["(%s, %s, NULL, NOW(6))"] * self.partitions)
+        params = [value for partition in range(self.partitions) for value in (self.provider, partition)]
+        cursor.execute(f"INSERT IGNORE INTO provider_leases (provider, partition_no, owner, expires_at) VALUES {rows}", tuple(params))
+
+    # True while the last renewal is recent enough to still trust the owned partitions
+    def is_fresh(self):
+        return self._renewed_at is not None and self._clock() - self._renewed_at < self.ttl * 2 / 3
+
+    # True when partitioning is on and the last renewal is too old to keep publishing: a batch
+    # selected under the lease is dropped instead of racing the replica that may take it over
+    def is_stale(self):
+        return self.enabled() and not self.is_fresh()
+
+    # Renews and rebalances at most every ttl/3 seconds; returns the owned partition numbers
+    def refresh(self, force=False):
+        if not self.enabled():
+            return ()
+        if not force and self._renewed_at is not None and self._clock() - self._renewed_at < self.ttl / 3:
+            return self.owned
+
+        started = self._clock()
+        conn = db.get_connection()
+        cursor = conn.cursor()
+        try:
+            if not self._initialized:
+                self._initialize(cursor)
+                conn.commit()
+                self._initialized = True
+
+            # Locks this provider's rows: concurrent refreshes of its replicas run one at a time
+            cursor.execute("""
+                SELECT partition_no, owner, expires_at > NOW(6)
+                FROM provider_leases
+                WHERE provider = %s AND partition_no < %s
+                ORDER BY partition_no
+                FOR UPDATE
+            """, (self.provider, self.partitions))
+            rows = cursor.fetchall()
+
+            expires = int(self.ttl * 1000000)
+            cursor.execute("""
+                INSERT INTO provider_replicas (provider, owner, expires_at)
+                VALUES (%s, %s, NOW(6) + INTERVAL %s MICROSECOND)
+                ON DUPLICATE KEY UPDATE expires_at = VALUES(expires_at)
+            """, (self.provider, self.owner, expires))
+            cursor.execute("DELETE FROM provider_replicas WHERE provider = %s AND expires_at < NOW(6)", (self.provider,))
+            cursor.execute("SELECT owner FROM provider_replicas WHERE provider = %s ORDER BY owner", (self.provider,))
+            replicas = [owner for (owner,) in cursor.fetchall()]
+            rank = replicas.index(self.owner) if self.owner in replicas else 0
+            # N // R each; the first N % R replicas (by name) take one extra
+            share = self.partitions // max(1, len(replicas)) + (rank < self.partitions % max(1, len(replicas)))
+
+            mine = [partition for partition, owner, _ in rows if owner == self.owner]
+            free = [partition for partition, owner, live in rows if owner != self.owner and not (owner and live)]
+            owned = mine[:share] + free[:max(0, share - len(mine))]
+            released = mine[share:]
+
+            if owned:
+                placeholders = ", ".join(["%s"] * len(owned))
+                cursor.execute(f"""
+                    UPDATE provider_leases
+                    SET owner = %s, expires_at = NOW(6) + INTERVAL %s MICROSECOND
+                    WHERE provider = %s AND partition_no IN ({placeholders})
+                """, (self.owner, expires, self.provider, *owned))
+            if released:
+                placeholders = ", ".join(["%s"] * len(released))
+                cursor.execute(f"""
+                    UPDATE provider_leases
+                    SET owner = NULL, expires_at = NOW(6)
+                    WHERE provider = %s AND owner = %s AND partition_no IN ({placeholders})
+                """, (self.provider, self.owner, *released))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+            conn.close()
+
+        owned = tuple(sorted(owned))
+        if owned != self.owned:
+            logger.info(f"{self.provider}: owning partitions {list(owned)} of {self.partitions}")
+        self.owned = owned
+        self._renewed_at = started
+        return owned
+
+    # SQL condition (and its parameters) restricting a query to the owned partitions of `column`.
+    # Returns None when partitioning is disabled; ("FALSE", ()) while nothing is owned.
+    def condition(self, column):
+        if not self.enabled():
+            return None
+        try:
+            owned = self.refresh()
+        except Exception as e:
+            logger.error(f"Renewing {self.provider} leases failed: {e}")
+            owned = self.owned if self.is_fresh() else ()
+        if not owned:
+            return "FALSE", ()
+        placeholders = ", ".join(["%s"] * len(owned))
+        return f"MOD({column}, %s) IN ({placeholders})", (self.partitions, *owned)
+
+    # Hands the partitions back on shutdown so the other replicas take over without waiting
+    def release(self):
+        if not self.enabled() or self._renewed_at is None:
+            return
+        conn = db.get_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("""
+                UPDATE provider_leases
+                SET owner = NULL, expires_at = NOW(6)
+                WHERE provider = %s AND owner = %s
+            """, (self.provider, self.owner))
+            cursor.execute("DELETE FROM provider_replicas WHERE provider = %s AND owner = %s", (self.provider, self.owner))
+            conn.commit()
+            self.owned = ()
+            self._renewed_at = None
+        finally:
+            cursor.close()
+            conn.close()
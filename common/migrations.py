@@ -0,0 +1,181 @@
+import sys
+import logging
+from collections import namedtuple
+from common import db
+
+logger = logging.getLogger(__name__)
+
+Index = namedtuple("Index", ["table", "name", "columns", "unique"], defaults=(False,))
+Migration = namedtuple("Migration", ["version", "description", "indexes"])
+
+# Versioned schema changes for the tables the services query on every message/poll.
+# Append new migrations at the end; never change a version that has already been applied.
+MIGRATIONS = [
+    Migration(1, "client lookups by UUID (timestamp) and keyset paging", [
+        Index("client", "idx_client_timestamp_id", ("timestamp", "id")),
+    ]),
+    Migration(2, "invoice mailing queue and hash lookups", [
+        Index("invoice", "idx_invoice_processed_approved", ("processed", "approved")),
+        Index("invoice", "idx_invoice_hash", ("hash",)),
+    ]),
+    Migration(3, "user_deletion_notifications outbox", [
+        Index("user_deletion_notifications", "idx_deletion_processed", ("processed",)),
+        Index("user_deletion_notifications", "idx_deletion_client_id", ("client_id",)),
+    ]),
+    # Lets the duplicate-key error catch two concurrent inserts of the same UUID; the creation
+    # consumer's INSERT ... WHERE NOT EXISTS covers the sequential case without this index.
+    # Fails (and stays pending) while the table still holds duplicate UUIDs; clean those up first.
+    Migration(4, "unique client UUID", [
+        Index("client", "uq_client_timestamp", ("timestamp",), unique=True),
+    ]),
+]
+
+# Several services run migrate() at startup at the same time; a named lock serialises them
+LOCK_NAME = "facturatie_schema_migrations"
+LOCK_TIMEOUT = 30
+
+
+def initialize_migrations(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description VARCHAR(255) NOT NULL,
+            applied_at DATETIME NOT NULL
+        )
+    """)
+
+
+def applied_versions(cursor):
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def table_exists(cursor, table):
+    cursor.execute(
+        "SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (table,)
+    )
+    return cursor.fetchone()[0] > 0
+
+
+# Returns every index on a table as (name, columns, unique), e.g. [("PRIMARY", ("id",), True), ...]
+def existing_indexes(cursor, table):
+    cursor.execute("""
+        SELECT INDEX_NAME, NON_UNIQUE, COLUMN_NAME
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        ORDER BY INDEX_NAME, SEQ_IN_INDEX
+    """, (table,))
+    indexes = {}
+    for name, non_unique, column in cursor.fetchall():
+        indexes.setdefault(name, (not non_unique, []))[1].append(column)
+    return [(name, tuple(columns), unique) for name, (unique, columns) in indexes.items()]
+
+
+# An index is present when any index (under any name) starts with the wanted columns.
+# That way an index FossBilling already ships is reused instead of duplicated.
+# A unique constraint only counts when an existing unique index covers exactly those columns.
+def has_index(cursor, index):
+    wanted = tuple(index.columns)
+    for _, columns, unique in existing_indexes(cursor, index.table):
+        if index.unique:
+            if unique and columns == wanted:
+                return True
+        elif columns[:len(wanted)] == wanted:
+            return True
+    return False
+
+
+def ensure_index(cursor, index):
+    if has_index(cursor, index):
+        return False
+    columns = ", ".join(f"`{column}`" for column in index.columns)
+    kind = "UNIQUE INDEX" if index.unique else "INDEX"
+    # Online DDL: the table stays readable and writable while the index is built
+    cursor.execute(f"ALTER TABLE `{index.table}` ADD {kind} `{index.name}` ({columns}), ALGORITHM=INPLACE, LOCK=NONE")
+    logger.info(f"Created index {index.name} on {index.table} ({', '.join(index.columns)})")
+    return True
+
+
+# Applies all pending migrations in order and returns the versions applied by this call.
+# A migration whose tables do not exist yet (e.g. a provider that has not created its outbox table)
+# is left pending together with everything after it; the next startup picks it up again.
+def migrate(migrations=None):
+    migrations = sorted(migrations if migrations is not None else MIGRATIONS, key=lambda m: m.version)
+    conn = db.get_connection()
+    cursor = conn.cursor()
+    applied = []
+
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (LOCK_NAME, LOCK_TIMEOUT))
+        if cursor.fetchone()[0] != 1:
+            logger.warning("Another service is running migrations, skipping")
+            return applied
+
+        try:
+            initialize_migrations(cursor)
+            done = applied_versions(cursor)
+            for migration in migrations:
+                if migration.version in done:
+                    continue
+
+                missing_tables = sorted({index.table for index in migration.indexes if not table_exists(cursor, index.table)})
+                if missing_tables:
+                    logger.info(f"Migration {migration.version} postponed, tables not created yet: {', '.join(missing_tables)}")
+                    break
+
+                for index in migration.indexes:
+                    ensure_index(cursor, index)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, description, applied_at) VALUES (%s, %s, NOW())",
+                    (migration.version, migration.description)
+                )
+                conn.commit()
+                applied.append(migration.version)
+                logger.info(f"Applied migration {migration.version}: {migration.description}")
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (LOCK_NAME,))
+            cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.close()
+
+    return applied
+
+
+# Verifies the live schema against every index declared in MIGRATIONS (applied or not)
+# and returns the ones that are missing, so a dropped or never-created index is reported.
+def missing_indexes(migrations=None):
+    migrations = migrations if migrations is not None else MIGRATIONS
+    conn = db.get_connection()
+    cursor = conn.cursor()
+    missing = []
+
+    try:
+        for migration in migrations:
+            for index in migration.indexes:
+                if not table_exists(cursor, index.table) or not has_index(cursor, index):
+                    logger.warning(f"Missing index {index.name} on {index.table} ({', '.join(index.columns)})")
+                    missing.append(index)
+    finally:
+        cursor.close()
+        conn.close()
+
+    return missing
+
+
+# python -m common.migrations          apply pending migrations, then verify
+# python -m common.migrations --check  only verify; exits 1 when an index is missing
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if "--check" not in argv:
+        migrate()
+    missing = missing_indexes()
+    for index in missing:
+        print(f"missing: {index.table}.{index.name} ({', '.join(index.columns)})")
+    return 1 if missing else 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    sys.exit(main())
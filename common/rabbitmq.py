@@ -0,0 +1,138 @@
+import os
+import logging
+import threading
+import pika
+from pika import exceptions
+from common import stats
+
+logger = logging.getLogger(__name__)
+
+PERSISTENT = pika.BasicProperties(delivery_mode=2)  # Make messages persistent
+
+# Errors after which the connection is considered dead and a reconnect is worth a try.
+# UnroutableError / NackError are deliberately not in here: the broker answered, it just refused the message.
+RECONNECT_ERRORS = (
+    exceptions.AMQPConnectionError,
+    exceptions.ChannelClosed,
+    exceptions.ChannelWrongStateError,
+)
+
+
+def get_connection_parameters():
+    return pika.ConnectionParameters(
+        host=os.environ["RABBITMQ_HOST"],
+        port=int(os.environ["RABBITMQ_PORT"]),
+        virtual_host="/",
+        credentials=pika.PlainCredentials(
+            os.environ["RABBITMQ_USER"],
+            os.environ["RABBITMQ_PASSWORD"]
+        ),
+        heartbeat=600,
+        blocked_connection_timeout=300
+    )
+
+
+# Long-lived publisher: opens one connection, declares the exchange/queues/bindings once
+# and keeps the channel open across poll cycles. With confirms enabled basic_publish only
+# returns after the broker acked the message, so callers can safely mark rows as processed.
+# declare_exchange=False is for exchanges owned by another team (e.g. the controlroom's
+# heartbeat exchange); a binding with routing_key None only declares the queue.
+class Publisher:
+    def __init__(self, exchange, exchange_type="topic", bindings=None, confirm=True, declare_exchange=True):
+        self.exchange = exchange
+        self.exchange_type = exchange_type
+        self.bindings = list(bindings or [])  # (queue, routing_key) pairs
+        self.confirm = confirm
+        self.declare_exchange = declare_exchange
+        self._connection = None
+        self._channel = None
+        # pika connections are not thread-safe; consumer worker lanes may share one publisher
+        self._lock = threading.RLock()
+
+    def _is_open(self):
+        return (
+            self._channel is not None
+            and self._connection.is_open
+            and self._channel.is_open
+        )
+
+    def _open(self):
+        connection = pika.BlockingConnection(get_connection_parameters())
+        try:
+            channel = connection.channel()
+            if self.confirm:
+                channel.confirm_delivery()
+
+            if self.declare_exchange:
+                channel.exchange_declare(
+                    exchange=self.exchange,
+                    exchange_type=self.exchange_type,
+                    durable=True
+                )
+            for queue, routing_key in self.bindings:
+                channel.queue_declare(queue=queue, durable=True)
+                if routing_key is None:
+                    continue
+                channel.queue_bind(
+                    exchange=self.exchange,
+                    queue=queue,
+                    routing_key=routing_key
+                )
+        except Exception:
+            connection.close()
+            raise
+
+        self._connection = connection
+        self._channel = channel
+        logger.info(f"Connected publisher to exchange '{self.exchange}'")
+
+    def channel(self):
+        with self._lock:
+            if not self._is_open():
+                self.close()
+                self._open()
+            return self._channel
+
+    # Publishes one message; reconnects once if the connection turned out to be dead.
+    # Raises when the message could not be delivered (or was not confirmed).
+    def publish(self, routing_key, body, properties=PERSISTENT):
+        with stats.timed("publish_seconds"), self._lock:
+            for attempt in (1, 2):
+                channel = self.channel()
+                try:
+                    channel.basic_publish(
+                        exchange=self.exchange,
+                        routing_key=routing_key,
+                        body=body,
+                        properties=properties,
+                        mandatory=self.confirm
+                    )
+                    return
+                except RECONNECT_ERRORS as e:
+                    self.close()
+                    if attempt == 2:
+                        raise
+                    logger.warning(f"Publisher connection lost ({e!r}), reconnecting")
+
+    # Lets pika answer broker heartbeats while the poll loop is idle
+    def process_data_events(self):
+        with self._lock:
+            if not self._is_open():
+                return
+            try:
+                self._connection.process_data_events(time_limit=0)
+            except RECONNECT_ERRORS as e:
+                logger.warning(f"Publisher connection dropped while idle: {e!r}")
+                self.close()
+
+    def close(self):
+        with self._lock:
+            connection = self._connection
+            self._connection = None
+            self._channel = None
+        if connection is not None:
+            try:
+                if connection.is_open:
+                    connection.close()
+            except Exception as e:
+                logger.debug(f"Closing publisher connection failed: {e}")
@@ -0,0 +1,210 @@
+import os
+import sys
+import time
+import argparse
+import logging
+import pika
+from pika import exceptions as amqp_errors
+from mysql.connector import errors as db_errors, errorcode
+from common import stats
+
+logger = logging.getLogger(__name__)
+
+ATTEMPTS_HEADER = "x-retry-attempts"
+
+# MySQL errors that say nothing about the message itself: the same statement can succeed later
+TRANSIENT_ERRNOS = {
+    errorcode.ER_CON_COUNT_ERROR,
+    errorcode.ER_LOCK_WAIT_TIMEOUT,
+    errorcode.ER_LOCK_DEADLOCK,
+    errorcode.CR_CONN_HOST_ERROR,
+    errorcode.CR_SERVER_GONE_ERROR,
+    errorcode.CR_SERVER_LOST,
+    errorcode.CR_SERVER_LOST_EXTENDED,
+}
+
+
+# Raise (or subclass) this for failures that are expected to clear up on their own,
+# e.g. an order that arrives before the user it belongs to was created
+class TransientError(Exception):
+    pass
+
+
+# True when handling the message again later may succeed: lost or busy database, broker or
+# network trouble. Everything else (bad XML, missing fields, constraint violations, bugs) is
+# permanent and goes straight to the dead-letter queue.
+def is_transient(error):
+    if isinstance(error, TransientError):
+        return True
+    if isinstance(error, db_errors.Error):
+        return (
+            error.errno in TRANSIENT_ERRNOS
+            or isinstance(error, (db_errors.PoolError, db_errors.OperationalError, db_errors.InterfaceError))
+        )
+    return isinstance(error, (ConnectionError, TimeoutError, amqp_errors.AMQPError))
+
+
+def dead_letter_queue(queue):
+    return f"{queue}.dlq"
+
+
+def attempts_made(properties):
+    headers = getattr(properties, "headers", None) or {}
+    return int(headers.get(ATTEMPTS_HEADER, 0))
+
+
+# Headers of a delivery to carry over when republishing it. x-death is RabbitMQ's own
+# dead-letter bookkeeping from the retry queues and would only grow with every round.
+def _carried_headers(properties, drop=()):
+    headers = getattr(properties, "headers", None) or {}
+    return {key: value for key, value in headers.items() if key != "x-death" and key not in drop}
+
+
+def _republish_properties(properties, headers):
+    return pika.BasicProperties(
+        content_type=getattr(properties, "content_type", None),
+        message_id=getattr(properties, "message_id", None),
+        correlation_id=getattr(properties, "correlation_id", None),
+        timestamp=getattr(properties, "timestamp", None),
+        headers=headers,
+        delivery_mode=2
+    )
+
+
+# Retry topology of one work queue. Failed messages are republished (and the original acked) to
+# "<queue>.retry.<delay>ms": a queue nobody consumes, whose x-message-ttl dead-letters the message
+# back into <queue> once the delay is over. Every attempt waits `backoff` times longer than the
+# previous one; each delay has its own queue, so a long delay never holds up a shorter one.
+# Permanent failures and messages out of attempts end up in "<queue>.dlq" for replay().
+# The work queue itself is left as it is declared, so existing queues need no new arguments.
+# CONSUMER_RETRY_ATTEMPTS=0 (the default) keeps the old behaviour: nack without requeue.
+class RetryTopology:
+    def __init__(self, queue, attempts=None, delay=None, backoff=None):
+        self.queue = queue
+        self.attempts = int(attempts if attempts is not None else os.getenv("CONSUMER_RETRY_ATTEMPTS", "0"))
+        self.delay = float(delay if delay is not None else os.getenv("CONSUMER_RETRY_DELAY", "5"))
+        self.backoff = float(backoff if backoff is not None else os.getenv("CONSUMER_RETRY_BACKOFF", "3"))
+
+    def enabled(self):
+        return self.attempts > 0
+
+    # Delay before attempt n + 1, in milliseconds
+    def delay_ms(self, attempt):
+        return int(self.delay * self.backoff ** attempt * 1000)
+
+    # The delay is part of the name: changing the settings declares new queues instead of
+    # clashing with the x-message-ttl of the old ones
+    def retry_queue(self, attempt):
+        return f"{self.queue}.retry.{self.delay_ms(attempt)}ms"
+
+    @property
+    def dead_letter_queue(self):
+        return dead_letter_queue(self.queue)
+
+    def declare(self, channel):
+        for attempt in range(self.attempts):
+            channel.queue_declare(queue=self.retry_queue(attempt), durable=True, arguments={
+                "x-message-ttl": self.delay_ms(attempt),
+                "x-dead-letter-exchange": "",
+                "x-dead-letter-routing-key": self.queue,
+            })
+        channel.queue_declare(queue=self.dead_letter_queue, durable=True)
+
+    # Moves a failed delivery to its next retry queue or to the DLQ, then acks it.
+    # Both go out on the consuming channel in this order, so the broker has the copy before the ack.
+    def reject(self, channel, method, properties, body, error):
+        attempt = attempts_made(properties)
+        headers = _carried_headers(properties)
+        if is_transient(error) and attempt < self.attempts:
+            target = self.retry_queue(attempt)
+            headers[ATTEMPTS_HEADER] = attempt + 1
+            stats.incr("retried")
+            logger.warning(f"Retrying message from {self.queue} in {self.delay_ms(attempt) / 1000:g}s (attempt {attempt + 1} of {self.attempts}): {error}")
+        else:
+            target = self.dead_letter_queue
+            headers["x-failure"] = "transient" if is_transient(error) else "permanent"
+            stats.incr("dead_lettered")
+            logger.error(f"Moving message from {self.queue} to {target} after {attempt + 1} attempt(s): {error}")
+        headers["x-original-queue"] = self.queue
+        headers["x-last-error"] = f"{type(error).__name__}: {error}"[:500]
+
+        stats.incr("errors")
+        channel.basic_publish(exchange="", routing_key=target, body=body, properties=_republish_properties(properties, headers))
+        channel.basic_ack(method.delivery_tag)
+
+
+_topologies = {}  # consumer tag -> RetryTopology
+
+
+# Called by the consumer runtimes for every basic_consume
+def register(consumer_tag, topology):
+    _topologies[consumer_tag] = topology
+
+
+# What the on_message handlers call instead of basic_nack(requeue=False) when handling failed.
+# The delivery's consumer tag tells which queue (and retry topology) it came from.
+def reject(channel, method, properties, body, error):
+    topology = _topologies.get(getattr(method, "consumer_tag", None))
+    if topology is None or not topology.enabled():
+        stats.incr("errors")
+        stats.incr("nacked")
+        channel.basic_nack(method.delivery_tag, requeue=False)
+        return
+    topology.reject(channel, method, properties, body, error)
+
+
+# Moves messages from <queue>.dlq back into <queue> at `rate` messages per second, with a fresh
+# set of retry attempts. Only the messages already in the DLQ when it starts are replayed (at most
+# `limit`), so messages that fail again straight away cannot keep it busy forever.
+# The channel should have publisher confirms on: a message is only acked after its copy was confirmed.
+def replay(channel, queue, rate=10.0, limit=None, clock=time.monotonic, sleep=time.sleep):
+    dlq = dead_letter_queue(queue)
+    pending = channel.queue_declare(queue=dlq, durable=True, passive=True).method.message_count
+    if limit is not None:
+        pending = min(pending, limit)
+
+    replayed = 0
+    next_at = clock()
+    while replayed < pending:
+        method, properties, body = channel.basic_get(queue=dlq, auto_ack=False)
+        if method is None:
+            break
+        wait = next_at - clock()
+        if wait > 0:
+            sleep(wait)
+
+        headers = _carried_headers(properties, drop=(ATTEMPTS_HEADER, "x-failure"))
+        headers["x-replayed"] = int(headers.get("x-replayed", 0)) + 1
+        channel.basic_publish(exchange="", routing_key=queue, body=body, properties=_republish_properties(properties, headers))
+        channel.basic_ack(method.delivery_tag)
+
+        replayed += 1
+        next_at = max(next_at + 1 / rate, clock() - 1)  # no catch-up burst after a slow publish
+    return replayed
+
+
+# python -m common.retry <queue> [--rate N] [--limit N]
+def main(argv=None):
+    from common import rabbitmq
+
+    parser = argparse.ArgumentParser(prog="python -m common.retry", description="Replay dead-lettered messages into their queue")
+    parser.add_argument("queue", help="work queue, e.g. order.created (its DLQ is <queue>.dlq)")
+    parser.add_argument("--rate", type=float, default=10.0, help="messages per second (default 10)")
+    parser.add_argument("--limit", type=int, default=None, help="replay at most this many messages")
+    args = parser.parse_args(argv)
+    if args.rate <= 0:
+        parser.error("--rate must be positive")
+
+    connection = pika.BlockingConnection(rabbitmq.get_connection_parameters())
+    try:
+        channel = connection.channel()
+        channel.confirm_delivery()
+        replayed = replay(channel, args.queue, rate=args.rate, limit=args.limit)
+    finally:
+        connection.close()
+    print(f"Replayed {replayed} message(s) from {dead_letter_queue(args.queue)} into {args.queue}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
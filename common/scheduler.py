@@ -0,0 +1,144 @@
+import os
+import time
+import socket
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# Adaptive poll scheduler for the provider loops.
+# - a full batch means there is more waiting: poll again immediately
+# - a partial batch means the backlog was just drained: short pause
+# - an empty poll doubles the pause up to max_interval
+# Any wake-up (wake() in-process, or a datagram on the optional UDP port) cuts the pause short,
+# so a writer that signals after its commit gets picked up within milliseconds.
+class PollScheduler:
+    def __init__(self, min_interval=None, max_interval=None, backoff=2.0, wake_port=None):
+        self.min_interval = float(min_interval if min_interval is not None else os.getenv("POLL_MIN_INTERVAL", "0.25"))
+        self.max_interval = float(max_interval if max_interval is not None else os.getenv("POLL_MAX_INTERVAL", "5"))
+        self.backoff = backoff
+        self.interval = self.min_interval
+        self._wake = threading.Event()
+        self._socket = None
+
+        if wake_port is None and os.getenv("POLL_WAKE_PORT"):
+            wake_port = int(os.getenv("POLL_WAKE_PORT"))
+        if wake_port:
+            self._listen(wake_port)
+
+    def _listen(self, port):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind(("127.0.0.1", port))
+        thread = threading.Thread(target=self._receive, daemon=True)
+        thread.start()
+        logger.info(f"Listening for poll wake-ups on udp://127.0.0.1:{port}")
+
+    def _receive(self):
+        sock = self._socket
+        while True:
+            try:
+                sock.recv(64)
+            except OSError:
+                return  # socket closed
+            self.wake()
+
+    def wake(self):
+        self._wake.set()
+
+    # How long to pause after a poll that handled `processed` rows
+    def next_delay(self, processed, full=False):
+        if full:
+            self.interval = self.min_interval
+            return 0
+        if processed:
+            self.interval = self.min_interval
+            return self.min_interval
+
+        delay = self.interval
+        self.interval = min(self.interval * self.backoff, self.max_interval)
+        return delay
+
+    # Sleeps until the next poll is due or a wake-up arrives; returns True when woken early
+    def wait(self, processed, full=False):
+        delay = self.next_delay(processed, full)
+        if delay <= 0:
+            return False
+
+        woken = self._wake.wait(delay)
+        self._wake.clear()
+        if woken:
+            self.interval = self.min_interval
+        return woken
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+# Lateness of the ticks since the last reset(), for periodic reporting
+class JitterStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, late):
+        self.count += 1
+        self.total += late
+        if late > self.max:
+            self.max = late
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+# Fixed-rate ticker for periodic senders such as the heartbeat.
+# Tick n is due at start + n * interval on the monotonic clock, so the time spent sending is not
+# added to the period and the rate does not drift. A tick that is a whole interval (or more) late,
+# e.g. after a slow reconnect, skips the ticks it missed instead of firing them in a burst.
+class FixedRateScheduler:
+    def __init__(self, interval, clock=time.monotonic, sleep=time.sleep):
+        if interval <= 0:
+            raise ValueError(f"interval must be positive, got {interval}")
+        self.interval = float(interval)
+        self._clock = clock
+        self._sleep = sleep
+        self._due = None
+        self.ticks = 0
+        self.missed = 0
+        self.jitter = JitterStats()
+
+    # Sleeps until the next tick is due and returns how late it fired, in seconds.
+    # The first tick is due immediately.
+    def wait(self):
+        now = self._clock()
+        if self._due is None:
+            self._due = now
+        else:
+            self._due += self.interval
+            behind = int((now - self._due) // self.interval)
+            if behind > 0:
+                self.missed += behind
+                self._due += behind * self.interval
+
+        delay = self._due - now
+        if delay > 0:
+            self._sleep(delay)
+            now = self._clock()
+
+        late = max(0.0, now - self._due)
+        self.ticks += 1
+        self.jitter.add(late)
+        return late
+
+
+# Wakes a provider listening on POLL_WAKE_PORT (e.g. from a script or a change-data-capture tailer)
+def notify(port, host="127.0.0.1"):
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.sendto(b"wake", (host, port))
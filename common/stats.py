@@ -0,0 +1,366 @@
+import os
+import re
+import json
+import time
+import bisect
+import socket
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Where the services send their stats; the heartbeat listens there and turns them into its Status
+DEFAULT_PORT = 9125
+
+# Upper bounds in seconds of the latency histogram buckets (1 ms to 10 s); Prometheus' +Inf comes on top
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# How often the providers' poll_backlog probe (a full COUNT over the outbox) really runs, in seconds
+BACKLOG_INTERVAL = float(os.getenv("STATS_BACKLOG_INTERVAL", "300"))
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}  # name -> [count per bucket, sum, count]
+_reporter = None
+_metrics_server = None
+
+
+# Counting is all the message path does: a dict update under a lock, no I/O.
+# Until start() is called the numbers are only kept in memory.
+def incr(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def gauge(name, value):
+    with _lock:
+        _gauges[name] = value
+
+
+# Records one duration in seconds; like incr() a bisect and a few additions under the lock
+def observe(name, seconds):
+    index = bisect.bisect_left(DEFAULT_BUCKETS, seconds)
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = [[0] * (len(DEFAULT_BUCKETS) + 1), 0.0, 0]
+        histogram[0][index] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+# with stats.timed("db_seconds"): ... observes how long the block took, also when it raises
+class timed:
+    __slots__ = ("name", "_started")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self._started)
+        return False
+
+
+def snapshot():
+    with _lock:
+        return dict(_counters), dict(_gauges)
+
+
+# {name: (count per bucket, sum, count)}; the last bucket counts what is above DEFAULT_BUCKETS
+def histograms():
+    with _lock:
+        return {name: (list(buckets), total, count) for name, (buckets, total, count) in _histograms.items()}
+
+
+# Clears all counters, gauges and histograms (used by tests)
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+# Runs probes, callables like {"db_latency_ms": db.ping_latency_ms}, and stores their results as
+# gauges; a failing probe is stored as None
+def run_probes(probes):
+    for name, probe in probes.items():
+        try:
+            gauge(name, probe())
+        except Exception as e:
+            logger.debug(f"Stats probe {name} failed: {e}")
+            gauge(name, None)
+
+
+# Wraps an expensive probe (a full COUNT, say) so it really runs at most once per `seconds`;
+# in between the previous result is reported again
+def every(seconds, probe, clock=time.monotonic):
+    last = {}
+
+    def cached():
+        now = clock()
+        if "at" not in last or now - last["at"] >= seconds:
+            last["value"] = probe()
+            last["at"] = now
+        return last["value"]
+    return cached
+
+
+# Background thread that sends one datagram with the cumulative counters and latest gauges
+# every `interval` seconds. Probes are callables run on that thread (never on the message path)
+# whose return value is stored as a gauge, e.g. {"db_latency_ms": db.ping_latency_ms}.
+class StatsReporter:
+    def __init__(self, service, host, port=DEFAULT_PORT, interval=5.0, probes=None):
+        self.service = service
+        self.address = (host, port)
+        self.interval = interval
+        self.probes = dict(probes or {})
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stats-reporter", daemon=True)
+        self._thread.start()
+        logger.info(f"Reporting stats for {self.service} to udp://{self.address[0]}:{self.address[1]}")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def run_probes(self):
+        run_probes(self.probes)
+
+    def payload(self):
+        counters, gauges = snapshot()
+        return json.dumps({
+            "service": self.service,
+            "interval": self.interval,
+            "counters": counters,
+            "gauges": gauges,
+        }).encode("utf-8")
+
+    def report(self):
+        self.run_probes()
+        try:
+            self._socket.sendto(self.payload(), self.address)
+        except OSError as e:  # heartbeat not up (yet); the next report will try again
+            logger.debug(f"Sending stats failed: {e}")
+
+    def stop(self):
+        self._stop.set()
+        self._socket.close()
+
+
+METRIC_PREFIX = "facturatie_"
+# Stats named "<name>:<detail>" become one metric with the detail as a label, e.g. queue_lag{queue="order.created"}
+METRIC_LABELS = {"queue_lag": "queue"}
+_INVALID_METRIC_CHARS = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# (metric name, extra label text) of a stats name
+def _metric(name):
+    base, _, detail = name.partition(":")
+    metric = METRIC_PREFIX + _INVALID_METRIC_CHARS.sub("_", base)
+    if not detail:
+        return metric, ""
+    return metric, f',{METRIC_LABELS.get(base, "key")}="{_escape(detail)}"'
+
+
+# Counters, gauges and histograms of this process in the Prometheus text format
+def render_metrics(service):
+    counters, gauges = snapshot()
+    families = {}  # metric name -> (type, sample lines)
+    labels = f'service="{_escape(service)}"'
+
+    def add(metric, kind, line):
+        families.setdefault(metric, (kind, []))[1].append(line)
+
+    for name, value in sorted(counters.items()):
+        metric, extra = _metric(name)
+        add(metric + "_total", "counter", f"{metric}_total{{{labels}{extra}}} {value}")
+    for name, value in sorted(gauges.items()):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue  # failed probe
+        metric, extra = _metric(name)
+        add(metric, "gauge", f"{metric}{{{labels}{extra}}} {value}")
+    for name, (buckets, total, count) in sorted(histograms().items()):
+        metric, extra = _metric(name)
+        cumulative = 0
+        for bound, observed in zip(DEFAULT_BUCKETS + (None,), buckets):
+            cumulative += observed
+            le = "+Inf" if bound is None else f"{bound:g}"
+            add(metric, "histogram", f'{metric}_bucket{{{labels}{extra},le="{le}"}} {cumulative}')
+        add(metric, "histogram", f"{metric}_sum{{{labels}{extra}}} {total}")
+        add(metric, "histogram", f"{metric}_count{{{labels}{extra}}} {count}")
+
+    lines = []
+    for metric, (kind, samples) in families.items():
+        lines.append(f"# TYPE {metric} {kind}")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # one line per scrape would drown the service's own logs
+
+
+# Local Prometheus-style endpoint, GET /metrics. Everything is rendered when it is scraped,
+# on the server's own thread, so the message path pays nothing extra for it.
+# Probes run per scrape when there is no StatsReporter to run them.
+class MetricsServer:
+    def __init__(self, service, port, host="0.0.0.0", probes=None):
+        self.service = service
+        self.address = (host, port)
+        self.probes = dict(probes or {})
+        self._server = None
+
+    def render(self):
+        run_probes(self.probes)
+        return render_metrics(self.service)
+
+    def start(self):
+        self._server = ThreadingHTTPServer(self.address, _MetricsHandler)
+        self._server.daemon_threads = True
+        self._server.metrics = self
+        self.address = self._server.server_address
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+        logger.info(f"Serving metrics for {self.service} on http://{self.address[0]}:{self.address[1]}/metrics")
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+# Starts reporting for this process when STATS_HOST is set and the /metrics endpoint when
+# METRICS_PORT is set; without them this is a no-op, so services run unchanged outside docker-compose.
+def start(service, probes=None):
+    global _reporter, _metrics_server
+    host = os.getenv("STATS_HOST")
+    if host and _reporter is None:
+        _reporter = StatsReporter(
+            service,
+            host,
+            port=int(os.getenv("STATS_PORT", str(DEFAULT_PORT))),
+            interval=float(os.getenv("STATS_INTERVAL", "5")),
+            probes=probes
+        )
+        _reporter.start()
+
+    port = os.getenv("METRICS_PORT")
+    if port and _metrics_server is None:
+        # With a reporter the probes already run every interval; scrapes just read the gauges
+        server = MetricsServer(service, int(port), probes=None if _reporter is not None else probes)
+        try:
+            server.start()
+            _metrics_server = server
+        except OSError as e:
+            logger.error(f"Cannot serve metrics on port {port}: {e}")
+    return _reporter
+
+
+def reporter():
+    return _reporter
+
+
+# Latest report of one service, with the counter rates since its previous report
+class ServiceStats:
+    def __init__(self, service):
+        self.service = service
+        self.received_at = None
+        self.interval = None
+        self.counters = {}
+        self.gauges = {}
+        self.rates = {}
+
+    def update(self, payload, now):
+        counters = payload.get("counters", {})
+        if self.received_at is not None and now > self.received_at:
+            elapsed = now - self.received_at
+            # A counter that went down means the service restarted; its new value is the delta
+            self.rates = {
+                name: (value - self.counters.get(name, 0) if value >= self.counters.get(name, 0) else value) / elapsed
+                for name, value in counters.items()
+            }
+        self.received_at = now
+        self.interval = float(payload.get("interval", 5))
+        self.counters = counters
+        self.gauges = payload.get("gauges", {})
+
+    def is_fresh(self, now, missed_reports=3):
+        return self.received_at is not None and now - self.received_at <= self.interval * missed_reports
+
+
+# Receiving side, run by the heartbeat: keeps the latest report per service.
+class StatsAggregator:
+    def __init__(self, port=DEFAULT_PORT, host="0.0.0.0", clock=time.monotonic):
+        self.port = port
+        self.host = host
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._services = {}
+        self._socket = None
+
+    def listen(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((self.host, self.port))
+        thread = threading.Thread(target=self._receive, name="stats-aggregator", daemon=True)
+        thread.start()
+        logger.info(f"Listening for service stats on udp://{self.host}:{self.port}")
+
+    def _receive(self):
+        sock = self._socket
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                return  # socket closed
+            self.handle(data)
+
+    def handle(self, data):
+        try:
+            payload = json.loads(data)
+            service = payload["service"]
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring malformed stats datagram: {e}")
+            return
+        with self._lock:
+            stats = self._services.get(service)
+            if stats is None:
+                stats = self._services[service] = ServiceStats(service)
+            stats.update(payload, self._clock())
+
+    def services(self):
+        with self._lock:
+            return dict(self._services)
+
+    def now(self):
+        return self._clock()
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
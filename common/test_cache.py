@@ -0,0 +1,76 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+from common import cache
+
+
+class TestTTLCache(unittest.TestCase):
+
+    def test_hit_and_miss_counters(self):
+        c = cache.TTLCache(maxsize=10, ttl=60)
+        self.assertIsNone(c.get("a"))
+        c.set("a", 1)
+        self.assertEqual(c.get("a"), 1)
+
+        stats = c.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['size']), (1, 1, 1))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        c = cache.TTLCache(maxsize=2, ttl=60)
+        c.set("a", 1)
+        c.set("b", 2)
+        c.get("a")  # "b" is now the oldest
+        c.set("c", 3)
+
+        self.assertIsNone(c.get("b"))
+        self.assertEqual(c.get("a"), 1)
+        self.assertEqual(c.stats()['evictions'], 1)
+
+    @patch('common.cache.time.monotonic')
+    def test_entries_expire(self, mock_time):
+        c = cache.TTLCache(maxsize=10, ttl=5)
+        mock_time.return_value = 100.0
+        c.set("a", 1)
+
+        mock_time.return_value = 104.9
+        self.assertEqual(c.get("a"), 1)
+        mock_time.return_value = 105.0
+        self.assertIsNone(c.get("a"))
+        self.assertEqual(c.stats()['size'], 0)
+
+    def test_invalidate(self):
+        c = cache.TTLCache()
+        c.set("a", 1)
+        c.invalidate("a")
+        c.invalidate("missing")
+
+        self.assertIsNone(c.get("a"))
+        self.assertEqual(c.stats()['invalidations'], 1)
+
+
+class TestInvalidationMessages(unittest.TestCase):
+
+    @patch.object(cache, '_publisher')
+    def test_publish_errors_are_swallowed(self, mock_publisher):
+        mock_publisher.publish.side_effect = Exception("broker down")
+
+        cache.publish_invalidation("2025-04-29 14:22:27.816332")
+
+        mock_publisher.publish.assert_called_once_with("", "2025-04-29 14:22:27.816332", properties=cache.TRANSIENT)
+
+    def test_subscribe_binds_private_queue(self):
+        channel = MagicMock()
+        channel.queue_declare.return_value.method.queue = "amq.gen-123"
+        on_invalidate = MagicMock()
+
+        cache.subscribe_invalidations(channel, on_invalidate)
+
+        channel.queue_declare.assert_called_once_with(queue="", exclusive=True, auto_delete=True)
+        channel.queue_bind.assert_called_once_with(exchange=cache.INVALIDATION_EXCHANGE, queue="amq.gen-123")
+        callback = channel.basic_consume.call_args[1]['on_message_callback']
+        callback(channel, MagicMock(), None, b"2025-04-29 14:22:27.816332")
+        on_invalidate.assert_called_once_with("2025-04-29 14:22:27.816332")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,200 @@
+import unittest
+from unittest.mock import patch, MagicMock
+from datetime import datetime
+
+from common import cdc
+
+
+class FakeWriteRowsEvent:
+    def __init__(self, rows):
+        self.rows = rows
+
+
+class FakeUpdateRowsEvent:
+    def __init__(self, rows):
+        self.rows = rows
+
+
+class FakeXidEvent:
+    pass
+
+
+class FakeQueryEvent:
+    def __init__(self, query):
+        self.query = query
+
+
+class FakeStream:
+    def __init__(self, events):
+        self._events = events
+        self.log_file = "binlog.000001"
+        self.log_pos = 0
+        self.closed = False
+
+    def __iter__(self):
+        for position, event in enumerate(self._events, start=1):
+            self.log_pos = position * 100
+            yield event
+
+    def close(self):
+        self.closed = True
+
+
+@patch.dict('os.environ', {
+    'DB_HOST': 'localhost',
+    'DB_USER': 'test',
+    'DB_PASSWORD': 'test',
+    'DB_NAME': 'test_db'
+})
+class TestBinlogTailer(unittest.TestCase):
+
+    def setUp(self):
+        patchers = [
+            patch.object(cdc, 'ROW_EVENTS', {FakeWriteRowsEvent: "insert", FakeUpdateRowsEvent: "update"}),
+            patch.object(cdc, 'XID_EVENTS', (FakeXidEvent,)),
+            patch.object(cdc, 'QUERY_EVENTS', (FakeQueryEvent,)),
+            patch('common.cdc.initialize_checkpoints'),
+            patch('common.cdc.load_checkpoint', return_value=("binlog.000001", 4)),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_requires_replication_package(self):
+        with patch.object(cdc, 'BinLogStreamReader', None):
+            with self.assertRaises(RuntimeError):
+                cdc.BinlogTailer("test")
+
+    def test_batches_follow_binlog_events(self):
+        stream = FakeStream([
+            FakeWriteRowsEvent([{"values": {"id": 1}}, {"values": {"id": 2}}]),
+            FakeUpdateRowsEvent([{"before_values": {"id": 3, "email": "a"}, "after_values": {"id": 3, "email": "b"}}]),
+            FakeXidEvent(),
+        ])
+        reader = MagicMock(return_value=stream)
+
+        with patch.object(cdc, 'BinLogStreamReader', reader):
+            tailer = cdc.BinlogTailer("test", actions=("insert",))
+            batches = list(tailer.batches())
+
+        # Only the requested action, resumed from the stored checkpoint
+        kwargs = reader.call_args[1]
+        self.assertEqual(kwargs['only_events'], [FakeWriteRowsEvent, FakeXidEvent, FakeQueryEvent])
+        self.assertEqual(kwargs['only_tables'], ["client"])
+        self.assertEqual((kwargs['log_file'], kwargs['log_pos']), ("binlog.000001", 4))
+
+        self.assertEqual(len(batches), 1)
+        self.assertEqual([change.row['id'] for change in batches[0].changes], [1, 2])
+        self.assertEqual((batches[0].log_file, batches[0].log_pos), ("binlog.000001", 300))
+
+    def test_batches_end_at_transaction_commits(self):
+        stream = FakeStream([
+            FakeQueryEvent("BEGIN"),
+            FakeWriteRowsEvent([{"values": {"id": 1}}]),
+            FakeWriteRowsEvent([{"values": {"id": 2}}]),
+            FakeXidEvent(),
+            FakeXidEvent(),  # a transaction on another table
+            FakeWriteRowsEvent([{"values": {"id": 3}}]),
+            FakeQueryEvent("COMMIT"),
+            FakeWriteRowsEvent([{"values": {"id": 4}}]),  # not committed yet
+        ])
+
+        with patch.object(cdc, 'BinLogStreamReader', MagicMock(return_value=stream)):
+            batches = list(cdc.BinlogTailer("test", actions=("insert",)).batches())
+
+        # Both rows of the first transaction in one batch, checkpointed after its commit only
+        self.assertEqual([[change.row['id'] for change in batch.changes] for batch in batches], [[1, 2], [3]])
+        self.assertEqual([batch.log_pos for batch in batches], [400, 700])
+
+    @patch('common.cdc.current_position', return_value=("binlog.000007", 1234))
+    def test_without_checkpoint_starts_at_pinned_position(self, mock_position):
+        reader = MagicMock(return_value=FakeStream([]))
+
+        with patch('common.cdc.load_checkpoint', return_value=(None, None)), \
+                patch.object(cdc, 'BinLogStreamReader', reader):
+            tailer = cdc.BinlogTailer("test")
+            self.assertTrue(tailer.pin_start())
+            list(tailer.batches())
+
+        mock_position.assert_called_once()
+        self.assertEqual((reader.call_args[1]['log_file'], reader.call_args[1]['log_pos']), ("binlog.000007", 1234))
+
+    def test_with_checkpoint_needs_no_backfill(self):
+        with patch.object(cdc, 'BinLogStreamReader', MagicMock()):
+            self.assertFalse(cdc.BinlogTailer("test").pin_start())
+
+    def test_update_changes_carry_before_values(self):
+        stream = FakeStream([
+            FakeUpdateRowsEvent([{"before_values": {"id": 3, "email": "a"}, "after_values": {"id": 3, "email": "b"}}]),
+            FakeXidEvent(),
+        ])
+
+        with patch.object(cdc, 'BinLogStreamReader', MagicMock(return_value=stream)):
+            tailer = cdc.BinlogTailer("test", actions=("update",))
+            change = next(tailer.batches()).changes[0]
+            tailer.close()
+
+        self.assertEqual(change, cdc.Change("update", {"id": 3, "email": "b"}, {"id": 3, "email": "a"}))
+        self.assertTrue(stream.closed)
+
+    @patch('common.cdc.save_checkpoint')
+    def test_save_checkpoint(self, mock_save):
+        with patch.object(cdc, 'BinLogStreamReader', MagicMock()):
+            tailer = cdc.BinlogTailer("test")
+        tailer.save_checkpoint(cdc.ChangeBatch([], "binlog.000002", 512))
+
+        mock_save.assert_called_once_with("test", "binlog.000002", 512)
+
+
+class TestServerId(unittest.TestCase):
+
+    def test_each_tailer_gets_its_own_server_id(self):
+        with patch.dict('os.environ', {}, clear=True):
+            ids = {cdc.server_id(name) for name in ("user_creation_providor", "user_update_providor", "user_deletion_providor")}
+
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(cdc.server_id("user_update_providor"), cdc.server_id("user_update_providor"))
+
+    def test_explicit_server_id(self):
+        with patch.dict('os.environ', {'CDC_SERVER_ID': '4102'}):
+            self.assertEqual(cdc.server_id("user_update_providor"), 4102)
+
+    def test_stream_uses_the_tailer_server_id(self):
+        reader = MagicMock(return_value=FakeStream([]))
+        env = {'DB_HOST': 'localhost', 'DB_USER': 'test', 'DB_PASSWORD': 'test', 'DB_NAME': 'test_db'}
+        with patch.dict('os.environ', env, clear=True), \
+                patch('common.cdc.initialize_checkpoints'), \
+                patch('common.cdc.load_checkpoint', return_value=("binlog.000001", 4)), \
+                patch.object(cdc, 'BinLogStreamReader', reader):
+            list(cdc.BinlogTailer("user_update_providor").batches())
+
+        self.assertEqual(reader.call_args[1]['server_id'], cdc.server_id("user_update_providor"))
+
+
+class TestClientRowToUser(unittest.TestCase):
+
+    def test_maps_columns_like_polling_query(self):
+        user = cdc.client_row_to_user({
+            'id': 7,
+            'first_name': 'John',
+            'last_name': 'Doe',
+            'email': 'john@example.com',
+            'pass': 'secret',
+            'phone': '123',
+            'timestamp': datetime(2025, 4, 29, 14, 22, 27, 816332),
+            'company': 'Doe Inc',
+            'company_vat': 'BE123',
+            'address_1': 'Main St 1',
+            'city': None,
+            'country': 'BE'
+        })
+
+        self.assertEqual(user['timestamp'], '2025-04-29T14:22:27.816332Z')
+        self.assertEqual(user['business_name'], 'Doe Inc')
+        self.assertEqual(user['btw_number'], 'BE123')
+        # CONCAT_WS skips NULLs
+        self.assertEqual(user['real_address'], 'Main St 1, BE')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,217 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import threading
+import time
+
+from common import consumer, stats
+
+
+class TestConsumerRuntime(unittest.TestCase):
+
+    def make_channel(self):
+        channel = MagicMock()
+        # Run thread-safe callbacks immediately, like the I/O loop would
+        channel.connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+        return channel
+
+    def test_extract_uuid(self):
+        body = b"<UserMessage><UUID> 2025-04-29T14:22:27.816332Z </UUID></UserMessage>"
+        self.assertEqual(consumer.extract_uuid(body), b"2025-04-29T14:22:27.816332Z")
+        self.assertIsNone(consumer.extract_uuid(b"<Invoice/>"))
+
+    def test_consume_sets_prefetch(self):
+        runtime = consumer.ConsumerRuntime(MagicMock(), workers=0, prefetch=7)
+        channel = MagicMock()
+
+        runtime.consume(channel, "facturatie_user_create")
+
+        channel.basic_qos.assert_called_once_with(prefetch_count=7)
+        channel.basic_consume.assert_called_once_with(
+            queue="facturatie_user_create",
+            on_message_callback=runtime.dispatch,
+            auto_ack=False
+        )
+
+    def test_inline_mode_passes_real_channel(self):
+        handler = MagicMock()
+        runtime = consumer.ConsumerRuntime(handler, workers=0)
+        channel = MagicMock()
+        method = MagicMock()
+
+        runtime.dispatch(channel, method, None, b"<x/>")
+
+        handler.assert_called_once_with(channel, method, None, b"<x/>")
+
+    def test_worker_acks_through_io_thread(self):
+        def handler(channel, method, properties, body):
+            channel.basic_ack(method.delivery_tag)
+
+        runtime = consumer.ConsumerRuntime(handler, workers=2)
+        channel = self.make_channel()
+        method = MagicMock(delivery_tag=5)
+
+        runtime.dispatch(channel, method, None, b"<UUID>a</UUID>")
+        runtime.shutdown()
+
+        channel.connection.add_callback_threadsafe.assert_called_once()
+        channel.basic_ack.assert_called_once_with(5, multiple=False)
+
+    def test_same_uuid_keeps_order(self):
+        seen = []
+        lock = threading.Lock()
+
+        def handler(channel, method, properties, body):
+            # Earlier messages sleep longer; without per-key ordering they would finish last
+            time.sleep(0.01 * (5 - method.delivery_tag))
+            with lock:
+                seen.append(method.delivery_tag)
+
+        runtime = consumer.ConsumerRuntime(handler, workers=4)
+        channel = self.make_channel()
+        for tag in range(5):
+            runtime.dispatch(channel, MagicMock(delivery_tag=tag), None, b"<UUID>same-user</UUID>")
+        runtime.shutdown()
+
+        self.assertEqual(seen, [0, 1, 2, 3, 4])
+
+    def test_crashing_handler_is_nacked(self):
+        handler = MagicMock(side_effect=Exception("boom"))
+        runtime = consumer.ConsumerRuntime(handler, workers=1)
+        channel = self.make_channel()
+
+        runtime.dispatch(channel, MagicMock(delivery_tag=9), None, b"<x/>")
+        runtime.shutdown()
+
+        channel.basic_nack.assert_called_once_with(9, multiple=False, requeue=False)
+
+    @patch.dict("os.environ", {"CONSUMER_RETRY_ATTEMPTS": "2", "CONSUMER_RETRY_DELAY": "1"})
+    def test_transient_crash_is_retried_through_the_io_thread(self):
+        stats.reset()
+        self.addCleanup(stats.reset)
+        handler = MagicMock(side_effect=ConnectionError("database gone"))
+        runtime = consumer.ConsumerRuntime(handler, workers=1)
+        channel = self.make_channel()
+        channel.basic_consume.return_value = "ctag-retry"
+        self.addCleanup(consumer.retry._topologies.clear)
+
+        runtime.consume(channel, "facturatie_user_update")
+        declared = [c.kwargs["queue"] for c in channel.queue_declare.call_args_list]
+        self.assertIn("facturatie_user_update.dlq", declared)
+
+        runtime.dispatch(channel, MagicMock(delivery_tag=3, consumer_tag="ctag-retry"), None, b"<x/>")
+        runtime.shutdown()
+
+        self.assertEqual(channel.basic_publish.call_args.kwargs["routing_key"], "facturatie_user_update.retry.1000ms")
+        channel.basic_ack.assert_called_once_with(3, multiple=False)
+        channel.basic_nack.assert_not_called()
+        # The ack only moves the message to the retry queue; it is not a handled message
+        self.assertNotIn("acked", stats.snapshot()[0])
+
+    def test_shutdown_flushes_pending_acks(self):
+        runtime = consumer.ConsumerRuntime(MagicMock(), workers=1)
+        connection = MagicMock()
+
+        runtime.shutdown(connection)
+
+        connection.process_data_events.assert_called_once_with(time_limit=0)
+
+    def test_counts_messages_and_nacks(self):
+        stats.reset()
+        self.addCleanup(stats.reset)
+        handler = MagicMock(side_effect=lambda ch, method, properties, body: consumer.retry.reject(ch, method, properties, body, ValueError("bad")))
+        runtime = consumer.ConsumerRuntime(handler, workers=1)
+
+        runtime.dispatch(self.make_channel(), MagicMock(delivery_tag=1), None, b"<x/>")
+        runtime.shutdown()
+
+        self.assertEqual(stats.snapshot()[0], {"messages": 1, "errors": 1, "nacked": 1})
+
+    def test_counts_acks_without_workers(self):
+        stats.reset()
+        self.addCleanup(stats.reset)
+        handler = MagicMock(side_effect=lambda ch, method, properties, body: consumer.ack(ch, method.delivery_tag))
+        runtime = consumer.ConsumerRuntime(handler, workers=0)
+        channel = MagicMock()
+
+        runtime.dispatch(channel, MagicMock(delivery_tag=1), None, b"<x/>")
+
+        channel.basic_ack.assert_called_once_with(1)
+        self.assertEqual(stats.snapshot()[0], {"messages": 1, "acked": 1})
+
+    def test_queue_depth_is_probed_only_when_reporting(self):
+        channel = MagicMock()
+        runtime = consumer.ConsumerRuntime(MagicMock(), workers=0)
+
+        runtime.consume(channel, "facturatie_user_create")
+        channel.connection.call_later.assert_not_called()
+
+        with patch.object(stats, "reporter", return_value=MagicMock(interval=5)):
+            runtime.consume(channel, "facturatie_user_create")
+        channel.connection.call_later.assert_called_once()
+
+    def test_watch_queue_depth_reports_gauge_and_reschedules(self):
+        stats.reset()
+        self.addCleanup(stats.reset)
+        channel = MagicMock()
+        channel.queue_declare.return_value.method.message_count = 42
+
+        consumer.watch_queue_depth(channel, "facturatie_user_create", 5)
+        interval, probe = channel.connection.call_later.call_args[0]
+        probe()
+
+        self.assertEqual(interval, 5)
+        channel.queue_declare.assert_called_once_with(queue="facturatie_user_create", durable=True, passive=True)
+        self.assertEqual(stats.snapshot()[1], {"queue_lag:facturatie_user_create": 42})
+        self.assertEqual(channel.connection.call_later.call_count, 2)
+
+
+class TestBatchingRuntime(unittest.TestCase):
+
+    def make_channel(self):
+        channel = MagicMock()
+        channel.connection.add_callback_threadsafe.side_effect = lambda callback: callback()
+        return channel
+
+    def test_prefetch_covers_a_full_batch(self):
+        runtime = consumer.BatchingRuntime(MagicMock(), batch_size=50, prefetch=10)
+        self.assertEqual(runtime.prefetch, 100)
+
+    def test_flushes_when_batch_is_full(self):
+        handler = MagicMock()
+        runtime = consumer.BatchingRuntime(handler, batch_size=2)
+        channel = self.make_channel()
+
+        runtime.dispatch(channel, MagicMock(delivery_tag=1), None, b"a")
+        channel.connection.call_later.assert_called_once_with(0.2, runtime._on_timer)
+        runtime.dispatch(channel, MagicMock(delivery_tag=2), None, b"b")
+        runtime.shutdown()
+
+        handler.assert_called_once()
+        deliveries = handler.call_args[0][1]
+        self.assertEqual([body for _, _, body in deliveries], [b"a", b"b"])
+        channel.connection.remove_timeout.assert_called_once()
+
+    def test_timer_flushes_partial_batch(self):
+        handler = MagicMock()
+        runtime = consumer.BatchingRuntime(handler, batch_size=10)
+        channel = self.make_channel()
+
+        runtime.dispatch(channel, MagicMock(delivery_tag=1), None, b"a")
+        runtime._on_timer()
+        runtime.shutdown()
+
+        self.assertEqual(len(handler.call_args[0][1]), 1)
+
+    def test_crashing_batch_handler_nacks_everything(self):
+        runtime = consumer.BatchingRuntime(MagicMock(side_effect=Exception("boom")), batch_size=2)
+        channel = self.make_channel()
+
+        runtime.dispatch(channel, MagicMock(delivery_tag=1), None, b"a")
+        runtime.dispatch(channel, MagicMock(delivery_tag=2), None, b"b")
+        runtime.shutdown()
+
+        self.assertEqual(channel.basic_nack.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
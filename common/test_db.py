@@ -0,0 +1,132 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import os
+
+from common import db
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('common.db.mysql.connector.connect')
+        self.mock_connect = patcher.start()
+        self.addCleanup(patcher.stop)
+        # Every connect() call hands out a fresh fake connection
+        self.mock_connect.side_effect = lambda **kwargs: MagicMock(in_transaction=False)
+
+    def test_connection_is_reused_after_close(self):
+        pool = db.ConnectionPool(size=2, host='localhost')
+
+        conn = pool.get_connection()
+        raw = conn._raw
+        conn.close()
+        conn = pool.get_connection()
+
+        self.assertIs(conn._raw, raw)
+        self.mock_connect.assert_called_once_with(host='localhost')
+        raw.close.assert_not_called()
+
+    def test_proxies_connection_methods(self):
+        pool = db.ConnectionPool(size=1)
+
+        conn = pool.get_connection()
+        conn.cursor()
+        conn.commit()
+
+        conn._raw.cursor.assert_called_once()
+        conn._raw.commit.assert_called_once()
+
+    def test_open_transaction_rolled_back_on_release(self):
+        pool = db.ConnectionPool(size=1)
+
+        conn = pool.get_connection()
+        raw = conn._raw
+        raw.in_transaction = True
+        conn.close()
+
+        raw.rollback.assert_called_once()
+
+    def test_expired_connection_is_recycled(self):
+        pool = db.ConnectionPool(size=1, max_lifetime=10)
+
+        with patch('common.db.time.monotonic', return_value=100.0):
+            conn = pool.get_connection()
+            raw = conn._raw
+        with patch('common.db.time.monotonic', return_value=200.0):
+            conn.close()
+
+        raw.close.assert_called_once()
+        self.assertEqual(pool.stats()['recycled'], 1)
+        self.assertEqual(pool.stats()['idle'], 0)
+
+    def test_failed_health_check_opens_new_connection(self):
+        pool = db.ConnectionPool(size=1, health_check_interval=0)
+
+        conn = pool.get_connection()
+        stale = conn._raw
+        stale.ping.side_effect = Exception("gone away")
+        conn.close()
+        conn = pool.get_connection()
+
+        self.assertIsNot(conn._raw, stale)
+        self.assertEqual(self.mock_connect.call_count, 2)
+        self.assertEqual(pool.stats()['health_check_failures'], 1)
+
+    def test_exhausted_pool_times_out(self):
+        pool = db.ConnectionPool(size=1, wait_timeout=0.01)
+
+        pool.get_connection()
+        with self.assertRaises(db.PoolTimeout):
+            pool.get_connection()
+
+        stats = pool.stats()
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['in_use'], 1)
+
+    def test_failed_connect_releases_slot(self):
+        pool = db.ConnectionPool(size=1, wait_timeout=0.01)
+        self.mock_connect.side_effect = Exception("refused")
+
+        with self.assertRaises(Exception):
+            pool.get_connection()
+
+        self.mock_connect.side_effect = lambda **kwargs: MagicMock(in_transaction=False)
+        self.assertIsNotNone(pool.get_connection())
+
+    @patch.dict('os.environ', {
+        'DB_HOST': 'localhost',
+        'DB_USER': 'test',
+        'DB_PASSWORD': 'test',
+        'DB_NAME': 'test_db',
+        'DB_POOL_SIZE': '3'
+    })
+    def test_get_pool_reads_environment(self):
+        db.reset_pool()
+        try:
+            pool = db.get_pool()
+            self.assertIs(db.get_pool(), pool)
+            self.assertEqual(pool.size, 3)
+            db.get_connection()
+            self.mock_connect.assert_called_once_with(
+                host='localhost',
+                user='test',
+                password='test',
+                database='test_db'
+            )
+        finally:
+            db.reset_pool()
+
+    def test_ping_latency_returns_connection_to_pool(self):
+        pool = db.ConnectionPool(size=1, host='localhost')
+
+        with patch('common.db.get_connection', pool.get_connection):
+            self.assertGreaterEqual(db.ping_latency_ms(), 0)
+            self.assertGreaterEqual(db.ping_latency_ms(), 0)
+
+        self.assertEqual(self.mock_connect.call_count, 1)
+        self.assertEqual(pool.stats()['in_use'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+from common import idempotency, stats
+
+
+class FakeLedgerTable:
+    """processed_messages in memory; answers the INSERT IGNORE like MySQL (rowcount 0 on a duplicate)."""
+
+    def __init__(self):
+        self.keys = set()
+        self.rowcount = 0
+        self.executed = []
+
+    def execute(self, sql, params=()):
+        self.executed.append(sql)
+        if sql.startswith("INSERT IGNORE INTO processed_messages"):
+            self.rowcount = 0 if params in self.keys else 1
+            self.keys.add(params)
+
+
+class TestMessageKey(unittest.TestCase):
+
+    def test_key_is_stable_and_fits_the_column(self):
+        key = idempotency.message_key("2025-04-29T14:22:27.816332Z", "2025-05-01T10:00:00Z")
+        self.assertEqual(key, idempotency.message_key("2025-04-29T14:22:27.816332Z", "2025-05-01T10:00:00Z"))
+        self.assertEqual(len(key), 64)
+
+    def test_different_time_of_action_is_a_different_message(self):
+        self.assertNotEqual(
+            idempotency.message_key("2025-04-29T14:22:27.816332Z", "2025-05-01T10:00:00Z"),
+            idempotency.message_key("2025-04-29T14:22:27.816332Z", "2025-05-01T10:00:01Z")
+        )
+
+    def test_missing_part_gives_no_key(self):
+        self.assertIsNone(idempotency.message_key("2025-04-29T14:22:27.816332Z", None))
+        self.assertIsNone(idempotency.message_key("", "2025-05-01T10:00:00Z"))
+
+
+class TestLedger(unittest.TestCase):
+
+    def setUp(self):
+        stats.reset()
+        self.table = FakeLedgerTable()
+
+    def test_claim_records_key_once(self):
+        ledger = idempotency.Ledger("test-consumer", maxsize=10)
+
+        self.assertTrue(ledger.claim(self.table, "k1"))
+        self.assertFalse(ledger.claim(self.table, "k1"))
+        self.assertIn(("test-consumer", "k1"), self.table.keys)
+        self.assertEqual(stats.snapshot()[0].get("duplicates"), 1)
+
+    def test_duplicate_found_in_the_table_is_remembered(self):
+        # A key recorded by another replica (or before a restart) is only in the table
+        self.table.keys.add(("test-consumer", "k1"))
+        ledger = idempotency.Ledger("test-consumer", maxsize=10)
+
+        self.assertFalse(ledger.is_duplicate("k1"))
+        self.assertFalse(ledger.claim(self.table, "k1"))
+        self.assertTrue(ledger.is_duplicate("k1"))
+
+    def test_claimed_key_is_only_known_in_memory_after_remember(self):
+        ledger = idempotency.Ledger("test-consumer", maxsize=10)
+        ledger.claim(self.table, "k1")
+
+        # The transaction may still roll back
+        self.assertFalse(ledger.is_duplicate("k1"))
+        ledger.remember("k1")
+        self.assertTrue(ledger.is_duplicate("k1"))
+
+    def test_memory_is_bounded_and_evicts_least_recently_used(self):
+        ledger = idempotency.Ledger("test-consumer", maxsize=2)
+        ledger.remember("a")
+        ledger.remember("b")
+        ledger.is_duplicate("a")  # "b" is now the oldest
+        ledger.remember("c")
+
+        self.assertTrue(ledger.is_duplicate("a"))
+        self.assertFalse(ledger.is_duplicate("b"))
+        self.assertTrue(ledger.is_duplicate("c"))
+
+    def test_messages_without_key_are_not_deduplicated(self):
+        ledger = idempotency.Ledger("test-consumer", maxsize=10)
+
+        self.assertTrue(ledger.claim(self.table, None))
+        self.assertTrue(ledger.claim(self.table, None))
+        ledger.remember(None)
+        self.assertFalse(ledger.is_duplicate(None))
+        self.assertEqual(self.table.executed, [])
+
+    def test_settings_from_environment(self):
+        with patch.dict("os.environ", {"IDEMPOTENCY_CACHE_SIZE": "5", "IDEMPOTENCY_RETENTION_DAYS": "7"}):
+            ledger = idempotency.Ledger("test-consumer")
+
+        self.assertEqual((ledger.maxsize, ledger.retention_days), (5, 7))
+
+    @patch("common.idempotency.db.get_connection")
+    def test_initialize_creates_table_and_purges_expired_keys(self, mock_get_connection):
+        cursor = MagicMock()
+        cursor.rowcount = 0
+        mock_get_connection.return_value.cursor.return_value = cursor
+
+        idempotency.Ledger("test-consumer", retention_days=30).initialize()
+
+        statements = [c[0][0] for c in cursor.execute.call_args_list]
+        self.assertIn("CREATE TABLE IF NOT EXISTS processed_messages", statements[0])
+        self.assertIn("DELETE FROM processed_messages", statements[1])
+        self.assertEqual(cursor.execute.call_args[0][1], ("test-consumer", 30))
+        mock_get_connection.return_value.commit.assert_called_once()
+        mock_get_connection.return_value.close.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
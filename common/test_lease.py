@@ -0,0 +1,195 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+from common.lease import PartitionLease
+
+
+class FakeLeaseTables:
+    """Keeps provider_leases and provider_replicas in memory and answers the queries PartitionLease
+    runs against them. `now` is the database clock in seconds."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.leases = {}  # (provider, partition) -> [owner, expires_at]
+        self.replicas = {}  # (provider, owner) -> expires_at
+        self.executed = []
+        self._result = []
+
+    def connection(self):
+        conn = MagicMock()
+        conn.cursor.return_value = self
+        return conn
+
+    def execute(self, sql, params=()):
+        self.executed.append((sql, params))
+        sql = " ".join(sql.split())
+        if sql.startswith("CREATE TABLE"):
+            return
+        if sql.startswith("INSERT IGNORE INTO provider_leases"):
+            for provider, partition in zip(params[::2], params[1::2]):
+                self.leases.setdefault((provider, partition), [None, self.now])
+        elif sql.startswith("SELECT partition_no, owner"):
+            provider, partitions = params
+            self._result = [
+                (partition, owner, int(expires > self.now))
+                for (p, partition), (owner, expires) in sorted(self.leases.items())
+                if p == provider and partition < partitions
+            ]
+        elif sql.startswith("INSERT INTO provider_replicas"):
+            provider, owner, micro = params
+            self.replicas[(provider, owner)] = self.now + micro / 1e6
+        elif sql.startswith("DELETE FROM provider_replicas") and "owner" in sql:
+            self.replicas.pop(params, None)
+        elif sql.startswith("DELETE FROM provider_replicas"):
+            for key in [key for key, expires in self.replicas.items() if key[0] == params[0] and expires < self.now]:
+                del self.replicas[key]
+        elif sql.startswith("SELECT owner FROM provider_replicas"):
+            self._result = sorted((owner,) for provider, owner in self.replicas if provider == params[0])
+        elif sql.startswith("UPDATE provider_leases SET owner = %s"):
+            owner, micro, provider, *partitions = params
+            for partition in partitions:
+                self.leases[(provider, partition)] = [owner, self.now + micro / 1e6]
+        elif sql.startswith("UPDATE provider_leases SET owner = NULL"):
+            provider, owner, *partitions = params
+            for (p, partition), row in self.leases.items():
+                if p == provider and row[0] == owner and (not partitions or partition in partitions):
+                    self.leases[(p, partition)] = [None, self.now]
+        else:
+            raise AssertionError(f"unexpected query: {sql}")
+
+    def fetchone(self):
+        return self._result[0]
+
+    def fetchall(self):
+        return self._result
+
+    def close(self):
+        pass
+
+    def owners(self, provider="user-creation-providor"):
+        return {partition: row[0] for (p, partition), row in sorted(self.leases.items()) if p == provider}
+
+
+class TestPartitionLease(unittest.TestCase):
+
+    def setUp(self):
+        self.tables = FakeLeaseTables()
+        self.clock = 0.0
+        patcher = patch("common.lease.db.get_connection", side_effect=self.tables.connection)
+        self.get_connection = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_lease(self, owner, partitions=4):
+        return PartitionLease("user-creation-providor", partitions=partitions, ttl=30, owner=owner, clock=lambda: self.clock)
+
+    # Advances the application and the database clock together
+    def advance(self, seconds):
+        self.clock += seconds
+        self.tables.now += seconds
+
+    def test_disabled_without_partitions(self):
+        with patch.dict("os.environ", {}, clear=True):
+            disabled = PartitionLease("user-creation-providor")
+
+        self.assertIsNone(disabled.condition("c.id"))
+        self.assertEqual(disabled.refresh(), ())
+        self.get_connection.assert_not_called()
+
+    def test_partition_count_from_environment(self):
+        with patch.dict("os.environ", {"PROVIDER_PARTITIONS": "8", "PROVIDER_LEASE_TTL": "12"}):
+            configured = PartitionLease("user-creation-providor", owner="a")
+
+        self.assertEqual((configured.partitions, configured.ttl), (8, 12.0))
+
+    def test_single_replica_owns_every_partition(self):
+        only = self.make_lease("a")
+
+        self.assertEqual(only.condition("c.id"), ("MOD(c.id, %s) IN (%s, %s, %s, %s)", (4, 0, 1, 2, 3)))
+        self.assertEqual(set(self.tables.owners().values()), {"a"})
+
+    def test_refresh_is_throttled_to_a_third_of_the_ttl(self):
+        only = self.make_lease("a")
+        only.refresh()
+        queries = len(self.tables.executed)
+
+        self.advance(9)
+        only.refresh()
+        self.assertEqual(len(self.tables.executed), queries)
+
+        self.advance(2)
+        only.refresh()
+        self.assertGreater(len(self.tables.executed), queries)
+
+    def test_new_replica_gets_its_share(self):
+        first, second = self.make_lease("a"), self.make_lease("b")
+        first.refresh()
+
+        self.assertEqual(second.refresh(), ())  # everything is still leased to "a"
+        self.advance(11)
+        self.assertEqual(first.refresh(), (0, 1))  # "a" sees two replicas and hands back its surplus
+        self.assertEqual(second.refresh(force=True), (2, 3))
+        self.assertEqual(self.tables.owners(), {0: "a", 1: "a", 2: "b", 3: "b"})
+
+    def test_partitions_of_a_crashed_replica_move_after_the_ttl(self):
+        first, second = self.make_lease("a"), self.make_lease("b")
+        first.refresh()
+        second.refresh()
+        self.advance(11)
+        first.refresh()
+        second.refresh()
+        self.assertEqual(second.owned, (2, 3))
+
+        # "b" stops renewing; its leases and replica row run out
+        for _ in range(3):
+            self.advance(11)
+            first.refresh()
+
+        self.assertEqual(first.owned, (0, 1, 2, 3))
+
+    def test_owned_partitions_are_disjoint(self):
+        replicas = [self.make_lease(owner, partitions=7) for owner in "abc"]
+        for _ in range(4):
+            self.advance(11)
+            for replica in replicas:
+                replica.refresh()
+
+        owned = [set(replica.owned) for replica in replicas]
+        self.assertEqual(set().union(*owned), set(range(7)))
+        self.assertEqual(sum(len(partitions) for partitions in owned), 7)
+        self.assertTrue(all(2 <= len(partitions) <= 3 for partitions in owned))
+
+    def test_failed_renewal_keeps_partitions_only_while_fresh(self):
+        only = self.make_lease("a")
+        only.refresh()
+        self.get_connection.side_effect = Exception("db down")
+
+        self.advance(11)
+        self.assertEqual(only.condition("c.id")[1], (4, 0, 1, 2, 3))
+        self.advance(10)
+        self.assertEqual(only.condition("c.id"), ("FALSE", ()))
+
+    def test_is_stale_once_renewals_stop(self):
+        only = self.make_lease("a")
+        only.refresh()
+
+        self.advance(19)
+        self.assertFalse(only.is_stale())
+        self.advance(2)
+        self.assertTrue(only.is_stale())
+
+    def test_never_stale_without_partitions(self):
+        self.assertFalse(self.make_lease("a", partitions=0).is_stale())
+
+    def test_release_hands_partitions_back(self):
+        first, second = self.make_lease("a"), self.make_lease("b")
+        first.refresh()
+        second.refresh()
+
+        first.release()
+
+        self.assertEqual(first.owned, ())
+        self.assertEqual(second.refresh(force=True), (0, 1, 2, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
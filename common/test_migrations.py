@@ -0,0 +1,128 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+from common import migrations
+
+
+class FakeSchema:
+    """Answers the information_schema queries from a dict {table: {index_name: (columns...)}}.
+    Index names starting with "uq_" or "PRIMARY" are reported as unique."""
+
+    def __init__(self, tables, applied=()):
+        self.tables = tables
+        self.applied = set(applied)
+        self.executed = []
+        self._result = []
+
+    def execute(self, sql, params=()):
+        self.executed.append((sql, params))
+        if "GET_LOCK" in sql or "RELEASE_LOCK" in sql:
+            self._result = [(1,)]
+        elif "FROM schema_migrations" in sql:
+            self._result = [(version,) for version in self.applied]
+        elif "information_schema.TABLES" in sql:
+            self._result = [(1 if params[0] in self.tables else 0,)]
+        elif "information_schema.STATISTICS" in sql:
+            indexes = self.tables.get(params[0], {})
+            self._result = [
+                (name, 0 if name.startswith(("uq_", "PRIMARY")) else 1, column)
+                for name, columns in indexes.items() for column in columns
+            ]
+        elif sql.startswith("ALTER TABLE"):
+            self._result = []
+        elif "INSERT INTO schema_migrations" in sql:
+            self.applied.add(params[0])
+
+    def fetchone(self):
+        return self._result[0]
+
+    def fetchall(self):
+        return self._result
+
+    def close(self):
+        pass
+
+    def ddl(self):
+        return [sql for sql, _ in self.executed if sql.startswith("ALTER TABLE")]
+
+
+TEST_MIGRATIONS = [
+    migrations.Migration(1, "client", [migrations.Index("client", "idx_client_timestamp_id", ("timestamp", "id"))]),
+    migrations.Migration(2, "outbox", [migrations.Index("outbox", "idx_outbox_processed", ("processed",))]),
+]
+
+
+class TestMigrations(unittest.TestCase):
+
+    def run_migrate(self, schema, migration_list=TEST_MIGRATIONS):
+        conn = MagicMock()
+        conn.cursor.return_value = schema
+        with patch('common.migrations.db.get_connection', return_value=conn):
+            return migrations.migrate(migration_list), conn
+
+    def test_applies_pending_migrations_in_order(self):
+        schema = FakeSchema({"client": {"PRIMARY": ("id",)}, "outbox": {}})
+
+        applied, conn = self.run_migrate(schema, list(reversed(TEST_MIGRATIONS)))
+
+        self.assertEqual(applied, [1, 2])
+        self.assertEqual(schema.ddl(), [
+            "ALTER TABLE `client` ADD INDEX `idx_client_timestamp_id` (`timestamp`, `id`), ALGORITHM=INPLACE, LOCK=NONE",
+            "ALTER TABLE `outbox` ADD INDEX `idx_outbox_processed` (`processed`), ALGORITHM=INPLACE, LOCK=NONE",
+        ])
+        self.assertEqual(conn.commit.call_count, 2)
+        self.assertIn("RELEASE_LOCK", schema.executed[-1][0])
+
+    def test_skips_applied_versions(self):
+        schema = FakeSchema({"client": {}, "outbox": {}}, applied=[1])
+
+        applied, _ = self.run_migrate(schema)
+
+        self.assertEqual(applied, [2])
+        self.assertEqual(len(schema.ddl()), 1)
+
+    def test_reuses_existing_index_with_same_leading_columns(self):
+        schema = FakeSchema({"client": {"client_timestamp": ("timestamp", "id", "email")}, "outbox": {}})
+
+        applied, _ = self.run_migrate(schema)
+
+        self.assertEqual(applied, [1, 2])
+        self.assertNotIn("client", " ".join(schema.ddl()))
+
+    def test_missing_table_postpones_migration(self):
+        schema = FakeSchema({"client": {}})
+
+        applied, _ = self.run_migrate(schema)
+
+        self.assertEqual(applied, [1])
+        self.assertNotIn(2, schema.applied)
+
+    def test_unique_index_needs_exact_unique_match(self):
+        unique = [migrations.Migration(1, "uuid", [migrations.Index("client", "uq_client_timestamp", ("timestamp",), unique=True)])]
+        schema = FakeSchema({"client": {"idx_client_timestamp_id": ("timestamp", "id")}})
+
+        self.run_migrate(schema, unique)
+
+        self.assertEqual(schema.ddl(), [
+            "ALTER TABLE `client` ADD UNIQUE INDEX `uq_client_timestamp` (`timestamp`), ALGORITHM=INPLACE, LOCK=NONE",
+        ])
+
+    def test_missing_indexes(self):
+        schema = FakeSchema({"client": {"idx_client_timestamp_id": ("timestamp", "id")}})
+        conn = MagicMock()
+        conn.cursor.return_value = schema
+
+        with patch('common.migrations.db.get_connection', return_value=conn):
+            missing = migrations.missing_indexes(TEST_MIGRATIONS)
+
+        self.assertEqual([index.name for index in missing], ["idx_outbox_processed"])
+
+    @patch('common.migrations.missing_indexes', return_value=[])
+    @patch('common.migrations.migrate')
+    def test_check_only_does_not_migrate(self, mock_migrate, mock_missing):
+        self.assertEqual(migrations.main(["--check"]), 0)
+        mock_migrate.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+from unittest.mock import patch, MagicMock
+from pika import exceptions
+
+from common import rabbitmq
+
+
+@patch.dict('os.environ', {
+    'RABBITMQ_HOST': 'localhost',
+    'RABBITMQ_PORT': '5672',
+    'RABBITMQ_USER': 'guest',
+    'RABBITMQ_PASSWORD': 'guest'
+})
+class TestPublisher(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('common.rabbitmq.pika.BlockingConnection')
+        self.mock_connection = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.publisher = rabbitmq.Publisher(
+            exchange="user",
+            bindings=[("crm_user_create", "user.create.crm_user_create")]
+        )
+
+    def test_declares_topology_once(self):
+        channel = self.mock_connection.return_value.channel.return_value
+
+        self.publisher.publish("user.create.crm_user_create", "<xml/>")
+        self.publisher.publish("user.create.crm_user_create", "<xml/>")
+
+        self.mock_connection.assert_called_once()
+        channel.exchange_declare.assert_called_once_with(exchange="user", exchange_type="topic", durable=True)
+        channel.queue_bind.assert_called_once_with(
+            exchange="user",
+            queue="crm_user_create",
+            routing_key="user.create.crm_user_create"
+        )
+        self.assertEqual(channel.basic_publish.call_count, 2)
+
+    def test_foreign_exchange_is_not_declared(self):
+        publisher = rabbitmq.Publisher(
+            exchange="heartbeat",
+            bindings=[("controlroom_heartbeat", None)],
+            confirm=False,
+            declare_exchange=False
+        )
+        channel = self.mock_connection.return_value.channel.return_value
+
+        publisher.publish("controlroom_heartbeat", "<Heartbeat/>")
+
+        channel.exchange_declare.assert_not_called()
+        channel.confirm_delivery.assert_not_called()
+        channel.queue_declare.assert_called_once_with(queue="controlroom_heartbeat", durable=True)
+        channel.queue_bind.assert_not_called()
+
+    def test_reconnects_after_lost_connection(self):
+        dead_channel = MagicMock()
+        dead_channel.basic_publish.side_effect = exceptions.StreamLostError("lost")
+        live_channel = MagicMock()
+        self.mock_connection.return_value.channel.side_effect = [dead_channel, live_channel]
+
+        self.publisher.publish("user.create.crm_user_create", "<xml/>")
+
+        self.assertEqual(self.mock_connection.call_count, 2)
+        live_channel.basic_publish.assert_called_once()
+
+    def test_gives_up_after_second_failure(self):
+        channel = self.mock_connection.return_value.channel.return_value
+        channel.basic_publish.side_effect = exceptions.StreamLostError("lost")
+
+        with self.assertRaises(exceptions.StreamLostError):
+            self.publisher.publish("user.create.crm_user_create", "<xml/>")
+        self.assertEqual(self.mock_connection.call_count, 2)
+
+    def test_nack_is_not_retried(self):
+        channel = self.mock_connection.return_value.channel.return_value
+        channel.basic_publish.side_effect = exceptions.NackError([])
+
+        with self.assertRaises(exceptions.NackError):
+            self.publisher.publish("user.create.crm_user_create", "<xml/>")
+        self.mock_connection.assert_called_once()
+
+    def test_process_data_events_drops_dead_connection(self):
+        self.publisher.channel()
+        connection = self.mock_connection.return_value
+        connection.process_data_events.side_effect = exceptions.StreamLostError("lost")
+
+        self.publisher.process_data_events()
+        self.publisher.channel()
+
+        self.assertEqual(self.mock_connection.call_count, 2)
+
+    def test_close_is_idempotent(self):
+        self.publisher.channel()
+        self.publisher.close()
+        self.publisher.close()
+
+        self.mock_connection.return_value.close.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
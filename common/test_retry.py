@@ -0,0 +1,187 @@
+import unittest
+import xml.etree.ElementTree as ET
+from unittest.mock import patch, MagicMock
+
+import pika
+from mysql.connector import errors, errorcode
+
+from common import retry, stats
+from common.db import PoolTimeout
+
+
+def delivery(tag=1, headers=None, consumer_tag="ctag-1"):
+    method = MagicMock(delivery_tag=tag, consumer_tag=consumer_tag)
+    properties = pika.BasicProperties(headers=headers, content_type="application/xml")
+    return method, properties, b"<Invoice/>"
+
+
+class FakeDeadLetterQueue:
+    """Channel holding one DLQ; basic_get hands out its messages in order."""
+
+    def __init__(self, messages):
+        self.messages = list(messages)
+        self.published = []
+        self.acked = []
+
+    def queue_declare(self, queue, durable, passive):
+        return MagicMock(method=MagicMock(message_count=len(self.messages)))
+
+    def basic_get(self, queue, auto_ack):
+        if not self.messages:
+            return None, None, None
+        properties, body = self.messages.pop(0)
+        return MagicMock(delivery_tag=body), properties, body
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        self.published.append((routing_key, body, properties))
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+
+class TestClassification(unittest.TestCase):
+
+    def test_connection_and_lock_errors_are_transient(self):
+        self.assertTrue(retry.is_transient(errors.OperationalError(msg="Lost connection", errno=errorcode.CR_SERVER_LOST)))
+        self.assertTrue(retry.is_transient(errors.InternalError(msg="Deadlock found", errno=errorcode.ER_LOCK_DEADLOCK)))
+        self.assertTrue(retry.is_transient(errors.DatabaseError(msg="Lock wait timeout", errno=errorcode.ER_LOCK_WAIT_TIMEOUT)))
+        self.assertTrue(retry.is_transient(PoolTimeout("no connection available")))
+        self.assertTrue(retry.is_transient(ConnectionRefusedError()))
+        self.assertTrue(retry.is_transient(retry.TransientError("client not there yet")))
+
+    def test_message_errors_are_permanent(self):
+        self.assertFalse(retry.is_transient(errors.IntegrityError(msg="Duplicate entry", errno=errorcode.ER_DUP_ENTRY)))
+        self.assertFalse(retry.is_transient(errors.ProgrammingError(msg="Unknown column", errno=errorcode.ER_BAD_FIELD_ERROR)))
+        self.assertFalse(retry.is_transient(ET.ParseError("not well-formed")))
+        self.assertFalse(retry.is_transient(KeyError("uuid")))
+        self.assertFalse(retry.is_transient(ValueError("bad date")))
+
+
+class TestRetryTopology(unittest.TestCase):
+
+    def setUp(self):
+        stats.reset()
+        self.topology = retry.RetryTopology("order.created", attempts=3, delay=5, backoff=3)
+        self.channel = MagicMock()
+
+    def test_disabled_by_default(self):
+        with patch.dict("os.environ", {}, clear=True):
+            self.assertFalse(retry.RetryTopology("order.created").enabled())
+
+    def test_declares_one_ttl_queue_per_delay_and_a_dlq(self):
+        self.topology.declare(self.channel)
+
+        declared = {c.kwargs["queue"]: c.kwargs.get("arguments") for c in self.channel.queue_declare.call_args_list}
+        self.assertEqual(list(declared), [
+            "order.created.retry.5000ms", "order.created.retry.15000ms", "order.created.retry.45000ms", "order.created.dlq"
+        ])
+        self.assertEqual(declared["order.created.retry.15000ms"], {
+            "x-message-ttl": 15000,
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": "order.created",
+        })
+        self.assertIsNone(declared["order.created.dlq"])
+
+    def test_transient_failure_goes_to_the_next_retry_queue(self):
+        method, properties, body = delivery(headers={"x-retry-attempts": 1, "x-death": [{"count": 1}]})
+
+        self.topology.reject(self.channel, method, properties, body, errors.OperationalError(msg="gone", errno=errorcode.CR_SERVER_GONE_ERROR))
+
+        publish = self.channel.basic_publish.call_args.kwargs
+        self.assertEqual(publish["routing_key"], "order.created.retry.15000ms")
+        self.assertEqual(publish["body"], body)
+        self.assertEqual(publish["properties"].headers["x-retry-attempts"], 2)
+        self.assertNotIn("x-death", publish["properties"].headers)
+        self.assertEqual(publish["properties"].delivery_mode, 2)
+        self.channel.basic_ack.assert_called_once_with(1)
+        self.assertEqual(stats.snapshot()[0]["retried"], 1)
+
+    def test_transient_failure_out_of_attempts_is_dead_lettered(self):
+        method, properties, body = delivery(headers={"x-retry-attempts": 3})
+
+        self.topology.reject(self.channel, method, properties, body, ConnectionResetError("reset"))
+
+        publish = self.channel.basic_publish.call_args.kwargs
+        self.assertEqual(publish["routing_key"], "order.created.dlq")
+        self.assertEqual(publish["properties"].headers["x-failure"], "transient")
+        self.channel.basic_ack.assert_called_once_with(1)
+
+    def test_permanent_failure_is_dead_lettered_right_away(self):
+        method, properties, body = delivery()
+
+        self.topology.reject(self.channel, method, properties, body, ET.ParseError("not well-formed"))
+
+        publish = self.channel.basic_publish.call_args.kwargs
+        self.assertEqual(publish["routing_key"], "order.created.dlq")
+        self.assertEqual(publish["properties"].headers["x-failure"], "permanent")
+        self.assertEqual(publish["properties"].headers["x-original-queue"], "order.created")
+        self.assertIn("ParseError", publish["properties"].headers["x-last-error"])
+        self.assertEqual(stats.snapshot()[0]["dead_lettered"], 1)
+
+
+class TestReject(unittest.TestCase):
+
+    def tearDown(self):
+        retry._topologies.clear()
+
+    def test_unregistered_delivery_is_nacked(self):
+        channel = MagicMock()
+        method, properties, body = delivery(consumer_tag="unknown")
+
+        retry.reject(channel, method, properties, body, ConnectionError())
+
+        channel.basic_nack.assert_called_once_with(1, requeue=False)
+        channel.basic_publish.assert_not_called()
+
+    def test_disabled_topology_keeps_the_nack(self):
+        retry.register("ctag-1", retry.RetryTopology("order.created", attempts=0))
+        channel = MagicMock()
+
+        retry.reject(channel, *delivery(), ConnectionError())
+
+        channel.basic_nack.assert_called_once_with(1, requeue=False)
+
+    def test_registered_consumer_uses_its_topology(self):
+        retry.register("ctag-1", retry.RetryTopology("facturatie_user_create", attempts=2, delay=1, backoff=2))
+        channel = MagicMock()
+
+        retry.reject(channel, *delivery(), ConnectionError())
+
+        self.assertEqual(channel.basic_publish.call_args.kwargs["routing_key"], "facturatie_user_create.retry.1000ms")
+        channel.basic_nack.assert_not_called()
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def test_replays_at_the_given_rate_with_fresh_attempts(self):
+        failed = pika.BasicProperties(headers={"x-retry-attempts": 3, "x-failure": "transient", "x-original-queue": "order.created"})
+        channel = FakeDeadLetterQueue([(failed, b"1"), (failed, b"2"), (failed, b"3")])
+
+        replayed = retry.replay(channel, "order.created", rate=4, clock=self.clock, sleep=self.sleep)
+
+        self.assertEqual(replayed, 3)
+        self.assertEqual([(queue, body) for queue, body, _ in channel.published], [("order.created", b"1"), ("order.created", b"2"), ("order.created", b"3")])
+        self.assertEqual(channel.acked, [b"1", b"2", b"3"])
+        self.assertEqual(self.sleeps, [0.25, 0.25])
+        self.assertEqual(channel.published[0][2].headers, {"x-original-queue": "order.created", "x-replayed": 1})
+
+    def test_only_replays_what_was_there_and_honours_the_limit(self):
+        channel = FakeDeadLetterQueue([(pika.BasicProperties(), str(n).encode()) for n in range(5)])
+
+        self.assertEqual(retry.replay(channel, "order.created", rate=1000, limit=2, clock=self.clock, sleep=self.sleep), 2)
+        self.assertEqual(len(channel.messages), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+import socket
+import time
+
+from common import scheduler
+
+
+class TestPollScheduler(unittest.TestCase):
+
+    def test_full_batch_polls_again_immediately(self):
+        poller = scheduler.PollScheduler(min_interval=1, max_interval=8)
+        self.assertEqual(poller.next_delay(100, full=True), 0)
+
+    def test_idle_polls_back_off_exponentially(self):
+        poller = scheduler.PollScheduler(min_interval=1, max_interval=8)
+
+        delays = [poller.next_delay(0) for _ in range(6)]
+
+        self.assertEqual(delays, [1, 2, 4, 8, 8, 8])
+
+    def test_work_resets_backoff(self):
+        poller = scheduler.PollScheduler(min_interval=1, max_interval=8)
+        for _ in range(4):
+            poller.next_delay(0)
+
+        self.assertEqual(poller.next_delay(3), 1)
+        self.assertEqual(poller.next_delay(0), 1)
+
+    def test_wake_interrupts_wait(self):
+        poller = scheduler.PollScheduler(min_interval=30, max_interval=30)
+        poller.wake()
+
+        start = time.monotonic()
+        self.assertTrue(poller.wait(0))
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_udp_notify_wakes_scheduler(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+
+        poller = scheduler.PollScheduler(min_interval=30, max_interval=30, wake_port=port)
+        self.addCleanup(poller.close)
+        scheduler.notify(port)
+
+        start = time.monotonic()
+        self.assertTrue(poller.wait(0))
+        self.assertLess(time.monotonic() - start, 5)
+
+
+# Clock that only moves when the scheduler sleeps or a test advances it
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestFixedRateScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.ticker = scheduler.FixedRateScheduler(1, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_send_time_does_not_drift_the_schedule(self):
+        due = []
+        for _ in range(5):
+            self.ticker.wait()
+            due.append(self.clock.now)
+            self.clock.now += 0.3  # time spent sending
+
+        self.assertEqual(due, [1000.0, 1001.0, 1002.0, 1003.0, 1004.0])
+        self.assertEqual(self.ticker.jitter.max, 0.0)
+
+    def test_late_tick_reports_jitter(self):
+        self.ticker.wait()
+        self.clock.now += 1.25
+
+        self.assertAlmostEqual(self.ticker.wait(), 0.25)
+        # the tick after that is back on the original grid
+        self.ticker.wait()
+        self.assertAlmostEqual(self.clock.now, 1002.0)
+        self.assertAlmostEqual(self.ticker.jitter.mean, 0.25 / 3)
+
+    def test_missed_ticks_are_skipped_not_bunched(self):
+        self.ticker.wait()
+        self.clock.now += 3.5
+
+        self.assertAlmostEqual(self.ticker.wait(), 0.5)
+        self.assertEqual(self.ticker.missed, 2)
+        self.ticker.wait()
+        self.assertAlmostEqual(self.clock.now, 1004.0)
+
+    def test_interval_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            scheduler.FixedRateScheduler(0)
+
+    def test_jitter_stats_reset(self):
+        stats = scheduler.JitterStats()
+        stats.add(0.1)
+        stats.add(0.3)
+        self.assertAlmostEqual(stats.mean, 0.2)
+        self.assertEqual(stats.max, 0.3)
+
+        stats.reset()
+        self.assertEqual((stats.count, stats.mean, stats.max), (0, 0.0, 0.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+import json
+import socket
+import time
+import unittest
+import urllib.error
+import urllib.request
+from unittest.mock import patch
+
+from common import stats
+
+
+class TestCounters(unittest.TestCase):
+
+    def setUp(self):
+        stats.reset()
+        self.addCleanup(stats.reset)
+
+    def test_incr_and_gauge(self):
+        stats.incr("messages")
+        stats.incr("messages", 2)
+        stats.gauge("db_latency_ms", 1.5)
+
+        self.assertEqual(stats.snapshot(), ({"messages": 3}, {"db_latency_ms": 1.5}))
+
+    @patch.dict('os.environ', {'STATS_HOST': ''})
+    def test_start_without_stats_host_is_a_no_op(self):
+        self.assertIsNone(stats.start("test-service"))
+        self.assertIsNone(stats.reporter())
+
+
+class TestHistograms(unittest.TestCase):
+
+    def setUp(self):
+        stats.reset()
+        self.addCleanup(stats.reset)
+
+    def test_observe_counts_per_bucket(self):
+        stats.observe("db_seconds", 0.001)  # on a bound: counted in that bucket (le)
+        stats.observe("db_seconds", 0.003)
+        stats.observe("db_seconds", 60)
+
+        buckets, total, count = stats.histograms()["db_seconds"]
+        self.assertEqual(count, 3)
+        self.assertAlmostEqual(total, 60.004)
+        self.assertEqual(buckets[0], 1)
+        self.assertEqual(buckets[stats.DEFAULT_BUCKETS.index(0.005)], 1)
+        self.assertEqual(buckets[-1], 1)
+
+    def test_timed_observes_also_when_the_block_raises(self):
+        with self.assertRaises(ValueError):
+            with stats.timed("parse_seconds"):
+                raise ValueError("bad xml")
+
+        self.assertEqual(stats.histograms()["parse_seconds"][2], 1)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        stats.reset()
+        self.addCleanup(stats.reset)
+
+    def test_render_metrics_in_prometheus_text_format(self):
+        stats.incr("acked", 3)
+        stats.gauge("queue_lag:order.created", 12)
+        stats.gauge("db_latency_ms", None)
+        stats.observe("publish_seconds", 0.02)
+
+        lines = stats.render_metrics("invoice-kassa-consumer").splitlines()
+
+        self.assertIn("# TYPE facturatie_acked_total counter", lines)
+        self.assertIn('facturatie_acked_total{service="invoice-kassa-consumer"} 3', lines)
+        self.assertIn('facturatie_queue_lag{service="invoice-kassa-consumer",queue="order.created"} 12', lines)
+        self.assertFalse(any("db_latency_ms" in line for line in lines))
+        self.assertIn("# TYPE facturatie_publish_seconds histogram", lines)
+        self.assertIn('facturatie_publish_seconds_bucket{service="invoice-kassa-consumer",le="0.01"} 0', lines)
+        self.assertIn('facturatie_publish_seconds_bucket{service="invoice-kassa-consumer",le="0.025"} 1', lines)
+        self.assertIn('facturatie_publish_seconds_bucket{service="invoice-kassa-consumer",le="+Inf"} 1', lines)
+        self.assertIn('facturatie_publish_seconds_count{service="invoice-kassa-consumer"} 1', lines)
+
+    def test_endpoint_serves_metrics_and_runs_probes(self):
+        server = stats.MetricsServer("user-update-providor", 0, host="127.0.0.1", probes={"poll_backlog": lambda: 7})
+        server.start()
+        self.addCleanup(server.stop)
+        url = f"http://127.0.0.1:{server.address[1]}"
+
+        with urllib.request.urlopen(url + "/metrics", timeout=5) as response:
+            body = response.read().decode()
+            self.assertTrue(response.headers["Content-Type"].startswith("text/plain"))
+        self.assertIn('facturatie_poll_backlog{service="user-update-providor"} 7', body)
+
+        with self.assertRaises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(url + "/", timeout=5)
+        self.assertEqual(error.exception.code, 404)
+
+    @patch.dict('os.environ', {'STATS_HOST': '', 'METRICS_PORT': '0'})
+    def test_start_with_metrics_port_serves_without_reporter(self):
+        self.addCleanup(setattr, stats, "_metrics_server", None)
+
+        self.assertIsNone(stats.start("heartbeat", probes={"poll_backlog": lambda: 1}))
+        server = stats._metrics_server
+        self.addCleanup(server.stop)
+        self.assertIn("poll_backlog", server.probes)
+        self.assertIsNone(stats.reporter())
+
+
+class TestStatsReporter(unittest.TestCase):
+
+    def setUp(self):
+        stats.reset()
+        self.addCleanup(stats.reset)
+
+    def test_report_runs_probes_and_sends_snapshot(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as receiver:
+            receiver.bind(("127.0.0.1", 0))
+            receiver.settimeout(5)
+            reporter = stats.StatsReporter(
+                "user-creation-consumer", "127.0.0.1", receiver.getsockname()[1],
+                probes={"db_latency_ms": lambda: 2.5}
+            )
+            self.addCleanup(reporter.stop)
+            stats.incr("messages", 7)
+
+            reporter.report()
+            payload = json.loads(receiver.recv(65536))
+
+        self.assertEqual(payload["service"], "user-creation-consumer")
+        self.assertEqual(payload["counters"], {"messages": 7})
+        self.assertEqual(payload["gauges"], {"db_latency_ms": 2.5})
+
+    def test_failing_probe_reports_none(self):
+        def broken():
+            raise RuntimeError("no database")
+
+        reporter = stats.StatsReporter("svc", "127.0.0.1", probes={"db_latency_ms": broken})
+        self.addCleanup(reporter.stop)
+
+        reporter.run_probes()
+
+        self.assertEqual(stats.snapshot()[1], {"db_latency_ms": None})
+
+    def test_every_reuses_the_result_until_the_interval_passed(self):
+        now = [0.0]
+        calls = []
+        probe = stats.every(300, lambda: calls.append(1) or len(calls), clock=lambda: now[0])
+
+        self.assertEqual([probe(), probe()], [1, 1])
+        now[0] = 299
+        self.assertEqual(probe(), 1)
+        now[0] = 300
+        self.assertEqual(probe(), 2)
+
+
+class TestStatsAggregator(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.aggregator = stats.StatsAggregator(clock=lambda: self.now)
+
+    def send(self, service, **counters):
+        self.aggregator.handle(json.dumps({
+            "service": service,
+            "interval": 5,
+            "counters": counters,
+            "gauges": {"queue_lag:q": 3},
+        }).encode())
+
+    def test_rates_from_consecutive_reports(self):
+        self.send("svc", messages=10)
+        self.now += 5
+        self.send("svc", messages=60)
+
+        service = self.aggregator.services()["svc"]
+        self.assertEqual(service.rates, {"messages": 10.0})
+        self.assertEqual(service.gauges, {"queue_lag:q": 3})
+
+    def test_restarted_service_counts_from_zero(self):
+        self.send("svc", messages=1000)
+        self.now += 5
+        self.send("svc", messages=25)
+
+        self.assertEqual(self.aggregator.services()["svc"].rates, {"messages": 5.0})
+
+    def test_service_goes_stale_after_missed_reports(self):
+        self.send("svc")
+        service = self.aggregator.services()["svc"]
+
+        self.assertTrue(service.is_fresh(self.now + 15))
+        self.assertFalse(service.is_fresh(self.now + 16))
+
+    def test_malformed_datagrams_are_ignored(self):
+        for data in (b"not json", b"{}", b"[1]"):
+            self.aggregator.handle(data)
+
+        self.assertEqual(self.aggregator.services(), {})
+
+    def test_receives_over_udp(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+            probe.bind(("127.0.0.1", 0))
+            port = probe.getsockname()[1]
+        aggregator = stats.StatsAggregator(port=port, host="127.0.0.1")
+        aggregator.listen()
+        self.addCleanup(aggregator.close)
+
+        reporter = stats.StatsReporter("svc", "127.0.0.1", port)
+        self.addCleanup(reporter.stop)
+        reporter.report()
+
+        deadline = time.monotonic() + 5
+        while "svc" not in aggregator.services() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertIn("svc", aggregator.services())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+from unittest.mock import patch
+
+from common import usermessage
+
+FULL_MESSAGE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<UserMessage>
+    <ActionType>CREATE</ActionType>
+    <UUID>2025-04-29T14:22:27.816332Z</UUID>
+    <TimeOfAction>2025-04-29T14:22:28.000000Z</TimeOfAction>
+    <EncryptedPassword>secure123</EncryptedPassword>
+    <FirstName>J\xc3\xa9r\xc3\xb4me</FirstName>
+    <LastName/>
+    <EmailAddress>jerome@example.com</EmailAddress>
+    <Business>
+        <BusinessName>Test &amp; Co</BusinessName>
+        <BTWNumber>BE0123456789</BTWNumber>
+    </Business>
+</UserMessage>"""
+
+
+class TestDecode(unittest.TestCase):
+
+    def test_extracts_fields_from_bytes(self):
+        message = usermessage.decode(FULL_MESSAGE)
+
+        self.assertEqual(message.action_type, "CREATE")
+        self.assertEqual(message.uuid, "2025-04-29T14:22:27.816332Z")
+        self.assertEqual(message.time_of_action, "2025-04-29T14:22:28.000000Z")
+        self.assertEqual(message.first_name, "Jérôme")
+        self.assertEqual(message.business_name, "Test & Co")
+        self.assertEqual(message.btw_number, "BE0123456789")
+        self.assertTrue(message.has_business)
+
+    def test_absent_and_empty_fields(self):
+        message = usermessage.decode(FULL_MESSAGE)
+
+        # Same distinction as findtext(): empty element -> "", missing element -> None
+        self.assertEqual(message.last_name, "")
+        self.assertIsNone(message.phone)
+        self.assertIsNone(message.real_address)
+        self.assertEqual(message.get("phone", ""), "")
+
+    def test_accepts_str(self):
+        message = usermessage.decode("<UserMessage><ActionType>DELETE</ActionType><UUID>x</UUID></UserMessage>")
+
+        self.assertEqual(message.action_type, "DELETE")
+        self.assertFalse(message.has_business)
+
+    def test_fields_outside_their_parent_are_ignored(self):
+        message = usermessage.decode(
+            b"<UserMessage><ActionType>CREATE</ActionType><UUID>x</UUID>"
+            b"<BusinessName>not in Business</BusinessName></UserMessage>"
+        )
+
+        self.assertIsNone(message.business_name)
+
+    def test_rejects_malformed_messages(self):
+        for body in (
+            b"invalid xml",
+            b"<UserMessage><ActionType>CREATE</ActionType>",
+            b"<Invoice><ActionType>CREATE</ActionType><UUID>x</UUID></Invoice>",
+            b"<UserMessage><ActionType>CREATE</ActionType></UserMessage>",
+        ):
+            with self.assertRaises(usermessage.MalformedMessage):
+                usermessage.decode(body)
+
+    def test_rejects_message_without_a_field_the_consumer_requires(self):
+        required = ("action_type", "uuid", "time_of_action", "password")
+        body = b"<UserMessage><ActionType>CREATE</ActionType><UUID>x</UUID><TimeOfAction>t</TimeOfAction></UserMessage>"
+
+        with self.assertRaises(usermessage.MalformedMessage):
+            usermessage.decode(body, required=required)
+        self.assertEqual(usermessage.decode(body).uuid, "x")
+        self.assertEqual(usermessage.decode(body.replace(b"</UserMessage>", b"<EncryptedPassword/></UserMessage>"), required=required).password, "")
+
+    def test_record_has_no_instance_dict(self):
+        message = usermessage.decode(FULL_MESSAGE)
+        with self.assertRaises(AttributeError):
+            message.unknown_field = 1
+
+    @unittest.skipIf(usermessage.lxml_etree is None, "lxml not installed")
+    def test_lxml_and_stdlib_agree(self):
+        fast = usermessage.decode(FULL_MESSAGE)
+        with patch.object(usermessage, 'lxml_etree', None):
+            slow = usermessage.decode(FULL_MESSAGE)
+
+        self.assertEqual(repr(fast), repr(slow))
+
+
+# Same cases without lxml, so the ElementTree fallback stays covered where lxml is installed
+class TestDecodeStdlib(TestDecode):
+
+    def setUp(self):
+        patcher = patch.object(usermessage, 'lxml_etree', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+import xml.etree.ElementTree as ET
+
+from common import xmlout
+from common.xmlout import Field, Group, Template
+
+TEMPLATE = Template("Message", [
+    Field("Name"),
+    Field("Note", optional=True),
+    Group("Business", [
+        Field("BusinessName", optional=True),
+        Field("VAT", optional=True),
+    ]),
+])
+
+
+# What the providers wrote with ElementTree for the same values
+def elementtree(values, attrib=None):
+    root = ET.Element("Message", attrib or {})
+    ET.SubElement(root, "Name").text = values.get("Name")
+    if values.get("Note"):
+        ET.SubElement(root, "Note").text = values["Note"]
+    if values.get("Business"):
+        business = ET.SubElement(root, "Business")
+        for tag in ("BusinessName", "VAT"):
+            if values.get(tag):
+                ET.SubElement(business, tag).text = values[tag]
+    return xmlout.XML_DECLARATION + ET.tostring(root, encoding="unicode")
+
+
+class TestTemplate(unittest.TestCase):
+
+    def assertSameAsElementTree(self, values):
+        self.assertEqual(TEMPLATE.render(values), elementtree(values))
+
+    def test_full_document(self):
+        self.assertSameAsElementTree({
+            "Name": "Jérôme",
+            "Note": "first order",
+            "Business": True,
+            "BusinessName": "Doe & Co",
+            "VAT": "BE0123456789",
+        })
+
+    def test_escaping(self):
+        self.assertSameAsElementTree({"Name": "a & b <c> \"d\" 'e'"})
+        self.assertEqual(xmlout.escape("<&>"), "&lt;&amp;&gt;")
+
+    def test_empty_mandatory_field_is_self_closing(self):
+        for value in (None, ""):
+            self.assertSameAsElementTree({"Name": value})
+        self.assertIn("<Name />", TEMPLATE.render({}))
+
+    def test_optional_fields_and_groups_are_left_out(self):
+        self.assertSameAsElementTree({"Name": "x", "Note": "", "BusinessName": "ignored without Business"})
+        self.assertNotIn("Business", TEMPLATE.render({"Name": "x", "BusinessName": "y"}))
+
+    def test_group_without_children(self):
+        self.assertSameAsElementTree({"Name": "x", "Business": True})
+
+    def test_attributes(self):
+        template = Template("Message", [Field("Name")], attrib={"service": "facturatie"})
+        values = {"Name": "x"}
+        self.assertEqual(template.render(values), elementtree(values, {"service": "facturatie"}))
+
+    def test_render_returns_str(self):
+        self.assertIsInstance(TEMPLATE.render({"Name": "x"}), str)
+
+    def test_non_string_values_are_rejected(self):
+        # ElementTree refuses these at serialization time as well
+        with self.assertRaises(TypeError):
+            TEMPLATE.render({"Name": 42})
+
+
+if __name__ == '__main__':
+    unittest.main()
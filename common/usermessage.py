@@ -0,0 +1,136 @@
+import threading
+import xml.etree.ElementTree as ET
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:  # optional: the stdlib parser is used when lxml is not installed
+    lxml_etree = None
+
+ROOT_TAG = "UserMessage"
+
+# Element path below <UserMessage> -> attribute on the decoded record.
+# This is the whole schema: add a field here and every consumer can read it.
+FIELDS = {
+    ("ActionType",): "action_type",
+    ("UUID",): "uuid",
+    ("TimeOfAction",): "time_of_action",
+    ("EncryptedPassword",): "password",
+    ("FirstName",): "first_name",
+    ("LastName",): "last_name",
+    ("PhoneNumber",): "phone",
+    ("EmailAddress",): "email",
+    ("Business", "BusinessName"): "business_name",
+    ("Business", "BusinessEmail"): "business_email",
+    ("Business", "RealAddress"): "real_address",
+    ("Business", "BTWNumber"): "btw_number",
+    ("Business", "FacturationAddress"): "facturation_address",
+}
+# Fields every message must carry; a consumer passes its own, longer list to decode()
+REQUIRED = ("action_type", "uuid")
+
+
+class MalformedMessage(ValueError):
+    pass
+
+
+# Decoded UserMessage. A field is None when its element is absent and "" when it is empty,
+# the same distinction ElementTree's findtext() made.
+class UserMessage:
+    __slots__ = tuple(FIELDS.values()) + ("has_business",)
+
+    def __init__(self):
+        for name in FIELDS.values():
+            setattr(self, name, None)
+        self.has_business = False
+
+    def get(self, name, default=None):
+        value = getattr(self, name)
+        return default if value is None else value
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"UserMessage({fields})"
+
+
+# FIELDS as a tag tree, e.g. {"UUID": "uuid", "Business": {"BusinessName": "business_name", ...}}
+def _compile(fields):
+    schema = {}
+    for path, name in fields.items():
+        node = schema
+        for tag in path[:-1]:
+            node = node.setdefault(tag, {})
+        node[path[-1]] = name
+    return schema
+
+
+SCHEMA = _compile(FIELDS)
+
+# lxml parsers must not be shared between threads (the consumers decode on several worker lanes)
+_local = threading.local()
+
+
+def _parse(body):
+    if lxml_etree is None:
+        return ET.fromstring(body)
+    parser = getattr(_local, "parser", None)
+    if parser is None:
+        parser = _local.parser = lxml_etree.XMLParser(resolve_entities=False, no_network=True)
+    return lxml_etree.fromstring(body, parser)
+
+
+# The two backends are fast at different things: ElementTree's findtext() on a plain tag is a
+# C loop, while lxml creates a Python proxy per element it touches, so there a single pass over
+# the children beats repeated lookups. Both only visit the tags in SCHEMA.
+def _extract_find(element, schema, message):
+    for tag, entry in schema.items():
+        if isinstance(entry, dict):
+            child = element.find(tag)
+            if child is not None:
+                if tag == "Business":
+                    message.has_business = True
+                _extract_find(child, entry, message)
+        else:
+            setattr(message, entry, element.findtext(tag))
+
+
+def _extract_iter(element, schema, message):
+    for child in element:
+        entry = schema.get(child.tag)
+        if entry is None:
+            continue
+        if isinstance(entry, dict):
+            if child.tag == "Business":
+                message.has_business = True
+            _extract_iter(child, entry, message)
+        # First occurrence wins, like find()
+        elif getattr(message, entry) is None:
+            setattr(message, entry, child.text or "")
+
+
+# Decodes a UserMessage straight from the AMQP body (bytes; str is accepted too), without
+# the body.decode() copy, into a slotted record driven by FIELDS.
+# Raises MalformedMessage for invalid XML, a different root element or when one of the `required`
+# fields is absent (an empty element still counts as present, like the old find().text lookups).
+def decode(body, required=REQUIRED):
+    try:
+        root = _parse(body)
+    except SyntaxError as e:  # ET.ParseError and lxml's XMLSyntaxError
+        raise MalformedMessage(f"Invalid XML: {e}") from e
+    except ValueError as e:  # lxml refuses str input that carries an encoding declaration
+        if not isinstance(body, str):
+            raise
+        return decode(body.encode("utf-8"), required)
+
+    if root.tag != ROOT_TAG:
+        raise MalformedMessage(f"Expected <{ROOT_TAG}>, got <{root.tag}>")
+
+    message = UserMessage()
+    if lxml_etree is None:
+        _extract_find(root, SCHEMA, message)
+    else:
+        _extract_iter(root, SCHEMA, message)
+
+    for name in required:
+        if getattr(message, name) is None:
+            raise MalformedMessage(f"{ROOT_TAG} without {name}")
+    return message
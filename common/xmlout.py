@@ -0,0 +1,78 @@
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+# optional fields are left out when their value is empty, like the `if user.get(...)` checks
+# the providers did around SubElement; other fields are always written (<Tag /> when empty)
+Field = namedtuple("Field", ["tag", "optional"], defaults=(False,))
+# Nested element; written when values[tag] is truthy
+Group = namedtuple("Group", ["tag", "fields"])
+
+
+# Same escaping as ElementTree uses for element text
+def escape(text):
+    if not isinstance(text, str):
+        raise TypeError(f"cannot serialize {text!r} (type {type(text).__name__})")
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+# Opening tag, closing tag and empty form of an element. The opening tag is rendered by
+# ElementTree once, so attribute quoting matches tostring() exactly.
+def _tags(tag, attrib=None):
+    empty = ET.tostring(ET.Element(tag, attrib or {}), encoding="unicode")
+    return empty[:-3] + ">", f"</{tag}>", empty
+
+
+# Message layout compiled to string fragments once; render() only looks values up, escapes
+# them and joins. Output is identical to building the same document with ElementTree and
+# prefixing XML_DECLARATION to ET.tostring(..., encoding='unicode'), and a str like that was.
+class Template:
+    def __init__(self, root, fields, attrib=None):
+        self.root = root
+        self._open, self._close, self._empty = _tags(root, attrib)
+        self._steps = self._compile(fields)
+
+    def _compile(self, fields):
+        steps = []
+        for field in fields:
+            if isinstance(field, Group):
+                steps.append((field.tag, True, _tags(field.tag), self._compile(field.fields)))
+            else:
+                steps.append((field.tag, field.optional, _tags(field.tag), None))
+        return steps
+
+    def _render(self, steps, values, parts):
+        for tag, optional, (open_tag, close_tag, empty_tag), children in steps:
+            value = values.get(tag)
+            if children is not None:
+                if not value:
+                    continue
+                start = len(parts)
+                parts.append(open_tag)
+                self._render(children, values, parts)
+                if len(parts) == start + 1:
+                    parts[start] = empty_tag
+                else:
+                    parts.append(close_tag)
+            elif value:
+                parts.append(open_tag)
+                parts.append(escape(value))
+                parts.append(close_tag)
+            elif not optional:
+                parts.append(empty_tag)
+
+    def render(self, values):
+        parts = [XML_DECLARATION, self._open]
+        self._render(self._steps, values, parts)
+        if len(parts) == 2:
+            parts[1] = self._empty
+        else:
+            parts.append(self._close)
+        return "".join(parts)
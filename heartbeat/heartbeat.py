@@ -1,9 +1,8 @@
-import pika
 import os
-import time
 import logging
 from datetime import datetime, timezone
 from dotenv import load_dotenv  # so python can read the .env file
+from common import rabbitmq, scheduler, stats
 
 # loading env variables from .env file
 load_dotenv()
@@ -12,24 +11,21 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# RabbitMQ connection setup with credentials from .env file
-def get_rabbitmq_connection():
-    try:
-        params = pika.ConnectionParameters(  # connection parameters
-            host=os.environ["RABBITMQ_HOST"], 
-            port=int(os.environ["RABBITMQ_PORT"]),
-            virtual_host="/",
-            credentials=pika.PlainCredentials(
-                os.environ["RABBITMQ_USER"],
-                os.environ["RABBITMQ_PASSWORD"]
-            ),
-            heartbeat=600,  # heartbeat interval
-            blocked_connection_timeout=300 # timeout for blocked connections
-        )
-        return pika.BlockingConnection(params)
-    except Exception as e:
-        logger.error(f"Fout bij verbinden met RabbitMQ: {e}")  # log error when connection fails
-        return None
+# Seconds between heartbeats; this is also the HeartBeatInterval advertised to the controlroom
+HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "1"))
+# Number of heartbeats between two jitter reports in the log
+JITTER_REPORT_EVERY = int(os.getenv("HEARTBEAT_JITTER_REPORT_EVERY", "60"))
+
+# Services whose stats (see common.stats) decide the Status; empty = every service that has reported
+EXPECTED_SERVICES = [name.strip() for name in os.getenv("HEARTBEAT_EXPECTED_SERVICES", "").split(",") if name.strip()]
+STATS_PORT = int(os.getenv("STATS_PORT", str(stats.DEFAULT_PORT)))
+# Above these the status is Degraded
+DB_LATENCY_DEGRADED_MS = float(os.getenv("HEARTBEAT_DB_LATENCY_DEGRADED_MS", "500"))
+QUEUE_LAG_DEGRADED = int(os.getenv("HEARTBEAT_QUEUE_LAG_DEGRADED", "1000"))
+ERROR_RATIO_DEGRADED = float(os.getenv("HEARTBEAT_ERROR_RATIO_DEGRADED", "0.1"))
+
+# Health metrics written into <Metadata> when the heartbeat has service stats
+METRICS = ("ServicesUp", "MessagesPerSecond", "ErrorsPerSecond", "QueueLag", "DbLatencyMs")
 
 
 # Convert dictionary to the specified XML format 
@@ -44,64 +40,164 @@ def dict_to_xml(log):
         <Metadata>
             <Version>{Version}</Version>
             <Host>{Host}</Host>
-            <Environment>{Environment}</Environment>
+            <Environment>{Environment}</Environment>{Metrics}
         </Metadata>
     </Heartbeat>
-    """.format(**log) 
+    """.format(**log, Metrics="".join(
+        f"\n            <{name}>{log[name]}</{name}>" for name in METRICS if name in log
+    ))
     return xml.strip()
 
 
-# Prepare heartbeat data
-def create_heartbeat_message():
+# Prepare heartbeat data; `health` (from evaluate_health) supplies the Status and metrics
+def heartbeat_data(interval=None, health=None):
+    interval = HEARTBEAT_INTERVAL if interval is None else interval
     # Define the heartbeat dictionary with necessary data
-    heartbeat_data = {
+    data = {
         "ServiceName": "Facturatie", # Example service name (can be adjusted)
-        "Status": "Online", # Example status (can be adjusted)
-        "Timestamp": datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ"),  # Current time in UTC
-        "HeartBeatInterval": "60",  # Interval in seconds (adjust as needed)
-        "Version": "1.0",  # Example version
+        "Status": "Online", # Online as long as no service stats say otherwise
+        "Timestamp": current_timestamp(),  # Current time in UTC
+        "HeartBeatInterval": f"{interval:g}",  # The interval the sender actually runs at
+        "Version": os.getenv("SERVICE_VERSION", "1.0"),
         "Host": os.environ["RABBITMQ_HOST"],  # Get the host from environment
-        "Environment": "Production"  # Define environment (can be adjusted)
+        "Environment": os.getenv("ENVIRONMENT", "Production")
+    }
+    if health:
+        data.update(health)
+    return data
+
+
+# Turns the latest report of every service into a Status plus metrics:
+# - Offline: none of the expected services reported recently
+# - Degraded: some are silent, or DB latency, queue lag or the error ratio is over its threshold
+# - Online: everything reported and is within limits (also when no stats are configured at all)
+def evaluate_health(services, now, expected=None):
+    expected = list(expected if expected is not None else EXPECTED_SERVICES) or sorted(services)
+    if not expected:
+        return {}
+
+    fresh = [services[name] for name in expected if name in services and services[name].is_fresh(now)]
+    messages = sum(service.rates.get("messages", 0) for service in fresh)
+    errors = sum(service.rates.get("errors", 0) for service in fresh)
+    queue_lag = sum(
+        value for service in fresh for name, value in service.gauges.items()
+        if name.startswith("queue_lag") and value is not None
+    )
+    latencies = [service.gauges.get("db_latency_ms", 0) for service in fresh]
+    db_down = None in latencies  # the probe failed: no database connection
+    db_latency = max((latency for latency in latencies if latency is not None), default=0)
+
+    if not fresh:
+        status = "Offline"
+    elif (
+        len(fresh) < len(expected)
+        or db_down
+        or db_latency > DB_LATENCY_DEGRADED_MS
+        or queue_lag > QUEUE_LAG_DEGRADED
+        or (errors and errors / (messages + errors) > ERROR_RATIO_DEGRADED)
+    ):
+        status = "Degraded"
+    else:
+        status = "Online"
+
+    return {
+        "Status": status,
+        "ServicesUp": f"{len(fresh)}/{len(expected)}",
+        "MessagesPerSecond": f"{messages:.2f}",
+        "ErrorsPerSecond": f"{errors:.2f}",
+        "QueueLag": str(int(queue_lag)),
+        "DbLatencyMs": f"{db_latency:.1f}",
     }
 
-    # Convert dictionary to XML
-    return dict_to_xml(heartbeat_data)
 
+def current_timestamp():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
 
-# Heartbeat to rabbitmq exchange
-def send_heartbeat():
-    connection = get_rabbitmq_connection()
 
-    if connection:
+def create_heartbeat_message():
+    # Convert dictionary to XML
+    return dict_to_xml(heartbeat_data())
+
+
+# The heartbeat XML rendered once; every tick only fills in the timestamp
+class HeartbeatMessage:
+    def __init__(self, data):
+        marker = "\0"
+        head, tail = dict_to_xml({**data, "Timestamp": marker}).split(marker)
+        self._head = head.encode("utf-8")
+        self._tail = tail.encode("utf-8")
+
+    def render(self, timestamp):
+        return self._head + timestamp.encode("ascii") + self._tail
+
+
+# Keeps one connection to RabbitMQ open and sends a heartbeat on a fixed-rate schedule.
+# The exchange belongs to the controlroom, so only the queue is declared (once per connection).
+# With an aggregator the health is re-evaluated every tick; the XML is only re-rendered when it changed.
+class HeartbeatSender:
+    def __init__(self, interval=None, publisher=None, ticker=None, aggregator=None):
+        self.interval = HEARTBEAT_INTERVAL if interval is None else interval
+        self.publisher = publisher or rabbitmq.Publisher(
+            exchange="heartbeat",  # The exchange we're using (can be find in confluence)
+            bindings=[("controlroom_heartbeat", None)],
+            confirm=False,  # a lost heartbeat is superseded by the next one
+            declare_exchange=False
+        )
+        self.ticker = ticker or scheduler.FixedRateScheduler(self.interval)
+        self.aggregator = aggregator
+        self.health = {}
+        self.message = HeartbeatMessage(heartbeat_data(self.interval))
+        self.failed = 0
+
+    def refresh_health(self):
+        health = evaluate_health(self.aggregator.services(), self.aggregator.now())
+        if health == self.health:
+            return
+        if health.get("Status") != self.health.get("Status"):
+            logger.info(f"Status {self.health.get('Status', 'Online')} -> {health.get('Status', 'Online')} ({health.get('ServicesUp', '0/0')} services up)")
+        self.health = health
+        self.message = HeartbeatMessage(heartbeat_data(self.interval, health))
+
+    def send(self):
+        if self.aggregator is not None:
+            self.refresh_health()
         try:
-            channel = connection.channel()
-
-            # Declare a queue (controlroom.heartbeat.ping)
-            channel.queue_declare(queue="controlroom_heartbeat", durable=True)  # Ensure queue durability
-
-            heartbeat_xml = create_heartbeat_message()  # Create heartbeat message
-
-            # Send message to the queue 'controlroom_heartbeat' (use appropriate routing key)
-            channel.basic_publish(
-                exchange="heartbeat",  # The exchange we're using (can be find in confluence)
-                routing_key="controlroom_heartbeat",  # Route to the correct queue
-                body=heartbeat_xml,
-                properties=pika.BasicProperties(
-                    delivery_mode=2  # Make the message persistent
-                )
-            )
-
-            logger.info("Heartbeat verzonden naar ControlRoom")  # Log message when heartbeat is sent
-            connection.close()
+            self.publisher.publish("controlroom_heartbeat", self.message.render(current_timestamp()))
+            logger.debug("Heartbeat verzonden naar ControlRoom")
+            return True
         except Exception as e:
+            self.failed += 1
             logger.error(f"Fout bij verzenden van heartbeat: {e}") # Log error when sending fails
-    else:
-        logger.error("Kan geen verbinding maken met RabbitMQ!") # Log error when connection fails
+            return False
+
+    # Logs how late the heartbeats went out since the previous report
+    def report(self):
+        jitter = self.ticker.jitter
+        logger.info(
+            f"Heartbeats: {jitter.count} sent every {self.interval:g}s, "
+            f"jitter avg {jitter.mean * 1000:.1f} ms / max {jitter.max * 1000:.1f} ms, "
+            f"{self.ticker.missed} missed, {self.failed} failed"
+        )
+        jitter.reset()
+
+    def run(self, ticks=None):
+        sent = 0
+        try:
+            while ticks is None or sent < ticks:
+                self.ticker.wait()
+                self.send()
+                sent += 1
+                if self.ticker.jitter.count >= JITTER_REPORT_EVERY:
+                    self.report()
+        finally:
+            self.publisher.close()
 
 
-# Main loop: each second send a heartbeat
+# Main loop: send a heartbeat every HEARTBEAT_INTERVAL seconds
 if __name__ == "__main__":
-    logger.info("Heartbeat sender gestart")
-    while True:
-        send_heartbeat() 
-        time.sleep(1)  # Send heartbeat every second (you can adjust the interval)
+    logger.info(f"Heartbeat sender gestart (interval {HEARTBEAT_INTERVAL:g}s)")
+    aggregator = stats.StatsAggregator(port=STATS_PORT)
+    aggregator.listen()
+    # Only the /metrics endpoint: the heartbeat is where the other services report to
+    stats.start("heartbeat")
+    HeartbeatSender(aggregator=aggregator).run()
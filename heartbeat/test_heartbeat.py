@@ -2,6 +2,7 @@ import pytest
 from unittest.mock import patch, MagicMock
 from datetime import datetime
 import heartbeat
+from common import scheduler, stats
 
 
 @pytest.fixture
@@ -15,19 +16,6 @@ def mock_env_vars():
         yield
 
 
-def test_get_rabbitmq_connection_success(mock_env_vars):
-    with patch("pika.BlockingConnection") as mock_connection:
-        connection = heartbeat.get_rabbitmq_connection()
-        assert connection is not None
-        mock_connection.assert_called_once()
-
-
-def test_get_rabbitmq_connection_failure(mock_env_vars):
-    with patch("pika.BlockingConnection", side_effect=Exception("Connection failed")):
-        connection = heartbeat.get_rabbitmq_connection()
-        assert connection is None
-
-
 def test_dict_to_xml_format():
     test_data = {
         "ServiceName": "TestService",
@@ -53,21 +41,136 @@ def test_create_heartbeat_message(mock_env_vars):
     assert "<Host>localhost</Host>" in xml_message
 
 
-def test_send_heartbeat_success(mock_env_vars):
-    mock_channel = MagicMock()
-    mock_connection = MagicMock()
-    mock_connection.channel.return_value = mock_channel
+def test_create_heartbeat_message_advertises_interval(mock_env_vars):
+    assert "<HeartBeatInterval>1</HeartBeatInterval>" in heartbeat.create_heartbeat_message()
+    assert "<HeartBeatInterval>0.5</HeartBeatInterval>" in heartbeat.dict_to_xml(heartbeat.heartbeat_data(0.5))
+
+
+def test_prerendered_message_matches_dict_to_xml(mock_env_vars):
+    data = heartbeat.heartbeat_data()
+    message = heartbeat.HeartbeatMessage(data)
+
+    assert message.render(data["Timestamp"]) == heartbeat.dict_to_xml(data).encode("utf-8")
+    assert b"<Timestamp>2025-05-24T12:00:00.000000Z</Timestamp>" in message.render("2025-05-24T12:00:00.000000Z")
+
+
+@pytest.fixture
+def sender(mock_env_vars):
+    ticker = MagicMock()
+    ticker.jitter = scheduler.JitterStats()
+    ticker.missed = 0
+    return heartbeat.HeartbeatSender(interval=1, publisher=MagicMock(), ticker=ticker)
+
+
+def test_send_heartbeat_success(sender):
+    assert sender.send() is True
+
+    routing_key, body = sender.publisher.publish.call_args[0]
+    assert routing_key == "controlroom_heartbeat"
+    assert b"<ServiceName>Facturatie</ServiceName>" in body
+
+
+def test_send_heartbeat_failure(sender):
+    sender.publisher.publish.side_effect = Exception("Connection failed")
+
+    with patch.object(heartbeat.logger, "error") as mock_log_error:
+        assert sender.send() is False
+        mock_log_error.assert_called_with("Fout bij verzenden van heartbeat: Connection failed")
+    assert sender.failed == 1
+
+
+def test_run_reuses_one_publisher(sender):
+    sender.run(ticks=3)
+
+    assert sender.ticker.wait.call_count == 3
+    assert sender.publisher.publish.call_count == 3
+    sender.publisher.close.assert_called_once()
+
+
+def test_run_reports_jitter(sender):
+    sender.ticker.wait.side_effect = lambda: sender.ticker.jitter.add(0.002)
+
+    with patch.object(heartbeat, "JITTER_REPORT_EVERY", 2), patch.object(heartbeat.logger, "info") as mock_log_info:
+        sender.run(ticks=4)
+
+    assert mock_log_info.call_count == 2
+    assert "jitter avg 2.0 ms / max 2.0 ms" in mock_log_info.call_args[0][0]
+    assert sender.ticker.jitter.count == 0
+
+
+def test_default_publisher_does_not_declare_foreign_exchange(mock_env_vars):
+    sender = heartbeat.HeartbeatSender(interval=1)
+
+    assert sender.publisher.exchange == "heartbeat"
+    assert sender.publisher.declare_exchange is False
+    assert sender.publisher.bindings == [("controlroom_heartbeat", None)]
+
+
+def fresh_service(name, messages=10.0, errors=0.0, db_latency_ms=2.0, queue_lag=0):
+    service = stats.ServiceStats(name)
+    service.update({"interval": 5, "counters": {}, "gauges": {"db_latency_ms": db_latency_ms, f"queue_lag:{name}": queue_lag}}, 100.0)
+    service.rates = {"messages": messages, "errors": errors}
+    return service
+
+
+def test_evaluate_health_online():
+    services = {name: fresh_service(name) for name in ("a", "b")}
+
+    health = heartbeat.evaluate_health(services, 101.0, expected=["a", "b"])
+
+    assert health == {
+        "Status": "Online",
+        "ServicesUp": "2/2",
+        "MessagesPerSecond": "20.00",
+        "ErrorsPerSecond": "0.00",
+        "QueueLag": "0",
+        "DbLatencyMs": "2.0",
+    }
+
+
+def test_evaluate_health_degraded():
+    assert heartbeat.evaluate_health({"a": fresh_service("a")}, 101.0, expected=["a", "b"])["Status"] == "Degraded"
+    for service in (
+        fresh_service("a", db_latency_ms=None),
+        fresh_service("a", db_latency_ms=900.0),
+        fresh_service("a", queue_lag=5000),
+        fresh_service("a", messages=1.0, errors=1.0),
+    ):
+        assert heartbeat.evaluate_health({"a": service}, 101.0, expected=["a"])["Status"] == "Degraded"
+
+
+def test_evaluate_health_offline_when_all_services_are_silent():
+    health = heartbeat.evaluate_health({"a": fresh_service("a")}, 200.0, expected=["a", "b"])
+
+    assert health["Status"] == "Offline"
+    assert health["ServicesUp"] == "0/2"
+
+
+def test_evaluate_health_without_stats():
+    assert heartbeat.evaluate_health({}, 100.0, expected=[]) == {}
+
+
+def test_metrics_are_written_in_metadata(mock_env_vars):
+    health = heartbeat.evaluate_health({"a": fresh_service("a")}, 101.0, expected=["a"])
+    xml_output = heartbeat.dict_to_xml(heartbeat.heartbeat_data(1, health))
+
+    assert "<Status>Online</Status>" in xml_output
+    assert "<Environment>Production</Environment>\n            <ServicesUp>1/1</ServicesUp>" in xml_output
+    assert "<DbLatencyMs>2.0</DbLatencyMs>\n        </Metadata>" in xml_output
 
-    with patch("heartbeat.get_rabbitmq_connection", return_value=mock_connection):
-        heartbeat.send_heartbeat()
 
-        mock_channel.queue_declare.assert_called_once_with(queue="controlroom_heartbeat", durable=True)
-        mock_channel.basic_publish.assert_called_once()
-        mock_connection.close.assert_called_once()
+def test_sender_rerenders_only_when_health_changes(sender):
+    services = {"a": fresh_service("a")}
+    sender.aggregator = MagicMock()
+    sender.aggregator.services.return_value = services
+    sender.aggregator.now.return_value = 101.0
 
+    sender.send()
+    message = sender.message
+    sender.send()
+    assert sender.message is message
 
-def test_send_heartbeat_failure(mock_env_vars):
-    with patch("heartbeat.get_rabbitmq_connection", return_value=None):
-        with patch.object(heartbeat.logger, "error") as mock_log_error:
-            heartbeat.send_heartbeat()
-            mock_log_error.assert_called_with("Kan geen verbinding maken met RabbitMQ!")
+    sender.aggregator.now.return_value = 200.0
+    sender.send()
+    body = sender.publisher.publish.call_args[0][1]
+    assert b"<Status>Offline</Status>" in body
@@ -1,15 +1,40 @@
 import hashlib
 import json
+import time
 import pika
 import os
 import logging
 import xml.etree.ElementTree as ET
 import mysql.connector
+from datetime import datetime
+from common import db, consumer, cache, stats, idempotency, retry
 
 # Logging instellen
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+BATCH_SIZE = int(os.getenv("INVOICE_BATCH_SIZE", "1"))
+BATCH_MAX_WAIT_MS = int(os.getenv("INVOICE_BATCH_MAX_WAIT_MS", "200"))
+
+# Client rows by UUID. Entries are dropped when a user consumer announces an update/delete,
+# and expire after CLIENT_CACHE_TTL seconds in case such a message is missed.
+client_cache = cache.TTLCache(
+    maxsize=int(os.getenv("CLIENT_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("CLIENT_CACHE_TTL", "60"))
+)
+
+# Orders already turned into an invoice, keyed by the invoice hash: a redelivered order is acked
+# without inserting a second invoice; see common/idempotency.py
+ledger = idempotency.Ledger("invoice-kassa-consumer")
+
+# An order can arrive before the user consumer created its client, so this one is retried
+class ClientNotFoundError(retry.TransientError, ValueError):
+    pass
+
+# Database connection from the shared pool
+def get_db_connection():
+    return db.get_connection()
+
 # first checking if the invoice already exists
 # no exception handling here because this is just to return something.
 # if the invoice already exists, it's checked later on in the create_invoice function
@@ -32,21 +57,22 @@ logger = logging.getLogger(__name__)
 # since the XSD provides us with the UUID of the user, we can use that to get the client_id
 # the client_id is necessary to insert the invoice into the database and to later send the email
 def get_client_by_uuid(uuid):
-    conn = mysql.connector.connect(
-        host=os.getenv("DB_HOST"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        database=os.getenv("DB_NAME")
-    )
+    cached = client_cache.get(uuid_key(uuid))
+    if cached is not None:
+        return cached
+
+    conn = get_db_connection()
     cursor = conn.cursor()
     try:
         cursor.execute("SELECT id, email, first_name, last_name, phone_cc, phone, company, company_vat, company_number, city, state, postcode, country, currency, address_1 FROM client WHERE timestamp = %s", (uuid,))
         result = cursor.fetchone()
         if result:
             logger.info(f"Client found for UUID: {uuid}, ID: {result[0]}, Email: {result[1]}")
-            return {'id': result[0], 'email': result[1], 'first_name': result[2], 'last_name': result[3], 'phone_cc': result[4], 'phone': result[5],
-                    'company': result[6], 'company_vat': result[7], 'company_number': result[8], 'city': result[9], 'state': result[10],
-                    'postcode': result[11], 'country': result[12], 'currency': result[13], 'address_1': result[14]}
+            client = {'id': result[0], 'email': result[1], 'first_name': result[2], 'last_name': result[3], 'phone_cc': result[4], 'phone': result[5],
+                      'company': result[6], 'company_vat': result[7], 'company_number': result[8], 'city': result[9], 'state': result[10],
+                      'postcode': result[11], 'country': result[12], 'currency': result[13], 'address_1': result[14]}
+            client_cache.set(uuid_key(uuid), client)
+            return client
         else:
             logger.warning(f"No client found for UUID: {uuid}")
             return None
@@ -54,6 +80,60 @@ def get_client_by_uuid(uuid):
         cursor.close()
         conn.close()
 
+CLIENT_COLUMNS = [
+    'id', 'email', 'first_name', 'last_name', 'phone_cc', 'phone', 'company', 'company_vat',
+    'company_number', 'city', 'state', 'postcode', 'country', 'currency', 'address_1'
+]
+
+# UUIDs are client.timestamp values; normalise them so "2025-04-29T14:22:27.816332Z" from the XML
+# and the datetime MySQL returns end up as the same dict key
+def uuid_key(value):
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value.strip().rstrip('Z'))
+        except ValueError:
+            return value
+    return value
+
+# Resolve all client UUIDs of a batch with one IN query; returns {uuid_key: client_info}
+def get_clients_by_uuids(uuids):
+    uuids = list(dict.fromkeys(uuids))
+    if not uuids:
+        return {}
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"SELECT timestamp, {', '.join(CLIENT_COLUMNS)} FROM client "
+            f"WHERE timestamp IN ({', '.join(['%s'] * len(uuids))})",
+            tuple(uuids)
+        )
+        return {uuid_key(row[0]): dict(zip(CLIENT_COLUMNS, row[1:])) for row in cursor.fetchall()}
+    finally:
+        cursor.close()
+        conn.close()
+
+# Cache-aware variant of get_clients_by_uuids: only the UUIDs that are not cached hit the database.
+# Unknown clients are not cached, so a client created right after its first order is still found.
+def resolve_clients(uuids):
+    clients = {}
+    misses = []
+    for uuid in uuids:
+        key = uuid_key(uuid)
+        if key in clients:
+            continue
+        cached = client_cache.get(key)
+        if cached is not None:
+            clients[key] = cached
+        elif uuid not in misses:
+            misses.append(uuid)
+
+    for key, client in get_clients_by_uuids(misses).items():
+        client_cache.set(key, client)
+        clients[key] = client
+    return clients
+
 # Parse the XML data
 def parse_invoice_xml(xml_data):
     try:
@@ -109,98 +189,87 @@ def generate_invoice_hash(data):
     
     return hashlib.sha256(hash_str.encode('utf-8')).hexdigest()
 
-def create_invoice(data):
-    client_info = get_client_by_uuid(data['uuid'])
-    if not client_info:
-        raise ValueError("Client not found for UUID: " + data['uuid'])
+# Insert one invoice and all of its items on an open cursor; the caller owns the transaction
+def insert_invoice(cursor, data, client_info, invoice_hash):
+    # Insert invoice
+    cursor.execute("""
+        INSERT INTO invoice (
+            client_id, hash, status, approved, created_at, buyer_email, buyer_first_name, 
+            buyer_last_name, buyer_phone_cc, buyer_phone, buyer_company, buyer_company_vat, 
+            buyer_company_number, buyer_city, buyer_state, buyer_zip, buyer_country, currency, buyer_address,
+            seller_company, seller_company_vat, seller_company_number, seller_address, seller_phone, seller_email
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 
+            %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 
+            %s, %s, %s, %s, %s)
+
+    """, (
+        client_info['id'],
+        invoice_hash,
+        'unpaid', # status is almost always unpaid. If this is not the case, the XSD must be changed
+        1,
+        data['date'],  # Use date from XML
+        client_info['email'],
+        client_info['first_name'],
+        client_info['last_name'],
+        client_info['phone_cc'],
+        client_info['phone'],
+        client_info['company'],
+        client_info['company_vat'],
+        client_info['company_number'],
+        client_info['city'],
+        client_info['state'],
+        client_info['postcode'],
+        client_info['country'],
+        client_info['currency'],
+        client_info['address_1'],
+        'E-XPO',
+        'BE4598792446749',
+        'E-XPO',
+        'Nijverheidskaai 170 Anderlecht 1070 België',
+        '+32 465 49 44 79',
+        'no.reply.expomail@gmail.com'
+
+    ))
+
+    invoice_id = cursor.lastrowid
 
-    client_id = client_info['id']
-    client_email = client_info['email']
-    client_first_name = client_info['first_name']
-    client_last_name = client_info['last_name']
-    client_phone_cc = client_info['phone_cc']
-    client_phone = client_info['phone']
-    client_company = client_info['company']
-    client_company_vat = client_info['company_vat']
-    client_company_number = client_info['company_number']
-    client_city = client_info['city']
-    client_state = client_info['state']
-    client_postcode = client_info['postcode']
-    client_country = client_info['country']
-    client_currency = client_info['currency']
-    client_address_1 = client_info['address_1']
+    # Insert all invoice items with a single multi-row INSERT instead of one statement per product
+    if data['products']:
+        values = []
+        for product in data['products']:
+            values.extend([invoice_id, product['quantity'], product['price'], product['name']])
+        cursor.execute(f"""
+            INSERT INTO invoice_item (
+                invoice_id, quantity, price, title, created_at
+            ) VALUES {", ".join(["(%s, %s, %s, %s, NOW())"] * len(data['products']))}
+        """, tuple(values))
 
+    return invoice_id
 
+# Returns False when the order was already invoiced (nothing is inserted then)
+def create_invoice(data, invoice_hash=None):
+    client_info = get_client_by_uuid(data['uuid'])
+    if not client_info:
+        raise ClientNotFoundError("Client not found for UUID: " + data['uuid'])
 
-    invoice_hash = generate_invoice_hash(data)
+    if invoice_hash is None:
+        invoice_hash = generate_invoice_hash(data)
 
     logger.info(f"Invoice hash generated: {invoice_hash}")
 
+    conn = get_db_connection()
+    cursor = conn.cursor()
     try:
-        conn = mysql.connector.connect(
-            host=os.getenv("DB_HOST"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD"),
-            database=os.getenv("DB_NAME")
-        )
-        cursor = conn.cursor()
+        # Recorded in the same transaction as the invoice, before the invoice tables are touched
+        if not ledger.claim(cursor, invoice_hash):
+            conn.rollback()
+            logger.info(f"Invoice with hash {invoice_hash} already exists, skipping duplicate order")
+            return False
 
-        # Insert invoice
-        cursor.execute("""
-            INSERT INTO invoice (
-                client_id, hash, status, approved, created_at, buyer_email, buyer_first_name, 
-                buyer_last_name, buyer_phone_cc, buyer_phone, buyer_company, buyer_company_vat, 
-                buyer_company_number, buyer_city, buyer_state, buyer_zip, buyer_country, currency, buyer_address,
-                seller_company, seller_company_vat, seller_company_number, seller_address, seller_phone, seller_email
-                ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, 
-                %s, %s, %s, %s, %s)
-
-        """, (
-            client_id,
-            invoice_hash,
-            'unpaid', # status is almost always unpaid. If this is not the case, the XSD must be changed
-            1,
-            data['date'],  # Use date from XML
-            client_email,
-            client_first_name,
-            client_last_name,
-            client_phone_cc,
-            client_phone,
-            client_company,
-            client_company_vat,
-            client_company_number,
-            client_city,
-            client_state,
-            client_postcode,
-            client_country,
-            client_currency,
-            client_address_1,
-            'E-XPO',
-            'BE4598792446749',
-            'E-XPO',
-            'Nijverheidskaai 170 Anderlecht 1070 België',
-            '+32 465 49 44 79',
-            'no.reply.expomail@gmail.com'
-
-        ))
-
-        invoice_id = cursor.lastrowid
-
-        # Insert invoice items
-        for product in data['products']:
-            cursor.execute("""
-                INSERT INTO invoice_item (
-                    invoice_id, quantity, price, title, created_at
-                ) VALUES (%s, %s, %s, %s, NOW())
-            """, (
-                invoice_id,
-                product['quantity'],
-                product['price'],
-                product['name']
-            ))
+        insert_invoice(cursor, data, client_info, invoice_hash)
 
         conn.commit()
+        ledger.remember(invoice_hash)
         logger.info(f"Invoice inserted with hash {invoice_hash}")
         return True
     except Exception as e:
@@ -211,17 +280,122 @@ def create_invoice(data):
         cursor.close()
         conn.close()
 
+# Batch mode: ingest a group of order messages with one client lookup and one commit.
+# Every invoice gets its own savepoint, so one bad order is rolled back on its own and
+# nacked while the rest of the batch is still committed and acked.
+def on_batch(channel, deliveries):
+    parsed = []
+    for delivery in deliveries:
+        method, properties, body = delivery
+        try:
+            with stats.timed("parse_seconds"):
+                data = parse_invoice_xml(body.decode())
+        except Exception as e:
+            logger.error(f"Processing error: {e}")
+            retry.reject(channel, method, properties, body, e)
+            continue
+        data['hash'] = generate_invoice_hash(data)
+        if ledger.is_duplicate(data['hash']):
+            logger.info(f"Invoice with hash {data['hash']} already exists, skipping duplicate order")
+            consumer.ack(channel, method.delivery_tag)
+            continue
+        parsed.append((delivery, data))
+    if not parsed:
+        return
+
+    # The client lookup and the batch transaction are observed as one db_seconds sample
+    db_started = time.perf_counter()
+    try:
+        clients = resolve_clients([data['uuid'] for _, data in parsed])
+    except Exception as e:
+        logger.error(f"Client lookup for invoice batch failed: {e}")
+        for (method, properties, body), _ in parsed:
+            retry.reject(channel, method, properties, body, e)
+        return
+
+    succeeded = []
+    duplicates = []
+    failed = []  # (delivery, error)
+    hashes = []
+    conn = cursor = None
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        for delivery, data in parsed:
+            client_info = clients.get(uuid_key(data['uuid']))
+            if not client_info:
+                logger.error(f"Processing error: Client not found for UUID: {data['uuid']}")
+                failed.append((delivery, ClientNotFoundError("Client not found for UUID: " + data['uuid'])))
+                continue
+
+            invoice_hash = data['hash']
+            cursor.execute("SAVEPOINT invoice")
+            try:
+                # Also catches the same order twice in one batch
+                if not ledger.claim(cursor, invoice_hash):
+                    cursor.execute("ROLLBACK TO SAVEPOINT invoice")
+                    logger.info(f"Invoice with hash {invoice_hash} already exists, skipping duplicate order")
+                    duplicates.append(delivery)
+                    continue
+                insert_invoice(cursor, data, client_info, invoice_hash)
+                cursor.execute("RELEASE SAVEPOINT invoice")
+                succeeded.append(delivery)
+                hashes.append(invoice_hash)
+            except Exception as e:
+                logger.error(f"Error creating invoice: {e}")
+                cursor.execute("ROLLBACK TO SAVEPOINT invoice")
+                failed.append((delivery, e))
+
+        conn.commit()
+        for invoice_hash in hashes:
+            ledger.remember(invoice_hash)
+        logger.info(f"Invoice batch committed: {len(succeeded)} inserted, {len(duplicates)} duplicates, {len(failed)} failed")
+    except Exception as e:
+        logger.error(f"Invoice batch failed: {e}")
+        if conn is not None:
+            try:
+                conn.rollback()
+            except Exception as rollback_error:
+                logger.error(f"Rollback of invoice batch failed: {rollback_error}")
+        # Nothing was committed: every delivery that is not settled yet is rejected exactly once.
+        # Raising instead would make the runtime reject the whole batch, including the ones
+        # acked above, and a tag settled twice closes the channel.
+        settled = {id(delivery) for delivery in duplicates} | {id(delivery) for delivery, _ in failed}
+        failed.extend((delivery, e) for delivery, _ in parsed if id(delivery) not in settled)
+        succeeded = []
+    finally:
+        if cursor is not None:
+            cursor.close()
+        if conn is not None:
+            conn.close()
+        stats.observe("db_seconds", time.perf_counter() - db_started)
+
+    for method, _, _ in succeeded + duplicates:
+        consumer.ack(channel, method.delivery_tag)
+    for (method, properties, body), error in failed:
+        retry.reject(channel, method, properties, body, error)
+
 # Callback functie
 def on_message(channel, method, properties, body):
     try:
         logger.info(f"Message received via {method.routing_key}")
-        invoice_data = parse_invoice_xml(body.decode())
+        with stats.timed("parse_seconds"):
+            invoice_data = parse_invoice_xml(body.decode())
+
+        # Redelivered order already handled by this process: ack without touching the database
+        invoice_hash = generate_invoice_hash(invoice_data)
+        if ledger.is_duplicate(invoice_hash):
+            logger.info(f"Invoice with hash {invoice_hash} already exists, skipping duplicate order")
+            consumer.ack(channel, method.delivery_tag)
+            return
 
-        create_invoice(invoice_data)
-        channel.basic_ack(method.delivery_tag)
+        with stats.timed("db_seconds"):
+            create_invoice(invoice_data, invoice_hash)
+        consumer.ack(channel, method.delivery_tag)
     except Exception as e:
         logger.error(f"Processing error: {e}")
-        channel.basic_nack(method.delivery_tag, requeue=False)
+        # Transient failures go to a retry queue, the rest to the DLQ (see common/retry.py)
+        retry.reject(channel, method, properties, body, e)
 
 def start_consumer():
     connection = pika.BlockingConnection(pika.ConnectionParameters(
@@ -233,16 +407,27 @@ def start_consumer():
         )
     ))
     channel = connection.channel()
+    try:
+        ledger.initialize()
+    except Exception as e:
+        logger.error(f"Idempotency ledger initialization failed: {e}")
+    # Throughput, queue lag and DB latency for the heartbeat (only when STATS_HOST is set)
+    stats.start("invoice-kassa-consumer", probes={"db_latency_ms": db.ping_latency_ms})
+    # Prefetch + worker lanes so DB work runs off the pika I/O thread.
+    # With INVOICE_BATCH_SIZE > 1 orders are micro-batched into one transaction instead.
+    if BATCH_SIZE > 1:
+        runtime = consumer.BatchingRuntime(on_batch, batch_size=BATCH_SIZE, max_wait=BATCH_MAX_WAIT_MS / 1000)
+    else:
+        runtime = consumer.ConsumerRuntime(on_message)
 
     try:
+        # Drop cached client rows as soon as a user consumer changed or deleted them
+        cache.subscribe_invalidations(channel, lambda uuid: client_cache.invalidate(uuid_key(uuid)))
+
         queues = ['order.created']
         for queue in queues:
             channel.queue_declare(queue=queue, durable=True)
-            channel.basic_consume(
-                queue=queue,
-                on_message_callback=on_message,
-                auto_ack=False
-            )
+            runtime.consume(channel, queue)
 
         logger.info("Wachten op facturatieberichten...")
         channel.start_consuming()
@@ -250,6 +435,7 @@ def start_consumer():
     except KeyboardInterrupt:
         logger.info("Stopping consumer...")
         channel.stop_consuming()
+        runtime.shutdown(connection)
         connection.close()
     except Exception as e:
         logger.error(f"Consumer failed: {e}")
@@ -5,19 +5,36 @@ import xml.etree.ElementTree as ET
 from unittest.mock import patch, MagicMock
 import os
 import logging
+from datetime import datetime
 from invoice_kassa_consumer import ( 
     parse_invoice_xml,
     generate_invoice_hash,
     get_client_by_uuid,
     create_invoice,
     on_message,
+    on_batch,
+    get_clients_by_uuids,
+    uuid_key,
+    resolve_clients,
+    client_cache,
+    ledger,
     start_consumer
 )
+from common import retry
+from common.db import PoolTimeout
 
 # Setup logging for tests
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+@pytest.fixture(autouse=True)
+def clear_client_cache():
+    client_cache.clear()
+    ledger.clear()
+    yield
+    client_cache.clear()
+    ledger.clear()
+
 @pytest.fixture
 def sample_xml_data():
     return """<?xml version="1.0" encoding="UTF-8"?>
@@ -99,7 +116,7 @@ def test_generate_invoice_hash(sample_invoice_data):
     )
     assert hash_result == expected_hash.hexdigest()
 
-@patch('invoice_kassa_consumer.mysql.connector.connect')
+@patch('invoice_kassa_consumer.get_db_connection')
 def test_get_client_by_uuid_success(mock_connect, sample_client_info):
     """Test successful client lookup by UUID"""
     # Setup mock database connection
@@ -116,7 +133,7 @@ def test_get_client_by_uuid_success(mock_connect, sample_client_info):
         (uuid,)
     )
 
-@patch('invoice_kassa_consumer.mysql.connector.connect')
+@patch('invoice_kassa_consumer.get_db_connection')
 def test_get_client_by_uuid_not_found(mock_connect):
     """Test client lookup when UUID doesn't exist"""
     mock_cursor = MagicMock()
@@ -129,7 +146,7 @@ def test_get_client_by_uuid_not_found(mock_connect):
     assert result is None
 
 @patch('invoice_kassa_consumer.get_client_by_uuid')
-@patch('invoice_kassa_consumer.mysql.connector.connect')
+@patch('invoice_kassa_consumer.get_db_connection')
 def test_create_invoice_success(mock_connect, mock_get_client, sample_invoice_data, sample_client_info):
     """Test successful invoice creation"""
     # Setup mocks
@@ -152,6 +169,18 @@ def test_create_invoice_client_not_found(mock_get_client, sample_invoice_data):
     with pytest.raises(ValueError, match="Client not found for UUID:"):
         create_invoice(sample_invoice_data)
 
+@patch('invoice_kassa_consumer.get_client_by_uuid')
+@patch('invoice_kassa_consumer.get_db_connection')
+def test_create_invoice_pool_timeout_is_retried(mock_connect, mock_get_client, sample_invoice_data, sample_client_info):
+    """A database outage surfaces as the pool error itself, so the order goes to a retry queue"""
+    mock_get_client.return_value = sample_client_info
+    mock_connect.side_effect = PoolTimeout("no connection available")
+
+    with pytest.raises(PoolTimeout) as raised:
+        create_invoice(sample_invoice_data)
+
+    assert retry.is_transient(raised.value)
+
 @patch('invoice_kassa_consumer.parse_invoice_xml')
 @patch('invoice_kassa_consumer.create_invoice')
 def test_on_message_success(mock_create_invoice, mock_parse, sample_invoice_data):
@@ -168,7 +197,7 @@ def test_on_message_success(mock_create_invoice, mock_parse, sample_invoice_data
     on_message(mock_channel, mock_method, mock_properties, body)
     
     mock_parse.assert_called_once_with(body.decode())
-    mock_create_invoice.assert_called_once_with(sample_invoice_data)
+    mock_create_invoice.assert_called_once_with(sample_invoice_data, generate_invoice_hash(sample_invoice_data))
     mock_channel.basic_ack.assert_called_once_with(mock_method.delivery_tag)
 
 @patch('invoice_kassa_consumer.parse_invoice_xml')
@@ -206,4 +235,249 @@ def test_start_consumer(mock_connection):
     mock_channel.queue_declare.assert_called()
     mock_channel.basic_consume.assert_called()
     mock_channel.stop_consuming.assert_called_once()
-    mock_connection.return_value.close.assert_called_once()
\ No newline at end of file
+    mock_connection.return_value.close.assert_called_once()
+
+def make_order_xml(uuid):
+    return f"""<Invoice>
+    <UUID>{uuid}</UUID>
+    <Date>2023-05-15T12:00:00Z</Date>
+    <Products>
+        <Product><ProductNR>P001</ProductNR><Quantity>2</Quantity><UnitPrice>19.99</UnitPrice><ProductNaam>A</ProductNaam></Product>
+        <Product><ProductNR>P002</ProductNR><Quantity>1</Quantity><UnitPrice>5.00</UnitPrice><ProductNaam>B</ProductNaam></Product>
+    </Products>
+</Invoice>""".encode()
+
+@patch('invoice_kassa_consumer.get_db_connection')
+def test_create_invoice_inserts_items_in_one_statement(mock_get_db, sample_invoice_data, sample_client_info):
+    """All products of an order go into invoice_item with a single multi-row INSERT"""
+    mock_cursor = MagicMock()
+    mock_get_db.return_value.cursor.return_value = mock_cursor
+    mock_cursor.lastrowid = 42
+    sample_invoice_data['products'].append({'product_id': 'P002', 'quantity': '1', 'price': '5.00', 'name': 'Other'})
+
+    with patch('invoice_kassa_consumer.get_client_by_uuid', return_value=sample_client_info):
+        create_invoice(sample_invoice_data)
+
+    # idempotency ledger, invoice, items
+    assert mock_cursor.execute.call_count == 3
+    sql, params = mock_cursor.execute.call_args[0]
+    assert "(%s, %s, %s, %s, NOW()), (%s, %s, %s, %s, NOW())" in sql
+    assert params == (42, '2', '19.99', 'Test Product', 42, '1', '5.00', 'Other')
+
+@patch('invoice_kassa_consumer.get_db_connection')
+def test_get_clients_by_uuids(mock_get_db, sample_client_info):
+    """Client UUIDs of a batch are resolved with one IN query"""
+    mock_cursor = MagicMock()
+    mock_get_db.return_value.cursor.return_value = mock_cursor
+    mock_cursor.fetchall.return_value = [
+        (datetime(2025, 4, 29, 14, 22, 27, 816332),) + tuple(sample_client_info.values())
+    ]
+
+    clients = get_clients_by_uuids(['2025-04-29T14:22:27.816332Z', '2025-04-29T14:22:27.816332Z', '2025-01-01T00:00:00Z'])
+
+    sql, params = mock_cursor.execute.call_args[0]
+    assert "WHERE timestamp IN (%s, %s)" in sql
+    assert len(params) == 2
+    assert clients[uuid_key('2025-04-29T14:22:27.816332Z')] == sample_client_info
+
+@patch('invoice_kassa_consumer.get_db_connection')
+@patch('invoice_kassa_consumer.get_clients_by_uuids')
+def test_on_batch_acks_and_nacks_individually(mock_get_clients, mock_get_db, sample_client_info):
+    """One commit for the batch; unknown clients and bad XML are nacked, the rest acked"""
+    known = '2025-04-29T14:22:27.816332Z'
+    mock_get_clients.return_value = {uuid_key(known): sample_client_info}
+    mock_cursor = MagicMock()
+    mock_get_db.return_value.cursor.return_value = mock_cursor
+
+    deliveries = [
+        (MagicMock(delivery_tag=1), None, make_order_xml(known)),
+        (MagicMock(delivery_tag=2), None, make_order_xml('2025-01-01T00:00:00Z')),
+        (MagicMock(delivery_tag=3), None, b"not xml"),
+        (MagicMock(delivery_tag=4), None, make_order_xml(known)),
+    ]
+    mock_channel = MagicMock()
+
+    on_batch(mock_channel, deliveries)
+
+    mock_get_clients.assert_called_once_with([known, '2025-01-01T00:00:00Z'])
+    mock_get_db.return_value.commit.assert_called_once()
+    executed = [c[0][0] for c in mock_cursor.execute.call_args_list]
+    assert executed.count("SAVEPOINT invoice") == 2
+    assert [c[0][0] for c in mock_channel.basic_ack.call_args_list] == [1, 4]
+    assert sorted(c[0][0] for c in mock_channel.basic_nack.call_args_list) == [2, 3]
+
+@patch('invoice_kassa_consumer.get_db_connection')
+@patch('invoice_kassa_consumer.insert_invoice')
+@patch('invoice_kassa_consumer.get_clients_by_uuids')
+def test_on_batch_rolls_back_single_failed_invoice(mock_get_clients, mock_insert, mock_get_db, sample_client_info):
+    """A failing invoice is rolled back to its savepoint without losing the others"""
+    known = '2025-04-29T14:22:27.816332Z'
+    mock_get_clients.return_value = {uuid_key(known): sample_client_info}
+    mock_insert.side_effect = [Exception("bad row"), 7]
+    mock_cursor = MagicMock()
+    mock_get_db.return_value.cursor.return_value = mock_cursor
+    mock_channel = MagicMock()
+
+    on_batch(mock_channel, [
+        (MagicMock(delivery_tag=1), None, make_order_xml(known)),
+        (MagicMock(delivery_tag=2), None, make_order_xml(known)),
+    ])
+
+    mock_cursor.execute.assert_any_call("ROLLBACK TO SAVEPOINT invoice")
+    mock_get_db.return_value.commit.assert_called_once()
+    mock_channel.basic_nack.assert_called_once_with(1, requeue=False)
+    mock_channel.basic_ack.assert_called_once_with(2)
+
+@patch('invoice_kassa_consumer.get_db_connection')
+@patch('invoice_kassa_consumer.get_clients_by_uuids')
+def test_on_batch_commit_failure_nacks_all(mock_get_clients, mock_get_db, sample_client_info):
+    """If the batch commit fails nothing is acked"""
+    known = '2025-04-29T14:22:27.816332Z'
+    mock_get_clients.return_value = {uuid_key(known): sample_client_info}
+    mock_get_db.return_value.commit.side_effect = Exception("lost connection")
+    mock_channel = MagicMock()
+
+    on_batch(mock_channel, [(MagicMock(delivery_tag=1), None, make_order_xml(known))])
+
+    mock_get_db.return_value.rollback.assert_called_once()
+    mock_channel.basic_ack.assert_not_called()
+    mock_channel.basic_nack.assert_called_once_with(1, requeue=False)
+
+@patch('invoice_kassa_consumer.get_db_connection')
+@patch('invoice_kassa_consumer.get_clients_by_uuids')
+def test_on_batch_connection_failure_settles_each_delivery_once(mock_get_clients, mock_get_db, sample_client_info):
+    """Deliveries acked or nacked before the database was reached are not rejected a second time"""
+    known = '2025-04-29T14:22:27.816332Z'
+    mock_get_clients.return_value = {uuid_key(known): sample_client_info}
+    mock_get_db.side_effect = PoolTimeout("no connection available")
+    mock_channel = MagicMock()
+
+    on_batch(mock_channel, [
+        (MagicMock(delivery_tag=1), None, b"not xml"),
+        (MagicMock(delivery_tag=2), None, make_order_xml(known)),
+        (MagicMock(delivery_tag=3), None, make_order_xml('2025-01-01T00:00:00Z')),
+    ])
+
+    mock_channel.basic_ack.assert_not_called()
+    assert sorted(c[0][0] for c in mock_channel.basic_nack.call_args_list) == [1, 2, 3]
+
+@patch('invoice_kassa_consumer.get_db_connection')
+def test_create_invoice_skips_duplicate_order(mock_get_db, sample_invoice_data, sample_client_info):
+    """An order whose hash is already in the idempotency ledger inserts no second invoice"""
+    mock_cursor = MagicMock()
+    mock_cursor.rowcount = 0  # INSERT IGNORE into processed_messages hit the unique key
+    mock_get_db.return_value.cursor.return_value = mock_cursor
+
+    with patch('invoice_kassa_consumer.get_client_by_uuid', return_value=sample_client_info):
+        assert create_invoice(sample_invoice_data) is False
+
+    mock_cursor.execute.assert_called_once()
+    assert "processed_messages" in mock_cursor.execute.call_args[0][0]
+    mock_get_db.return_value.rollback.assert_called_once()
+    mock_get_db.return_value.commit.assert_not_called()
+
+@patch('invoice_kassa_consumer.get_db_connection')
+@patch('invoice_kassa_consumer.get_client_by_uuid')
+def test_on_message_acks_redelivery_without_database(mock_get_client, mock_get_db, sample_xml_data, sample_client_info):
+    """Once an order is invoiced, a redelivery is acked from memory"""
+    mock_get_client.return_value = sample_client_info
+    mock_get_db.return_value.cursor.return_value.rowcount = 1
+    mock_channel = MagicMock()
+
+    on_message(mock_channel, MagicMock(delivery_tag=1), None, sample_xml_data.encode())
+    on_message(mock_channel, MagicMock(delivery_tag=2), None, sample_xml_data.encode())
+
+    assert mock_get_db.call_count == 1
+    assert mock_get_client.call_count == 1
+    assert [c[0][0] for c in mock_channel.basic_ack.call_args_list] == [1, 2]
+    mock_channel.basic_nack.assert_not_called()
+
+@patch('invoice_kassa_consumer.get_db_connection')
+@patch('invoice_kassa_consumer.insert_invoice')
+@patch('invoice_kassa_consumer.get_clients_by_uuids')
+def test_on_batch_acks_duplicates_without_inserting(mock_get_clients, mock_insert, mock_get_db, sample_client_info):
+    """Orders already in the ledger are rolled back to their savepoint and acked"""
+    known = '2025-04-29T14:22:27.816332Z'
+    mock_get_clients.return_value = {uuid_key(known): sample_client_info}
+    mock_cursor = MagicMock()
+    mock_get_db.return_value.cursor.return_value = mock_cursor
+    # Only the ledger INSERT IGNORE reads rowcount: the first order is new, the second a duplicate
+    type(mock_cursor).rowcount = property(lambda self, counts=iter([1, 0]): next(counts))
+    mock_channel = MagicMock()
+
+    on_batch(mock_channel, [
+        (MagicMock(delivery_tag=1), None, make_order_xml(known)),
+        (MagicMock(delivery_tag=2), None, make_order_xml(known)),
+    ])
+
+    mock_insert.assert_called_once()
+    mock_cursor.execute.assert_any_call("ROLLBACK TO SAVEPOINT invoice")
+    assert [c[0][0] for c in mock_channel.basic_ack.call_args_list] == [1, 2]
+    mock_channel.basic_nack.assert_not_called()
+
+    # Both are known now: a redelivered batch never reaches the database
+    mock_get_db.reset_mock()
+    on_batch(mock_channel, [(MagicMock(delivery_tag=3), None, make_order_xml(known))])
+    mock_get_db.assert_not_called()
+    mock_channel.basic_ack.assert_called_with(3)
+
+@patch('invoice_kassa_consumer.get_clients_by_uuids')
+def test_on_batch_retries_order_for_unknown_client(mock_get_clients):
+    """An order can arrive before its client exists: it goes to a retry queue instead of being dropped"""
+    mock_get_clients.return_value = {}
+    retry.register("ctag-orders", retry.RetryTopology("order.created", attempts=3, delay=5, backoff=3))
+    mock_channel = MagicMock()
+    try:
+        with patch('invoice_kassa_consumer.get_db_connection'):
+            on_batch(mock_channel, [(MagicMock(delivery_tag=1, consumer_tag="ctag-orders"), None, make_order_xml('2025-01-01T00:00:00Z'))])
+    finally:
+        retry._topologies.clear()
+
+    assert mock_channel.basic_publish.call_args.kwargs["routing_key"] == "order.created.retry.5000ms"
+    mock_channel.basic_ack.assert_called_once_with(1)
+    mock_channel.basic_nack.assert_not_called()
+
+@patch('invoice_kassa_consumer.get_db_connection')
+def test_get_client_by_uuid_uses_cache(mock_connect, sample_client_info):
+    """A second lookup for the same client does not touch the database"""
+    mock_cursor = MagicMock()
+    mock_connect.return_value.cursor.return_value = mock_cursor
+    mock_cursor.fetchone.return_value = tuple(sample_client_info.values())
+
+    assert get_client_by_uuid('2025-04-29T14:22:27.816332Z') == sample_client_info
+    assert get_client_by_uuid('2025-04-29T14:22:27.816332Z') == sample_client_info
+
+    mock_connect.assert_called_once()
+
+@patch('invoice_kassa_consumer.get_clients_by_uuids')
+def test_resolve_clients_only_queries_misses(mock_get_clients, sample_client_info):
+    """Cached clients are served from memory, unknown ones are looked up and not cached"""
+    cached = '2025-04-29T14:22:27.816332Z'
+    client_cache.set(uuid_key(cached), sample_client_info)
+    mock_get_clients.return_value = {}
+
+    clients = resolve_clients([cached, '2025-01-01T00:00:00Z', '2025-01-01T00:00:00Z'])
+
+    mock_get_clients.assert_called_once_with(['2025-01-01T00:00:00Z'])
+    assert clients == {uuid_key(cached): sample_client_info}
+    assert client_cache.get(uuid_key('2025-01-01T00:00:00Z')) is None
+
+@patch('invoice_kassa_consumer.pika.BlockingConnection')
+def test_start_consumer_subscribes_to_invalidations(mock_connection, sample_client_info):
+    """Invalidation messages remove the client from the cache"""
+    mock_channel = MagicMock()
+    mock_connection.return_value.channel.return_value = mock_channel
+    mock_channel.start_consuming.side_effect = KeyboardInterrupt()
+    client_cache.set(uuid_key('2025-04-29T14:22:27.816332Z'), sample_client_info)
+
+    with patch.dict(os.environ, {
+        'RABBITMQ_HOST': 'localhost',
+        'RABBITMQ_PORT': '5672',
+        'RABBITMQ_USER': 'guest',
+        'RABBITMQ_PASSWORD': 'guest'
+    }), patch('invoice_kassa_consumer.cache.subscribe_invalidations') as mock_subscribe:
+        start_consumer()
+
+    on_invalidate = mock_subscribe.call_args[0][1]
+    on_invalidate('2025-04-29T14:22:27.816332Z')
+    assert client_cache.get(uuid_key('2025-04-29T14:22:27.816332Z')) is None
@@ -1,8 +1,7 @@
-import pika
 import os
-import xml.etree.ElementTree as ET
 import logging
 import mysql.connector
+from common import db, rabbitmq, scheduler, migrations, xmlout, stats, lease
 import time
 
 logging.basicConfig(
@@ -11,174 +10,179 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-def get_db_connection():
-    return mysql.connector.connect(
-        host=os.environ["DB_HOST"],
-        user=os.environ["DB_USER"],
-        password=os.environ["DB_PASSWORD"],
-        database=os.environ["DB_NAME"],
-    )
-
-def get_invoices():
-    conn= get_db_connection()
-    cursor = conn.cursor()
+# Invoices claimed and mailed per cycle
+BATCH_SIZE = int(os.getenv("INVOICE_MAIL_BATCH_SIZE", "50"))
 
-    logger.info("get_invoices() was called")
+QUEUE_NAME = "mail_queue"
+ROUTING_KEY = "mail"
 
-    try:
-        cursor.execute("""
-            SELECT 
-                c.email, i.hash, i.approved, i.processed, i.created_at, i.id
+# One long-lived publisher with confirms: publish() returns once the broker has the message,
+# so an invoice is only marked processed after its mail is safely queued
+publisher = rabbitmq.Publisher(
+    exchange="email",
+    exchange_type="topic",
+    bindings=[(QUEUE_NAME, ROUTING_KEY)]
+)
+
+# SKIP LOCKED already keeps replicas off each other's invoices; with PROVIDER_PARTITIONS set they
+# also stop competing for the same oldest rows (MOD(i.id, N), see common/lease.py)
+partitions = lease.PartitionLease("invoice-mailing-providor")
+
+def get_db_connection():
+    return db.get_connection()
+
+# Claims up to batch_size approved, unprocessed invoices, oldest first. The invoice rows stay
+# locked (FOR UPDATE) until the caller commits or rolls back on the same connection; another
+# instance running this query skips them (SKIP LOCKED) instead of waiting, so each invoice is
+# mailed by one instance only. Client rows are not locked.
+CLAIM_INVOICES_SQL = """
+            SELECT c.email, i.hash, i.id
             FROM invoice i
             JOIN client c ON i.client_id = c.id
-            WHERE i.processed = 0 AND i.approved = 1
+            WHERE i.processed = 0 AND i.approved = 1 {partition}
             ORDER BY i.created_at ASC
-        """)
-        invoices = cursor.fetchall()
+            LIMIT %s
+            FOR UPDATE OF i SKIP LOCKED
+        """
 
-        if not invoices:
-            logger.info("No unprocessed invoices found.")
-            return []
-        
-        for email, hash_, approved, processed, created_at, invoice_id in invoices:
-            logger.info(f"Will process invoice: id={invoice_id}, hash={hash_}, approved={approved}, processed={processed}, created_at={created_at}, email={email}")
-        
-        return invoices
-    
-    except mysql.connector.Error as err:
-        logger.error(f"Error fetching invoices: {err}")
-        return []
-    
-    except Exception as e:
-        logging.error(f"Error fetching invoices: {e}")
-        return []
-    
+def claim_invoices(conn, batch_size=BATCH_SIZE):
+    cursor = conn.cursor()
+    try:
+        partition, params = "", ()
+        condition = partitions.condition("i.id")
+        if condition is not None:
+            partition = f"AND {condition[0]}"
+            params = condition[1]
+        with stats.timed("db_seconds"):
+            cursor.execute(CLAIM_INVOICES_SQL.format(partition=partition), params + (batch_size,))
+            return cursor.fetchall()
     finally:
         cursor.close()
-        conn.close()
-
 
+# Marks the published invoices of a claimed batch in one statement; the caller commits,
+# which also releases the claim on the rest of the batch
+def mark_batch_as_processed(conn, invoice_ids):
+    if not invoice_ids:
+        return
+    cursor = conn.cursor()
+    try:
+        placeholders = ", ".join(["%s"] * len(invoice_ids))
+        cursor.execute(f"UPDATE invoice SET processed = 1 WHERE id IN ({placeholders})", tuple(invoice_ids))
+    finally:
+        cursor.close()
 
-def mark_as_processed(invoice_hash):
+# Invoices still waiting to be mailed, for the poll_backlog gauge (runs on the stats thread, at most every STATS_BACKLOG_INTERVAL seconds)
+def count_backlog():
     conn = get_db_connection()
     cursor = conn.cursor()
-
     try:
-        cursor.execute("""
-            SELECT approved FROM invoice WHERE hash = %s
-        """, (invoice_hash,))
-        result = cursor.fetchone()
-
-        if result and result[0] == 1:
-            cursor.execute("""
-                UPDATE invoice
-                SET processed = 1
-                WHERE hash = %s
-            """, (invoice_hash,))
-            conn.commit()
-            logger.info(f"Marked invoice {invoice_hash} as processed.")
-    except Exception as e:
-        logging.error(f"Error marking invoice as processed: {e}")
+        cursor.execute("SELECT COUNT(*) FROM invoice WHERE processed = 0 AND approved = 1")
+        return cursor.fetchone()[0]
     finally:
         cursor.close()
         conn.close()
 
+# This service="facturatie" attribute was added upon request of the kassa team
+# according to them this was needed so that the email template is the right one for the invoices
+EMAIL_TEMPLATE = xmlout.Template("emailMessage", [
+    xmlout.Field("to"),
+    xmlout.Field("from"),
+    xmlout.Field("subject"),
+    xmlout.Field("title"),
+    xmlout.Field("opener"),
+    xmlout.Field("body"),
+    xmlout.Field("footer"),
+    xmlout.Field("attachmenturl"),
+], attrib={"service": "facturatie"})
+
 def create_xml_message(client_email, invoice_hash):
     host = os.environ["INVOICE_HOST"]
     port = os.environ["INVOICE_PORT"]
 
     invoice_pdf_url = f"http://{host}:{port}/invoice/pdf/{invoice_hash}"
 
-    xml = ET.Element("emailMessage", attrib={"service": "facturatie"})
-    # This was added upon request of the kassa team
-    # according to them this was needed so that the email template is the right one for the invoices
-
-    ET.SubElement(xml, "to").text = client_email
-    ET.SubElement(xml, "from").text = "no.reply.expomail@gmail.com"
-    ET.SubElement(xml, "subject").text = f"Invoice E-XPO"
-    ET.SubElement(xml, "title").text = "Invoice for Your Recent Purchase"
-    ET.SubElement(xml, "opener").text = "Dear Customer,"
-    ET.SubElement(xml, "body").text = f"Thank you for your business! Please review the details carefully."
-    ET.SubElement(xml, "footer").text = "If you have any questions, feel free to contact us at support@E-XPO.com."
-    ET.SubElement(xml, "attachmenturl").text = invoice_pdf_url
+    xml = EMAIL_TEMPLATE.render({
+        "to": client_email,
+        "from": "no.reply.expomail@gmail.com",
+        "subject": "Invoice E-XPO",
+        "title": "Invoice for Your Recent Purchase",
+        "opener": "Dear Customer,",
+        "body": "Thank you for your business! Please review the details carefully.",
+        "footer": "If you have any questions, feel free to contact us at support@E-XPO.com.",
+        "attachmenturl": invoice_pdf_url,
+    })
 
     logger.info(f"Creating XML with sender: no.reply.expomail@gmail.com")
-    logger.info(f"Full XML: {ET.tostring(xml, encoding='unicode')}")
+    # Rendered once; the log line reuses it instead of serialising the document a second time
+    logger.info(f"Full XML: {xml[len(xmlout.XML_DECLARATION):]}")
 
-    return '<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(xml, encoding='unicode')
+    return xml
 
 def send_to_rabbitmq(xml):
-    queue_name = "mail_queue"
-    routing_key = "mail"
     try:
-        params = pika.ConnectionParameters(
-            host=os.environ["RABBITMQ_HOST"],
-            port=int(os.environ["RABBITMQ_PORT"]),
-            virtual_host="/",
-            credentials=pika.PlainCredentials(
-                os.environ["RABBITMQ_USER"],
-                os.environ["RABBITMQ_PASSWORD"]
-            ),
-            heartbeat=600,
-            blocked_connection_timeout=300
-        )
-        connection = pika.BlockingConnection(params)
-        channel = connection.channel()
-
-        # Declare the email exchange
-        channel.exchange_declare(
-            exchange="email",
-            exchange_type="topic",
-            durable=True
-        )
-
-        # Declare the mail queue
-        channel.queue_declare(queue=queue_name, durable=True)
-        
-        # Bind the queue to the exchange with the routing key
-        channel.queue_bind(
-            exchange="email",
-            queue=queue_name,
-            routing_key=routing_key
-        )
-        
-        # Publish the message
-        channel.basic_publish(
-            exchange="email",
-            routing_key=routing_key,
-            body=xml,
-            properties=pika.BasicProperties(
-                delivery_mode=2  # make message persistent
-            )
-        )
-        logger.info(f"Sent XML message to {queue_name}")
-
-        connection.close()
+        publisher.publish(ROUTING_KEY, xml)
+        logger.info(f"Sent XML message to {QUEUE_NAME}")
+        stats.incr("messages")
         return True
     except Exception as e:
         logger.error(f"RabbitMQ Error: {e}")
+        stats.incr("errors")
         return False
+
+# One cycle: claim a batch, publish every invoice (each one confirmed by the broker) and mark the
+# published ones processed, committed together with the claim. An invoice that could not be
+# published stays unprocessed and is claimed again next cycle. If the commit itself fails the
+# mails were already sent and go out again (at least once). Returns the number of invoices claimed.
+def process_batch(batch_size=BATCH_SIZE):
+    conn = get_db_connection()
+    try:
+        invoices = claim_invoices(conn, batch_size)
+        if not invoices:
+            conn.rollback()
+            return 0
+
+        published = []
+        for email, invoice_hash, invoice_id in invoices:
+            # not using the uuid because a user could have multiple invoices
+            # and we don't want to send the same invoice multiple times
+            if send_to_rabbitmq(create_xml_message(email, invoice_hash)):
+                published.append((invoice_id, invoice_hash, email))
+            else:
+                logger.error(f"Failed to process invoice {invoice_id}")
+
+        with stats.timed("db_seconds"):
+            mark_batch_as_processed(conn, [invoice_id for invoice_id, _, _ in published])
+            conn.commit()
+        for invoice_id, invoice_hash, email in published:
+            logger.info(f"Processed invoice with hash {invoice_hash} for client {email}")
+        return len(invoices)
+    except mysql.connector.Error as err:
+        logger.error(f"Error processing invoice batch: {err}")
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
     
 if __name__ == "__main__":
     logger.info("Starting invoice mailing provider")
+    stats.start("invoice-mailing-providor", probes={
+        "db_latency_ms": db.ping_latency_ms,
+        "poll_backlog": stats.every(stats.BACKLOG_INTERVAL, count_backlog)
+    })
+    # The invoice queue and hash lookups depend on the indexes from migration 2
+    try:
+        migrations.migrate()
+        migrations.missing_indexes()
+    except Exception as e:
+        logger.error(f"Schema migration failed: {e}")
+    poller = scheduler.PollScheduler()
     
     while True:
         try:
-            new_users = get_invoices()
-            
-            for user in new_users:
-                xml = create_xml_message(user[0], user[1])
-                # user[0] is the email, user[1] is the hash
-                if send_to_rabbitmq(xml):
-                    mark_as_processed(user[1])
-                    # not using the uuid because a user could have multiple invoices
-                    # and we don't want to send the same invoice multiple times
-
-                    logger.info(f"Processed invoice with hash {user[1]} for client {user[0]}")
-                else:
-                    logger.error(f"Failed to process user {user['id']}")
-            
-            time.sleep(5)
+            claimed = process_batch()
+            publisher.process_data_events()
+            # A full batch means more invoices are probably waiting: claim the next one right away
+            poller.wait(claimed, full=claimed >= BATCH_SIZE)
         except Exception as e:
             logger.error(f"Processing error: {e}")
             time.sleep(60)
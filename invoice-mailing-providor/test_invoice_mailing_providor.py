@@ -4,12 +4,16 @@ from unittest.mock import patch, MagicMock, call
 import os
 import logging
 import pika
+import mysql.connector
+from common import db, rabbitmq
 from invoice_mailing_providor import (
     get_db_connection,
-    get_invoices,
-    mark_as_processed,
+    claim_invoices,
+    mark_batch_as_processed,
+    process_batch,
     create_xml_message,
-    send_to_rabbitmq
+    send_to_rabbitmq,
+    publisher
 )
 
 # Setup logging for tests
@@ -19,19 +23,22 @@ logger = logging.getLogger(__name__)
 @pytest.fixture
 def sample_invoice_data():
     return [
-        ('test@example.com', 'abc123', 1, 0, '2023-05-15 12:00:00', 1),
-        ('another@test.com', 'def456', 1, 0, '2023-05-16 10:00:00', 2)
+        ('test@example.com', 'abc123', 1),
+        ('another@test.com', 'def456', 2)
     ]
 
 @pytest.fixture
 def mock_db_connection():
-    with patch('invoice_mailing_providor.mysql.connector.connect') as mock_connect:
+    with patch('invoice_mailing_providor.get_db_connection') as mock_connect:
         yield mock_connect
 
 @pytest.fixture
 def mock_rabbitmq():
-    with patch('invoice_mailing_providor.pika.BlockingConnection') as mock_connection:
+    # The publisher is long-lived; drop any connection left over from a previous test
+    publisher.close()
+    with patch('invoice_mailing_providor.rabbitmq.pika.BlockingConnection') as mock_connection:
         yield mock_connection
+    publisher.close()
 
 @pytest.fixture
 def env_vars():
@@ -52,96 +59,105 @@ def env_vars():
 def setup_logging(caplog):
     caplog.set_level(logging.INFO)
 
-def test_get_db_connection(mock_db_connection, env_vars):
-    """Test database connection creation"""
-    with patch.dict(os.environ, env_vars):
-        get_db_connection()
+@patch('invoice_mailing_providor.mysql.connector.connect')
+def test_get_db_connection(mock_connect, env_vars):
+    """Test database connection creation through the shared pool"""
+    db.reset_pool()
+    try:
+        with patch.dict(os.environ, env_vars):
+            get_db_connection()
+    finally:
+        db.reset_pool()
     
-    mock_db_connection.assert_called_once_with(
+    mock_connect.assert_called_once_with(
         host='localhost',
         user='test',
         password='test',
         database='test_db'
     )
 
-def test_get_invoices_success(mock_db_connection, sample_invoice_data, env_vars):
-    """Test successful invoice retrieval"""
-    mock_cursor = MagicMock()
-    mock_db_connection.return_value.cursor.return_value = mock_cursor
+def test_claim_invoices_locks_batch_and_skips_claimed_rows(sample_invoice_data):
+    """Claim query takes a batch of invoice rows and skips the ones another instance holds"""
+    conn = MagicMock()
+    mock_cursor = conn.cursor.return_value
     mock_cursor.fetchall.return_value = sample_invoice_data
-    
-    with patch.dict(os.environ, env_vars):
-        invoices = get_invoices()
-    
-    assert invoices == sample_invoice_data
+
+    assert claim_invoices(conn, batch_size=2) == sample_invoice_data
+
+    sql, params = mock_cursor.execute.call_args[0]
+    assert "WHERE i.processed = 0 AND i.approved = 1" in sql
+    assert "LIMIT %s" in sql
+    assert "FOR UPDATE OF i SKIP LOCKED" in sql
+    assert params == (2,)
+    mock_cursor.close.assert_called_once()
+    conn.commit.assert_not_called()
+
+def test_mark_batch_as_processed_by_id():
+    """Whole batch marked in one statement, without re-reading the approved flag"""
+    conn = MagicMock()
+    mock_cursor = conn.cursor.return_value
+
+    mark_batch_as_processed(conn, [1, 2, 3])
+
     mock_cursor.execute.assert_called_once_with(
-        """\n            SELECT \n                c.email, i.hash, i.approved, i.processed, i.created_at, i.id\n            FROM invoice i\n            JOIN client c ON i.client_id = c.id\n            WHERE i.processed = 0 AND i.approved = 1\n            ORDER BY i.created_at ASC\n        """
+        "UPDATE invoice SET processed = 1 WHERE id IN (%s, %s, %s)", (1, 2, 3)
     )
 
-def test_get_invoices_empty(mock_db_connection, env_vars, caplog):
-    """Test invoice retrieval when no invoices found"""
-    mock_cursor = MagicMock()
-    mock_db_connection.return_value.cursor.return_value = mock_cursor
-    mock_cursor.fetchall.return_value = []
-    
-    with patch.dict(os.environ, env_vars):
-        invoices = get_invoices()
-    
-    assert invoices == []
-    assert any("No unprocessed invoices found" in record.message for record in caplog.records)
+def test_mark_batch_as_processed_empty():
+    conn = MagicMock()
 
-def test_get_invoices_error(mock_db_connection, env_vars, caplog):
-    """Test invoice retrieval with database error"""
-    mock_cursor = MagicMock()
-    mock_db_connection.return_value.cursor.return_value = mock_cursor
-    mock_cursor.execute.side_effect = Exception("DB error")
+    mark_batch_as_processed(conn, [])
 
-    with patch.dict(os.environ, env_vars):
-        invoices = get_invoices()
+    conn.cursor.assert_not_called()
 
-    assert invoices == []
-    assert any("Error fetching invoices" in record.message for record in caplog.records)
+@patch('invoice_mailing_providor.send_to_rabbitmq', return_value=True)
+def test_process_batch_publishes_and_commits_once(mock_send, mock_db_connection, sample_invoice_data, env_vars):
+    """Every claimed invoice is published, then the batch is marked and committed together"""
+    conn = mock_db_connection.return_value
+    conn.cursor.return_value.fetchall.return_value = sample_invoice_data
 
-def test_mark_as_processed_success(mock_db_connection, env_vars):
-    """Test successful invoice marking"""
-    mock_cursor = MagicMock()
-    mock_db_connection.return_value.cursor.return_value = mock_cursor
-    mock_cursor.fetchone.return_value = (1,)  # approved = 1
-    
     with patch.dict(os.environ, env_vars):
-        mark_as_processed('abc123')
-    
-    calls = [
-        call("""\n            SELECT approved FROM invoice WHERE hash = %s\n        """, ('abc123',)),
-        call("""\n                UPDATE invoice\n                SET processed = 1\n                WHERE hash = %s\n            """, ('abc123',))
-    ]
-    mock_cursor.execute.assert_has_calls(calls)
-    mock_db_connection.return_value.commit.assert_called_once()
-
-def test_mark_as_processed_not_approved(mock_db_connection, env_vars):
-    """Test marking when invoice not approved"""
-    mock_cursor = MagicMock()
-    mock_db_connection.return_value.cursor.return_value = mock_cursor
-    mock_cursor.fetchone.return_value = (0,)  # approved = 0
-    
-    with patch.dict(os.environ, env_vars):
-        mark_as_processed('abc123')
-    
-    mock_cursor.execute.assert_called_once_with(
-        """\n            SELECT approved FROM invoice WHERE hash = %s\n        """, ('abc123',)
-    )
-    mock_db_connection.return_value.commit.assert_not_called()
+        assert process_batch(batch_size=10) == 2
+
+    assert mock_send.call_count == 2
+    update = conn.cursor.return_value.execute.call_args_list[-1]
+    assert update == call("UPDATE invoice SET processed = 1 WHERE id IN (%s, %s)", (1, 2))
+    conn.commit.assert_called_once()
+    conn.close.assert_called_once()
 
-def test_mark_as_processed_error(mock_db_connection, env_vars, caplog):
-    """Test marking with database error"""
-    mock_cursor = MagicMock()
-    mock_db_connection.return_value.cursor.return_value = mock_cursor
-    mock_cursor.execute.side_effect = Exception("DB error")
+@patch('invoice_mailing_providor.send_to_rabbitmq', side_effect=[False, True])
+def test_process_batch_leaves_unpublished_invoice_unprocessed(mock_send, mock_db_connection, sample_invoice_data, env_vars, caplog):
+    conn = mock_db_connection.return_value
+    conn.cursor.return_value.fetchall.return_value = sample_invoice_data
 
     with patch.dict(os.environ, env_vars):
-        mark_as_processed('abc123')
+        process_batch(batch_size=10)
+
+    update = conn.cursor.return_value.execute.call_args_list[-1]
+    assert update == call("UPDATE invoice SET processed = 1 WHERE id IN (%s)", (2,))
+    conn.commit.assert_called_once()
+    assert any("Failed to process invoice 1" in record.message for record in caplog.records)
+
+def test_process_batch_nothing_to_claim(mock_db_connection, caplog):
+    conn = mock_db_connection.return_value
+    conn.cursor.return_value.fetchall.return_value = []
+
+    assert process_batch() == 0
+
+    conn.commit.assert_not_called()
+    conn.rollback.assert_called_once()
+    conn.close.assert_called_once()
+
+def test_process_batch_db_error_rolls_back(mock_db_connection, caplog):
+    conn = mock_db_connection.return_value
+    conn.cursor.return_value.execute.side_effect = mysql.connector.Error("lock wait timeout")
+
+    with pytest.raises(mysql.connector.Error):
+        process_batch()
 
-    assert any("Error marking invoice as processed" in record.message for record in caplog.records)
+    conn.rollback.assert_called_once()
+    conn.close.assert_called_once()
+    assert any("Error processing invoice batch" in record.message for record in caplog.records)
 
 def test_create_xml_message(env_vars):
     """Test XML message creation"""
@@ -156,15 +172,31 @@ def test_create_xml_message(env_vars):
     assert root.find('subject').text == 'Invoice E-XPO'
     assert root.find('attachmenturl').text == 'http://example.com:8080/invoice/pdf/abc123'
 
+def test_create_xml_message_matches_elementtree_output(env_vars):
+    """Byte-for-byte the document the former ElementTree implementation produced"""
+    with patch.dict(os.environ, env_vars):
+        xml = create_xml_message('a&b@example.com', 'abc123')
+
+    assert xml == (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<emailMessage service="facturatie"><to>a&amp;b@example.com</to><from>no.reply.expomail@gmail.com</from>'
+        '<subject>Invoice E-XPO</subject><title>Invoice for Your Recent Purchase</title><opener>Dear Customer,</opener>'
+        '<body>Thank you for your business! Please review the details carefully.</body>'
+        '<footer>If you have any questions, feel free to contact us at support@E-XPO.com.</footer>'
+        '<attachmenturl>http://example.com:8080/invoice/pdf/abc123</attachmenturl></emailMessage>'
+    )
+
 def test_send_to_rabbitmq_success(mock_rabbitmq, env_vars):
-    """Test successful RabbitMQ message sending"""
+    """One connection and one topology declaration, then only confirmed publishes"""
     with patch.dict(os.environ, env_vars):
         mock_channel = MagicMock()
         mock_rabbitmq.return_value.channel.return_value = mock_channel
         
-        result = send_to_rabbitmq('<test>xml</test>')
-        
-        assert result is True
+        assert send_to_rabbitmq('<test>xml</test>') is True
+        assert send_to_rabbitmq('<test>xml</test>') is True
+
+        mock_rabbitmq.assert_called_once()
+        mock_channel.confirm_delivery.assert_called_once()
         mock_channel.exchange_declare.assert_called_once_with(
             exchange="email",
             exchange_type="topic",
@@ -179,13 +211,23 @@ def test_send_to_rabbitmq_success(mock_rabbitmq, env_vars):
             queue="mail_queue",
             routing_key="mail"
         )
-        mock_channel.basic_publish.assert_called_once_with(
+        assert mock_channel.basic_publish.call_count == 2
+        mock_channel.basic_publish.assert_called_with(
             exchange="email",
             routing_key="mail",
             body='<test>xml</test>',
-            properties=pika.BasicProperties(delivery_mode=2)
+            properties=rabbitmq.PERSISTENT,
+            mandatory=True
         )
 
+def test_send_to_rabbitmq_not_confirmed(mock_rabbitmq, env_vars, caplog):
+    """A message the broker refuses is reported as not sent"""
+    with patch.dict(os.environ, env_vars):
+        mock_channel = mock_rabbitmq.return_value.channel.return_value
+        mock_channel.basic_publish.side_effect = pika.exceptions.NackError([])
+
+        assert send_to_rabbitmq('<test>xml</test>') is False
+
 def test_send_to_rabbitmq_failure(mock_rabbitmq, env_vars, caplog):
     """Test failed RabbitMQ message sending"""
     with patch.dict(os.environ, env_vars):
@@ -194,4 +236,4 @@ def test_send_to_rabbitmq_failure(mock_rabbitmq, env_vars, caplog):
         result = send_to_rabbitmq('<test>xml</test>')
         
         assert result is False
-        assert any("RabbitMQ Error" in record.message for record in caplog.records)
\ No newline at end of file
+        assert any("RabbitMQ Error" in record.message for record in caplog.records)
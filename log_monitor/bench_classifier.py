@@ -0,0 +1,82 @@
+# Compares the compiled SeverityClassifier with the keyword loop monitor_container_logs used before.
+# Run from the log_monitor directory, on a captured log (e.g. `docker logs facturatie_app > app.log`)
+# or on a generated one:
+#
+#   python bench_classifier.py [captured.log] [repeat]
+import sys
+import time
+import random
+from classifier import SeverityClassifier
+
+SERVICE_LINES = [
+    "2025-05-24 12:00:00,123 - INFO - Bericht ontvangen via user.create.facturatie_user_create",
+    "2025-05-24 12:00:00,124 - INFO - Processed user 1234 with timestamp ID 2025-04-29T14:22:27.816332Z",
+    "2025-05-24 12:00:00,125 - WARNING - User met timestamp 2025-04-29 14:22:27.816332 bestaat al.",
+    "2025-05-24 12:00:00,126 - ERROR - RabbitMQ Error: Connection reset by peer",
+]
+OTHER_LINES = [
+    "Starting log stream for: facturatie_user_providor",
+    "[Note] Aborted connection 42 to db: 'facturatie' user: 'app' host: '172.18.0.5' (Got an error reading communication packets)",
+    "Traceback (most recent call last):",
+    "mysql.connector.errors.IntegrityError: 1062 (23000): Duplicate entry",
+    "DeprecationWarning: datetime.utcnow() is deprecated",
+    "KeyboardInterrupt received, stopping consumer",
+    "GET /invoice/pdf/abc123 HTTP/1.1 200 5123",
+]
+
+
+def generated_log(lines=200000, seed=1):
+    rng = random.Random(seed)
+    pool = SERVICE_LINES * 3 + OTHER_LINES
+    return [rng.choice(pool) for _ in range(lines)]
+
+
+# The classification monitor_container_logs did before
+def legacy_classify(log_line):
+    error_keywords = ["error", "err", "fatal", "critical", "exception"]
+    warning_keywords = ["warn", "warning", "deprecated"]
+    normalized = log_line.lower()
+    status = "INFO"
+    if any(word in normalized for word in error_keywords):
+        status = "ERROR"
+    elif any(word in normalized for word in warning_keywords):
+        status = "WARNING"
+    return status
+
+
+def bench(name, classify, lines, repeat):
+    size = sum(len(line) for line in lines)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            classify(line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{name:<24} {len(lines) / best:12.0f} lines/s  {size / best / 1e6:8.1f} MB/s")
+    return best
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] != "-":
+        with open(argv[0], encoding="utf-8", errors="replace") as f:
+            lines = [line.strip() for line in f]
+        source = argv[0]
+    else:
+        lines = generated_log()
+        source = "generated log"
+    repeat = int(argv[1]) if len(argv) > 1 else 5
+
+    print(f"{source}: {len(lines)} lines, best of {repeat}")
+    classifier = SeverityClassifier()
+    legacy = bench("keyword loop", legacy_classify, lines, repeat)
+    compiled = bench("SeverityClassifier", classifier.classify, lines, repeat)
+    print(f"{'speed-up':<24} {legacy / compiled:12.2f}x")
+
+    changed = sum(1 for line in lines if legacy_classify(line) != classifier.classify(line))
+    print(f"{'classified differently':<24} {changed:12d} lines")
+
+
+if __name__ == "__main__":
+    main()
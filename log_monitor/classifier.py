@@ -0,0 +1,81 @@
+import re
+
+ERROR = "ERROR"
+WARNING = "WARNING"
+INFO = "INFO"
+
+ERROR_KEYWORDS = ("error", "err", "fatal", "critical", "exception")
+WARNING_KEYWORDS = ("warn", "warning", "deprecated")
+# Also recognised at the end of a CamelCase name, e.g. IntegrityError, DeprecationWarning
+CLASS_SUFFIXES = {"error": ERROR, "exception": ERROR, "warning": WARNING}
+
+# Our own services log with '%(asctime)s - %(levelname)s - %(message)s', e.g.
+# "2025-05-24 12:00:00,123 - WARNING - ..."; asctime is always 23 characters wide.
+LEVEL_OFFSET = 23 + len(" - ")
+LEVELS = {
+    "CRITICAL": ERROR,
+    "ERROR": ERROR,
+    "WARNING": WARNING,
+    "INFO": INFO,
+    "DEBUG": INFO,
+}
+
+
+def _is_word_char(char):
+    return char.isalnum() or char == "_"
+
+
+# Classifies a log line as ERROR, WARNING or INFO.
+# Lines in our services' logging format are classified by their levelname, read at a fixed offset.
+# Other lines are lowercased once and scanned with one regex, compiled from both keyword lists,
+# that finds every word starting with a keyword. Non-ASCII lines are scanned as they are with a
+# case-insensitive copy of that regex instead: str.lower() can change their length (e.g. "İ"),
+# which would shift the match positions. A hit only counts when it is a whole keyword
+# (optionally plural), so "err" does not match "interrupt" or "stderr", or when it is the
+# CamelCase suffix of a class name such as ValueError. Python's re has no fast path for \b,
+# so the boundaries are checked on the (rare) hits instead of in the pattern.
+class SeverityClassifier:
+    def __init__(self, error_keywords=ERROR_KEYWORDS, warning_keywords=WARNING_KEYWORDS, class_suffixes=CLASS_SUFFIXES):
+        self._words = {}
+        for keywords, status in ((warning_keywords, WARNING), (error_keywords, ERROR)):
+            for keyword in keywords:
+                self._words[keyword] = self._words[keyword + "s"] = status
+        self._class_suffixes = dict(class_suffixes)
+        stems = sorted(set(self._words) | set(self._class_suffixes), key=len, reverse=True)
+        pattern = f"(?:{'|'.join(re.escape(stem) for stem in stems)})\\w*"
+        self._candidates = re.compile(pattern)
+        # Case-insensitive matching is about twice as slow, so it is kept for non-ASCII lines
+        self._candidates_any_case = re.compile(pattern, re.IGNORECASE)
+
+    @staticmethod
+    def levelname(line):
+        if line[LEVEL_OFFSET - 3:LEVEL_OFFSET] != " - " or line[4:5] != "-":
+            return None
+        end = line.find(" - ", LEVEL_OFFSET, LEVEL_OFFSET + 12)
+        if end < 0:
+            return None
+        return LEVELS.get(line[LEVEL_OFFSET:end])
+
+    def classify(self, line):
+        status = self.levelname(line)
+        if status is not None:
+            return status
+
+        if line.isascii():
+            text, candidates = line.lower(), self._candidates
+        else:
+            text, candidates = line, self._candidates_any_case
+        status = INFO
+        for match in candidates.finditer(text):
+            word = match.group().lower()
+            start = match.start()
+            if start and _is_word_char(text[start - 1]):
+                # Inside a word: only a CamelCase class name counts
+                found = self._class_suffixes.get(word) if line[start].isupper() else None
+            else:
+                found = self._words.get(word)
+            if found == ERROR:
+                return ERROR
+            if found == WARNING:
+                status = WARNING
+        return status
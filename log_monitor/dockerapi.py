@@ -0,0 +1,160 @@
+import os
+import json
+import struct
+import asyncio
+import urllib.parse
+
+DEFAULT_SOCKET = "/var/run/docker.sock"
+# Longest log line passed on in one piece; longer lines are split so no buffer grows without bound
+MAX_LINE = 64 * 1024
+
+
+class DockerError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Docker API returned {status}: {message}")
+        self.status = status
+
+
+# DOCKER_HOST=unix:///path/to/docker.sock, like the docker CLI; the default socket otherwise
+def socket_path():
+    host = os.getenv("DOCKER_HOST", "")
+    if host.startswith("unix://"):
+        return host[len("unix://"):]
+    return DEFAULT_SOCKET
+
+
+# Splits a stream of chunks into lines (without the newline)
+async def iter_lines(chunks, max_line=MAX_LINE):
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        while True:
+            end = buffer.find(b"\n")
+            if end < 0:
+                break
+            yield buffer[:end]
+            buffer = buffer[end + 1:]
+        while len(buffer) > max_line:
+            yield buffer[:max_line]
+            buffer = buffer[max_line:]
+    if buffer:
+        yield buffer
+
+
+# Strips the 8-byte frame headers docker puts in front of stdout/stderr output of a container
+# without a TTY: stream type (1 byte), 3 padding bytes and the payload size (big-endian uint32)
+async def demultiplex(chunks):
+    buffer = b""
+    async for chunk in chunks:
+        buffer += chunk
+        while len(buffer) >= 8:
+            size = struct.unpack(">I", buffer[4:8])[0]
+            if len(buffer) < 8 + size:
+                break
+            yield buffer[8:8 + size]
+            buffer = buffer[8 + size:]
+
+
+# Minimal asyncio client for the Docker Engine API over its unix socket: just the calls the log
+# monitor needs. Every request uses its own connection, so any number of log streams can be
+# followed concurrently on one event loop. Streams are async generators; close them (e.g. with
+# contextlib.aclosing) to close the connection.
+class DockerAPI:
+    def __init__(self, path=None):
+        self.path = path or socket_path()
+
+    async def _request(self, path, params=None):
+        reader, writer = await asyncio.open_unix_connection(self.path, limit=MAX_LINE)
+        try:
+            query = urllib.parse.urlencode({k: v for k, v in (params or {}).items() if v is not None})
+            target = f"{path}?{query}" if query else path
+            writer.write(f"GET {target} HTTP/1.1\r\nHost: docker\r\nConnection: close\r\n\r\n".encode("ascii"))
+            await writer.drain()
+
+            status_line = await reader.readline()
+            parts = status_line.split(None, 2)
+            if len(parts) < 2:
+                raise DockerError(0, f"invalid response {status_line!r}")
+            status = int(parts[1])
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            if status >= 400:
+                body = b"".join([chunk async for chunk in self._body(reader, headers)])
+                raise DockerError(status, body.decode("utf-8", errors="replace").strip())
+        except BaseException:
+            writer.close()
+            raise
+        return self._body(reader, headers), writer
+
+    @staticmethod
+    async def _body(reader, headers):
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size = int((await reader.readline()).split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    return
+                chunk = await reader.readexactly(size)
+                await reader.readexactly(2)  # CRLF after every chunk
+                yield chunk
+        elif "content-length" in headers:
+            yield await reader.readexactly(int(headers["content-length"]))
+        else:
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    return
+                yield chunk
+
+    async def _get_json(self, path, params=None):
+        body, writer = await self._request(path, params)
+        try:
+            return json.loads(b"".join([chunk async for chunk in body]) or b"null")
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _stream(items, writer):
+        try:
+            async for item in items:
+                yield item
+        finally:
+            writer.close()
+
+    async def list_containers(self):
+        return await self._get_json("/containers/json")
+
+    async def inspect_container(self, container_id):
+        return await self._get_json(f"/containers/{container_id}/json")
+
+    # Subscribes to the events stream; the subscription is active once this returns.
+    # Returns an async iterator of event dicts.
+    async def events(self, since=None, filters=None):
+        body, writer = await self._request("/events", {
+            "since": f"{since:.9f}" if since is not None else None,
+            "filters": json.dumps(filters) if filters else None,
+        })
+        return self._stream(self._decode_events(body), writer)
+
+    @staticmethod
+    async def _decode_events(body):
+        async for line in iter_lines(body):
+            if line.strip():
+                yield json.loads(line)
+
+    # Follows a container's output; returns an async iterator of lines, each prefixed by
+    # docker's timestamp. tty tells whether the container has a TTY (no frame headers then).
+    async def logs(self, container_id, since=None, tty=False):
+        body, writer = await self._request(f"/containers/{container_id}/logs", {
+            "follow": 1,
+            "stdout": 1,
+            "stderr": 1,
+            "timestamps": 1,
+            "since": f"{since:.9f}" if since is not None else None,
+        })
+        return self._stream(iter_lines(body if tty else demultiplex(body)), writer)
@@ -1,21 +1,63 @@
-import docker
-import pika
 import xml.etree.ElementTree as ET
 import time
 import os
+import re
+import queue
+import signal
+import asyncio
+import calendar
 import threading
-from collections import defaultdict
-from time import time
+import contextlib
+from collections import defaultdict, deque
+from common import rabbitmq, stats
+from classifier import SeverityClassifier
+from dockerapi import DockerAPI
 
 SERVICE_NAME = "Facturatie"
 EXCHANGE_NAME = "log_monitoring"
 ROUTING_KEY = "controlroom.log.event"
+QUEUE_NAME = "controlroom.log.event"
 
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST")
 RABBITMQ_PORT = int(os.getenv("RABBITMQ_PORT", "5672"))
 RABBITMQ_USER = os.getenv("RABBITMQ_USER")
 RABBITMQ_PASSWORD = os.getenv("RABBITMQ_PASSWORD")
 
+# Log lines waiting for the shipper; when it is full a log stream waits at most
+# LOG_ENQUEUE_TIMEOUT seconds, then LOG_DROP_POLICY decides which line is lost ("oldest" or "newest")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "1000"))
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "100"))
+LOG_ENQUEUE_TIMEOUT = float(os.getenv("LOG_ENQUEUE_TIMEOUT", "0.1"))
+LOG_DROP_POLICY = os.getenv("LOG_DROP_POLICY", "oldest")
+
+# Containers to monitor: a name that fully matches LOG_CONTAINER_PATTERN (a regex), or a container
+# carrying LOG_CONTAINER_LABEL ("key" or "key=value"). The default pattern is the old whitelist.
+WHITELIST = [
+    "facturatie_user_providor",
+    "facturatie_update_providor",
+    "facturatie_deletion_providor",
+    "facturatie_creation_consumer",
+    "facturatie_update_consumer",
+    "facturatie_deletion_consumer",
+    "facturatie_invoice_processor",
+    "facturatie_app",
+    "facturatie_log_monitor",
+]
+LOG_CONTAINER_PATTERN = os.getenv("LOG_CONTAINER_PATTERN") or "|".join(re.escape(name) for name in WHITELIST)
+LOG_CONTAINER_LABEL = os.getenv("LOG_CONTAINER_LABEL", "")
+
+# Per container and severity: sustained lines per second and burst size, as "rate,burst"
+LOG_RATE_LIMITS = {
+    "ERROR": os.getenv("LOG_RATE_ERROR", "5,50"),
+    "WARNING": os.getenv("LOG_RATE_WARNING", "1,10"),
+    "INFO": os.getenv("LOG_RATE_INFO", "0.2,5"),
+}
+# How often the suppressed lines are summarised (and the shipper counters reported)
+LOG_SUMMARY_INTERVAL = float(os.getenv("LOG_SUMMARY_INTERVAL", "30"))
+
+# Prefix docker adds with timestamps=True, e.g. "2025-05-24T12:00:00.123456789Z "
+TIMESTAMP_PATTERN = re.compile(rb"^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.(\d+))?Z ")
+
 def create_xml_log(status, message, container_name=None):
     log = ET.Element("Log")
     ET.SubElement(log, "ServiceName").text = f"{SERVICE_NAME}::{container_name}" if container_name else SERVICE_NAME
@@ -23,104 +65,434 @@ def create_xml_log(status, message, container_name=None):
     ET.SubElement(log, "Message").text = message
     return ET.tostring(log, encoding='utf-8', method='xml')
 
-def publish_log(xml_message):
-    try:
-        credentials = pika.PlainCredentials(RABBITMQ_USER, RABBITMQ_PASSWORD)
-        params = pika.ConnectionParameters(RABBITMQ_HOST, RABBITMQ_PORT, '/', credentials)
-        connection = pika.BlockingConnection(params)
-        channel = connection.channel()
-        channel.exchange_declare(exchange=EXCHANGE_NAME, exchange_type='direct', durable=True)
-        channel.queue_declare(queue="controlroom.log.event", durable=True)
-        channel.queue_bind(exchange=EXCHANGE_NAME, queue="controlroom.log.event", routing_key=ROUTING_KEY)
-        channel.basic_publish(exchange=EXCHANGE_NAME, routing_key=ROUTING_KEY, body=xml_message)
-        connection.close()
-    except Exception as e:
-        print("Fout bij verzenden naar RabbitMQ:", e)
+# Ships log messages to RabbitMQ from one background thread over one long-lived channel.
+# The log streams only put messages on a bounded queue, so a slow or unreachable broker
+# no longer stalls log reading: once the queue is full they wait briefly (backpressure) and then
+# a message is dropped and counted. The shipper drains up to batch_size messages at a time and
+# publishes them back to back; a failed batch is retried after retry_delay.
+class LogShipper:
+    def __init__(self, publisher=None, maxsize=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE,
+                 enqueue_timeout=LOG_ENQUEUE_TIMEOUT, drop_policy=LOG_DROP_POLICY, retry_delay=1.0):
+        if drop_policy not in ("oldest", "newest"):
+            raise ValueError(f"Unknown drop policy: {drop_policy}")
+        self.publisher = publisher or rabbitmq.Publisher(
+            exchange=EXCHANGE_NAME,
+            exchange_type="direct",
+            bindings=[(QUEUE_NAME, ROUTING_KEY)],
+            confirm=False
+        )
+        self.batch_size = batch_size
+        self.enqueue_timeout = enqueue_timeout
+        self.drop_policy = drop_policy
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._counters = {"queued": 0, "published": 0, "dropped": 0, "failed_batches": 0}
+        self._reported = dict(self._counters)
+        self._stopping = threading.Event()
+        self._thread = None
 
-last_log_time = defaultdict(lambda: 0)
+    def _bump(self, key, amount=1):
+        with self._lock:
+            self._counters[key] += amount
 
-def monitor_container_logs(container):
-    error_keywords = ["error", "err", "fatal", "critical", "exception"]
-    warning_keywords = ["warn", "warning", "deprecated"]
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        counters["backlog"] = self._queue.qsize()
+        return counters
 
-    print("Starting log stream for:", container.name)
-    try:
-        for line in container.logs(stream=True, follow=True):
-            log_line = line.decode('utf-8').strip()
-            print(f"[RAW] {container.name}:", repr(log_line))
-
-            # Skip empty or generic lines
-            normalized = log_line.lower()
-            if normalized in ["", "info", "error", "warning", "deprecated"]:
-                print(f"[SKIPPED] Empty or generic log from {container.name}: '{log_line}'")
-                continue
-
-            # Throttle: 1 log per 5 seconds per container
-            now = time()
-            if now - last_log_time[container.name] < 5:
-                print(f"[THROTTLED] {container.name} log skipped to reduce spam.")
-                continue
-            last_log_time[container.name] = now
-
-            # Determine log status
-            status = "INFO"
-            if any(word in normalized for word in error_keywords):
-                status = "ERROR"
-            elif any(word in normalized for word in warning_keywords):
-                status = "WARNING"
-
-            xml_message = create_xml_log(status, f"{container.name}: {log_line}")
-            publish_log(xml_message)
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="log-shipper", daemon=True)
+        self._thread.start()
 
-    except Exception as e:
-        print(f"Error while streaming logs from {container.name}: {e}")
-        
-def monitor_logs():
+    # Queues one message; returns False when it was dropped
+    def submit(self, xml_message, timeout=None):
+        try:
+            self._queue.put(xml_message, timeout=self.enqueue_timeout if timeout is None else timeout)
+            self._bump("queued")
+            return True
+        except queue.Full:
+            pass
+
+        if self.drop_policy == "oldest":
+            # Make room by discarding the oldest queued message; the newest lines matter most
+            try:
+                self._queue.get_nowait()
+                self._queue.put_nowait(xml_message)
+                self._bump("dropped")
+                self._bump("queued")
+                return True
+            except (queue.Empty, queue.Full):
+                pass
+        self._bump("dropped")
+        return False
+
+    # Queues one message only if there is room right now (never blocks)
+    def offer(self, xml_message):
+        try:
+            self._queue.put_nowait(xml_message)
+        except queue.Full:
+            return False
+        self._bump("queued")
+        return True
+
+    def _next_batch(self):
+        try:
+            batch = deque([self._queue.get(timeout=0.5)])
+        except queue.Empty:
+            return None
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        batch = None
+        while True:
+            if not batch:
+                batch = self._next_batch()
+                if batch is None:
+                    if self._stopping.is_set():
+                        return
+                    self.publisher.process_data_events()
+                    continue
+
+            try:
+                while batch:
+                    self.publisher.publish(ROUTING_KEY, batch[0])
+                    batch.popleft()
+                    self._bump("published")
+            except Exception as e:
+                self._bump("failed_batches")
+                print(f"Fout bij verzenden naar RabbitMQ: {e} ({len(batch)} berichten wachten)")
+                if self._stopping.is_set():
+                    self._bump("dropped", len(batch))
+                    return
+                self._stopping.wait(self.retry_delay)
+
+    # Prints the counters when messages were dropped or batches failed since the previous report
+    def report(self):
+        current = self.stats()
+        if current["dropped"] != self._reported["dropped"] or current["failed_batches"] != self._reported["failed_batches"]:
+            print(f"[SHIPPER] {current}")
+        self._reported = current
+
+    # Publishes what is still queued (waiting at most `timeout` seconds) and closes the connection
+    def close(self, timeout=5):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.publisher.close()
+
+
+shipper = LogShipper()
+
+
+# Hands a log message to the shipper from the event loop: while its queue is full only the calling log stream
+# waits (up to LOG_ENQUEUE_TIMEOUT, then the drop policy applies); the other streams keep running.
+# A waiting stream stops reading its socket, so docker is slowed down instead of our memory filling up.
+async def publish_log_async(xml_message):
+    shipper.start()
+    deadline = time.monotonic() + shipper.enqueue_timeout
+    while not shipper.offer(xml_message):
+        if time.monotonic() >= deadline:
+            return shipper.submit(xml_message, timeout=0)
+        await asyncio.sleep(0.01)
+    return True
+
+# Allows `rate` events per second on average with bursts of up to `burst`
+class TokenBucket:
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+# Rate limits forwarded lines per (container, severity), so INFO spam from a container only uses
+# up its own INFO bucket and never the budget of its ERROR lines. Lines over the limit are
+# counted and reported by summaries() instead of disappearing silently.
+class RateLimiter:
+    def __init__(self, limits=None, clock=time.monotonic):
+        self.limits = {
+            status: tuple(float(part) for part in limit.split(","))
+            for status, limit in (limits or LOG_RATE_LIMITS).items()
+        }
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._suppressed = defaultdict(int)
+
+    def allow(self, container_name, status):
+        key = (container_name, status)
+        with self._lock:
+            now = self._clock()
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                rate, burst = self.limits.get(status, self.limits["INFO"])
+                bucket = self._buckets[key] = TokenBucket(rate, burst, now)
+            if bucket.take(now):
+                return True
+            self._suppressed[key] += 1
+            return False
+
+    # Returns [(container, status, count)] of the lines suppressed since the previous call
+    def summaries(self):
+        with self._lock:
+            suppressed, self._suppressed = self._suppressed, defaultdict(int)
+        return sorted((container, status, count) for (container, status), count in suppressed.items())
+
+
+rate_limiter = RateLimiter()
+
+# Decides the Status of every forwarded line; any object with classify(line) can be swapped in
+classifier = SeverityClassifier()
+
+GENERIC_LINES = {"", "info", "error", "warning", "deprecated"}
+GENERIC_LINE_LENGTH = max(len(line) for line in GENERIC_LINES)
+
+
+# Publishes one summary event per container and severity that had lines suppressed
+async def publish_suppressed(interval=LOG_SUMMARY_INTERVAL):
+    for container_name, status, count in rate_limiter.summaries():
+        await publish_log_async(create_xml_log(
+            status,
+            f"{container_name}: {count} similar {status} lines suppressed in the last {interval:g}s"
+        ))
+
+# Splits docker's timestamp prefix off a log line: (unix time, rest of the line).
+# Lines without a prefix come back as (None, line).
+def split_timestamp(line):
+    match = TIMESTAMP_PATTERN.match(line)
+    if not match:
+        return None, line
+    seconds = calendar.timegm(time.strptime(match.group(1).decode(), "%Y-%m-%dT%H:%M:%S"))
+    fraction = match.group(2) or b"0"
+    return seconds + float(b"0." + fraction[:9]), line[match.end():]
+
+
+# What happens to every log line: generic lines are skipped, the rest is classified and rate
+# limited per container and severity (suppressed lines end up in a summary).
+# Returns the XML event to publish, or None.
+def log_event(container_name, line):
+    log_line = line.decode('utf-8', errors='replace').strip()
+
+    # Skip empty or generic lines
+    if len(log_line) <= GENERIC_LINE_LENGTH and log_line.lower() in GENERIC_LINES:
+        return None
+
+    status = classifier.classify(log_line)
+    if not rate_limiter.allow(container_name, status):
+        return None
+    return create_xml_log(status, f"{container_name}: {log_line}")
+
+
+# Follows the docker events stream and runs one log reader task per matching container, all on
+# one event loop. A reader starts on the container's "start" event and is cancelled on "die".
+# The readers belong to a TaskGroup owned by run(): when run() ends, fails or is cancelled, every
+# reader is cancelled and awaited with it, and each closes its connection on the way out.
+# The time of the last line read is kept per container name, so a restarted or recreated container
+# (or every container, after run() is called again) is resumed with since= instead of being read again.
+class ContainerWatcher:
+    def __init__(self, api, name_pattern=None, label=None, clock=time.time):
+        self.api = api
+        self.name_pattern = re.compile(name_pattern if name_pattern is not None else LOG_CONTAINER_PATTERN)
+        key, _, value = (label if label is not None else LOG_CONTAINER_LABEL).partition("=")
+        self.label = (key, value) if key else None
+        self.started_at = clock()
+        self.events_since = self.started_at
+        self.last_seen = {}  # container name -> time of the last log line read
+        self.readers = {}  # container id -> asyncio.Task
+        self._tasks = None  # TaskGroup while run() is active
+
+    def matches(self, name, labels):
+        if self.name_pattern.fullmatch(name):
+            return True
+        if self.label is not None:
+            key, value = self.label
+            return key in labels and (not value or labels[key] == value)
+        return False
+
+    def _seen(self, name, stamp):
+        if stamp > self.last_seen.get(name, 0):
+            self.last_seen[name] = stamp
+
+    # Starts a reader unless one is still running for this container; returns True when started
+    async def start_reader(self, container_id, name, since=None):
+        reader = self.readers.get(container_id)
+        if reader is not None and not reader.done():
+            return False
+
+        after = self.last_seen.get(name)
+        if after is None:
+            # Never read before: from the container's start (or the monitor's, if that is later)
+            after = max(since or 0, self.started_at)
+        try:
+            info = await self.api.inspect_container(container_id)
+        except Exception as e:
+            print(f"Cannot follow container {name}: {e}")  # e.g. already gone again
+            return False
+        # Without a TTY docker multiplexes stdout and stderr into frames
+        tty = bool(info.get("Config", {}).get("Tty"))
+        reader = self._tasks.create_task(self._read(container_id, name, after, tty), name=f"logs-{name}")
+        self.readers[container_id] = reader
+        reader.add_done_callback(lambda task: self._forget(container_id, task))
+        return True
+
+    def _forget(self, container_id, task):
+        if self.readers.get(container_id) is task:
+            del self.readers[container_id]
+
+    async def _read(self, container_id, name, after, tty):
+        print("Starting log stream for:", name)
+        try:
+            lines = await self.api.logs(container_id, since=after, tty=tty)
+            async with contextlib.aclosing(lines):
+                async for line in lines:
+                    stamp, line = split_timestamp(line)
+                    if stamp is not None:
+                        if stamp <= after:
+                            continue  # since= is inclusive: already handled
+                        self._seen(name, stamp)
+                    xml_message = log_event(name, line)
+                    if xml_message is not None:
+                        await publish_log_async(xml_message)
+        except Exception as e:
+            print(f"Error while streaming logs from {name}: {e}")
+        finally:
+            print(f"Log stream for {name} ended")
+
+    # Cancels the container's reader and waits for it to close its stream
+    async def stop_reader(self, container_id):
+        reader = self.readers.get(container_id)
+        if reader is None:
+            return
+        reader.cancel()
+        await asyncio.wait([reader])
+
+    async def handle_event(self, event):
+        actor = event.get("Actor", {})
+        attributes = actor.get("Attributes", {})
+        container_id = actor.get("ID") or event.get("id")
+        action = event.get("Action") or event.get("status")
+        if event.get("timeNano"):
+            self.events_since = max(self.events_since, event["timeNano"] / 1e9)
+
+        if action in ("die", "destroy"):
+            await self.stop_reader(container_id)
+            return
+        if action != "start":
+            return
+
+        # Event attributes hold the container's labels next to name and image
+        name = attributes.get("name", "")
+        if not self.matches(name, attributes):
+            return
+        # A reader still registered for this id belongs to the previous run of the container
+        await self.stop_reader(container_id)
+        if await self.start_reader(container_id, name, since=event.get("timeNano", 0) / 1e9 or None):
+            print(f"Container {name} started, following its logs")
+
+    # Runs until the events stream ends or fails (e.g. the docker daemon restarted); calling run()
+    # again resumes the events from the last one handled and every log stream from its last line.
+    async def run(self):
+        async with asyncio.TaskGroup() as tasks:
+            self._tasks = tasks
+            try:
+                # Subscribe before listing, so a container that starts in between is not missed
+                events = await self.api.events(
+                    since=self.events_since,
+                    filters={"type": ["container"], "event": ["start", "die", "destroy"]}
+                )
+                async with contextlib.aclosing(events):
+                    for container in await self.api.list_containers():
+                        name = container["Names"][0].lstrip("/")
+                        if self.matches(name, container.get("Labels") or {}):
+                            await self.start_reader(container["Id"], name)
+                    async for event in events:
+                        await self.handle_event(event)
+            finally:
+                for reader in list(self.readers.values()):
+                    reader.cancel()
+                self._tasks = None
+
+
+async def monitor_logs(watcher=None):
     print("Start met log monitoring...")
-    client = docker.from_env()
-    whitelist = [
-        "facturatie_user_providor",
-        "facturatie_update_providor",
-        "facturatie_deletion_providor",
-        "facturatie_creation_consumer",
-        "facturatie_update_consumer",
-        "facturatie_deletion_consumer",
-        "facturatie_invoice_processor",
-        "facturatie_app",
-        "facturatie_log_monitor",
-                ]
-    containers = [c for c in client.containers.list() if c.name in whitelist]
-
-    for container in containers:
-        thread = threading.Thread(target=monitor_container_logs, args=(container,))
-        thread.daemon = True
-        thread.start()
+    watcher = watcher or ContainerWatcher(DockerAPI())
+    await watcher.run()
+    return watcher
 
-if __name__ == "__main__":
+
+# Gauge probe for the /metrics endpoint: one of the shipper's counters, read when it is scraped
+def shipper_probe(key):
+    return lambda: shipper.stats()[key]
+
+
+# Publishes the suppression summaries and prints the shipper counters
+async def report_forever(interval=LOG_SUMMARY_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        await publish_suppressed(interval)
+        shipper.report()
+
+
+async def main():
     print("Logger wordt gestart...")
     print("Verbinden met RabbitMQ op", RABBITMQ_HOST, ":", RABBITMQ_PORT, "als", RABBITMQ_USER)
 
     try:
         # Testlogs bij opstart
         test_msg = create_xml_log("INFO", "Test startbericht van log-monitor")
-        publish_log(test_msg)
-        publish_log(create_xml_log("ERROR", "Test ERROR log van logger"))
-        publish_log(create_xml_log("WARNING", "Test WARNING log van logger"))
-        print("Testberichten succesvol verzonden\n")
+        await publish_log_async(test_msg)
+        await publish_log_async(create_xml_log("ERROR", "Test ERROR log van logger"))
+        await publish_log_async(create_xml_log("WARNING", "Test WARNING log van logger"))
+        print("Testberichten in de wachtrij gezet\n")
     except Exception as e:
         print("Kan geen verbinding maken met RabbitMQ:", e, "\n")
 
-    # Start monitoring
-    while True:
-        try:
-            monitor_logs()
-            while True:
-                time.sleep(1)  # Hou de main-thread levend
-        except Exception as e:
-            error_log = create_xml_log("ERROR", f"Logger crashed: {str(e)}")
-            print("Logger crashed:", e)
+    # docker stop: cancel everything, so every log stream is closed and the queue is flushed
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, main_task.cancel)
+
+    stats.start("log-monitor", probes={
+        f"log_shipper_{key}": shipper_probe(key) for key in ("queued", "published", "dropped", "failed_batches", "backlog")
+    })
+    reporter = asyncio.create_task(report_forever(), name="shipper-report")
+    # Start monitoring; after a crash the same watcher resumes events and log streams where it was
+    watcher = ContainerWatcher(DockerAPI())
+    try:
+        while True:
             try:
-                publish_log(error_log)
-            except Exception as pub_error:
-                print("Fout bij verzenden van crash-log:", pub_error)
-            time.sleep(5)
+                await monitor_logs(watcher)
+            except Exception as e:
+                print("Logger crashed:", e)
+                await publish_log_async(create_xml_log("ERROR", f"Logger crashed: {str(e)}"))
+            await asyncio.sleep(5)
+    finally:
+        reporter.cancel()
+        await asyncio.gather(reporter, return_exceptions=True)
+        shipper.close()
+        print("Logger gestopt")
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        pass
@@ -0,0 +1,65 @@
+import unittest
+
+from classifier import SeverityClassifier, ERROR, WARNING, INFO
+
+
+class TestSeverityClassifier(unittest.TestCase):
+
+    def setUp(self):
+        self.classifier = SeverityClassifier()
+
+    def test_keywords(self):
+        cases = {
+            "Critical failure occurred!": ERROR,
+            "Fatal: cannot connect": ERROR,
+            "3 errors found": ERROR,
+            "ERR connection refused": ERROR,
+            "Warning: deprecated method": WARNING,
+            "This is a normal log": INFO,
+        }
+        for line, status in cases.items():
+            self.assertEqual(self.classifier.classify(line), status, line)
+
+    def test_keywords_only_match_whole_words(self):
+        for line in ("interrupt received", "stderr redirected", "KeyboardInterrupt", "terrace", "forewarned"):
+            self.assertEqual(self.classifier.classify(line), INFO, line)
+
+    def test_class_names(self):
+        self.assertEqual(self.classifier.classify("mysql.connector.errors.IntegrityError: 1062"), ERROR)
+        self.assertEqual(self.classifier.classify("Traceback: ValueError raised"), ERROR)
+        self.assertEqual(self.classifier.classify("DeprecationWarning: use x"), WARNING)
+
+    def test_non_ascii_lines(self):
+        # "İ".lower() is two characters long; match positions must still line up with the line
+        self.assertEqual(self.classifier.classify("İİİİ xerr"), INFO)
+        self.assertEqual(self.classifier.classify("İstanbul connection ValueError"), ERROR)
+        self.assertEqual(self.classifier.classify("Ünïcödé warning"), WARNING)
+
+    def test_error_after_warning_wins(self):
+        self.assertEqual(self.classifier.classify("warning: retry failed with a fatal error"), ERROR)
+
+    def test_levelname_of_our_services_takes_precedence(self):
+        cases = {
+            "2025-05-24 12:00:00,123 - INFO - Processing error was retried": INFO,
+            "2025-05-24 12:00:00,123 - WARNING - User not found": WARNING,
+            "2025-05-24 12:00:00,123 - ERROR - RabbitMQ Error: lost": ERROR,
+            "2025-05-24 12:00:00,123 - CRITICAL - out of memory": ERROR,
+            "2025-05-24 12:00:00,123 - DEBUG - exception details": INFO,
+        }
+        for line, status in cases.items():
+            self.assertEqual(self.classifier.classify(line), status, line)
+
+    def test_unknown_levelname_falls_back_to_keywords(self):
+        self.assertIsNone(SeverityClassifier.levelname("2025-05-24 12:00:00,123 - NOTICE - fatal"))
+        self.assertEqual(self.classifier.classify("2025-05-24 12:00:00,123 - NOTICE - fatal"), ERROR)
+
+    def test_custom_keywords(self):
+        classifier = SeverityClassifier(error_keywords=("panic",), warning_keywords=("slow",))
+
+        self.assertEqual(classifier.classify("kernel panic"), ERROR)
+        self.assertEqual(classifier.classify("slow query"), WARNING)
+        self.assertEqual(classifier.classify("error"), INFO)
+
+
+if __name__ == "__main__":
+    unittest.main()
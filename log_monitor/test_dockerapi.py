@@ -0,0 +1,124 @@
+import os
+import json
+import struct
+import asyncio
+import tempfile
+import unittest
+
+from dockerapi import DockerAPI, DockerError, demultiplex, iter_lines, socket_path
+
+
+def chunked(*parts):
+    return b"".join(b"%x\r\n%s\r\n" % (len(part), part) for part in parts) + b"0\r\n\r\n"
+
+
+def frame(payload, stream=1):
+    return struct.pack(">BxxxI", stream, len(payload)) + payload
+
+
+async def chunks(*parts):
+    for part in parts:
+        yield part
+
+
+# Serves canned HTTP responses on a unix socket the way dockerd does, keyed by request path
+class FakeDaemon:
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "docker.sock")
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_unix_server(self.serve, path=self.path)
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+        self.directory.cleanup()
+
+    async def serve(self, reader, writer):
+        request = await reader.readuntil(b"\r\n\r\n")
+        target = request.split(b" ")[1].decode()
+        self.requests.append(target)
+        status, headers, body = self.responses[target.split("?")[0]]
+        writer.write(b"HTTP/1.1 %d X\r\n%s\r\n%s" % (status, b"".join(h + b"\r\n" for h in headers), body))
+        await writer.drain()
+        writer.close()
+
+
+class TestDockerAPI(unittest.TestCase):
+
+    def test_socket_path_from_docker_host(self):
+        os.environ["DOCKER_HOST"] = "unix:///run/user/1000/docker.sock"
+        try:
+            self.assertEqual(socket_path(), "/run/user/1000/docker.sock")
+        finally:
+            del os.environ["DOCKER_HOST"]
+        self.assertEqual(socket_path(), "/var/run/docker.sock")
+
+    def test_iter_lines_splits_across_chunks_and_caps_length(self):
+        async def collect(max_line):
+            return [line async for line in iter_lines(chunks(b"fir", b"st\nsec", b"ond\n", b"x" * 10), max_line)]
+
+        self.assertEqual(asyncio.run(collect(64)), [b"first", b"second", b"x" * 10])
+        self.assertEqual(asyncio.run(collect(4)), [b"first", b"second", b"xxxx", b"xxxx", b"xx"])
+
+    def test_demultiplex_strips_frame_headers(self):
+        data = frame(b"out\n") + frame(b"err\n", stream=2)
+
+        async def collect():
+            return [payload async for payload in demultiplex(chunks(data[:3], data[3:10], data[10:]))]
+
+        self.assertEqual(asyncio.run(collect()), [b"out\n", b"err\n"])
+
+    def test_list_containers(self):
+        body = json.dumps([{"Id": "abc", "Names": ["/facturatie_app"]}]).encode()
+
+        async def scenario():
+            async with FakeDaemon({"/containers/json": (200, [b"Content-Length: %d" % len(body)], body)}) as daemon:
+                return await DockerAPI(daemon.path).list_containers()
+
+        self.assertEqual(asyncio.run(scenario()), [{"Id": "abc", "Names": ["/facturatie_app"]}])
+
+    def test_error_status_raises(self):
+        async def scenario():
+            body = chunked(b'{"message":"No such container: abc"}')
+            async with FakeDaemon({"/containers/abc/json": (404, [b"Transfer-Encoding: chunked"], body)}) as daemon:
+                await DockerAPI(daemon.path).inspect_container("abc")
+
+        with self.assertRaises(DockerError) as raised:
+            asyncio.run(scenario())
+        self.assertEqual(raised.exception.status, 404)
+
+    def test_follow_logs(self):
+        body = chunked(frame(b"2025-05-24T12:00:01.000000000Z up\n"), frame(b"2025-05-24T12:00:02.0"), frame(b"00000000Z ready\n"))
+
+        async def scenario():
+            async with FakeDaemon({"/containers/abc/logs": (200, [b"Transfer-Encoding: chunked"], body)}) as daemon:
+                lines = await DockerAPI(daemon.path).logs("abc", since=1748088000.5)
+                return [line async for line in lines], daemon.requests
+
+        lines, requests = asyncio.run(scenario())
+
+        self.assertEqual(lines, [b"2025-05-24T12:00:01.000000000Z up", b"2025-05-24T12:00:02.000000000Z ready"])
+        self.assertEqual(requests, ["/containers/abc/logs?follow=1&stdout=1&stderr=1&timestamps=1&since=1748088000.500000000"])
+
+    def test_events(self):
+        events = [{"Action": "start", "Actor": {"ID": "abc"}}, {"Action": "die", "Actor": {"ID": "abc"}}]
+        body = chunked(*(json.dumps(event).encode() + b"\n" for event in events))
+
+        async def scenario():
+            async with FakeDaemon({"/events": (200, [b"Transfer-Encoding: chunked"], body)}) as daemon:
+                stream = await DockerAPI(daemon.path).events(filters={"type": ["container"]})
+                return [event async for event in stream], daemon.requests
+
+        received, requests = asyncio.run(scenario())
+
+        self.assertEqual(received, events)
+        self.assertEqual(requests, ["/events?filters=%7B%22type%22%3A+%5B%22container%22%5D%7D"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,9 @@
 import unittest
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 import xml.etree.ElementTree as ET
 import os
+import time
+import asyncio
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -12,7 +14,8 @@ os.environ["RABBITMQ_PORT"] = "5672"
 os.environ["RABBITMQ_USER"] = "guest"
 os.environ["RABBITMQ_PASSWORD"] = "guest"
 
-from logger import create_xml_log, publish_log, monitor_container_logs
+from logger import create_xml_log, publish_log_async, LogShipper, ContainerWatcher, split_timestamp, RateLimiter, TokenBucket
+import logger as log_monitor
 
 class TestLogger(unittest.TestCase):
 
@@ -24,39 +27,358 @@ class TestLogger(unittest.TestCase):
         self.assertEqual(root.find("Status").text, "ERROR")
         self.assertEqual(root.find("Message").text, "Something went wrong")
 
-    @patch("logger.pika.BlockingConnection")
-    def test_publish_log_success(self, mock_connection):
-        mock_channel = MagicMock()
-        mock_connection.return_value.channel.return_value = mock_channel
-
+    @patch("logger.shipper")
+    def test_publish_log_async_hands_message_to_shipper(self, mock_shipper):
+        mock_shipper.offer.return_value = True
         xml_message = create_xml_log("INFO", "Test message")
-        publish_log(xml_message)
 
-        mock_channel.exchange_declare.assert_called_with(exchange="log_monitoring", exchange_type="direct", durable=True)
-        mock_channel.basic_publish.assert_called_with(
-            exchange="log_monitoring",
-            routing_key="controlroom.log.event",
-            body=xml_message
+        self.assertTrue(asyncio.run(publish_log_async(xml_message)))
+
+        mock_shipper.start.assert_called_once()
+        mock_shipper.offer.assert_called_once_with(xml_message)
+        mock_shipper.submit.assert_not_called()
+
+class TestLogShipper(unittest.TestCase):
+
+    def test_declares_log_topology_once_on_one_publisher(self):
+        publisher = LogShipper().publisher
+
+        self.assertEqual(publisher.exchange, "log_monitoring")
+        self.assertEqual(publisher.exchange_type, "direct")
+        self.assertEqual(publisher.bindings, [("controlroom.log.event", "controlroom.log.event")])
+
+    def test_publishes_queued_messages_in_order(self):
+        publisher = MagicMock()
+        shipper = LogShipper(publisher=publisher)
+        shipper.start()
+
+        for i in range(3):
+            shipper.submit(f"<Log>{i}</Log>".encode())
+        shipper.close()
+
+        self.assertEqual(
+            [c.args for c in publisher.publish.call_args_list],
+            [("controlroom.log.event", f"<Log>{i}</Log>".encode()) for i in range(3)]
         )
+        publisher.close.assert_called_once()
+        self.assertEqual(shipper.stats()["published"], 3)
+
+    def test_full_queue_drops_oldest(self):
+        shipper = LogShipper(publisher=MagicMock(), maxsize=2, enqueue_timeout=0)
+
+        results = [shipper.submit(message) for message in (b"a", b"b", b"c")]
+
+        self.assertEqual(results, [True, True, True])
+        self.assertEqual(list(shipper._queue.queue), [b"b", b"c"])
+        self.assertEqual(shipper.stats()["dropped"], 1)
+
+    def test_full_queue_drops_newest(self):
+        shipper = LogShipper(publisher=MagicMock(), maxsize=2, enqueue_timeout=0, drop_policy="newest")
+
+        results = [shipper.submit(message) for message in (b"a", b"b", b"c")]
+
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(list(shipper._queue.queue), [b"a", b"b"])
+        self.assertEqual(shipper.stats()["dropped"], 1)
+
+    def test_failed_batch_is_retried(self):
+        publisher = MagicMock()
+        publisher.publish.side_effect = [Exception("broker down"), None, None]
+        shipper = LogShipper(publisher=publisher, retry_delay=0)
+        shipper.start()
+        shipper.submit(b"a")
+        shipper.submit(b"b")
+
+        deadline = time.monotonic() + 5
+        while shipper.stats()["published"] < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        shipper.close()
+
+        self.assertEqual([c.args[1] for c in publisher.publish.call_args_list], [b"a", b"a", b"b"])
+        self.assertEqual(shipper.stats()["published"], 2)
+        self.assertEqual(shipper.stats()["failed_batches"], 1)
+
+    def test_offer_never_blocks(self):
+        shipper = LogShipper(publisher=MagicMock(), maxsize=1)
+
+        self.assertEqual([shipper.offer(b"a"), shipper.offer(b"b")], [True, False])
+        self.assertEqual(shipper.stats()["dropped"], 0)
+
+    def test_publish_log_async_waits_for_room_then_applies_drop_policy(self):
+        shipper = LogShipper(publisher=MagicMock(), maxsize=1, enqueue_timeout=0.05, drop_policy="newest")
+        shipper.start = MagicMock()
+        shipper.offer(b"a")
+
+        with patch.object(log_monitor, "shipper", shipper):
+            self.assertFalse(asyncio.run(log_monitor.publish_log_async(b"b")))
+
+        self.assertEqual(list(shipper._queue.queue), [b"a"])
+        self.assertEqual(shipper.stats()["dropped"], 1)
+
+    def test_unknown_drop_policy(self):
+        with self.assertRaises(ValueError):
+            LogShipper(publisher=MagicMock(), drop_policy="random")
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.limiter = RateLimiter({"ERROR": "1,3", "INFO": "0.5,2"}, clock=lambda: self.now)
+
+    def test_token_bucket_burst_and_refill(self):
+        bucket = TokenBucket(rate=2, burst=3, now=0)
+
+        self.assertEqual([bucket.take(0) for _ in range(4)], [True, True, True, False])
+        self.assertTrue(bucket.take(0.5))
+        self.assertFalse(bucket.take(0.5))
+
+    def test_info_spam_does_not_use_error_budget(self):
+        info = [self.limiter.allow("facturatie_app", "INFO") for _ in range(100)]
+        errors = [self.limiter.allow("facturatie_app", "ERROR") for _ in range(3)]
+
+        self.assertEqual(info.count(True), 2)
+        self.assertEqual(errors, [True, True, True])
+
+    def test_containers_have_their_own_buckets(self):
+        for _ in range(5):
+            self.limiter.allow("facturatie_app", "INFO")
+
+        self.assertTrue(self.limiter.allow("facturatie_user_providor", "INFO"))
+
+    def test_unknown_severity_uses_info_limit(self):
+        self.assertEqual([self.limiter.allow("facturatie_app", "DEBUG") for _ in range(3)], [True, True, False])
+
+    def test_suppressed_lines_are_summarised_once(self):
+        for _ in range(40):
+            self.limiter.allow("facturatie_app", "INFO")
+        for _ in range(5):
+            self.limiter.allow("facturatie_app", "ERROR")
+
+        self.assertEqual(self.limiter.summaries(), [
+            ("facturatie_app", "ERROR", 2),
+            ("facturatie_app", "INFO", 38),
+        ])
+        self.assertEqual(self.limiter.summaries(), [])
+
+    @patch("logger.publish_log_async", new_callable=AsyncMock)
+    def test_publish_suppressed_sends_summary_events(self, mock_publish):
+        with patch.object(log_monitor, "rate_limiter", self.limiter):
+            for _ in range(39):
+                self.limiter.allow("facturatie_app", "WARNING")
+
+            asyncio.run(log_monitor.publish_suppressed(30))
+
+        root = ET.fromstring(mock_publish.call_args[0][0])
+        self.assertEqual(root.find("Status").text, "WARNING")
+        self.assertEqual(root.find("Message").text, "facturatie_app: 37 similar WARNING lines suppressed in the last 30s")
+
+
+async def iterate(items, close_log=None, hold=False):
+    try:
+        for item in items:
+            yield item
+        if hold:
+            await asyncio.Event().wait()  # a followed stream only ends when it is closed
+    finally:
+        if close_log is not None:
+            close_log.append(True)
+
 
-    @patch("logger.publish_log")
-    def test_monitor_container_logs_detects_errors_and_warnings(self, mock_publish):
-        mock_container = MagicMock()
-        mock_container.name = "facturatie_app"
-        mock_container.logs.return_value = iter([
+def container(name, container_id=None, labels=None):
+    return {"Id": container_id or f"id-{name}", "Names": [f"/{name}"], "Labels": labels or {}}
+
+
+def start_event(container_id, name, attributes=None, time_nano=1748088000000000000):
+    return {
+        "Type": "container",
+        "Action": "start",
+        "Actor": {"ID": container_id, "Attributes": {"name": name, **(attributes or {})}},
+        "timeNano": time_nano,
+    }
+
+
+# Stands in for dockerapi.DockerAPI: canned containers, events and log lines per container id
+class FakeDockerAPI:
+    def __init__(self, containers=(), events=(), logs=None, hold=False):
+        self.containers = list(containers)
+        self.event_list = list(events)
+        self.log_lines = logs or {}
+        self.hold = hold
+        self.calls = []
+        self.closed = []
+
+    async def events(self, since=None, filters=None):
+        self.calls.append(("events", since, filters))
+        return iterate(self.event_list, hold=True)
+
+    async def list_containers(self):
+        return self.containers
+
+    async def inspect_container(self, container_id):
+        if container_id not in self.log_lines:
+            raise KeyError(container_id)
+        return {"Id": container_id, "Config": {"Tty": False}}
+
+    async def logs(self, container_id, since=None, tty=False):
+        self.calls.append(("logs", container_id, since))
+        return iterate(self.log_lines[container_id], self.closed, self.hold)
+
+
+@patch("logger.publish_log_async", new_callable=AsyncMock)
+class TestContainerWatcher(unittest.TestCase):
+
+    def make_watcher(self, api=None, **kwargs):
+        return ContainerWatcher(api or FakeDockerAPI(), clock=lambda: 1748088000.0, **kwargs)
+
+    # Runs the watcher until `done()` holds, then cancels it like a SIGTERM would
+    def run_until(self, watcher, done):
+        async def scenario():
+            run = asyncio.create_task(watcher.run())
+            for _ in range(10000):
+                if done():
+                    break
+                await asyncio.sleep(0)
+            run.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await run
+            self.assertTrue(done())
+
+        asyncio.run(scenario())
+
+    def test_split_timestamp(self, mock_publish):
+        stamp, line = split_timestamp(b"2025-05-24T12:00:00.123456789Z Starting consumer")
+
+        self.assertAlmostEqual(stamp, 1748088000.123456789)
+        self.assertEqual(line, b"Starting consumer")
+        self.assertEqual(split_timestamp(b"no timestamp"), (None, b"no timestamp"))
+
+    def test_matches_name_pattern_or_label(self, mock_publish):
+        watcher = self.make_watcher(name_pattern=r"facturatie_.*", label="logs.monitor=true")
+
+        self.assertTrue(watcher.matches("facturatie_app", {}))
+        self.assertFalse(watcher.matches("other_facturatie_app", {}))
+        self.assertTrue(watcher.matches("crm", {"logs.monitor": "true"}))
+        self.assertFalse(watcher.matches("crm", {"logs.monitor": "false"}))
+
+    def test_default_pattern_is_the_whitelist(self, mock_publish):
+        watcher = self.make_watcher()
+
+        self.assertTrue(watcher.matches("facturatie_app", {}))
+        self.assertFalse(watcher.matches("facturatie_app_old", {}))
+
+    def test_follows_running_and_started_containers(self, mock_publish):
+        api = FakeDockerAPI(
+            containers=[container("facturatie_user_providor"), container("mysql")],
+            events=[
+                start_event("id-facturatie_update_consumer", "facturatie_update_consumer"),
+                start_event("id-mysql", "mysql"),
+            ],
+            logs={
+                "id-facturatie_user_providor": [b"2025-05-24T12:00:01.000000000Z up"],
+                "id-facturatie_update_consumer": [b"2025-05-24T12:00:05.000000000Z Error: broker down"],
+                "id-mysql": [b"2025-05-24T12:00:01.000000000Z ready"],
+            }
+        )
+        watcher = self.make_watcher(api)
+
+        self.run_until(watcher, lambda: len(watcher.last_seen) == 2)
+
+        self.assertEqual(api.calls[0], (
+            "events", 1748088000.0, {"type": ["container"], "event": ["start", "die", "destroy"]}
+        ))
+        self.assertIn(("logs", "id-facturatie_user_providor", 1748088000.0), api.calls)
+        self.assertNotIn("id-mysql", [call[1] for call in api.calls])
+        self.assertEqual(watcher.last_seen, {
+            "facturatie_user_providor": 1748088001.0,
+            "facturatie_update_consumer": 1748088005.0,
+        })
+        statuses = sorted(ET.fromstring(c.args[0]).find("Status").text for c in mock_publish.call_args_list)
+        self.assertEqual(statuses, ["ERROR", "INFO"])
+
+    def test_reader_classifies_errors_and_warnings(self, mock_publish):
+        api = FakeDockerAPI(logs={"id-app": [
             b"This is a normal log",
             b"Warning: deprecated method",
-            b"Critical failure occurred!"
-        ])
+            b"Critical failure occurred!",
+        ]})
+        watcher = self.make_watcher(api)
+
+        async def scenario():
+            async with asyncio.TaskGroup() as tasks:
+                watcher._tasks = tasks
+                await watcher.start_reader("id-app", "facturatie_app")
+
+        asyncio.run(scenario())
+
+        decoded = [ET.fromstring(c.args[0]) for c in mock_publish.await_args_list]
+        self.assertEqual([event.find("Status").text for event in decoded], ["INFO", "WARNING", "ERROR"])
+        self.assertEqual(decoded[2].find("Message").text, "facturatie_app: Critical failure occurred!")
+
+    def test_restarted_container_resumes_after_last_seen_line(self, mock_publish):
+        api = FakeDockerAPI(logs={"id-app": [
+            b"2025-05-24T12:00:01.000000000Z first",
+            b"2025-05-24T12:00:02.000000000Z second",
+        ]})
+        watcher = self.make_watcher(api)
+
+        async def scenario():
+            async with asyncio.TaskGroup() as tasks:
+                watcher._tasks = tasks
+                await watcher.start_reader("id-app", "facturatie_app")
+                await asyncio.wait(list(watcher.readers.values()))
+                published = mock_publish.await_count
+                await watcher.handle_event(start_event("id-app", "facturatie_app", time_nano=1748088010000000000))
+            return published
+
+        published = asyncio.run(scenario())
+
+        self.assertEqual(api.calls[-1], ("logs", "id-app", 1748088002.0))
+        # Both lines come back from docker (since= is inclusive) but none is handled twice
+        self.assertEqual(watcher.last_seen["facturatie_app"], 1748088002.0)
+        self.assertEqual(mock_publish.await_count, published)
+
+    def test_die_event_cancels_reader_and_closes_stream(self, mock_publish):
+        api = FakeDockerAPI(logs={"id-app": [b"2025-05-24T12:00:01.000000000Z up"]}, hold=True)
+        watcher = self.make_watcher(api)
+
+        async def scenario():
+            async with asyncio.TaskGroup() as tasks:
+                watcher._tasks = tasks
+                await watcher.start_reader("id-app", "facturatie_app")
+                while mock_publish.await_count == 0:
+                    await asyncio.sleep(0)
+                await watcher.handle_event({"Action": "die", "Actor": {"ID": "id-app", "Attributes": {"name": "facturatie_app"}}})
+
+        asyncio.run(scenario())
+
+        self.assertEqual(api.closed, [True])
+        self.assertEqual(watcher.readers, {})
+
+    def test_cancelling_run_closes_every_stream(self, mock_publish):
+        names = [f"facturatie_app_{i}" for i in range(50)]
+        api = FakeDockerAPI(
+            containers=[container(name) for name in names],
+            logs={f"id-{name}": [] for name in names},
+            hold=True
+        )
+        watcher = self.make_watcher(api, name_pattern=r"facturatie_app_\d+")
+
+        self.run_until(watcher, lambda: len(api.calls) == 1 + len(names))
+
+        self.assertEqual(len(api.closed), len(names))
+        self.assertEqual(watcher.readers, {})
+
+    def test_container_gone_before_reader_starts(self, mock_publish):
+        watcher = self.make_watcher()
 
-        monitor_container_logs(mock_container)
+        async def scenario():
+            async with asyncio.TaskGroup() as tasks:
+                watcher._tasks = tasks
+                return await watcher.start_reader("id-gone", "facturatie_app")
 
-        calls = [call[0][0] for call in mock_publish.call_args_list]
-        decoded = [ET.fromstring(c) for c in calls]
+        self.assertFalse(asyncio.run(scenario()))
 
-        self.assertEqual(decoded[0].find("Status").text, "INFO")
-        self.assertEqual(decoded[1].find("Status").text, "WARNING")
-        self.assertEqual(decoded[2].find("Status").text, "ERROR")
 
 if __name__ == "__main__":
     unittest.main()
@@ -4,18 +4,22 @@ import xml.etree.ElementTree as ET
 import logging
 import io
 import os
+import mysql.connector
+from mysql.connector import errorcode
 
 from user_creation_consumer import (
-    user_exists,
     parse_user_xml,
     create_user,
     on_message,
-    start_consumer
+    start_consumer,
+    ledger
 )
+from common import idempotency, usermessage
 
 class TestUserCreationConsumer(unittest.TestCase):
     
     def setUp(self):
+        ledger.clear()
         # Set up test data
         self.sample_xml = """
         <UserMessage>
@@ -68,24 +72,6 @@ class TestUserCreationConsumer(unittest.TestCase):
     def tearDown(self):
         self.log_capture.close()
 
-    @patch('user_creation_consumer.mysql.connector.connect')
-    def test_user_exists_true(self, mock_connect):
-        mock_cursor = MagicMock()
-        mock_connect.return_value.cursor.return_value = mock_cursor
-        mock_cursor.fetchone.return_value = [1]
-        
-        result = user_exists('2025-04-29T14:22:27.816332Z')
-        self.assertTrue(result)
-        
-    @patch('user_creation_consumer.mysql.connector.connect')
-    def test_user_exists_false(self, mock_connect):
-        mock_cursor = MagicMock()
-        mock_connect.return_value.cursor.return_value = mock_cursor
-        mock_cursor.fetchone.return_value = None
-        
-        result = user_exists('2025-04-29T14:22:27.816332Z')
-        self.assertFalse(result)
-        
     def test_parse_user_xml_success(self):
         result = parse_user_xml(self.sample_xml)
         self.assertEqual(result['action_type'], 'CREATE')
@@ -105,31 +91,97 @@ class TestUserCreationConsumer(unittest.TestCase):
         self.assertEqual(result['first_name'], '')  # Default empty string
         self.assertEqual(result['company'], '')    # Default empty string
         
+    def test_parse_user_xml_without_password(self):
+        test_xml = """
+        <UserMessage>
+            <ActionType>CREATE</ActionType>
+            <UUID>2025-04-29T14:22:27.816332Z</UUID>
+            <TimeOfAction>2025-04-29T14:22:27.816332Z</TimeOfAction>
+        </UserMessage>
+        """
+        with self.assertRaises(usermessage.MalformedMessage):
+            parse_user_xml(test_xml)
+
     def test_parse_user_xml_invalid(self):
         with self.assertRaises(Exception):
             parse_user_xml("invalid xml data")
 
-    @patch('user_creation_consumer.user_exists')
-    @patch('user_creation_consumer.mysql.connector.connect')
-    def test_create_user_success(self, mock_connect, mock_user_exists):
-        mock_user_exists.return_value = False
+    @patch('user_creation_consumer.get_db_connection')
+    def test_create_user_success(self, mock_connect):
         mock_cursor = MagicMock()
         mock_connect.return_value.cursor.return_value = mock_cursor
         
         result = create_user(self.sample_data)
         self.assertTrue(result)
+        # One INSERT on one connection, no separate existence check
         mock_cursor.execute.assert_called_once()
+        mock_connect.assert_called_once()
         
-    @patch('user_creation_consumer.user_exists')
-    def test_create_user_already_exists(self, mock_user_exists):
-        mock_user_exists.return_value = True
+    @patch('user_creation_consumer.get_db_connection')
+    def test_create_user_already_exists(self, mock_connect):
+        mock_cursor = MagicMock()
+        mock_connect.return_value.cursor.return_value = mock_cursor
+        mock_cursor.execute.side_effect = mysql.connector.IntegrityError(
+            msg="Duplicate entry", errno=errorcode.ER_DUP_ENTRY
+        )
         
         result = create_user(self.sample_data)
         self.assertFalse(result)
+        mock_connect.return_value.rollback.assert_called_once()
         logs = self.log_capture.getvalue()
         self.assertIn("User met timestamp", logs)
         self.assertIn("bestaat al", logs)
 
+    @patch('user_creation_consumer.get_db_connection')
+    def test_create_user_skips_existing_uuid_without_unique_index(self, mock_connect):
+        mock_cursor = MagicMock()
+        mock_cursor.rowcount = 0  # WHERE NOT EXISTS found the UUID, nothing inserted
+        mock_connect.return_value.cursor.return_value = mock_cursor
+
+        result = create_user(self.sample_data)
+        self.assertFalse(result)
+        sql, values = mock_cursor.execute.call_args[0]
+        self.assertIn("WHERE NOT EXISTS (SELECT 1 FROM client WHERE timestamp = %s)", sql)
+        self.assertEqual(values[-1], self.sample_data['uuid'])
+        mock_connect.return_value.rollback.assert_called_once()
+        mock_connect.return_value.commit.assert_not_called()
+        self.assertIn("bestaat al", self.log_capture.getvalue())
+
+    @patch('user_creation_consumer.get_db_connection')
+    def test_create_user_other_integrity_error_raises(self, mock_connect):
+        mock_cursor = MagicMock()
+        mock_connect.return_value.cursor.return_value = mock_cursor
+        mock_cursor.execute.side_effect = mysql.connector.IntegrityError(
+            msg="Column 'email' cannot be null", errno=errorcode.ER_BAD_NULL_ERROR
+        )
+        
+        with self.assertRaises(mysql.connector.IntegrityError):
+            create_user(self.sample_data)
+
+    @patch('user_creation_consumer.get_db_connection')
+    def test_create_user_duplicate_message_is_skipped(self, mock_connect):
+        mock_cursor = MagicMock()
+        mock_cursor.rowcount = 0  # key already in processed_messages
+        mock_connect.return_value.cursor.return_value = mock_cursor
+
+        result = create_user(self.sample_data, "a" * 64)
+        self.assertFalse(result)
+        # Only the ledger insert ran, the client table was not touched
+        mock_cursor.execute.assert_called_once()
+        self.assertIn("processed_messages", mock_cursor.execute.call_args[0][0])
+        mock_connect.return_value.rollback.assert_called_once()
+
+    @patch('user_creation_consumer.create_user')
+    def test_on_message_redelivery_is_acked_without_processing(self, mock_create):
+        ledger.remember(idempotency.message_key(self.sample_data['uuid'], self.sample_data['timestamp']))
+        mock_channel = MagicMock()
+        mock_method = MagicMock()
+
+        on_message(mock_channel, mock_method, None, self.sample_xml.encode())
+
+        mock_create.assert_not_called()
+        mock_channel.basic_ack.assert_called_once_with(mock_method.delivery_tag)
+
     @patch('user_creation_consumer.create_user')
     @patch('user_creation_consumer.parse_user_xml')
     def test_on_message_success(self, mock_parse, mock_create):
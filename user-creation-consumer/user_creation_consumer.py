@@ -1,75 +1,70 @@
 import pika
 import os
 import logging
-import xml.etree.ElementTree as ET
 import mysql.connector
+from mysql.connector import errorcode
+from common import db, consumer, usermessage, stats, idempotency, retry
 
 # Logging instellen
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Check of gebruiker al bestaat via UUID (= timestamp)
-def user_exists(uuid_timestamp):
-    conn = mysql.connector.connect(
-        host=os.getenv("DB_HOST"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        database=os.getenv("DB_NAME")
-    )
-    cursor = conn.cursor()
-    try:
-        cursor.execute("SELECT id FROM client WHERE timestamp = %s", (uuid_timestamp,))
-        return cursor.fetchone() is not None
-    finally:
-        cursor.close()
-        conn.close()
+# Reeds verwerkte berichten (UUID + TimeOfAction): een herlevering wordt geackt zonder DB-werk
+ledger = idempotency.Ledger("user-creation-consumer")
 
-# XML parser
+# Databaseverbinding uit de gedeelde pool
+def get_db_connection():
+    return db.get_connection()
+
+# Velden die een CREATE-bericht moet bevatten
+REQUIRED_FIELDS = ("action_type", "uuid", "time_of_action", "password")
+
+# XML parser (gedeelde UserMessage decoder, rechtstreeks op de bytes van het bericht)
 def parse_user_xml(xml_data):
     try:
-        root = ET.fromstring(xml_data)
-
-        business = root.find('Business')
+        message = usermessage.decode(xml_data, required=REQUIRED_FIELDS)
 
         return {
-            'action_type': root.find('ActionType').text,
-            'uuid': root.find('UUID').text,
-            'timestamp': root.find('TimeOfAction').text,
-            'password': root.find('EncryptedPassword').text,
-            'first_name': root.findtext('FirstName', default=''),
-            'last_name': root.findtext('LastName', default=''),
-            'phone': root.findtext('PhoneNumber', default=''),
-            'email': root.findtext('EmailAddress', default=''),
-            'company': business.findtext('BusinessName', default='') if business is not None else '',
-            'company_email': business.findtext('BusinessEmail', default='') if business is not None else '',
-            'address': business.findtext('RealAddress', default='') if business is not None else '',
-            'vat': business.findtext('BTWNumber', default='') if business is not None else '',
-            'invoice_address': business.findtext('FacturationAddress', default='') if business is not None else ''
+            'action_type': message.action_type,
+            'uuid': message.uuid,
+            'timestamp': message.time_of_action,
+            'password': message.password,
+            'first_name': message.get('first_name', ''),
+            'last_name': message.get('last_name', ''),
+            'phone': message.get('phone', ''),
+            'email': message.get('email', ''),
+            'company': message.get('business_name', ''),
+            'company_email': message.get('business_email', ''),
+            'address': message.get('real_address', ''),
+            'vat': message.get('btw_number', ''),
+            'invoice_address': message.get('facturation_address', '')
         }
     except Exception as e:
         logger.error(f"XML parsing failed: {e}")
         raise
 
 # Gebruiker toevoegen aan DB
-def create_user(data):
-    if user_exists(data['uuid']):
-        logger.warning(f"User met timestamp {data['uuid']} bestaat al.")
-        return False
-
+# Geen aparte bestaat-check meer: de INSERT zelf slaat een bestaande UUID over (WHERE NOT EXISTS),
+# dus 0 rijen betekent "bestaat al". De consumer draait geen migraties, dus dit werkt ook zolang
+# de unieke index op client.timestamp (migratie 4) er nog niet is. Met die index vangt de
+# duplicate-key fout bovendien twee gelijktijdige inserts van dezelfde UUID op.
+# message_key wordt in dezelfde transactie in processed_messages gezet; False als het bericht al verwerkt was.
+def create_user(data, message_key=None):
+    conn = get_db_connection()
+    cursor = conn.cursor()
     try:
-        conn = mysql.connector.connect(
-            host=os.getenv("DB_HOST"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD"),
-            database=os.getenv("DB_NAME")
-        )
-        cursor = conn.cursor()
+        if not ledger.claim(cursor, message_key):
+            conn.rollback()
+            logger.info(f"Bericht voor {data['uuid']} al verwerkt, overslaan.")
+            return False
         sql = """
             INSERT INTO client (
                 role, email, pass, status, first_name, last_name,
                 phone, company, address_1, company_vat,
                 timestamp, created_at
-            ) VALUES (%s, %s, %s, 'active', %s, %s, %s, %s, %s, %s, %s, NOW())
+            )
+            SELECT %s, %s, %s, 'active', %s, %s, %s, %s, %s, %s, %s, NOW() FROM DUAL
+            WHERE NOT EXISTS (SELECT 1 FROM client WHERE timestamp = %s)
         """
         values = (
             'client',
@@ -81,12 +76,25 @@ def create_user(data):
             data['company'],
             data['address'],
             data['vat'],
+            data['uuid'],
             data['uuid']
         )
         cursor.execute(sql, values)
+        if cursor.rowcount == 0:
+            conn.rollback()
+            logger.warning(f"User met timestamp {data['uuid']} bestaat al.")
+            return False
         conn.commit()
+        ledger.remember(message_key)
         logger.info(f"Gebruiker aangemaakt: {data['email']} ({data['uuid']})")
         return True
+    except mysql.connector.IntegrityError as e:
+        conn.rollback()
+        if e.errno == errorcode.ER_DUP_ENTRY:
+            logger.warning(f"User met timestamp {data['uuid']} bestaat al.")
+            return False
+        logger.error(f"Gebruiker aanmaken mislukt: {e}")
+        raise
     except Exception as e:
         logger.error(f"Gebruiker aanmaken mislukt: {e}")
         conn.rollback()
@@ -99,11 +107,19 @@ def create_user(data):
 def on_message(channel, method, properties, body):
     try:
         logger.info(f"Bericht ontvangen via {method.routing_key}")
-        user_data = parse_user_xml(body.decode())
+        with stats.timed("parse_seconds"):
+            user_data = parse_user_xml(body)
 
         if user_data['action_type'].upper() != 'CREATE':
             logger.warning(f"Ignoreren: niet-‘CREATE’ actie: {user_data['action_type']}")
-            channel.basic_ack(method.delivery_tag)
+            consumer.ack(channel, method.delivery_tag)
+            return
+
+        # Herlevering van een bericht dat dit proces al verwerkte: meteen acken
+        message_key = idempotency.message_key(user_data['uuid'], user_data['timestamp'])
+        if ledger.is_duplicate(message_key):
+            logger.info(f"Bericht voor {user_data['uuid']} al verwerkt, overslaan.")
+            consumer.ack(channel, method.delivery_tag)
             return
 
         # UUID format fix
@@ -112,12 +128,14 @@ def on_message(channel, method, properties, body):
         if 'T' in user_data['uuid']:
             user_data['uuid'] = user_data['uuid'].replace('T', ' ')
 
-        create_user(user_data)
-        channel.basic_ack(method.delivery_tag)
+        with stats.timed("db_seconds"):
+            create_user(user_data, message_key)
+        consumer.ack(channel, method.delivery_tag)
 
     except Exception as e:
         logger.error(f"Fout tijdens verwerking: {e}")
-        channel.basic_nack(method.delivery_tag, requeue=False)
+        # Tijdelijke fouten (DB weg, lock timeout) gaan naar een retry queue, de rest naar de DLQ
+        retry.reject(channel, method, properties, body, e)
 
 # Consumer starten
 def start_consumer():
@@ -130,16 +148,20 @@ def start_consumer():
         )
     ))
     channel = connection.channel()
+    try:
+        ledger.initialize()
+    except Exception as e:
+        logger.error(f"Initialisatie idempotency ledger mislukt: {e}")
+    # Statistieken voor de heartbeat (enkel als STATS_HOST gezet is)
+    stats.start("user-creation-consumer", probes={"db_latency_ms": db.ping_latency_ms})
+    # Prefetch + worker lanes so DB work runs off the pika I/O thread
+    runtime = consumer.ConsumerRuntime(on_message)
 
     try:
         queues = ['facturatie_user_create']
         for queue in queues:
             channel.queue_declare(queue=queue, durable=True)
-            channel.basic_consume(
-                queue=queue,
-                on_message_callback=on_message,
-                auto_ack=False
-            )
+            runtime.consume(channel, queue)
 
         logger.info("Wachten op gebruikerscreatieberichten...")
         channel.start_consuming()
@@ -147,6 +169,7 @@ def start_consumer():
     except KeyboardInterrupt:
         logger.info("Consumer stoppen...")
         channel.stop_consuming()
+        runtime.shutdown(connection)
         connection.close()
     except Exception as e:
         logger.error(f"Consumer mislukt: {e}")
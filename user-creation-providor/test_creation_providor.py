@@ -1,15 +1,22 @@
 import unittest
 from unittest.mock import patch, MagicMock
+import pika
+import mysql.connector
 import os
 import xml.etree.ElementTree as ET
 from datetime import datetime, timezone
+from common import db, rabbitmq, cdc
 from user_creation_providor import (
     get_db_connection,
     get_new_users,
-    mark_as_processed,
+    iter_new_user_batches,
+    mark_batch_as_processed,
     create_xml_message,
     send_to_rabbitmq,
-    initialize_database
+    publisher,
+    initialize_database,
+    publish_new_users,
+    run_cdc
 )
 import logging
 import io
@@ -17,6 +24,10 @@ import io
 class TestUserCreationProvidor(unittest.TestCase):
     
     def setUp(self):
+        # The publisher is long-lived; drop any connection left over from a previous test
+        publisher.close()
+        self.addCleanup(publisher.close)
+
         # Sample test data
         self.sample_user = {
             'id': 1,
@@ -55,7 +66,11 @@ class TestUserCreationProvidor(unittest.TestCase):
     })
     @patch('user_creation_providor.mysql.connector.connect')
     def test_get_db_connection(self, mock_connect):
-        get_db_connection()
+        db.reset_pool()
+        try:
+            get_db_connection()
+        finally:
+            db.reset_pool()
         mock_connect.assert_called_once_with(
             host='localhost',
             user='test',
@@ -77,28 +92,50 @@ class TestUserCreationProvidor(unittest.TestCase):
         mock_cursor.execute.assert_called_once()
         args = mock_cursor.execute.call_args[0][0]
         self.assertIn("WHERE p.client_id IS NULL", args)
-        self.assertIn("ORDER BY c.created_at ASC", args)
+        self.assertIn("ORDER BY c.timestamp ASC, c.id ASC", args)
+        self.assertNotIn("LIMIT", args)
 
     @patch('user_creation_providor.get_db_connection')
-    def test_mark_as_processed(self, mock_db_conn):
+    def test_get_new_users_keyset_page(self, mock_db_conn):
         mock_cursor = MagicMock()
         mock_db_conn.return_value.cursor.return_value = mock_cursor
+        mock_cursor.fetchall.return_value = [dict(self.sample_user)]
 
-        mark_as_processed(123)
+        users = get_new_users(50, after=('2023-01-01 11:00:00', 7))
 
-        # Get the actual SQL that was called
-        actual_sql = mock_cursor.execute.call_args[0][0]
-        
-        # Verify the key components
-        self.assertIn("INSERT INTO processed_users", actual_sql)
-        self.assertIn("(client_id, processed_at)", actual_sql)
-        self.assertIn("VALUES (%s, NOW())", actual_sql)
-        
-        # Verify the parameters
-        self.assertEqual(mock_cursor.execute.call_args[0][1], (123,))
-        
-        # Verify commit was called
-        mock_db_conn.return_value.commit.assert_called_once()
+        sql, params = mock_cursor.execute.call_args[0]
+        self.assertIn("(c.timestamp > %s OR (c.timestamp = %s AND c.id > %s))", sql)
+        self.assertIn("LIMIT %s", sql)
+        self.assertEqual(params, ('2023-01-01 11:00:00', '2023-01-01 11:00:00', 7, 50))
+        self.assertEqual(users[0]['cursor'], ('2023-01-01T12:00:00.000000Z', 1))
+
+    @patch('user_creation_providor.partitions.condition', return_value=("FALSE", ()))
+    @patch('user_creation_providor.get_db_connection')
+    def test_get_new_users_without_owned_partitions(self, mock_db_conn, mock_condition):
+        mock_cursor = MagicMock()
+        mock_db_conn.return_value.cursor.return_value = mock_cursor
+        mock_cursor.fetchall.return_value = []
+
+        self.assertEqual(get_new_users(50, after=('2023-01-01 11:00:00', 7)), [])
+
+        sql, params = mock_cursor.execute.call_args[0]
+        self.assertIn("AND FALSE", sql)
+        self.assertEqual(params, ('2023-01-01 11:00:00', '2023-01-01 11:00:00', 7, 50))
+        mock_condition.assert_called_once_with("c.id")
+
+    @patch('user_creation_providor.get_new_users')
+    def test_iter_new_user_batches(self, mock_get_new_users):
+        first = [{'id': 1, 'cursor': ('t1', 1)}, {'id': 2, 'cursor': ('t2', 2)}]
+        second = [{'id': 3, 'cursor': ('t3', 3)}]
+        mock_get_new_users.side_effect = [first, second]
+
+        batches = list(iter_new_user_batches(batch_size=2))
+
+        self.assertEqual(batches, [first, second])
+        mock_get_new_users.assert_any_call(2, None)
+        mock_get_new_users.assert_any_call(2, ('t2', 2))
+        # A short page means the backlog is drained; no extra query
+        self.assertEqual(mock_get_new_users.call_count, 2)
 
     def test_create_xml_message(self):
         xml_str = create_xml_message(self.sample_user)
@@ -110,6 +147,29 @@ class TestUserCreationProvidor(unittest.TestCase):
         self.assertEqual(root.find('FirstName').text, 'John')
         self.assertEqual(root.find('Business/BusinessName').text, 'Doe Inc')
 
+    @patch('user_creation_providor.datetime')
+    def test_create_xml_message_matches_elementtree_output(self, mock_datetime):
+        # Reference output of the former ElementTree implementation, including escaping
+        mock_datetime.utcnow.return_value = datetime(2025, 5, 1, 12, 0, 0, 123456)
+        user = {
+            'first_name': 'John',
+            'last_name': "O'Brien & <Sons>",
+            'email': 'john@example.com',
+            'phone': '+32 470',
+            'pass': '',
+            'timestamp': '2025-04-29T14:22:27.816332Z',
+            'business_name': 'Doe & Co',
+            'btw_number': 'BE123',
+            'real_address': 'Main St 1, BE'
+        }
+
+        self.assertEqual(create_xml_message(user), (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<UserMessage><ActionType>CREATE</ActionType><UUID>2025-04-29T14:22:27.816332Z</UUID><TimeOfAction>2025-05-01T12:00:00.123456Z</TimeOfAction><EncryptedPassword />'
+            "<FirstName>John</FirstName><LastName>O'Brien &amp; &lt;Sons&gt;</LastName><PhoneNumber>+32 470</PhoneNumber><EmailAddress>john@example.com</EmailAddress>"
+            '<Business><BusinessName>Doe &amp; Co</BusinessName><BusinessEmail>john@example.com</BusinessEmail><RealAddress>Main St 1, BE</RealAddress><BTWNumber>BE123</BTWNumber><FacturationAddress>Main St 1, BE</FacturationAddress></Business></UserMessage>'
+        ))
+
     def test_create_xml_message_minimal(self):
         minimal_user = {
             'id': 2,
@@ -158,8 +218,10 @@ class TestUserCreationProvidor(unittest.TestCase):
         self.assertIn("Sent XML message to kassa_user_create", logs)
         self.assertIn("Sent XML message to frontend_user_create", logs)
 
+    @patch('user_creation_providor.migrations.missing_indexes')
+    @patch('user_creation_providor.migrations.migrate')
     @patch('user_creation_providor.get_db_connection')
-    def test_initialize_database(self, mock_db_conn):
+    def test_initialize_database(self, mock_db_conn, mock_migrate, mock_missing):
         mock_cursor = MagicMock()
         mock_db_conn.return_value.cursor.return_value = mock_cursor
 
@@ -176,6 +238,127 @@ class TestUserCreationProvidor(unittest.TestCase):
         
         # Verify commit was called
         mock_db_conn.return_value.commit.assert_called_once()
+        mock_migrate.assert_called_once()
+        mock_missing.assert_called_once()
+
+    @patch.dict('os.environ', {
+        'RABBITMQ_HOST': 'localhost',
+        'RABBITMQ_PORT': '5672',
+        'RABBITMQ_USER': 'guest',
+        'RABBITMQ_PASSWORD': 'guest'
+    })
+    @patch('user_creation_providor.pika.BlockingConnection')
+    def test_send_to_rabbitmq_reuses_connection(self, mock_connection):
+        mock_channel = MagicMock()
+        mock_connection.return_value.channel.return_value = mock_channel
+
+        self.assertTrue(send_to_rabbitmq("<xml></xml>"))
+        self.assertTrue(send_to_rabbitmq("<xml></xml>"))
+
+        # One handshake and one topology declaration, then only publishes
+        mock_connection.assert_called_once()
+        mock_channel.confirm_delivery.assert_called_once()
+        self.assertEqual(mock_channel.queue_declare.call_count, 3)
+        self.assertEqual(mock_channel.basic_publish.call_count, 6)
+        mock_channel.basic_publish.assert_called_with(
+            exchange="user",
+            routing_key="user.create.frontend_user_create",
+            body="<xml></xml>",
+            properties=rabbitmq.PERSISTENT,
+            mandatory=True
+        )
+
+    @patch.dict('os.environ', {
+        'RABBITMQ_HOST': 'localhost',
+        'RABBITMQ_PORT': '5672',
+        'RABBITMQ_USER': 'guest',
+        'RABBITMQ_PASSWORD': 'guest'
+    })
+    @patch('user_creation_providor.pika.BlockingConnection')
+    def test_send_to_rabbitmq_not_confirmed(self, mock_connection):
+        mock_channel = MagicMock()
+        mock_connection.return_value.channel.return_value = mock_channel
+        mock_channel.basic_publish.side_effect = pika.exceptions.NackError([])
+
+        self.assertFalse(send_to_rabbitmq("<xml></xml>"))
+
+    @patch('user_creation_providor.get_db_connection')
+    def test_mark_batch_as_processed(self, mock_get_db_connection):
+        mock_cursor = MagicMock()
+        mock_conn = MagicMock()
+        mock_get_db_connection.return_value = mock_conn
+        mock_conn.cursor.return_value = mock_cursor
+
+        self.assertTrue(mark_batch_as_processed([1, 2, 3]))
+
+        # One statement and one commit for the whole batch
+        mock_cursor.execute.assert_called_once()
+        sql, params = mock_cursor.execute.call_args[0]
+        self.assertIn("INSERT INTO processed_users (client_id, processed_at)", sql)
+        self.assertIn("VALUES (%s, NOW()), (%s, NOW()), (%s, NOW())", sql)
+        self.assertEqual(params, (1, 2, 3))
+        mock_conn.commit.assert_called_once()
+
+    @patch('user_creation_providor.get_db_connection')
+    def test_mark_batch_as_processed_empty(self, mock_get_db_connection):
+        self.assertTrue(mark_batch_as_processed([]))
+        mock_get_db_connection.assert_not_called()
+
+    @patch('user_creation_providor.get_db_connection')
+    def test_mark_batch_as_processed_error(self, mock_get_db_connection):
+        mock_cursor = MagicMock()
+        mock_conn = MagicMock()
+        mock_get_db_connection.return_value = mock_conn
+        mock_conn.cursor.return_value = mock_cursor
+        mock_cursor.execute.side_effect = mysql.connector.Error("deadlock")
+
+        self.assertFalse(mark_batch_as_processed([1, 2]))
+        mock_conn.rollback.assert_called_once()
+        mock_conn.close.assert_called_once()
+
+    @patch('user_creation_providor.mark_batch_as_processed', return_value=True)
+    @patch('user_creation_providor.send_to_rabbitmq', return_value=False)
+    @patch('user_creation_providor.cdc.BinlogTailer')
+    def test_run_cdc_keeps_checkpoint_on_publish_failure(self, mock_tailer, mock_send, mock_mark):
+        row = {'id': 1, 'first_name': 'John', 'timestamp': '2023-01-01T12:00:00.000000Z'}
+        mock_tailer.return_value.pin_start.return_value = False
+        mock_tailer.return_value.batches.return_value = [
+            cdc.ChangeBatch([cdc.Change("insert", row, None)], "binlog.000001", 100)
+        ]
+
+        with self.assertRaises(RuntimeError):
+            run_cdc()
+
+        mock_mark.assert_not_called()
+        mock_tailer.return_value.save_checkpoint.assert_not_called()
+        mock_tailer.return_value.close.assert_called_once()
+
+    @patch('user_creation_providor.publish_new_users', return_value=(3, 2))
+    @patch('user_creation_providor.cdc.BinlogTailer')
+    def test_run_cdc_stops_when_backfill_is_incomplete(self, mock_tailer, mock_publish):
+        mock_tailer.return_value.pin_start.return_value = True
+
+        with self.assertRaises(RuntimeError):
+            run_cdc()
+
+        mock_publish.assert_called_once()
+        mock_tailer.return_value.batches.assert_not_called()
+        mock_tailer.return_value.close.assert_called_once()
+
+    @patch('user_creation_providor.mark_batch_as_processed', return_value=True)
+    @patch('user_creation_providor.send_to_rabbitmq', return_value=True)
+    @patch('user_creation_providor.partitions.is_stale', side_effect=[False, True])
+    @patch('user_creation_providor.iter_new_user_batches')
+    def test_publish_new_users_drops_page_when_lease_goes_stale(self, mock_batches, mock_stale, mock_send, mock_mark):
+        mock_batches.return_value = iter([[
+            {'id': 1, 'timestamp': '2023-01-01T12:00:00.000000Z'},
+            {'id': 2, 'timestamp': '2023-01-01T12:00:01.000000Z'},
+        ]])
+
+        self.assertEqual(publish_new_users(), (2, 0))
+        mock_send.assert_called_once()
+        mock_mark.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,8 +1,8 @@
 import pika
 import os
-import xml.etree.ElementTree as ET
 from datetime import datetime
 import mysql.connector
+from common import db, rabbitmq, scheduler, cdc, migrations, xmlout, stats, lease
 import time
 import logging
 
@@ -13,22 +13,48 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+BATCH_SIZE = int(os.getenv("USER_BATCH_SIZE", "100"))
+
+QUEUES = ["crm_user_create", "kassa_user_create", "frontend_user_create"]
+
+# One long-lived publisher; the exchange, queues and bindings are declared once when it connects
+publisher = rabbitmq.Publisher(
+    exchange="user",
+    exchange_type="topic",
+    bindings=[(queue, f"user.create.{queue}") for queue in QUEUES]
+)
+
+# With PROVIDER_PARTITIONS set, replicas split the clients by MOD(id, N); see common/lease.py
+partitions = lease.PartitionLease("user-creation-providor")
+
 # Database connection
 def get_db_connection():
-    return mysql.connector.connect(
-        host=os.environ["DB_HOST"],
-        user=os.environ["DB_USER"],
-        password=os.environ["DB_PASSWORD"],
-        database=os.environ["DB_NAME"]
-    )
-
-def get_new_users():
+    return db.get_connection()
+
+def get_new_users(batch_size=None, after=None):
+    started = time.perf_counter()
     # Establish connection
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
     
+    # Keyset pagination on (timestamp, id): every page continues right after the last row
+    # of the previous one, so the database never has to skip over rows with an OFFSET
+    conditions = ["p.client_id IS NULL"]
+    params = []
+    if after is not None:
+        conditions.append("(c.timestamp > %s OR (c.timestamp = %s AND c.id > %s))")
+        params.extend([after[0], after[0], after[1]])
+    partition = partitions.condition("c.id")
+    if partition is not None:
+        conditions.append(partition[0])
+        params.extend(partition[1])
+    limit = ""
+    if batch_size:
+        limit = "LIMIT %s"
+        params.append(batch_size)
+    
     try:
-        cursor.execute("""
+        cursor.execute(f"""
             SELECT 
                 c.id, c.first_name, c.last_name, c.email, c.pass, c.phone, c.timestamp,
                 c.company AS business_name,
@@ -36,12 +62,15 @@ def get_new_users():
                 CONCAT_WS(', ', c.address_1, c.city, c.country) AS real_address
             FROM client c
             LEFT JOIN processed_users p ON c.id = p.client_id
-            WHERE p.client_id IS NULL
-            ORDER BY c.timestamp ASC
-        """)
+            WHERE {' AND '.join(conditions)}
+            ORDER BY c.timestamp ASC, c.id ASC
+            {limit}
+        """, tuple(params))
         users = cursor.fetchall()
         
         for user in users:
+            # Remember the raw key before the timestamp is reformatted for the XML
+            user['cursor'] = (user.get('timestamp'), user['id'])
             # The timestamp is already in the correct format from the database
             # So we don't need any conversion, just ensure it's properly named
             if 'timestamp' in user and user['timestamp']:
@@ -60,121 +89,121 @@ def get_new_users():
     finally:
         cursor.close()
         conn.close()
+        stats.observe("db_seconds", time.perf_counter() - started)
+
+# Users still waiting to be published, for the poll_backlog gauge (runs on the stats thread, at most every STATS_BACKLOG_INTERVAL seconds)
+def count_backlog():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT COUNT(*)
+            FROM client c
+            LEFT JOIN processed_users p ON c.id = p.client_id
+            WHERE p.client_id IS NULL
+        """)
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+        conn.close()
 
+# Walk through all unprocessed users one page at a time.
+# Only a single page is held in memory and the caller can publish it before the next one is fetched.
+def iter_new_user_batches(batch_size=BATCH_SIZE):
+    after = None
+    while True:
+        users = get_new_users(batch_size, after)
+        if not users:
+            return
+        yield users
+        if len(users) < batch_size:
+            return
+        after = users[-1]['cursor']
 
-# Mark user as processed so it won't be processed again
-def mark_as_processed(client_id):
-    # Establish connection
+
+# Mark a whole batch of published users as processed in one multi-row INSERT / one commit.
+# Only ids that were actually published are passed in, so a partially failed batch
+# leaves the failed users unprocessed and they are picked up again on the next poll.
+def mark_batch_as_processed(client_ids):
+    if not client_ids:
+        return True
+
+    started = time.perf_counter()
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Insert user into processed_users table
     try:
-        cursor.execute("""
+        values = ", ".join(["(%s, NOW())"] * len(client_ids))
+        cursor.execute(f"""
             INSERT INTO processed_users (client_id, processed_at)
-            VALUES (%s, NOW())
-        """, (client_id,))
+            VALUES {values}
+            ON DUPLICATE KEY UPDATE processed_at = processed_at
+        """, tuple(client_ids))
         conn.commit()
+        return True
     except mysql.connector.Error as err:
-        logger.error(f"Failed to mark user {client_id} as processed: {err}")
+        logger.error(f"Failed to mark users {client_ids} as processed: {err}")
+        conn.rollback()
+        return False
     finally:
         cursor.close()
         conn.close()
+        stats.observe("db_seconds", time.perf_counter() - started)
 
 # Create XML message for RabbitMQ
-def create_xml_message(user):
-    # Create XML structure with root element UserMessage
-    xml = ET.Element("UserMessage")
-    
+# Layout of the CREATE message; compiled once, see common/xmlout.py
+USER_CREATE_TEMPLATE = xmlout.Template("UserMessage", [
     # Action info
-    ET.SubElement(xml, "ActionType").text = "CREATE"
-    ET.SubElement(xml, "UUID").text = user['timestamp']
-    ET.SubElement(xml, "TimeOfAction").text = datetime.utcnow().isoformat() + "Z"
-    ET.SubElement(xml, "EncryptedPassword").text = user.get('pass', '')
-    
+    xmlout.Field("ActionType"),
+    xmlout.Field("UUID"),
+    xmlout.Field("TimeOfAction"),
+    xmlout.Field("EncryptedPassword"),
     # Personal info
-    if user.get('first_name'):
-        ET.SubElement(xml, "FirstName").text = user['first_name']
-    if user.get('last_name'):
-        ET.SubElement(xml, "LastName").text = user['last_name']
-    if user.get('phone'):
-        ET.SubElement(xml, "PhoneNumber").text = user['phone']
-    if user.get('email'):
-        ET.SubElement(xml, "EmailAddress").text = user['email']
-    
-    # Business info (only if VAT or business name exists)
-    if any(user.get(field) for field in ['business_name', 'btw_number', 'real_address']):
-        business = ET.SubElement(xml, "Business")
-        
-        if user.get('business_name'):
-            ET.SubElement(business, "BusinessName").text = user['business_name']
-        
+    xmlout.Field("FirstName", optional=True),
+    xmlout.Field("LastName", optional=True),
+    xmlout.Field("PhoneNumber", optional=True),
+    xmlout.Field("EmailAddress", optional=True),
+    # Business info
+    xmlout.Group("Business", [
+        xmlout.Field("BusinessName", optional=True),
+        xmlout.Field("BusinessEmail", optional=True),
+        xmlout.Field("RealAddress", optional=True),
+        xmlout.Field("BTWNumber", optional=True),
+        xmlout.Field("FacturationAddress", optional=True),
+    ]),
+])
+
+def create_xml_message(user):
+    return USER_CREATE_TEMPLATE.render({
+        "ActionType": "CREATE",
+        "UUID": user['timestamp'],
+        "TimeOfAction": datetime.utcnow().isoformat() + "Z",
+        "EncryptedPassword": user.get('pass', ''),
+        "FirstName": user.get('first_name'),
+        "LastName": user.get('last_name'),
+        "PhoneNumber": user.get('phone'),
+        "EmailAddress": user.get('email'),
+        # Business info (only if VAT or business name exists)
+        "Business": any(user.get(field) for field in ['business_name', 'btw_number', 'real_address']),
+        "BusinessName": user.get('business_name'),
         # Business email (fallback to personal email)
-        business_email = user.get('email', '')
-        if business_email:
-            ET.SubElement(business, "BusinessEmail").text = business_email
-        
-        # Only include fields that exist
-        if user.get('real_address'):
-            ET.SubElement(business, "RealAddress").text = user['real_address']
-        if user.get('btw_number'):
-            ET.SubElement(business, "BTWNumber").text = user['btw_number']
-        
+        "BusinessEmail": user.get('email', ''),
+        "RealAddress": user.get('real_address'),
+        "BTWNumber": user.get('btw_number'),
         # Facturation address (fallback to real address)
-        facturation_address = user.get('real_address', '')
-        if facturation_address:
-            ET.SubElement(business, "FacturationAddress").text = facturation_address
-    
-    return '<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(xml, encoding='unicode')
+        "FacturationAddress": user.get('real_address', ''),
+    })
 
 def send_to_rabbitmq(xml):
-    queues = ["crm_user_create", "kassa_user_create", "frontend_user_create"]
-    
     try:
-        params = pika.ConnectionParameters(
-            host=os.environ["RABBITMQ_HOST"],
-            port=int(os.environ["RABBITMQ_PORT"]),
-            virtual_host="/",
-            credentials=pika.PlainCredentials(
-                os.environ["RABBITMQ_USER"],
-                os.environ["RABBITMQ_PASSWORD"]
-            ),
-            heartbeat=600,
-            blocked_connection_timeout=300
-        )
-        
-        connection = pika.BlockingConnection(params)
-        channel = connection.channel()
-
-        # Declare exchange as TOPIC type to match existing configuration
-        channel.exchange_declare(
-            exchange="user",
-            exchange_type="topic",  # Changed from 'direct' to 'topic'
-            durable=True
-        )
-
-        for queue in queues:
-            channel.queue_declare(queue=queue, durable=True)
-            # Ensure the routing pattern matches topic exchange expectations
-            channel.queue_bind(
-                exchange="user",
-                queue=queue,
-                routing_key=f"user.create.{queue}"
-            )
-            channel.basic_publish(
-                exchange="user",
-                routing_key=f"user.create.{queue}",
-                body=xml,
-                properties=pika.BasicProperties(
-                    delivery_mode=2  # Make messages persistent
-                )
-            )
+        for queue in QUEUES:
+            publisher.publish(f"user.create.{queue}", xml)
             logger.info(f"Sent XML message to {queue}")
-
-        connection.close()
+        stats.incr("messages")
         return True
     except Exception as e:
         logger.error(f"RabbitMQ Error: {e}")
+        stats.incr("errors")
         return False
 
 # Initialize database for safety and to avoid errors
@@ -198,24 +227,93 @@ def initialize_database():
         cursor.close()
         conn.close()
 
+    # Create/verify the indexes the lookups rely on
+    try:
+        migrations.migrate()
+        migrations.missing_indexes()
+    except Exception as e:
+        logger.error(f"Schema migration failed: {e}")
+
+# One polling pass: publishes every unprocessed user page by page.
+# Returns (fetched, published); users that failed to publish are picked up again by the next pass.
+def publish_new_users():
+    processed = 0
+    published_total = 0
+    for new_users in iter_new_user_batches():
+        processed += len(new_users)
+        published = []
+        for user in new_users:
+            # The page was selected under the partition lease; once that is no longer fresh another
+            # replica may already own these users, so leave the rest of the page to it
+            if partitions.is_stale():
+                logger.warning(f"Partition lease went stale, dropping {len(new_users) - len(published)} users of this page")
+                return processed, published_total
+            xml = create_xml_message(user)
+            if send_to_rabbitmq(xml):
+                published.append(user)
+            else:
+                logger.error(f"Failed to process user {user['id']}")
+
+        if partitions.is_stale():
+            logger.warning("Partition lease went stale, not marking this page as processed")
+            return processed, published_total
+        if mark_batch_as_processed([user['id'] for user in published]):
+            published_total += len(published)
+            for user in published:
+                logger.info(f"Processed user {user['id']} with timestamp ID {user['timestamp']}")
+    return processed, published_total
+
+# Change-data-capture mode: publish new clients straight from the binlog instead of polling
+def run_cdc():
+    tailer = cdc.BinlogTailer("user_creation_providor", actions=("insert",))
+    try:
+        if tailer.pin_start():
+            # First start in CDC mode: users created before the pinned position are not in the
+            # binlog we read, so the polling query publishes them once
+            fetched, published = publish_new_users()
+            if published < fetched:
+                raise RuntimeError(f"Backfill before CDC published {published} of {fetched} users")
+        for batch in tailer.batches():
+            users = [cdc.client_row_to_user(change.row) for change in batch.changes]
+            for user in users:
+                if not send_to_rabbitmq(create_xml_message(user)):
+                    # Leave the checkpoint where it is; the event is replayed after the restart
+                    raise RuntimeError(f"Failed to process user {user['id']}")
+
+            # Keep processed_users in sync so switching back to polling does not resend these users
+            if not mark_batch_as_processed([user['id'] for user in users]):
+                raise RuntimeError("Failed to record CDC batch in processed_users")
+            tailer.save_checkpoint(batch)
+            for user in users:
+                logger.info(f"Processed user {user['id']} with timestamp ID {user['timestamp']}")
+    finally:
+        tailer.close()
+
 # Main loop
 if __name__ == "__main__":
     initialize_database()
     logger.info("Starting user creation provider")
+    probes = {"db_latency_ms": db.ping_latency_ms}
+    # In CDC mode nothing polls the outbox, so there is no poll backlog worth a full COUNT
+    if not cdc.is_enabled():
+        probes["poll_backlog"] = stats.every(stats.BACKLOG_INTERVAL, count_backlog)
+    stats.start("user-creation-providor", probes=probes)
+
+    while cdc.is_enabled():
+        try:
+            run_cdc()
+        except Exception as e:
+            logger.error(f"CDC error: {e}")
+            time.sleep(60)
+    poller = scheduler.PollScheduler()
     
     while True:
         try:
-            new_users = get_new_users()
-            
-            for user in new_users:
-                xml = create_xml_message(user)
-                if send_to_rabbitmq(xml):
-                    mark_as_processed(user['id'])
-                    logger.info(f"Processed user {user['id']} with timestamp ID {user['timestamp']}")
-                else:
-                    logger.error(f"Failed to process user {user['id']}")
+            processed, _ = publish_new_users()
             
-            time.sleep(5)
+            publisher.process_data_events()
+            # iter_new_user_batches already drains full pages, so only back off between polls
+            poller.wait(processed)
         except Exception as e:
             logger.error(f"Processing error: {e}")
             time.sleep(60)
\ No newline at end of file
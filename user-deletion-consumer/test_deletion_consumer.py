@@ -5,16 +5,18 @@ import logging
 import io
 import os
 from user_deletion_consumer import (
-    user_exists,
     delete_user,
     parse_user_xml,
     on_message,
-    start_consumer
+    start_consumer,
+    ledger
 )
+from common import idempotency
 
 class TestUserDeletionConsumer(unittest.TestCase):
     
     def setUp(self):
+        ledger.clear()
         # Sample test data
         self.sample_xml = """
         <UserMessage>
@@ -45,50 +47,57 @@ class TestUserDeletionConsumer(unittest.TestCase):
     def tearDown(self):
         self.log_capture.close()
 
-    @patch('user_deletion_consumer.mysql.connector.connect')
-    def test_user_exists_true(self, mock_connect):
-        mock_cursor = MagicMock()
-        mock_connect.return_value.cursor.return_value = mock_cursor
-        mock_cursor.fetchone.return_value = [1]  # User exists
-        
-        result = user_exists('2025-04-29T14:22:27.816332Z')
-        self.assertTrue(result)
-
-    @patch('user_deletion_consumer.mysql.connector.connect')
-    def test_user_exists_false(self, mock_connect):
-        mock_cursor = MagicMock()
-        mock_connect.return_value.cursor.return_value = mock_cursor
-        mock_cursor.fetchone.return_value = None  # User doesn't exist
-        
-        result = user_exists('2025-04-29T14:22:27.816332Z')
-        self.assertFalse(result)
-
-    @patch('user_deletion_consumer.user_exists')
-    @patch('user_deletion_consumer.mysql.connector.connect')
-    def test_delete_user_success(self, mock_connect, mock_user_exists):
-        mock_user_exists.return_value = True
+    @patch('user_deletion_consumer.get_db_connection')
+    def test_delete_user_success(self, mock_connect):
         mock_cursor = MagicMock()
+        mock_cursor.rowcount = 1
         mock_connect.return_value.cursor.return_value = mock_cursor
         
         result = delete_user(self.sample_data)
         self.assertTrue(result)
+        mock_cursor.execute.assert_called_once_with("DELETE FROM client WHERE timestamp = %s", (self.sample_data['uuid'],))
+        mock_connect.return_value.commit.assert_called_once()
         logs = self.log_capture.getvalue()
         self.assertIn("Deleted client", logs)
 
-    @patch('user_deletion_consumer.mysql.connector.connect')
-    @patch('user_deletion_consumer.user_exists')
-    def test_delete_user_not_found(self, mock_user_exists, mock_connect):
-        mock_user_exists.return_value = False
+    @patch('user_deletion_consumer.get_db_connection')
+    def test_delete_user_not_found(self, mock_connect):
         mock_conn = MagicMock()
         mock_cursor = MagicMock()
+        mock_cursor.rowcount = 0
         mock_conn.cursor.return_value = mock_cursor
         mock_connect.return_value = mock_conn
 
         result = delete_user(self.sample_data)
 
         self.assertEqual(result, False)
+        mock_conn.commit.assert_not_called()
         mock_cursor.close.assert_called_once()
         mock_conn.close.assert_called_once()
+        self.assertIn("not found - nothing to delete", self.log_capture.getvalue())
+
+    @patch('user_deletion_consumer.get_db_connection')
+    def test_delete_user_duplicate_message_is_skipped(self, mock_connect):
+        mock_cursor = MagicMock()
+        mock_cursor.rowcount = 0  # key already in processed_messages
+        mock_connect.return_value.cursor.return_value = mock_cursor
+
+        self.assertFalse(delete_user(self.sample_data, "c" * 64))
+        mock_cursor.execute.assert_called_once()
+        self.assertIn("processed_messages", mock_cursor.execute.call_args[0][0])
+        self.assertIn("already handled", self.log_capture.getvalue())
+
+    @patch('user_deletion_consumer.cache.publish_invalidation')
+    @patch('user_deletion_consumer.delete_user')
+    def test_on_message_redelivery_is_acked_without_processing(self, mock_delete, mock_invalidate):
+        ledger.remember(idempotency.message_key(self.sample_data['uuid'], self.sample_data['action_time']))
+        mock_channel = MagicMock()
+
+        on_message(mock_channel, MagicMock(), None, self.sample_xml.encode())
+
+        mock_delete.assert_not_called()
+        mock_invalidate.assert_not_called()
+        mock_channel.basic_ack.assert_called_once()
 
     def test_parse_user_xml_success(self):
         result = parse_user_xml(self.sample_xml)
@@ -99,9 +108,10 @@ class TestUserDeletionConsumer(unittest.TestCase):
         with self.assertRaises(Exception):
             parse_user_xml("invalid xml")
 
+    @patch('user_deletion_consumer.cache.publish_invalidation')
     @patch('user_deletion_consumer.delete_user')
     @patch('user_deletion_consumer.parse_user_xml')
-    def test_on_message_success(self, mock_parse, mock_delete):
+    def test_on_message_success(self, mock_parse, mock_delete, mock_invalidate):
         mock_parse.return_value = self.sample_data
         mock_delete.return_value = True
         
@@ -116,6 +126,7 @@ class TestUserDeletionConsumer(unittest.TestCase):
         self.assertNotIn('T', parsed_data['uuid'])
         
         mock_channel.basic_ack.assert_called_once()
+        mock_invalidate.assert_called_once_with(parsed_data['uuid'])
 
     @patch('user_deletion_consumer.parse_user_xml')
     def test_on_message_wrong_action(self, mock_parse):
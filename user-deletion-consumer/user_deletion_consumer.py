@@ -1,8 +1,8 @@
 import pika
 import os
 import logging
-import xml.etree.ElementTree as ET
 import mysql.connector
+from common import db, consumer, cache, usermessage, stats, idempotency, retry
 from datetime import datetime
 from dotenv import load_dotenv
 load_dotenv()
@@ -11,50 +11,37 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
  
-# Load environment variables and check if user exists
-def user_exists(uuid_timestamp):
-    conn = mysql.connector.connect(
-        host=os.getenv("DB_HOST"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        database=os.getenv("DB_NAME")
-    )
-    cursor = conn.cursor()
+# Messages already handled, keyed by UUID + TimeOfAction: a redelivered delete is acked
+# without going to the client table again; see common/idempotency.py
+ledger = idempotency.Ledger("user-deletion-consumer")
  
-    try:
-        cursor.execute("SELECT id FROM client WHERE timestamp = %s", (uuid_timestamp,))
-        return cursor.fetchone() is not None
-    except Exception as e:
-        logger.error(f"Error checking user existence: {e}")
-        raise
-    finally:
-        cursor.close()
-        conn.close()
+# Database connection from the shared pool
+def get_db_connection():
+    return db.get_connection()
  
 # Delete user from FossBilling database
-def delete_user(user_data):
-    conn = mysql.connector.connect(
-        host=os.getenv("DB_HOST"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        database=os.getenv("DB_NAME")
-    )
+# message_key is recorded in the same transaction; a message that was already handled returns False
+def delete_user(user_data, message_key=None):
+    conn = get_db_connection()
     cursor = conn.cursor()
  
-    # check if client exists
-    # if we do not check if the client exists, we won't get an error on deletion
-    # because technically nothing went wrong, the client just didn't exist
+    # if the client does not exist the DELETE simply matches no rows,
+    # so the row count tells us whether there was anything to delete (one query, no race with a separate check)
     try:
         uuid_timestamp = user_data['uuid']
+        if not ledger.claim(cursor, message_key):
+            conn.rollback()
+            logger.info(f"Delete of client {uuid_timestamp} already handled, skipping duplicate message")
+            return False
  
-        # check if user exists
-        if not user_exists(uuid_timestamp):
+        cursor.execute("DELETE FROM client WHERE timestamp = %s", (uuid_timestamp,))
+        if cursor.rowcount == 0:
+            conn.rollback()
             logger.warning(f"Client with timestamp {uuid_timestamp} not found - nothing to delete")
             return False
  
-        # so now i only delete the client if it exists -> helps with debugging if something goes wrong as well
-        cursor.execute("DELETE FROM client WHERE timestamp = %s", (uuid_timestamp,))
         conn.commit()
+        ledger.remember(message_key)
         logger.info(f"Deleted client: {uuid_timestamp}")
         return True
  
@@ -66,15 +53,18 @@ def delete_user(user_data):
         cursor.close()
         conn.close()
  
+# Elements a DELETE message must carry
+REQUIRED_FIELDS = ("action_type", "uuid", "time_of_action")
+ 
 # Parse XML message
 def parse_user_xml(xml_data):
     try:
-        root = ET.fromstring(xml_data)
+        message = usermessage.decode(xml_data, required=REQUIRED_FIELDS)
  
         return {
-            'action_type': root.find('ActionType').text,
-            'uuid': root.find('UUID').text,
-            'action_time': root.find('TimeOfAction').text
+            'action_type': message.action_type,
+            'uuid': message.uuid,
+            'action_time': message.time_of_action
         }
     except Exception as e:
         logger.error(f"XML parsing failed: {e}")
@@ -90,12 +80,20 @@ def on_message(channel, method, properties, body):
         logger.info(f"Received message from {method.routing_key}")
  
         # Parse XML
-        user_data = parse_user_xml(body.decode())
+        with stats.timed("parse_seconds"):
+            user_data = parse_user_xml(body)
  
         # Only process DELETE actions
         if user_data['action_type'].upper() != 'DELETE':
             logger.warning(f"Ignoring non-DELETE action: {user_data['action_type']}")
-            channel.basic_ack(method.delivery_tag)
+            consumer.ack(channel, method.delivery_tag)
+            return
+ 
+        # Redelivery of a message this process already handled: ack straight away
+        message_key = idempotency.message_key(user_data['uuid'], user_data['action_time'])
+        if ledger.is_duplicate(message_key):
+            logger.info(f"Delete of client {user_data['uuid']} already handled, skipping duplicate message")
+            consumer.ack(channel, method.delivery_tag)
             return
  
         # Clean UUID timestamp (remove 'Z' if present)
@@ -105,18 +103,22 @@ def on_message(channel, method, properties, body):
             user_data['uuid'] = user_data['uuid'].replace('T', ' ')       
  
         # Delete user from database
-        delete_user(user_data)
+        with stats.timed("db_seconds"):
+            deleted = delete_user(user_data, message_key)
+        if deleted:
+            # Let the invoice consumer drop its cached copy of this client
+            cache.publish_invalidation(user_data['uuid'])
  
         # Acknowledge message
-        channel.basic_ack(method.delivery_tag)
+        consumer.ack(channel, method.delivery_tag)
         # 'tells' RabbitMQ that the message was processed successfully
         # the message is then removed from the queue
  
     except Exception as e:
         logger.error(f"Message processing failed: {e}")
-        channel.basic_nack(method.delivery_tag, requeue=False)
-        # 'tells' RabbitMQ that the message processing failed
-        # requeue=False -> the message is not requeued, but discarded or sent to a dead-letter queue
+        retry.reject(channel, method, properties, body, e)
+        # transient failures (database gone, lock timeout) are published to a retry queue and come back
+        # after a delay, anything else to <queue>.dlq; with retries disabled this is basic_nack(requeue=False)
  
 # Start the RabbitMQ consumer
 def start_consumer():
@@ -129,17 +131,21 @@ def start_consumer():
         )
     ))
     channel = connection.channel()
+    try:
+        ledger.initialize()
+    except Exception as e:
+        logger.error(f"Idempotency ledger initialization failed: {e}")
+    # Stats for the heartbeat
+    stats.start("user-deletion-consumer", probes={"db_latency_ms": db.ping_latency_ms})
+    # Prefetch + worker lanes so DB work runs off the pika I/O thread
+    runtime = consumer.ConsumerRuntime(on_message)
  
     try:
         # Declare all queues we want to listen to
         queues = ['facturatie_user_delete']
         for queue in queues:
             channel.queue_declare(queue=queue, durable=True)
-            channel.basic_consume(
-                queue=queue,
-                on_message_callback=on_message,
-                auto_ack=False
-            )
+            runtime.consume(channel, queue)
             # queue=queue -> this is the queue we are listening to
             # durable=True -> the queue will survive a RabbitMQ server restart
             # the whole function ensures that the queues exist and are ready to receive messages
@@ -153,6 +159,7 @@ def start_consumer():
     except KeyboardInterrupt:
         logger.info("Stopping consumer...")
         channel.stop_consuming()
+        runtime.shutdown(connection)
         connection.close()
         logger.info("Consumer stopped.")
     except Exception as e:
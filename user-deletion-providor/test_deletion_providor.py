@@ -1,20 +1,32 @@
 import unittest
 from unittest.mock import patch, MagicMock
+import pika
+import mysql.connector
 import xml.etree.ElementTree as ET
 import logging
 import io
 import os
+from datetime import datetime
+from common import rabbitmq, cdc
 from user_deletion_providor import (
     get_users_to_delete,
-    mark_as_deleted,
+    mark_batch_as_deleted,
     create_delete_xml,
     send_to_rabbitmq,
-    initialize_database
+    publisher,
+    initialize_database,
+    publish_pending_deletions,
+    run_cdc,
+    BATCH_SIZE
 )
 
 class TestUserDeletionProvidor(unittest.TestCase):
     
     def setUp(self):
+        # The publisher is long-lived; drop any connection left over from a previous test
+        publisher.close()
+        self.addCleanup(publisher.close)
+
         # Sample test data
         self.sample_user = {
             'client_id': 1,
@@ -50,27 +62,21 @@ class TestUserDeletionProvidor(unittest.TestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0]['client_id'], 1)
 
-    @patch('user_deletion_providor.get_db_connection')
-    def test_mark_as_deleted_success(self, mock_get_db_connection):
-        mock_cursor = MagicMock()
-        mock_conn = MagicMock()
-        mock_get_db_connection.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-        
-        mark_as_deleted(1)
-        
-        mock_cursor.execute.assert_called_once_with("""
-            UPDATE user_deletion_notifications
-            SET processed = 1
-            WHERE client_id = %s
-        """, (1,))
-        mock_conn.commit.assert_called_once()
-
     def test_create_delete_xml_success(self):
         xml = create_delete_xml(self.sample_user)
         self.assertIn("<ActionType>DELETE</ActionType>", xml)
         self.assertIn("<UUID>2025-04-29T14:22:27.816332Z</UUID>", xml)
 
+    @patch('user_deletion_providor.datetime')
+    def test_create_delete_xml_matches_elementtree_output(self, mock_datetime):
+        mock_datetime.utcnow.return_value = datetime(2025, 5, 1, 12, 0, 0, 123456)
+
+        self.assertEqual(create_delete_xml(self.sample_user), (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<UserMessage><ActionType>DELETE</ActionType><UUID>2025-04-29T14:22:27.816332Z</UUID>'
+            '<TimeOfAction>2025-05-01T12:00:00.123456Z</TimeOfAction></UserMessage>'
+        ))
+
     @patch.dict('os.environ', {
         'RABBITMQ_HOST': 'localhost',
         'RABBITMQ_PORT': '5672',
@@ -93,8 +99,10 @@ class TestUserDeletionProvidor(unittest.TestCase):
         result = send_to_rabbitmq("<xml></xml>")
         self.assertFalse(result)
 
+    @patch('user_deletion_providor.migrations.missing_indexes')
+    @patch('user_deletion_providor.migrations.migrate')
     @patch('user_deletion_providor.get_db_connection')
-    def test_initialize_database(self, mock_get_db_connection):
+    def test_initialize_database(self, mock_get_db_connection, mock_migrate, mock_missing):
         mock_cursor = MagicMock()
         mock_conn = MagicMock()
         mock_get_db_connection.return_value = mock_conn
@@ -112,6 +120,159 @@ class TestUserDeletionProvidor(unittest.TestCase):
             )
         """)
         mock_conn.commit.assert_called_once()
+        mock_migrate.assert_called_once()
+        mock_missing.assert_called_once()
+
+    @patch.dict('os.environ', {
+        'RABBITMQ_HOST': 'localhost',
+        'RABBITMQ_PORT': '5672',
+        'RABBITMQ_USER': 'guest',
+        'RABBITMQ_PASSWORD': 'guest'
+    })
+    @patch('user_deletion_providor.pika.BlockingConnection')
+    def test_send_to_rabbitmq_reuses_connection(self, mock_connection):
+        mock_channel = MagicMock()
+        mock_connection.return_value.channel.return_value = mock_channel
+
+        self.assertTrue(send_to_rabbitmq("<xml></xml>"))
+        self.assertTrue(send_to_rabbitmq("<xml></xml>"))
+
+        # One handshake and one topology declaration, then only publishes
+        mock_connection.assert_called_once()
+        mock_channel.confirm_delivery.assert_called_once()
+        self.assertEqual(mock_channel.queue_declare.call_count, 3)
+        self.assertEqual(mock_channel.basic_publish.call_count, 6)
+        mock_channel.basic_publish.assert_called_with(
+            exchange="user",
+            routing_key="user.delete.frontend_user_delete",
+            body="<xml></xml>",
+            properties=rabbitmq.PERSISTENT,
+            mandatory=True
+        )
+
+    @patch.dict('os.environ', {
+        'RABBITMQ_HOST': 'localhost',
+        'RABBITMQ_PORT': '5672',
+        'RABBITMQ_USER': 'guest',
+        'RABBITMQ_PASSWORD': 'guest'
+    })
+    @patch('user_deletion_providor.pika.BlockingConnection')
+    def test_send_to_rabbitmq_not_confirmed(self, mock_connection):
+        mock_channel = MagicMock()
+        mock_connection.return_value.channel.return_value = mock_channel
+        mock_channel.basic_publish.side_effect = pika.exceptions.NackError([])
+
+        self.assertFalse(send_to_rabbitmq("<xml></xml>"))
+
+    @patch('user_deletion_providor.get_db_connection')
+    def test_mark_batch_as_deleted(self, mock_get_db_connection):
+        mock_cursor = MagicMock()
+        mock_conn = MagicMock()
+        mock_get_db_connection.return_value = mock_conn
+        mock_conn.cursor.return_value = mock_cursor
+
+        first, second = datetime(2025, 5, 1, 9, 30), datetime(2025, 5, 1, 9, 31)
+        self.assertTrue(mark_batch_as_deleted([(1, first), (2, second)]))
+
+        # One statement and one commit for the whole batch; a notification written after the read is left alone
+        mock_cursor.execute.assert_called_once()
+        sql, params = mock_cursor.execute.call_args[0]
+        self.assertIn("UPDATE user_deletion_notifications", sql)
+        self.assertIn("WHERE (client_id = %s AND deleted_at <= %s) OR (client_id = %s AND deleted_at <= %s)", sql)
+        self.assertEqual(params, (1, first, 2, second))
+        mock_conn.commit.assert_called_once()
+
+    @patch('user_deletion_providor.get_db_connection')
+    def test_mark_batch_as_deleted_empty(self, mock_get_db_connection):
+        self.assertTrue(mark_batch_as_deleted([]))
+        mock_get_db_connection.assert_not_called()
+
+    @patch('user_deletion_providor.get_db_connection')
+    def test_mark_batch_as_deleted_error(self, mock_get_db_connection):
+        mock_cursor = MagicMock()
+        mock_conn = MagicMock()
+        mock_get_db_connection.return_value = mock_conn
+        mock_conn.cursor.return_value = mock_cursor
+        mock_cursor.execute.side_effect = mysql.connector.Error("deadlock")
+
+        self.assertFalse(mark_batch_as_deleted([(1, datetime(2025, 5, 1, 9, 30))]))
+        mock_conn.rollback.assert_called_once()
+        mock_conn.close.assert_called_once()
+
+    @patch('user_deletion_providor.get_db_connection')
+    def test_get_users_to_delete_batch_limit(self, mock_get_db_connection):
+        mock_cursor = MagicMock()
+        mock_conn = MagicMock()
+        mock_get_db_connection.return_value = mock_conn
+        mock_conn.cursor.return_value = mock_cursor
+        mock_cursor.fetchall.return_value = []
+
+        get_users_to_delete(25)
+
+        sql, params = mock_cursor.execute.call_args[0]
+        self.assertIn("LIMIT %s", sql)
+        self.assertEqual(params, (25,))
+
+    @patch('user_deletion_providor.datetime')
+    @patch('user_deletion_providor.mark_batch_as_deleted', return_value=True)
+    @patch('user_deletion_providor.send_to_rabbitmq', return_value=True)
+    @patch('user_deletion_providor.cdc.BinlogTailer')
+    @patch('user_deletion_providor.get_db_connection')
+    def test_run_cdc_sends_the_same_xml_as_polling(self, mock_get_db_connection, mock_tailer, mock_send, mock_mark, mock_datetime):
+        mock_datetime.utcnow.return_value = datetime(2025, 5, 1, 12, 0, 0)
+        deleted_at = datetime(2025, 5, 1, 9, 30, 0, 250000)
+        mock_cursor = mock_get_db_connection.return_value.cursor.return_value
+        mock_cursor.fetchall.side_effect = [
+            [{'client_id': 1, 'deleted_at': deleted_at}],  # polling query
+            [(1, deleted_at)],  # get_deletion_times in CDC mode
+        ]
+        row = {'id': 1, 'email': 'john@example.com', 'timestamp': datetime(2025, 4, 29, 14, 22, 27, 816332)}
+        batch = cdc.ChangeBatch([cdc.Change("delete", row, None)], "binlog.000001", 100)
+        mock_tailer.return_value.pin_start.return_value = False
+        mock_tailer.return_value.batches.return_value = [batch]
+
+        polled = create_delete_xml(get_users_to_delete()[0])
+        run_cdc()
+
+        self.assertEqual(mock_send.call_args[0][0], polled)
+        self.assertIn("<UUID>2025-05-01T09:30:00.250000Z</UUID>", polled)
+        self.assertIn("GROUP BY client_id", mock_cursor.execute.call_args[0][0])
+        mock_mark.assert_called_once_with([(1, deleted_at)])
+        mock_tailer.return_value.save_checkpoint.assert_called_once_with(batch)
+
+    @patch('user_deletion_providor.publish_pending_deletions')
+    @patch('user_deletion_providor.cdc.BinlogTailer')
+    def test_run_cdc_drains_notifications_before_tailing(self, mock_tailer, mock_publish):
+        mock_publish.side_effect = [(BATCH_SIZE, BATCH_SIZE), (0, 0)]
+        mock_tailer.return_value.pin_start.return_value = True
+        mock_tailer.return_value.batches.return_value = []
+
+        run_cdc()
+
+        self.assertEqual(mock_publish.call_count, 2)
+        mock_tailer.return_value.batches.assert_called_once()
+
+    @patch('user_deletion_providor.publish_pending_deletions', return_value=(2, 1))
+    @patch('user_deletion_providor.cdc.BinlogTailer')
+    def test_run_cdc_stops_when_backfill_is_incomplete(self, mock_tailer, mock_publish):
+        mock_tailer.return_value.pin_start.return_value = True
+
+        with self.assertRaises(RuntimeError):
+            run_cdc()
+
+        mock_tailer.return_value.batches.assert_not_called()
+
+    @patch('user_deletion_providor.mark_batch_as_deleted', return_value=True)
+    @patch('user_deletion_providor.send_to_rabbitmq', return_value=True)
+    @patch('user_deletion_providor.partitions.is_stale', return_value=True)
+    @patch('user_deletion_providor.get_users_to_delete')
+    def test_publish_pending_deletions_drops_batch_when_lease_is_stale(self, mock_get, mock_stale, mock_send, mock_mark):
+        mock_get.return_value = [{'client_id': 1, 'timestamp': '2025-05-01T09:30:00.000000Z'}]
+
+        self.assertEqual(publish_pending_deletions(), (1, 0))
+        mock_send.assert_not_called()
+        mock_mark.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
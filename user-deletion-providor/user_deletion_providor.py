@@ -1,8 +1,8 @@
 import pika
 import os
-import xml.etree.ElementTree as ET
 from datetime import datetime
 import mysql.connector
+from common import db, rabbitmq, scheduler, cdc, migrations, xmlout, stats, lease
 import time
 import logging
 
@@ -13,36 +13,53 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+BATCH_SIZE = int(os.getenv("USER_BATCH_SIZE", "100"))
+
+QUEUES = ["crm_user_delete", "kassa_user_delete", "frontend_user_delete"]
+
+# One long-lived publisher; the exchange, queues and bindings are declared once when it connects
+publisher = rabbitmq.Publisher(
+    exchange="user",
+    exchange_type="topic",
+    bindings=[(queue, f"user.delete.{queue}") for queue in QUEUES]
+)
+
+# Met PROVIDER_PARTITIONS verdelen replica's het werk op MOD(client_id, N); zie common/lease.py
+partitions = lease.PartitionLease("user-deletion-providor")
+
 # Database connection
 def get_db_connection():
-    return mysql.connector.connect(
-        host=os.environ["DB_HOST"],
-        user=os.environ["DB_USER"],
-        password=os.environ["DB_PASSWORD"],
-        database=os.environ["DB_NAME"]
-    )
+    return db.get_connection()
 
 # Haal alle users die nog niet verwerkt zijn (processed = 0)
-def get_users_to_delete():
+def get_users_to_delete(batch_size=None):
+    started = time.perf_counter()
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
+    limit = "LIMIT %s" if batch_size else ""
+    params = ()
+    partition = ""
+    condition = partitions.condition("client_id")
+    if condition is not None:
+        partition = f"AND {condition[0]}"
+        params = condition[1]
+    if batch_size:
+        params += (batch_size,)
 
     try:
-        cursor.execute("""
+        cursor.execute(f"""
             SELECT 
                 client_id, 
                 deleted_at
             FROM user_deletion_notifications
-            WHERE processed = 0
+            WHERE processed = 0 {partition}
             ORDER BY deleted_at ASC
-        """)
+            {limit}
+        """, params)
         users = cursor.fetchall()
 
         for user in users:
-            deleted_at = user['deleted_at']
-            if isinstance(deleted_at, str):
-                deleted_at = datetime.strptime(deleted_at, '%Y-%m-%d %H:%M:%S.%f')
-            user['timestamp'] = deleted_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            user['timestamp'] = format_uuid(user['deleted_at'])
 
         return users
     except mysql.connector.Error as err:
@@ -51,82 +68,100 @@ def get_users_to_delete():
     finally:
         cursor.close()
         conn.close()
+        stats.observe("db_seconds", time.perf_counter() - started)
+
+# De UUID van een delete is deleted_at uit user_deletion_notifications, bij polling en in CDC-modus
+def format_uuid(deleted_at):
+    if isinstance(deleted_at, str):
+        deleted_at = datetime.strptime(deleted_at, '%Y-%m-%d %H:%M:%S.%f')
+    return deleted_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+# Laatste deleted_at voor de clients van een CDC-batch, {client_id: deleted_at}; de notificatie wordt
+# in dezelfde transactie als de DELETE geschreven, dus staat er zodra de binlog het event heeft
+def get_deletion_times(client_ids):
+    if not client_ids:
+        return {}
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"SELECT client_id, MAX(deleted_at) FROM user_deletion_notifications "
+            f"WHERE client_id IN ({', '.join(['%s'] * len(client_ids))}) GROUP BY client_id",
+            tuple(client_ids)
+        )
+        return dict(cursor.fetchall())
+    finally:
+        cursor.close()
+        conn.close()
+
+# Aantal deletes dat nog verzonden moet worden, voor de poll_backlog gauge (draait op de stats-thread)
+def count_backlog():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT COUNT(*) FROM user_deletion_notifications WHERE processed = 0")
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+        conn.close()
 
-# Zet processed = 1 zodat hij niet opnieuw verzonden wordt
-def mark_as_deleted(client_id):
+# Zet processed = 1 voor een hele batch in één UPDATE-transactie.
+# `deletions` zijn (client_id, deleted_at) paren zoals gelezen: een notificatie die na die SELECT is
+# geschreven heeft een latere deleted_at en blijft dus staan voor de volgende poll.
+# Alleen succesvol verzonden clients zitten in `deletions`; de rest wordt bij de volgende poll opnieuw geprobeerd.
+def mark_batch_as_deleted(deletions):
+    if not deletions:
+        return True
+
+    started = time.perf_counter()
     conn = get_db_connection()
     cursor = conn.cursor()
 
     try:
-        cursor.execute("""
+        conditions = " OR ".join(["(client_id = %s AND deleted_at <= %s)"] * len(deletions))
+        cursor.execute(f"""
             UPDATE user_deletion_notifications
             SET processed = 1
-            WHERE client_id = %s
-        """, (client_id,))
+            WHERE {conditions}
+        """, tuple(value for deletion in deletions for value in deletion))
         conn.commit()
+        return True
     except mysql.connector.Error as err:
-        logger.error(f"Failed to mark client {client_id} as processed: {err}")
+        logger.error(f"Failed to mark clients {[client_id for client_id, _ in deletions]} as processed: {err}")
+        conn.rollback()
+        return False
     finally:
         cursor.close()
         conn.close()
+        stats.observe("db_seconds", time.perf_counter() - started)
+
+# Opbouw van het DELETE-bericht; wordt één keer gecompileerd, zie common/xmlout.py
+USER_DELETE_TEMPLATE = xmlout.Template("UserMessage", [
+    xmlout.Field("ActionType"),
+    xmlout.Field("UUID"),
+    xmlout.Field("TimeOfAction"),
+])
 
 # Maak een geldig XML-bestand volgens het XSD-formaat (DELETE)
 def create_delete_xml(user):
-    xml = ET.Element("UserMessage")
-
-    ET.SubElement(xml, "ActionType").text = "DELETE"
-    ET.SubElement(xml, "UUID").text = user['timestamp']
-    ET.SubElement(xml, "TimeOfAction").text = datetime.utcnow().isoformat() + "Z"
-
-    return '<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(xml, encoding='unicode')
+    return USER_DELETE_TEMPLATE.render({
+        "ActionType": "DELETE",
+        "UUID": user['timestamp'],
+        "TimeOfAction": datetime.utcnow().isoformat() + "Z",
+    })
 
 # Verstuur XML naar RabbitMQ queues
 def send_to_rabbitmq(xml):
-    queues = ["crm_user_delete", "kassa_user_delete", "frontend_user_delete"]
-
     try:
-        params = pika.ConnectionParameters(
-            host=os.environ["RABBITMQ_HOST"],
-            port=int(os.environ["RABBITMQ_PORT"]),
-            virtual_host="/",
-            credentials=pika.PlainCredentials(
-                os.environ["RABBITMQ_USER"],
-                os.environ["RABBITMQ_PASSWORD"]
-            ),
-            heartbeat=600,
-            blocked_connection_timeout=300
-        )
-
-        connection = pika.BlockingConnection(params)
-        channel = connection.channel()
-
-        channel.exchange_declare(
-            exchange="user",
-            exchange_type="topic",
-            durable=True
-        )
-
-        for queue in queues:
-            channel.queue_declare(queue=queue, durable=True)
-            channel.queue_bind(
-                exchange="user",
-                queue=queue,
-                routing_key=f"user.delete.{queue}"
-            )
-            channel.basic_publish(
-                exchange="user",
-                routing_key=f"user.delete.{queue}",
-                body=xml,
-                properties=pika.BasicProperties(
-                    delivery_mode=2
-                )
-            )
+        for queue in QUEUES:
+            publisher.publish(f"user.delete.{queue}", xml)
             logger.info(f"Sent DELETE XML message to {queue}")
-
-        connection.close()
+        stats.incr("messages")
         return True
     except Exception as e:
         logger.error(f"RabbitMQ Error: {e}")
+        stats.incr("errors")
         return False
 
 # Optioneel: initialiseer tabel als die nog niet bestaat
@@ -151,24 +186,104 @@ def initialize_database():
         cursor.close()
         conn.close()
 
+    # Indexen voor de lookups aanmaken/controleren
+    try:
+        migrations.migrate()
+        migrations.missing_indexes()
+    except Exception as e:
+        logger.error(f"Schema migration failed: {e}")
+
+# Eén pollronde: verstuurt tot BATCH_SIZE openstaande deletes.
+# Geeft (opgehaald, verstuurd) terug; wat niet verstuurd kon worden blijft staan voor de volgende ronde.
+def publish_pending_deletions():
+    users_to_delete = get_users_to_delete(BATCH_SIZE)
+
+    published = []
+    for user in users_to_delete:
+        # De batch is geselecteerd onder de partition lease; is die niet meer vers, dan kan een
+        # andere replica deze clients al overnemen, dus de rest van de batch laten we aan hem
+        if partitions.is_stale():
+            logger.warning(f"Partition lease went stale, dropping {len(users_to_delete) - len(published)} deletions of this batch")
+            return len(users_to_delete), 0
+        xml = create_delete_xml(user)
+        if send_to_rabbitmq(xml):
+            published.append(user)
+        else:
+            logger.error(f"Failed to process deletion for client {user['client_id']}")
+
+    if partitions.is_stale():
+        logger.warning("Partition lease went stale, not marking this batch as deleted")
+        return len(users_to_delete), 0
+    if not mark_batch_as_deleted([(user['client_id'], user['deleted_at']) for user in published]):
+        return len(users_to_delete), 0
+    for user in published:
+        logger.info(f"Processed deletion for client {user['client_id']} with timestamp {user['timestamp']}")
+    return len(users_to_delete), len(published)
+
+# Change-data-capture modus: verwijderde clients rechtstreeks uit de binlog publiceren in plaats van te pollen
+def run_cdc():
+    tailer = cdc.BinlogTailer("user_deletion_providor", actions=("delete",))
+    try:
+        if tailer.pin_start():
+            # Eerste start in CDC-modus: deletes van voor de vastgezette positie staan niet in het
+            # stuk binlog dat we lezen, dus de pollquery verstuurt ze één keer
+            while True:
+                fetched, published = publish_pending_deletions()
+                if published < fetched:
+                    raise RuntimeError(f"Backfill before CDC published {published} of {fetched} deletions")
+                if fetched < BATCH_SIZE:
+                    break
+        for batch in tailer.batches():
+            notified = get_deletion_times(list(dict.fromkeys(change.row.get('id') for change in batch.changes)))
+            users = []
+            for change in batch.changes:
+                user = cdc.client_row_to_user(change.row)
+                if user['id'] not in notified:
+                    # Polling zou deze delete ook nooit versturen
+                    logger.warning(f"No user_deletion_notifications entry for client {user['id']}, skipping deletion")
+                    continue
+                user['deleted_at'] = notified[user['id']]
+                user['timestamp'] = format_uuid(user['deleted_at'])
+                users.append(user)
+            for user in users:
+                if not send_to_rabbitmq(create_delete_xml(user)):
+                    # Checkpoint niet verplaatsen; het event wordt na de herstart opnieuw afgespeeld
+                    raise RuntimeError(f"Failed to process deletion for client {user['id']}")
+
+            # user_deletion_notifications bijwerken zodat terugschakelen naar polling niets opnieuw verstuurt
+            if not mark_batch_as_deleted([(user['id'], user['deleted_at']) for user in users]):
+                raise RuntimeError("Failed to record CDC batch in user_deletion_notifications")
+            tailer.save_checkpoint(batch)
+            for user in users:
+                logger.info(f"Processed deletion for client {user['id']} with timestamp {user['timestamp']}")
+    finally:
+        tailer.close()
+
 # Main loop
 if __name__ == "__main__":
     initialize_database()
     logger.info("Starting user deletion provider")
+    probes = {"db_latency_ms": db.ping_latency_ms}
+    # In CDC-modus wordt de outbox niet gepold en is er geen poll backlog om te tellen
+    if not cdc.is_enabled():
+        probes["poll_backlog"] = stats.every(stats.BACKLOG_INTERVAL, count_backlog)
+    stats.start("user-deletion-providor", probes=probes)
 
-    while True:
+    while cdc.is_enabled():
         try:
-            users_to_delete = get_users_to_delete()
+            run_cdc()
+        except Exception as e:
+            logger.error(f"CDC error: {e}")
+            time.sleep(60)
+    poller = scheduler.PollScheduler()
 
-            for user in users_to_delete:
-                xml = create_delete_xml(user)
-                if send_to_rabbitmq(xml):
-                    mark_as_deleted(user['client_id'])
-                    logger.info(f"Processed deletion for client {user['client_id']} with timestamp {user['timestamp']}")
-                else:
-                    logger.error(f"Failed to process deletion for client {user['client_id']}")
+    while True:
+        try:
+            fetched, _ = publish_pending_deletions()
 
-            time.sleep(5)
+            publisher.process_data_events()
+            # Een volle batch betekent dat er nog meer klaarstaat: meteen opnieuw pollen
+            poller.wait(fetched, full=fetched >= BATCH_SIZE)
         except Exception as e:
             logger.error(f"Processing error: {e}")
             time.sleep(60)
@@ -5,16 +5,18 @@ import logging
 import io
 import os
 from user_update_consumer import (
-    get_current_user_data,
     update_user,
     parse_user_xml,
     on_message,
-    start_consumer
+    start_consumer,
+    ledger
 )
+from common import idempotency
 
 class TestUserUpdateConsumer(unittest.TestCase):
     
     def setUp(self):
+        ledger.clear()
         # Sample test data
         self.sample_xml = """
         <UserMessage>
@@ -60,46 +62,58 @@ class TestUserUpdateConsumer(unittest.TestCase):
     def tearDown(self):
         self.log_capture.close()
 
-    @patch('user_update_consumer.mysql.connector.connect')
-    def test_get_current_user_data_exists(self, mock_connect):
-        mock_cursor = MagicMock()
-        mock_connect.return_value.cursor.return_value = mock_cursor
-        mock_cursor.fetchone.return_value = [1]  # User exists
-        
-        result = get_current_user_data('2025-04-29T14:22:27.816332Z')
-        self.assertIsNotNone(result)
-
-    @patch('user_update_consumer.mysql.connector.connect')
-    def test_get_current_user_data_not_found(self, mock_connect):
-        mock_cursor = MagicMock()
-        mock_connect.return_value.cursor.return_value = mock_cursor
-        mock_cursor.fetchone.return_value = None  # User doesn't exist
-        
-        result = get_current_user_data('2025-04-29T14:22:27.816332Z')
-        self.assertIsNone(result)
-
-    @patch('user_update_consumer.mysql.connector.connect')
+    @patch('user_update_consumer.get_db_connection')
     def test_update_user_success(self, mock_connect):
         mock_cursor = MagicMock()
         mock_connect.return_value.cursor.return_value = mock_cursor
-        mock_cursor.fetchone.return_value = [1]  # User exists
+        mock_cursor.rowcount = 1  # User exists and was changed
         
         result = update_user(self.sample_data)
         self.assertTrue(result)
+        # Only the UPDATE, no SELECT beforehand
+        mock_cursor.execute.assert_called_once()
+        self.assertIn("UPDATE client", mock_cursor.execute.call_args[0][0])
         logs = self.log_capture.getvalue()
         self.assertIn("Successfully updated user", logs)
 
-    @patch('user_update_consumer.mysql.connector.connect')
+    @patch('user_update_consumer.get_db_connection')
     def test_update_user_not_found(self, mock_connect):
         mock_cursor = MagicMock()
         mock_connect.return_value.cursor.return_value = mock_cursor
+        mock_cursor.rowcount = 0
         mock_cursor.fetchone.return_value = None  # User doesn't exist
         
         result = update_user(self.sample_data)
         self.assertFalse(result)
+        mock_connect.return_value.commit.assert_not_called()
         logs = self.log_capture.getvalue()
         self.assertIn("Cannot update - user with timestamp", logs)
 
+    @patch('user_update_consumer.get_db_connection')
+    def test_update_user_unchanged_values(self, mock_connect):
+        mock_cursor = MagicMock()
+        mock_connect.return_value.cursor.return_value = mock_cursor
+        mock_cursor.rowcount = 0  # Same values as before
+        mock_cursor.fetchone.return_value = (1,)  # but the user does exist
+        
+        result = update_user(self.sample_data)
+        self.assertTrue(result)
+
+    @patch('user_update_consumer.get_db_connection')
+    def test_update_user_without_fields_commits_ledger_key(self, mock_connect):
+        mock_cursor = MagicMock()
+        mock_connect.return_value.cursor.return_value = mock_cursor
+        mock_cursor.rowcount = 1  # ledger key claimed
+        mock_cursor.fetchone.return_value = (1,)  # the user exists
+        data = dict(self.sample_data, first_name=None, last_name=None, email=None, phone=None, password=None)
+
+        result = update_user(data, "a" * 64)
+        self.assertTrue(result)
+        self.assertNotIn("UPDATE client", " ".join(c[0][0] for c in mock_cursor.execute.call_args_list))
+        mock_connect.return_value.commit.assert_called_once()
+        self.assertTrue(ledger.is_duplicate("a" * 64))
+        self.assertIn("No fields to update", self.log_capture.getvalue())
+
     def test_parse_user_xml_success(self):
         result = parse_user_xml(self.sample_xml)
         self.assertEqual(result['action_type'], 'UPDATE')
@@ -109,9 +123,10 @@ class TestUserUpdateConsumer(unittest.TestCase):
         with self.assertRaises(Exception):
             parse_user_xml("invalid xml")
 
+    @patch('user_update_consumer.cache.publish_invalidation')
     @patch('user_update_consumer.update_user')
     @patch('user_update_consumer.parse_user_xml')
-    def test_on_message_success(self, mock_parse, mock_update):
+    def test_on_message_success(self, mock_parse, mock_update, mock_invalidate):
         mock_parse.return_value = self.sample_data
         mock_update.return_value = True
         
@@ -126,6 +141,31 @@ class TestUserUpdateConsumer(unittest.TestCase):
         self.assertNotIn('T', parsed_data['uuid'])
         
         mock_channel.basic_ack.assert_called_once()
+        mock_invalidate.assert_called_once_with(parsed_data['uuid'])
+
+    @patch('user_update_consumer.get_db_connection')
+    def test_update_user_duplicate_message_is_skipped(self, mock_connect):
+        mock_cursor = MagicMock()
+        mock_cursor.rowcount = 0  # key already in processed_messages
+        mock_connect.return_value.cursor.return_value = mock_cursor
+
+        self.assertFalse(update_user(self.sample_data, "b" * 64))
+        mock_cursor.execute.assert_called_once()
+        self.assertIn("processed_messages", mock_cursor.execute.call_args[0][0])
+        mock_connect.return_value.commit.assert_not_called()
+
+    @patch('user_update_consumer.cache.publish_invalidation')
+    @patch('user_update_consumer.update_user')
+    def test_on_message_redelivery_is_acked_without_processing(self, mock_update, mock_invalidate):
+        ledger.remember(idempotency.message_key(self.sample_data['uuid'], self.sample_data['timestamp']))
+        mock_channel = MagicMock()
+
+        with patch('user_update_consumer.parse_user_xml', return_value=dict(self.sample_data)):
+            on_message(mock_channel, MagicMock(), None, self.sample_xml.encode())
+
+        mock_update.assert_not_called()
+        mock_invalidate.assert_not_called()
+        mock_channel.basic_ack.assert_called_once()
 
     @patch('user_update_consumer.update_user')
     @patch('user_update_consumer.parse_user_xml')
@@ -1,8 +1,8 @@
 import pika
 import os
 import logging
-import xml.etree.ElementTree as ET
 import mysql.connector
+from common import db, consumer, cache, usermessage, stats, idempotency, retry
 from datetime import datetime
 
 # Configure logging with debug level
@@ -12,67 +12,43 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Messages already applied, keyed by UUID + TimeOfAction: a redelivered update is acked
+# without running the UPDATE again; see common/idempotency.py
+ledger = idempotency.Ledger("user-update-consumer")
+
 # Database connection helper function
 def get_db_connection():
-    return mysql.connector.connect(
-        host=os.getenv("DB_HOST"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        database=os.getenv("DB_NAME")
-    )
-
-# Check if user exists and return current data if they do
-def get_current_user_data(uuid_timestamp):
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    try:
-        logger.debug(f"Checking for existing user with timestamp: {uuid_timestamp}")
-        cursor.execute("""
-            SELECT 
-                id, email, pass, first_name, last_name, 
-                phone, company, address_1 as address, company_vat as vat
-            FROM client 
-            WHERE timestamp = %s
-        """, (uuid_timestamp,))
-        user = cursor.fetchone()
-        
-        if user:
-            logger.debug(f"Found existing user: {user}")
-            return user
-        logger.warning(f"No user found with timestamp: {uuid_timestamp}")
-        return None
-    finally:
-        cursor.close()
-        conn.close()
+    return db.get_connection()
+
+# Elements an UPDATE message must carry; everything else is optional
+REQUIRED_FIELDS = ("action_type", "uuid", "time_of_action")
 
 # XML parser (similar to creation but handles UPDATE action type)
 def parse_user_xml(xml_data):
     try:
         logger.debug("Parsing XML data")
-        root = ET.fromstring(xml_data)
+        message = usermessage.decode(xml_data, required=REQUIRED_FIELDS)
         
         # Validate action type
-        action_type = root.find('ActionType').text.upper()
+        action_type = message.action_type.upper()
         if action_type != 'UPDATE':
             raise ValueError(f"Invalid action type for update consumer: {action_type}")
 
-        business = root.find('Business')
-        
-        # Parse all possible fields (most are optional)
+        # Parse all possible fields (most are optional, None when absent)
         parsed_data = {
             'action_type': action_type,
-            'uuid': root.find('UUID').text,
-            'timestamp': root.find('TimeOfAction').text,
-            'password': root.findtext('EncryptedPassword'),  # Optional for updates
-            'first_name': root.findtext('FirstName'),
-            'last_name': root.findtext('LastName'),
-            'phone': root.findtext('PhoneNumber'),
-            'email': root.findtext('EmailAddress'),
-            'company': business.findtext('BusinessName') if business is not None else None,
-            'company_email': business.findtext('BusinessEmail') if business is not None else None,
-            'address': business.findtext('RealAddress') if business is not None else None,
-            'vat': business.findtext('BTWNumber') if business is not None else None,
-            'invoice_address': business.findtext('FacturationAddress') if business is not None else None
+            'uuid': message.uuid,
+            'timestamp': message.time_of_action,
+            'password': message.password,  # Optional for updates
+            'first_name': message.first_name,
+            'last_name': message.last_name,
+            'phone': message.phone,
+            'email': message.email,
+            'company': message.business_name,
+            'company_email': message.business_email,
+            'address': message.real_address,
+            'vat': message.btw_number,
+            'invoice_address': message.facturation_address
         }
         
         logger.debug(f"Parsed XML data: {parsed_data}")
@@ -82,13 +58,11 @@ def parse_user_xml(xml_data):
         raise
 
 # Update user in database
-def update_user(data):
-    # First get current user data
-    current_data = get_current_user_data(data['uuid'])
-    if not current_data:
-        logger.error(f"Cannot update - user with timestamp {data['uuid']} does not exist")
-        return False
-
+# The UPDATE itself tells us whether the user exists: no separate SELECT (and second connection)
+# beforehand. Only when no row changed do we look the user up, to tell "not found" apart from
+# "nothing to change". message_key is recorded in the same transaction; a message that was
+# already applied returns False without touching the client table.
+def update_user(data, message_key=None):
     # Prepare update fields - only include fields that are provided in the XML
     update_fields = {}
     
@@ -112,33 +86,47 @@ def update_user(data):
     if data['vat'] is not None:
         update_fields['company_vat'] = data['vat']
     
-    # If no fields to update, log and return
-    if not update_fields:
-        logger.info("No fields to update - all fields in XML were empty")
-        return True
-    
-    # Build the dynamic SQL update query
-    set_clause = ", ".join([f"{field} = %s" for field in update_fields.keys()])
-    values = list(update_fields.values())
-    values.append(data['uuid'])  # For WHERE clause
-    
+    conn = get_db_connection()
+    cursor = conn.cursor()
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        sql = f"""
-            UPDATE client 
-            SET {set_clause}, updated_at = NOW()
-            WHERE timestamp = %s
-        """
-        
-        logger.debug(f"Executing update query: {sql}")
-        logger.debug(f"With values: {values}")
-        
-        cursor.execute(sql, values)
+        if not ledger.claim(cursor, message_key):
+            conn.rollback()
+            logger.info(f"Update for user {data['uuid']} already applied, skipping duplicate message")
+            return False
+
+        updated = 0
+        if update_fields:
+            # Build the dynamic SQL update query
+            set_clause = ", ".join([f"{field} = %s" for field in update_fields.keys()])
+            values = list(update_fields.values())
+            values.append(data['uuid'])  # For WHERE clause
+
+            sql = f"""
+                UPDATE client 
+                SET {set_clause}, updated_at = NOW()
+                WHERE timestamp = %s
+            """
+            
+            logger.debug(f"Executing update query: {sql}")
+            logger.debug(f"With values: {values}")
+            
+            cursor.execute(sql, values)
+            updated = cursor.rowcount
+
+        if updated == 0:
+            cursor.execute("SELECT id FROM client WHERE timestamp = %s", (data['uuid'],))
+            if cursor.fetchone() is None:
+                conn.rollback()
+                logger.error(f"Cannot update - user with timestamp {data['uuid']} does not exist")
+                return False
+
+        # Also without fields to update: the ledger key claimed above has to be committed
         conn.commit()
-        
-        logger.info(f"Successfully updated user with timestamp: {data['uuid']}")
+        ledger.remember(message_key)
+        if not update_fields:
+            logger.info("No fields to update - all fields in XML were empty")
+        else:
+            logger.info(f"Successfully updated user with timestamp: {data['uuid']}")
         return True
     except Exception as e:
         logger.error(f"User update failed: {e}")
@@ -153,12 +141,20 @@ def on_message(channel, method, properties, body):
         logger.info(f"Received message via {method.routing_key}")
         logger.debug(f"Message body: {body.decode()}")
         
-        user_data = parse_user_xml(body.decode())
+        with stats.timed("parse_seconds"):
+            user_data = parse_user_xml(body)
 
         # Check action type
         if user_data['action_type'] != 'UPDATE':
             logger.warning(f"Ignoring non-UPDATE action: {user_data['action_type']}")
-            channel.basic_ack(method.delivery_tag)
+            consumer.ack(channel, method.delivery_tag)
+            return
+
+        # Redelivery of a message this process already applied: ack straight away
+        message_key = idempotency.message_key(user_data['uuid'], user_data['timestamp'])
+        if ledger.is_duplicate(message_key):
+            logger.info(f"Update for user {user_data['uuid']} already applied, skipping duplicate message")
+            consumer.ack(channel, method.delivery_tag)
             return
 
         # Format UUID/timestamp (same as creation consumer)
@@ -167,12 +163,17 @@ def on_message(channel, method, properties, body):
         if 'T' in user_data['uuid']:
             user_data['uuid'] = user_data['uuid'].replace('T', ' ')
         
-        update_user(user_data)
-        channel.basic_ack(method.delivery_tag)
+        with stats.timed("db_seconds"):
+            updated = update_user(user_data, message_key)
+        if updated:
+            # Let the invoice consumer drop its cached copy of this client
+            cache.publish_invalidation(user_data['uuid'])
+        consumer.ack(channel, method.delivery_tag)
         
     except Exception as e:
         logger.error(f"Error processing message: {e}")
-        channel.basic_nack(method.delivery_tag, requeue=False)
+        # Transient failures go to a retry queue, the rest to the DLQ (see common/retry.py)
+        retry.reject(channel, method, properties, body, e)
 
 # Start the consumer
 def start_consumer():
@@ -187,16 +188,20 @@ def start_consumer():
         blocked_connection_timeout=300
     ))
     channel = connection.channel()
+    try:
+        ledger.initialize()
+    except Exception as e:
+        logger.error(f"Idempotency ledger initialization failed: {e}")
+    # Stats for the heartbeat
+    stats.start("user-update-consumer", probes={"db_latency_ms": db.ping_latency_ms})
+    # Prefetch + worker lanes so DB work runs off the pika I/O thread
+    runtime = consumer.ConsumerRuntime(on_message)
 
     try:
         # Declare the update queue
         queue_name = 'facturatie_user_update'
         channel.queue_declare(queue=queue_name, durable=True)
-        channel.basic_consume(
-            queue=queue_name,
-            on_message_callback=on_message,
-            auto_ack=False
-        )
+        runtime.consume(channel, queue_name)
 
         logger.info("Waiting for user update messages...")
         channel.start_consuming()
@@ -204,6 +209,7 @@ def start_consumer():
     except KeyboardInterrupt:
         logger.info("Stopping consumer...")
         channel.stop_consuming()
+        runtime.shutdown(connection)
         connection.close()
     except Exception as e:
         logger.error(f"Consumer failed: {e}")
@@ -1,20 +1,33 @@
 import unittest
 from unittest.mock import patch, MagicMock
+import pika
+import mysql.connector
 import xml.etree.ElementTree as ET
 import logging
 import io
 import os
+from datetime import datetime
+from common import rabbitmq, cdc, stats
 from user_update_providor import (
     get_updated_users,
-    mark_as_processed,
+    mark_batch_as_processed,
     create_xml_message,
     send_to_rabbitmq,
-    initialize_database
+    publisher,
+    initialize_database,
+    publish_pending_updates,
+    run_cdc,
+    BATCH_SIZE,
+    count_backlog
 )
 
 class TestUserUpdateProvidor(unittest.TestCase):
     
     def setUp(self):
+        # The publisher is long-lived; drop any connection left over from a previous test
+        publisher.close()
+        self.addCleanup(publisher.close)
+
         # Sample test data
         self.sample_user = {
             'id': 1,
@@ -58,22 +71,6 @@ class TestUserUpdateProvidor(unittest.TestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[0]['id'], 1)
 
-    @patch('user_update_providor.get_db_connection')
-    def test_mark_as_processed_success(self, mock_get_db_connection):
-        mock_cursor = MagicMock()
-        mock_conn = MagicMock()
-        mock_get_db_connection.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
-        
-        mark_as_processed(1)
-        
-        mock_cursor.execute.assert_called_once_with("""
-            UPDATE user_updates_queue
-            SET processed = TRUE
-            WHERE client_id = %s
-        """, (1,))
-        mock_conn.commit.assert_called_once()
-
     def test_create_xml_message_success(self):
         xml = create_xml_message(self.sample_user)
         self.assertIn("<ActionType>UPDATE</ActionType>", xml)
@@ -81,6 +78,29 @@ class TestUserUpdateProvidor(unittest.TestCase):
         self.assertIn("<FirstName>John</FirstName>", xml)
         self.assertIn("<LastName>Doe</LastName>", xml)
 
+    @patch('user_update_providor.datetime')
+    def test_create_xml_message_matches_elementtree_output(self, mock_datetime):
+        # Reference output of the former ElementTree implementation, including escaping
+        mock_datetime.utcnow.return_value = datetime(2025, 5, 1, 12, 0, 0, 123456)
+        user = {
+            'first_name': 'John',
+            'last_name': "O'Brien & <Sons>",
+            'email': 'john@example.com',
+            'phone': '+32 470',
+            'pass': '',
+            'timestamp': '2025-04-29T14:22:27.816332Z',
+            'business_name': 'Doe & Co',
+            'btw_number': 'BE123',
+            'real_address': 'Main St 1, BE'
+        }
+
+        self.assertEqual(create_xml_message(user), (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<UserMessage><ActionType>UPDATE</ActionType><UUID>2025-04-29T14:22:27.816332Z</UUID><TimeOfAction>2025-05-01T12:00:00.123456Z</TimeOfAction><EncryptedPassword />'
+            "<FirstName>John</FirstName><LastName>O'Brien &amp; &lt;Sons&gt;</LastName><PhoneNumber>+32 470</PhoneNumber><EmailAddress>john@example.com</EmailAddress>"
+            '<Business><BusinessName>Doe &amp; Co</BusinessName><BusinessEmail>john@example.com</BusinessEmail><RealAddress>Main St 1, BE</RealAddress><FacturationAddress>Main St 1, BE</FacturationAddress><BTWNumber>BE123</BTWNumber></Business></UserMessage>'
+        ))
+
     @patch.dict('os.environ', {
         'RABBITMQ_HOST': 'localhost',
         'RABBITMQ_PORT': '5672',
@@ -103,8 +123,10 @@ class TestUserUpdateProvidor(unittest.TestCase):
         result = send_to_rabbitmq("<xml></xml>")
         self.assertFalse(result)
 
+    @patch('user_update_providor.migrations.missing_indexes')
+    @patch('user_update_providor.migrations.migrate')
     @patch('user_update_providor.get_db_connection')
-    def test_initialize_database(self, mock_get_db_connection):
+    def test_initialize_database(self, mock_get_db_connection, mock_migrate, mock_missing):
         mock_cursor = MagicMock()
         mock_conn = MagicMock()
         mock_get_db_connection.return_value = mock_conn
@@ -123,6 +145,232 @@ class TestUserUpdateProvidor(unittest.TestCase):
             )
         """)
         mock_conn.commit.assert_called_once()
+        mock_migrate.assert_called_once()
+        mock_missing.assert_called_once()
+
+    @patch.dict('os.environ', {
+        'RABBITMQ_HOST': 'localhost',
+        'RABBITMQ_PORT': '5672',
+        'RABBITMQ_USER': 'guest',
+        'RABBITMQ_PASSWORD': 'guest'
+    })
+    @patch('user_update_providor.pika.BlockingConnection')
+    def test_send_to_rabbitmq_reuses_connection(self, mock_connection):
+        mock_channel = MagicMock()
+        mock_connection.return_value.channel.return_value = mock_channel
+
+        self.assertTrue(send_to_rabbitmq("<xml></xml>"))
+        self.assertTrue(send_to_rabbitmq("<xml></xml>"))
+
+        # One handshake and one topology declaration, then only publishes
+        mock_connection.assert_called_once()
+        mock_channel.confirm_delivery.assert_called_once()
+        self.assertEqual(mock_channel.queue_declare.call_count, 3)
+        self.assertEqual(mock_channel.basic_publish.call_count, 6)
+        mock_channel.basic_publish.assert_called_with(
+            exchange="user",
+            routing_key="user.update.frontend_user_update",
+            body="<xml></xml>",
+            properties=rabbitmq.PERSISTENT,
+            mandatory=True
+        )
+
+    @patch.dict('os.environ', {
+        'RABBITMQ_HOST': 'localhost',
+        'RABBITMQ_PORT': '5672',
+        'RABBITMQ_USER': 'guest',
+        'RABBITMQ_PASSWORD': 'guest'
+    })
+    @patch('user_update_providor.pika.BlockingConnection')
+    def test_send_to_rabbitmq_not_confirmed(self, mock_connection):
+        mock_channel = MagicMock()
+        mock_connection.return_value.channel.return_value = mock_channel
+        mock_channel.basic_publish.side_effect = pika.exceptions.NackError([])
+
+        self.assertFalse(send_to_rabbitmq("<xml></xml>"))
+
+    @patch('user_update_providor.get_db_connection')
+    def test_mark_batch_as_processed(self, mock_get_db_connection):
+        mock_cursor = MagicMock()
+        mock_conn = MagicMock()
+        mock_get_db_connection.return_value = mock_conn
+        mock_conn.cursor.return_value = mock_cursor
+
+        first, second = datetime(2025, 5, 1, 9, 30), datetime(2025, 5, 1, 9, 31)
+        self.assertTrue(mark_batch_as_processed([(1, first), (2, second)]))
+
+        # One statement and one commit for the whole batch; an update queued after the read is left alone
+        mock_cursor.execute.assert_called_once()
+        sql, params = mock_cursor.execute.call_args[0]
+        self.assertIn("UPDATE user_updates_queue", sql)
+        self.assertIn("WHERE (client_id = %s AND updated_at <= %s) OR (client_id = %s AND updated_at <= %s)", sql)
+        self.assertEqual(params, (1, first, 2, second))
+        mock_conn.commit.assert_called_once()
+
+    @patch('user_update_providor.get_db_connection')
+    def test_mark_batch_as_processed_records_db_time(self, mock_get_db_connection):
+        stats.reset()
+        self.addCleanup(stats.reset)
+
+        mark_batch_as_processed([(1, datetime(2025, 5, 1, 9, 30))])
+
+        self.assertEqual(stats.histograms()["db_seconds"][2], 1)
+
+    @patch('user_update_providor.get_db_connection')
+    def test_count_backlog(self, mock_get_db_connection):
+        mock_cursor = mock_get_db_connection.return_value.cursor.return_value
+        mock_cursor.fetchone.return_value = (42,)
+
+        self.assertEqual(count_backlog(), 42)
+        self.assertIn("processed = FALSE", mock_cursor.execute.call_args[0][0])
+        mock_get_db_connection.return_value.close.assert_called_once()
+
+    @patch('user_update_providor.get_db_connection')
+    def test_mark_batch_as_processed_empty(self, mock_get_db_connection):
+        self.assertTrue(mark_batch_as_processed([]))
+        mock_get_db_connection.assert_not_called()
+
+    @patch('user_update_providor.get_db_connection')
+    def test_mark_batch_as_processed_error(self, mock_get_db_connection):
+        mock_cursor = MagicMock()
+        mock_conn = MagicMock()
+        mock_get_db_connection.return_value = mock_conn
+        mock_conn.cursor.return_value = mock_cursor
+        mock_cursor.execute.side_effect = mysql.connector.Error("deadlock")
+
+        self.assertFalse(mark_batch_as_processed([(1, datetime(2025, 5, 1, 9, 30))]))
+        mock_conn.rollback.assert_called_once()
+        mock_conn.close.assert_called_once()
+
+    @patch('user_update_providor.get_db_connection')
+    def test_get_updated_users_batch_limit(self, mock_get_db_connection):
+        mock_cursor = MagicMock()
+        mock_conn = MagicMock()
+        mock_get_db_connection.return_value = mock_conn
+        mock_conn.cursor.return_value = mock_cursor
+        mock_cursor.fetchall.return_value = []
+
+        get_updated_users(25)
+
+        sql, params = mock_cursor.execute.call_args[0]
+        self.assertIn("LIMIT %s", sql)
+        self.assertEqual(params, (25,))
+
+    @patch('user_update_providor.partitions.condition', return_value=("MOD(q.client_id, %s) IN (%s, %s)", (4, 1, 3)))
+    @patch('user_update_providor.get_db_connection')
+    def test_get_updated_users_only_owned_partitions(self, mock_get_db_connection, mock_condition):
+        mock_cursor = MagicMock()
+        mock_get_db_connection.return_value.cursor.return_value = mock_cursor
+        mock_cursor.fetchall.return_value = []
+
+        get_updated_users(25)
+
+        sql, params = mock_cursor.execute.call_args[0]
+        self.assertIn("WHERE q.processed = FALSE AND MOD(q.client_id, %s) IN (%s, %s)", sql)
+        self.assertEqual(params, (4, 1, 3, 25))
+        mock_condition.assert_called_once_with("q.client_id")
+
+    @patch('user_update_providor.get_update_times', return_value={1: datetime(2025, 5, 1, 9, 30)})
+    @patch('user_update_providor.mark_batch_as_processed', return_value=True)
+    @patch('user_update_providor.send_to_rabbitmq', return_value=True)
+    @patch('user_update_providor.cdc.BinlogTailer')
+    def test_run_cdc_skips_irrelevant_updates(self, mock_tailer, mock_send, mock_mark, mock_uuids):
+        row = {'id': 1, 'first_name': 'John', 'email': 'john@example.com', 'timestamp': '2025-04-29T14:22:27.000000Z'}
+        changed = dict(row, email='new@example.com')
+        batch = cdc.ChangeBatch([
+            cdc.Change("update", dict(row), dict(row)),
+            cdc.Change("update", changed, dict(row)),
+        ], "binlog.000001", 100)
+        mock_tailer.return_value.pin_start.return_value = False
+        mock_tailer.return_value.batches.return_value = [batch]
+
+        run_cdc()
+
+        mock_send.assert_called_once()
+        self.assertIn("<EmailAddress>new@example.com</EmailAddress>", mock_send.call_args[0][0])
+        mock_mark.assert_called_once_with([(1, datetime(2025, 5, 1, 9, 30))])
+        mock_tailer.return_value.save_checkpoint.assert_called_once_with(batch)
+        mock_tailer.return_value.close.assert_called_once()
+
+    @patch('user_update_providor.datetime')
+    @patch('user_update_providor.mark_batch_as_processed', return_value=True)
+    @patch('user_update_providor.send_to_rabbitmq', return_value=True)
+    @patch('user_update_providor.cdc.BinlogTailer')
+    @patch('user_update_providor.get_db_connection')
+    def test_run_cdc_sends_the_same_xml_as_polling(self, mock_get_db_connection, mock_tailer, mock_send, mock_mark, mock_datetime):
+        mock_datetime.utcnow.return_value = datetime(2025, 5, 1, 12, 0, 0)
+        uuid_timestamp = datetime(2025, 4, 29, 14, 22, 27, 816332)
+        updated_at = datetime(2025, 5, 1, 9, 30, 0, 250000)
+        mock_cursor = mock_get_db_connection.return_value.cursor.return_value
+        mock_cursor.fetchall.side_effect = [
+            # Polling query
+            [{
+                'id': 1, 'first_name': 'John', 'last_name': 'Doe', 'email': 'john@example.com', 'pass': 'secret',
+                'phone': '123', 'business_name': 'Doe Inc', 'btw_number': 'BE123',
+                'real_address': 'Main St 1, BE', 'updated_at': updated_at, 'timestamp': uuid_timestamp
+            }],
+            # get_update_times in CDC mode
+            [(1, updated_at)],
+        ]
+        row = {
+            'id': 1, 'first_name': 'John', 'last_name': 'Doe', 'email': 'john@example.com', 'pass': 'secret',
+            'phone': '123', 'company': 'Doe Inc', 'company_vat': 'BE123', 'address_1': 'Main St 1',
+            'city': None, 'country': 'BE', 'timestamp': uuid_timestamp
+        }
+        mock_tailer.return_value.pin_start.return_value = False
+        mock_tailer.return_value.batches.return_value = [
+            cdc.ChangeBatch([cdc.Change("update", row, dict(row, email='old@example.com'))], "binlog.000001", 100)
+        ]
+
+        polled = create_xml_message(get_updated_users()[0])
+        run_cdc()
+
+        self.assertEqual(mock_send.call_args[0][0], polled)
+        self.assertIn("<UUID>2025-05-01T09:30:00.250000Z</UUID>", polled)
+
+    @patch('user_update_providor.mark_batch_as_processed', return_value=True)
+    @patch('user_update_providor.send_to_rabbitmq', return_value=True)
+    @patch('user_update_providor.cdc.BinlogTailer')
+    @patch('user_update_providor.get_update_times', return_value={})
+    def test_run_cdc_skips_update_without_queue_entry(self, mock_uuids, mock_tailer, mock_send, mock_mark):
+        row = {'id': 1, 'email': 'new@example.com'}
+        batch = cdc.ChangeBatch([cdc.Change("update", row, dict(row, email='old@example.com'))], "binlog.000001", 100)
+        mock_tailer.return_value.pin_start.return_value = False
+        mock_tailer.return_value.batches.return_value = [batch]
+
+        run_cdc()
+
+        mock_uuids.assert_called_once_with([1])
+        mock_send.assert_not_called()
+        mock_mark.assert_called_once_with([])
+        mock_tailer.return_value.save_checkpoint.assert_called_once_with(batch)
+
+    @patch('user_update_providor.publish_pending_updates')
+    @patch('user_update_providor.cdc.BinlogTailer')
+    def test_run_cdc_drains_the_queue_before_tailing(self, mock_tailer, mock_publish):
+        mock_publish.side_effect = [(BATCH_SIZE, BATCH_SIZE), (3, 3)]
+        mock_tailer.return_value.pin_start.return_value = True
+        mock_tailer.return_value.batches.return_value = []
+
+        run_cdc()
+
+        self.assertEqual(mock_publish.call_count, 2)
+        mock_tailer.return_value.batches.assert_called_once()
+
+    @patch('user_update_providor.mark_batch_as_processed', return_value=True)
+    @patch('user_update_providor.send_to_rabbitmq', return_value=True)
+    @patch('user_update_providor.partitions.is_stale', side_effect=[False, False, True])
+    @patch('user_update_providor.get_updated_users')
+    def test_publish_pending_updates_skips_mark_when_lease_goes_stale(self, mock_get, mock_stale, mock_send, mock_mark):
+        mock_get.return_value = [
+            {'id': 1, 'timestamp': '2025-05-01T09:30:00.000000Z'},
+            {'id': 2, 'timestamp': '2025-05-01T09:31:00.000000Z'},
+        ]
+
+        self.assertEqual(publish_pending_updates(), (2, 0))
+        self.assertEqual(mock_send.call_count, 2)
+        mock_mark.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()
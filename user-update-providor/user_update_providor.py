@@ -1,8 +1,8 @@
 import pika
 import os
-import xml.etree.ElementTree as ET
 from datetime import datetime
 import mysql.connector
+from common import db, rabbitmq, scheduler, cdc, migrations, xmlout, stats, lease
 import time
 import logging
 
@@ -13,21 +13,41 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+BATCH_SIZE = int(os.getenv("USER_BATCH_SIZE", "100"))
+
+QUEUES = ["crm_user_update", "kassa_user_update", "frontend_user_update"]
+
+# One long-lived publisher; the exchange, queues and bindings are declared once when it connects
+publisher = rabbitmq.Publisher(
+    exchange="user",
+    exchange_type="topic",
+    bindings=[(queue, f"user.update.{queue}") for queue in QUEUES]
+)
+
+# With PROVIDER_PARTITIONS set, replicas split the queue by MOD(client_id, N), so all updates
+# of one client stay with one replica and keep their order; see common/lease.py
+partitions = lease.PartitionLease("user-update-providor")
+
 # Database connection
 def get_db_connection():
-    return mysql.connector.connect(
-        host=os.environ["DB_HOST"],
-        user=os.environ["DB_USER"],
-        password=os.environ["DB_PASSWORD"],
-        database=os.environ["DB_NAME"]
-    )
-
-def get_updated_users():
+    return db.get_connection()
+
+def get_updated_users(batch_size=None):
+    started = time.perf_counter()
     conn = get_db_connection()
     cursor = conn.cursor(dictionary=True)
+    limit = "LIMIT %s" if batch_size else ""
+    params = ()
+    partition = ""
+    condition = partitions.condition("q.client_id")
+    if condition is not None:
+        partition = f"AND {condition[0]}"
+        params = condition[1]
+    if batch_size:
+        params += (batch_size,)
     
     try:
-        cursor.execute("""
+        cursor.execute(f"""
             SELECT 
                 c.id,
                 c.first_name, 
@@ -42,16 +62,14 @@ def get_updated_users():
                 c.timestamp
             FROM client c
             JOIN user_updates_queue q ON c.id = q.client_id
-            WHERE q.processed = FALSE
+            WHERE q.processed = FALSE {partition}
             ORDER BY q.updated_at ASC
-        """)
+            {limit}
+        """, params)
         users = cursor.fetchall()
         
         for user in users:
-            updated_at = user['updated_at']
-            if isinstance(updated_at, str):
-                updated_at = datetime.strptime(updated_at, '%Y-%m-%d %H:%M:%S')
-            user['timestamp'] = updated_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+            user['timestamp'] = format_uuid(user['updated_at'])
         
         return users
     except mysql.connector.Error as err:
@@ -60,110 +78,124 @@ def get_updated_users():
     finally:
         cursor.close()
         conn.close()
+        stats.observe("db_seconds", time.perf_counter() - started)
 
-def create_xml_message(user):
-    xml = ET.Element("UserMessage")
-    
+# The UUID an update is sent with is its user_updates_queue.updated_at, in polling and in CDC mode
+def format_uuid(updated_at):
+    if isinstance(updated_at, str):
+        updated_at = datetime.strptime(updated_at, '%Y-%m-%d %H:%M:%S')
+    return updated_at.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+# Queue times for the clients of a CDC batch, {client_id: updated_at}; the row in user_updates_queue
+# is written in the same transaction as the client update, so it is there once the binlog has it
+def get_update_times(client_ids):
+    if not client_ids:
+        return {}
+
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"SELECT client_id, updated_at FROM user_updates_queue WHERE client_id IN ({', '.join(['%s'] * len(client_ids))})",
+            tuple(client_ids)
+        )
+        return dict(cursor.fetchall())
+    finally:
+        cursor.close()
+        conn.close()
+
+# Updates still waiting to be published, for the poll_backlog gauge (runs on the stats thread, at most every STATS_BACKLOG_INTERVAL seconds)
+def count_backlog():
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT COUNT(*) FROM user_updates_queue WHERE processed = FALSE")
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+        conn.close()
+
+# Layout of the UPDATE message; compiled once, see common/xmlout.py
+USER_UPDATE_TEMPLATE = xmlout.Template("UserMessage", [
     # Action info
-    ET.SubElement(xml, "ActionType").text = "UPDATE"
-    ET.SubElement(xml, "UUID").text = user['timestamp']
-    ET.SubElement(xml, "TimeOfAction").text = datetime.utcnow().isoformat() + "Z"
-    ET.SubElement(xml, "EncryptedPassword").text = user.get('pass', '')
-    
+    xmlout.Field("ActionType"),
+    xmlout.Field("UUID"),
+    xmlout.Field("TimeOfAction"),
+    xmlout.Field("EncryptedPassword"),
     # Personal info
-    if user.get('first_name'):
-        ET.SubElement(xml, "FirstName").text = user['first_name']
-    if user.get('last_name'):
-        ET.SubElement(xml, "LastName").text = user['last_name']
-    if user.get('phone'):
-        ET.SubElement(xml, "PhoneNumber").text = user['phone']
-    if user.get('email'):
-        ET.SubElement(xml, "EmailAddress").text = user['email']
-    
+    xmlout.Field("FirstName", optional=True),
+    xmlout.Field("LastName", optional=True),
+    xmlout.Field("PhoneNumber", optional=True),
+    xmlout.Field("EmailAddress", optional=True),
     # Business info
-    if any(user.get(field) for field in ['business_name', 'btw_number', 'real_address']):
-        business = ET.SubElement(xml, "Business")
-        
-        if user.get('business_name'):
-            ET.SubElement(business, "BusinessName").text = user['business_name']
-        
-        business_email = user.get('email', '')
-        if business_email:
-            ET.SubElement(business, "BusinessEmail").text = business_email
-        
-        if user.get('real_address'):
-            ET.SubElement(business, "RealAddress").text = user['real_address']
-            ET.SubElement(business, "FacturationAddress").text = user['real_address']
-        
-        if user.get('btw_number'):
-            ET.SubElement(business, "BTWNumber").text = user['btw_number']
-    
-    return '<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(xml, encoding='unicode')
+    xmlout.Group("Business", [
+        xmlout.Field("BusinessName", optional=True),
+        xmlout.Field("BusinessEmail", optional=True),
+        xmlout.Field("RealAddress", optional=True),
+        xmlout.Field("FacturationAddress", optional=True),
+        xmlout.Field("BTWNumber", optional=True),
+    ]),
+])
+
+def create_xml_message(user):
+    return USER_UPDATE_TEMPLATE.render({
+        "ActionType": "UPDATE",
+        "UUID": user['timestamp'],
+        "TimeOfAction": datetime.utcnow().isoformat() + "Z",
+        "EncryptedPassword": user.get('pass', ''),
+        "FirstName": user.get('first_name'),
+        "LastName": user.get('last_name'),
+        "PhoneNumber": user.get('phone'),
+        "EmailAddress": user.get('email'),
+        "Business": any(user.get(field) for field in ['business_name', 'btw_number', 'real_address']),
+        "BusinessName": user.get('business_name'),
+        "BusinessEmail": user.get('email', ''),
+        "RealAddress": user.get('real_address'),
+        "FacturationAddress": user.get('real_address'),
+        "BTWNumber": user.get('btw_number'),
+    })
 
 def send_to_rabbitmq(xml):
-    queues = ["crm_user_update", "kassa_user_update", "frontend_user_update"]
-    
     try:
-        params = pika.ConnectionParameters(
-            host=os.environ["RABBITMQ_HOST"],
-            port=int(os.environ["RABBITMQ_PORT"]),
-            virtual_host="/",
-            credentials=pika.PlainCredentials(
-                os.environ["RABBITMQ_USER"],
-                os.environ["RABBITMQ_PASSWORD"]
-            ),
-            heartbeat=600,
-            blocked_connection_timeout=300
-        )
-        
-        connection = pika.BlockingConnection(params)
-        channel = connection.channel()
-
-        channel.exchange_declare(
-            exchange="user",
-            exchange_type="topic",
-            durable=True
-        )
-
-        for queue in queues:
-            channel.queue_declare(queue=queue, durable=True)
-            channel.queue_bind(
-                exchange="user",
-                queue=queue,
-                routing_key=f"user.update.{queue}"
-            )
-            channel.basic_publish(
-                exchange="user",
-                routing_key=f"user.update.{queue}",
-                body=xml,
-                properties=pika.BasicProperties(
-                    delivery_mode=2  # Make messages persistent
-                )
-            )
+        for queue in QUEUES:
+            publisher.publish(f"user.update.{queue}", xml)
             logger.info(f"Sent XML message to {queue}")
-
-        connection.close()
+        stats.incr("messages")
         return True
     except Exception as e:
         logger.error(f"RabbitMQ Error: {e}")
+        stats.incr("errors")
         return False
 
-def mark_as_processed(client_id):
+# Mark all published updates of one poll cycle in a single UPDATE transaction.
+# `updates` are (client_id, updated_at) pairs as read: a client updated again after that read has a
+# newer updated_at, so its queue row stays unprocessed and the newer update is still sent.
+# Updates that failed to publish are not in `updates` and stay queued for the next poll.
+def mark_batch_as_processed(updates):
+    if not updates:
+        return True
+
+    started = time.perf_counter()
     conn = get_db_connection()
     cursor = conn.cursor()
     
     try:
-        cursor.execute("""
+        conditions = " OR ".join(["(client_id = %s AND updated_at <= %s)"] * len(updates))
+        cursor.execute(f"""
             UPDATE user_updates_queue
             SET processed = TRUE
-            WHERE client_id = %s
-        """, (client_id,))
+            WHERE {conditions}
+        """, tuple(value for update in updates for value in update))
         conn.commit()
+        return True
     except mysql.connector.Error as err:
-        logger.error(f"Failed to mark update {client_id} as processed: {err}")
+        logger.error(f"Failed to mark updates {[client_id for client_id, _ in updates]} as processed: {err}")
+        conn.rollback()
+        return False
     finally:
         cursor.close()
         conn.close()
+        stats.observe("db_seconds", time.perf_counter() - started)
 
 def initialize_database():
     conn = get_db_connection()
@@ -187,23 +219,108 @@ def initialize_database():
         cursor.close()
         conn.close()
 
+    # Create/verify the indexes the lookups rely on
+    try:
+        migrations.migrate()
+        migrations.missing_indexes()
+    except Exception as e:
+        logger.error(f"Schema migration failed: {e}")
+
+# One polling pass: publishes up to BATCH_SIZE queued updates.
+# Returns (fetched, published); updates that failed to publish stay queued for the next pass.
+def publish_pending_updates():
+    updated_users = get_updated_users(BATCH_SIZE)
+
+    published = []
+    for user in updated_users:
+        # The batch was selected under the partition lease; once that is no longer fresh another
+        # replica may already own these updates, so leave the rest of the batch to it
+        if partitions.is_stale():
+            logger.warning(f"Partition lease went stale, dropping {len(updated_users) - len(published)} updates of this batch")
+            return len(updated_users), 0
+        xml = create_xml_message(user)
+        if send_to_rabbitmq(xml):
+            published.append(user)
+        else:
+            logger.error(f"Failed to process user update {user['id']}")
+
+    if partitions.is_stale():
+        logger.warning("Partition lease went stale, not marking this batch as processed")
+        return len(updated_users), 0
+    if not mark_batch_as_processed([(user['id'], user['updated_at']) for user in published]):
+        return len(updated_users), 0
+    for user in published:
+        logger.info(f"Processed user update {user['id']} with timestamp ID {user['timestamp']}")
+    return len(updated_users), len(published)
+
+# Change-data-capture mode: publish client updates straight from the binlog instead of polling
+# user_updates_queue. Every row version is seen, so intermediate updates are no longer collapsed.
+def run_cdc():
+    tailer = cdc.BinlogTailer("user_update_providor", actions=("update",))
+    try:
+        if tailer.pin_start():
+            # First start in CDC mode: updates queued before the pinned position are not in the
+            # binlog we read, so the polling query publishes them once
+            while True:
+                fetched, published = publish_pending_updates()
+                if published < fetched:
+                    raise RuntimeError(f"Backfill before CDC published {published} of {fetched} updates")
+                if fetched < BATCH_SIZE:
+                    break
+        for batch in tailer.batches():
+            users = []
+            for change in batch.changes:
+                user = cdc.client_row_to_user(change.row)
+                # Skip updates that do not touch any field we send (e.g. FossBilling bookkeeping columns)
+                if user != cdc.client_row_to_user(change.before):
+                    users.append(user)
+            queued = get_update_times(list(dict.fromkeys(user['id'] for user in users)))
+            published = []
+            for user in users:
+                if user['id'] not in queued:
+                    # Polling would never send it either
+                    logger.warning(f"No user_updates_queue entry for client {user['id']}, skipping update")
+                    continue
+                user['updated_at'] = queued[user['id']]
+                user['timestamp'] = format_uuid(user['updated_at'])
+                if not send_to_rabbitmq(create_xml_message(user)):
+                    # Leave the checkpoint where it is; the event is replayed after the restart
+                    raise RuntimeError(f"Failed to process user update {user['id']}")
+                published.append(user)
+
+            # Keep user_updates_queue in sync so switching back to polling does not resend these updates
+            if not mark_batch_as_processed([(user['id'], user['updated_at']) for user in published]):
+                raise RuntimeError("Failed to record CDC batch in user_updates_queue")
+            tailer.save_checkpoint(batch)
+            for user in published:
+                logger.info(f"Processed user update {user['id']} with timestamp ID {user['timestamp']}")
+    finally:
+        tailer.close()
+
 if __name__ == "__main__":
     initialize_database()
     logger.info("Starting user update provider")
+    probes = {"db_latency_ms": db.ping_latency_ms}
+    # In CDC mode nothing polls the outbox, so there is no poll backlog worth a full COUNT
+    if not cdc.is_enabled():
+        probes["poll_backlog"] = stats.every(stats.BACKLOG_INTERVAL, count_backlog)
+    stats.start("user-update-providor", probes=probes)
+
+    while cdc.is_enabled():
+        try:
+            run_cdc()
+        except Exception as e:
+            logger.error(f"CDC error: {e}")
+            time.sleep(60)
+    poller = scheduler.PollScheduler()
     
     while True:
         try:
-            updated_users = get_updated_users()
-            
-            for user in updated_users:
-                xml = create_xml_message(user)
-                if send_to_rabbitmq(xml):
-                    mark_as_processed(user['id'])
-                    logger.info(f"Processed user update {user['id']} with timestamp ID {user['timestamp']}")
-                else:
-                    logger.error(f"Failed to process user update {user['id']}")
+            fetched, _ = publish_pending_updates()
             
-            time.sleep(5)
+            publisher.process_data_events()
+            # A full batch means more updates are waiting, so poll again straight away
+            poller.wait(fetched, full=fetched >= BATCH_SIZE)
         except Exception as e:
             logger.error(f"Processing error: {e}")
             time.sleep(60)
\ No newline at end of file